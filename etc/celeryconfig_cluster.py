@@ -35,9 +35,11 @@ else:
 
 
 CELERYBEAT_SCHEDULE = {
+    # The provisioning server has lease changes uploaded as they happen.
+    # This is only a safety net, in case any changes slip through.
     'unconditional-dhcp-lease-upload': {
         'task': 'provisioningserver.tasks.upload_dhcp_leases',
-        'schedule': timedelta(minutes=1),
+        'schedule': timedelta(minutes=30),
         'options': {'queue': CLUSTER_UUID},
     },
     'report-boot-images': {
@@ -45,4 +47,9 @@ CELERYBEAT_SCHEDULE = {
         'schedule': timedelta(minutes=5),
         'options': {'queue': CLUSTER_UUID},
     },
+    'poll-power-states': {
+        'task': 'provisioningserver.tasks.poll_power_states',
+        'schedule': timedelta(minutes=5),
+        'options': {'queue': CLUSTER_UUID},
+    },
 }
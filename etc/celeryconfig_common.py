@@ -20,6 +20,34 @@ POWER_TEMPLATES_DIR = None
 # None to use the files installed with the running version of MAAS.
 POWER_CONFIG_DIR = None
 
+# Maximum number of power actions that a cluster controller runs at the
+# same time against BMCs in the same subnet.
+POWER_ACTIONS_PER_SUBNET = 10
+
+# Maximum number of power actions that a cluster controller runs at the
+# same time, across all subnets.
+POWER_ACTIONS_TOTAL = 100
+
+# Prefix length of the subnets that BMCs are grouped into, for the limit
+# on concurrent power actions.
+POWER_SUBNET_PREFIX_LENGTH = 24
+
+# Seconds to allow each attempt at a power action before killing it.
+POWER_ACTION_TIMEOUT = 60
+
+# Number of attempts at each power action before giving up on it.
+POWER_ACTION_ATTEMPTS = 2
+
+# Where Wake-on-LAN magic packets are sent: a broadcast address, and a
+# UDP port.
+WAKE_ON_LAN_ADDRESS = '255.255.255.255'
+WAKE_ON_LAN_PORT = 9
+
+# Number of times each Wake-on-LAN packet is sent, and seconds between
+# those times.
+WAKE_ON_LAN_REPEAT = 3
+WAKE_ON_LAN_SPACING = 0.1
+
 # Location of MAAS' bind configuration files.
 DNS_CONFIG_DIR = '/etc/bind/maas'
 
@@ -27,6 +55,9 @@ DNS_CONFIG_DIR = '/etc/bind/maas'
 # server.
 DNS_RNDC_PORT = 954
 
+# Port on which the BIND server accepts queries and dynamic updates.
+DNS_SERVER_PORT = 53
+
 # Include the default RNDC controls (default RNDC key on port 953).
 DNS_DEFAULT_CONTROLS = True
 
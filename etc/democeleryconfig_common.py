@@ -25,6 +25,9 @@ DNS_CONFIG_DIR = os.path.join(
 DNS_RNDC_PORT = 9154
 
 
+DNS_SERVER_PORT = 5246
+
+
 # Do not include the default RNDC controls statement to avoid
 # a conflict while trying to listen on port 943.
 DNS_DEFAULT_CONTROLS = False
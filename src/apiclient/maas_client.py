@@ -16,9 +16,8 @@ __all__ = [
     'MAASOAuth',
     ]
 
-import gzip
-from io import BytesIO
 import urllib2
+import zlib
 
 from apiclient.encode_json import encode_json_data
 from apiclient.multipart import encode_multipart_data
@@ -63,6 +62,75 @@ class NoAuth:
         """
 
 
+class GzipReader:
+    """A file-like object that decompresses a gzip stream as it is read.
+
+    Unlike `gzip.GzipFile`, this does not need to seek in the underlying
+    file, so the response to a request does not have to be read in all at
+    once before it can be decompressed.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        # The extra 16 tells zlib to expect a gzip header and trailer.
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = b''
+        self.finished = False
+
+    def _read_chunk(self):
+        """Decompress another chunk of the underlying file into the buffer.
+
+        :return: False if the end of the file was reached before.
+        """
+        if self.finished:
+            return False
+        data = self.fileobj.read(self.chunk_size)
+        if len(data) == 0:
+            self.buffer += self.decompressor.flush()
+            self.finished = True
+        else:
+            self.buffer += self.decompressor.decompress(data)
+        return True
+
+    def _take(self, size):
+        """Remove and return the first `size` bytes of the buffer."""
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self._take(len(self.buffer))]
+            while self._read_chunk():
+                chunks.append(self._take(len(self.buffer)))
+            return b''.join(chunks)
+        while len(self.buffer) < size and self._read_chunk():
+            pass
+        return self._take(size)
+
+    def readline(self, size=-1):
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', start)
+            if end >= 0:
+                end += 1
+                break
+            start = len(self.buffer)
+            if 0 <= size <= start or not self._read_chunk():
+                end = len(self.buffer)
+                break
+        if 0 <= size < end:
+            end = size
+        return self._take(end)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def close(self):
+        self.fileobj.close()
+
+
 class MAASDispatcher:
     """Helper class to connect to a MAAS server using blocking requests.
 
@@ -103,11 +171,10 @@ class MAASDispatcher:
             set_accept_encoding
             and res.info().get('Content-Encoding') == 'gzip')
         if is_gzip:
-            # Workaround python's gzip failure, gzip.GzipFile wants to be able
-            # to seek the file object.
-            res_content_io = BytesIO(res.read())
-            ungz = gzip.GzipFile(mode='rb', fileobj=res_content_io)
-            res = urllib2.addinfourl(ungz, res.headers, res.url, res.code)
+            # Decompress the response as it is read, so that big responses
+            # can be processed piece by piece.
+            res = urllib2.addinfourl(
+                GzipReader(res), res.headers, res.url, res.code)
         return res
 
 
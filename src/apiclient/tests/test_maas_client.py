@@ -24,6 +24,7 @@ from urlparse import (
     )
 
 from apiclient.maas_client import (
+    GzipReader,
     MAASClient,
     MAASDispatcher,
     MAASOAuth,
@@ -52,6 +53,48 @@ class TestMAASOAuth(TestCase):
         self.assertIn('Authorization', headers)
 
 
+def gzip_compress(content):
+    """Compress `content` in gzip format."""
+    compressed = BytesIO()
+    with gzip.GzipFile(mode='wb', fileobj=compressed) as gzip_file:
+        gzip_file.write(content)
+    return compressed.getvalue()
+
+
+class TestGzipReader(TestCase):
+
+    def make_reader(self, content, chunk_size=7):
+        reader = GzipReader(BytesIO(gzip_compress(content)))
+        reader.chunk_size = chunk_size
+        return reader
+
+    def test_read_decompresses_everything(self):
+        content = factory.getRandomString(300).encode('ascii')
+        self.assertEqual(content, self.make_reader(content).read())
+
+    def test_read_decompresses_incrementally(self):
+        content = factory.getRandomString(300).encode('ascii')
+        reader = self.make_reader(content)
+        self.assertEqual(content[:10], reader.read(10))
+        self.assertLess(reader.fileobj.tell(), 300)
+        self.assertEqual(content[10:], reader.read())
+        self.assertEqual(b'', reader.read(10))
+
+    def test_readline_splits_lines(self):
+        lines = [
+            factory.getRandomString(size).encode('ascii') + b'\n'
+            for size in (1, 30, 5)]
+        reader = self.make_reader(b''.join(lines) + b'last')
+        self.assertEqual(lines + [b'last'], list(reader))
+
+    def test_readline_limits_size(self):
+        reader = self.make_reader(b'abcdef\ngh')
+        self.assertEqual(
+            [b'abc', b'def\n', b'gh', b''],
+            [reader.readline(3), reader.readline(),
+             reader.readline(5), reader.readline()])
+
+
 class TestMAASDispatcher(TestCase):
 
     def test_dispatch_query_makes_direct_call(self):
@@ -241,13 +241,18 @@ MIDDLEWARE_CLASSES = (
     'maasserver.middleware.APIErrorsMiddleware',
     'maasserver.middleware.ExternalComponentsMiddleware',
     'metadataserver.middleware.MetadataErrorsMiddleware',
+    # DNSChangesMiddleware and PXEConfigInvalidationMiddleware act after
+    # the transaction is committed, so they must come before
+    # TransactionMiddleware.
+    'maasserver.middleware.DNSChangesMiddleware',
+    'maasserver.middleware.PXEConfigInvalidationMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'maasserver.middleware.ExceptionLoggerMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'maasserver.middleware.AccessMiddleware',
-    'django.middleware.gzip.GZipMiddleware',
+    'maasserver.middleware.GZipMiddleware',
 )
 
 ROOT_URLCONF = 'maas.urls'
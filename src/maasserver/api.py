@@ -114,6 +114,7 @@ from maasserver.api_support import (
     AnonymousOperationsHandler,
     operation,
     OperationsHandler,
+    StreamingResponse,
     )
 from maasserver.api_utils import (
     extract_oauth_key,
@@ -167,6 +168,7 @@ from maasserver.models import (
     NodeGroup,
     NodeGroupInterface,
     Tag,
+    TagRebuild,
     )
 from maasserver.models.node import CONSTRAINTS_MAAS_MAP
 from maasserver.preseed import (
@@ -188,7 +190,10 @@ from metadataserver.models import (
     NodeCommissionResult,
     )
 from piston.utils import rc
-from provisioningserver.enum import POWER_TYPE
+from provisioningserver.enum import (
+    POWER_STATE,
+    POWER_TYPE,
+    )
 from provisioningserver.kernel_opts import KernelParameters
 import simplejson as json
 
@@ -201,6 +206,7 @@ DISPLAYED_NODE_FIELDS = (
     'status',
     'netboot',
     'power_type',
+    'power_state',
     'tag_names',
     )
 
@@ -696,6 +702,27 @@ class NodesHandler(OperationsHandler):
         node.acquire(request.user, get_oauth_token(request))
         return node
 
+    @operation(idempotent=False)
+    def acquire_many(self, request):
+        """Acquire several available nodes for deployment, in one go.
+
+        The nodes are reserved atomically: concurrent requests never get
+        the same nodes.  The same constraints as for `acquire` apply.
+
+        :param count: The maximum number of nodes to acquire.  Fewer are
+            acquired if not enough matching nodes are available.
+        """
+        count = get_mandatory_param(
+            request.data, 'count', validators.Int(min=1))
+        nodes = Node.objects.get_available_nodes_for_acquisition(
+            request.user, count, constraints=extract_constraints(request.data))
+        if len(nodes) == 0:
+            raise NodesNotAvailable("No matching node is available.")
+        token = get_oauth_token(request)
+        for node in nodes:
+            node.acquire(request.user, token)
+        return nodes
+
     @classmethod
     def resource_uri(cls, *args, **kwargs):
         return ('nodes_handler', [])
@@ -1042,6 +1069,27 @@ def check_nodegroup_access(request, nodegroup):
             "Only allowed for the %r worker." % nodegroup.name)
 
 
+# How many nodes' hardware details stream_hardware_details() loads from the
+# database at a time.
+HARDWARE_DETAILS_STREAM_BATCH_SIZE = 10
+
+
+def stream_hardware_details(nodegroup, system_ids):
+    """Generate the hardware details of `nodegroup`'s nodes in `system_ids`.
+
+    The details are loaded a few nodes at a time, and generated as lines
+    of JSON, each holding a node's system_id and its hardware details.
+    Nodes that are not in `nodegroup` are ignored.
+    """
+    batch_size = HARDWARE_DETAILS_STREAM_BATCH_SIZE
+    for start in range(0, len(system_ids), batch_size):
+        value_list = Node.objects.filter(
+            system_id__in=system_ids[start:start + batch_size],
+            nodegroup=nodegroup).values_list('system_id', 'hardware_details')
+        for record in value_list:
+            yield json.dumps(record) + '\n'
+
+
 class NodeGroupHandler(OperationsHandler):
     """Manage a NodeGroup.
 
@@ -1076,16 +1124,42 @@ class NodeGroupHandler(OperationsHandler):
 
         The cluster controller calls this periodically to tell the region
         controller about the IP addresses it manages.
+
+        It can either submit all of its current leases, or only the changes
+        since a version of the leases that the region controller returned
+        earlier.
+
+        :param leases: JSON dict of all current leases, mapping IP addresses
+            to MAC addresses.
+        :param generation: The version of the leases that `added` and
+            `removed` are relative to.  Pass this instead of `leases`.
+        :param added: JSON dict of leases that are new or changed since
+            `generation`, mapping IP addresses to MAC addresses.
+        :param removed: JSON list of IP addresses that are no longer
+            leased since `generation`.
+
+        Returns a JSON dict with the new version of the leases as
+        `generation`.  Returns 409 (Conflict) if `generation` is not the
+        current version; the cluster controller should then submit all of
+        its leases.
         """
-        leases = get_mandatory_param(request.data, 'leases')
         nodegroup = get_object_or_404(NodeGroup, uuid=uuid)
         check_nodegroup_access(request, nodegroup)
-        leases = json.loads(leases)
-        new_leases = DHCPLease.objects.update_leases(nodegroup, leases)
+        generation = request.data.get('generation')
+        if generation is None:
+            leases = json.loads(get_mandatory_param(request.data, 'leases'))
+            new_leases = DHCPLease.objects.update_leases(nodegroup, leases)
+        else:
+            generation = get_mandatory_param(
+                request.data, 'generation', validators.Int(min=0))
+            leases = json.loads(get_mandatory_param(request.data, 'added'))
+            removed = json.loads(get_mandatory_param(request.data, 'removed'))
+            new_leases = DHCPLease.objects.update_leases_incrementally(
+                nodegroup, generation, leases, removed)
         if len(new_leases) > 0:
             nodegroup.add_dhcp_host_maps(
                 {ip: leases[ip] for ip in new_leases if ip in leases})
-        return HttpResponse("Leases updated.", status=httplib.OK)
+        return {'generation': nodegroup.leases_generation}
 
     @operation(idempotent=False)
     def import_boot_images(self, request, uuid):
@@ -1100,11 +1174,18 @@ class NodeGroupHandler(OperationsHandler):
 
     @operation(idempotent=True)
     def list_nodes(self, request, uuid):
-        """Get the list of node ids that are part of this group."""
+        """Get the list of node ids that are part of this group.
+
+        :param tag: Optional name of a tag.  If given, only the nodes that
+            have this tag are listed.
+        """
         nodegroup = get_object_or_404(NodeGroup, uuid=uuid)
         if not request.user.is_superuser:
             check_nodegroup_access(request, nodegroup)
         nodes = Node.objects.filter(nodegroup=nodegroup).only('system_id')
+        tag = request.GET.get('tag', None)
+        if tag is not None:
+            nodes = nodes.filter(tags__name=tag)
         return [node.system_id for node in nodes]
 
     # node_hardware_details is actually idempotent, however:
@@ -1139,6 +1220,77 @@ class NodeGroupHandler(OperationsHandler):
         return HttpResponse(
             json.dumps(list(value_list)), content_type='application/json')
 
+    @operation(idempotent=False)
+    def stream_node_hardware_details(self, request, uuid):
+        """Stream specific hardware_details for each node specified.
+
+        This is like `node_hardware_details`, but the response is sent as
+        it is generated, so that neither end has to hold the details of all
+        the nodes at once.  It holds a line of JSON for each node: a list
+        of its system_id and its hardware details.  It is gzip-compressed
+        if the client accepts that.
+        """
+        system_ids = get_list_from_dict_or_multidict(
+            request.data, 'system_ids', [])
+        nodegroup = get_object_or_404(NodeGroup, uuid=uuid)
+        if not request.user.is_superuser:
+            check_nodegroup_access(request, nodegroup)
+        return StreamingResponse.compressed_if_accepted(
+            request, stream_hardware_details(nodegroup, system_ids),
+            content_type='application/x-ndjson')
+
+    @operation(idempotent=True)
+    def list_power_parameters(self, request, uuid):
+        """Get the power parameters of the nodes whose power can be queried.
+
+        Returns a list of dicts, each with a node's `system_id`,
+        `power_type`, `power_parameters`, and last known `power_state`.
+        Nodes that use Wake-on-LAN are left out, as are nodes that have no
+        power parameters, or no usable power type.
+        """
+        nodegroup = get_object_or_404(NodeGroup, uuid=uuid)
+        if not request.user.is_superuser:
+            check_nodegroup_access(request, nodegroup)
+        default_power_type = Config.objects.get_config('node_power_type')
+        power_parameters = []
+        for node in Node.objects.filter(nodegroup=nodegroup):
+            if not node.power_parameters:
+                # Querying with only the defaults would just fail.
+                continue
+            try:
+                power_type = node.get_effective_power_type(default_power_type)
+            except ValueError:
+                # The node uses the default power type, which is not set.
+                continue
+            if power_type == POWER_TYPE.WAKE_ON_LAN:
+                continue
+            power_parameters.append({
+                'system_id': node.system_id,
+                'power_type': power_type,
+                'power_parameters': node.get_effective_power_parameters(),
+                'power_state': node.power_state,
+            })
+        return power_parameters
+
+    @operation(idempotent=False)
+    def update_power_states(self, request, uuid):
+        """Record the power states of nodes in this cluster.
+
+        :param states: JSON dict mapping the nodes' system_ids to their
+            power states: "on", "off", "error", or "unknown".  Nodes that
+            are not in this cluster are ignored.
+        """
+        nodegroup = get_object_or_404(NodeGroup, uuid=uuid)
+        check_nodegroup_access(request, nodegroup)
+        states = json.loads(get_mandatory_param(request.data, 'states'))
+        power_states = map_enum(POWER_STATE).values()
+        for system_id, power_state in states.items():
+            if power_state not in power_states:
+                raise MAASAPIBadRequest(
+                    "Bad power state for %s: %r" % (system_id, power_state))
+        Node.objects.update_power_states(nodegroup, states)
+        return HttpResponse("Power states updated.", status=httplib.OK)
+
 
 DISPLAYED_NODEGROUP_FIELDS = (
     'ip', 'management', 'interface', 'subnet_mask',
@@ -1384,7 +1536,7 @@ class TagHandler(OperationsHandler):
         """
         tag = Tag.objects.get_tag_or_404(name=name, user=request.user,
                                          to_edit=True)
-        tag.populate_nodes()
+        tag.populate_nodes(force=True)
         return {'rebuilding': tag.name}
 
     @operation(idempotent=False)
@@ -1423,11 +1575,64 @@ class TagHandler(OperationsHandler):
         tag.node_set.add(*nodes_to_add)
         nodes_to_remove = self._get_nodes_for(request, 'remove', nodegroup)
         tag.node_set.remove(*nodes_to_remove)
+        if nodegroup is not None and definition is not None:
+            TagRebuild.objects.finish_rebuild(tag, nodegroup, definition)
         return {
             'added': nodes_to_add.count(),
             'removed': nodes_to_remove.count()
             }
 
+    @operation(idempotent=False)
+    def start_rebuild(self, request, name):
+        """Report that a nodegroup's worker is starting to rebuild this tag.
+
+        :param nodegroup: The uuid of the worker's nodegroup.  Only that
+            worker may report on its rebuilds.
+        :param definition: The definition that the worker is going to
+            evaluate.  If it doesn't match the current definition, the
+            rebuild has been superseded and a CONFLICT is returned; the
+            worker should give up on it.
+        """
+        tag = Tag.objects.get_tag_or_404(name=name, user=request.user)
+        nodegroup = get_object_or_404(
+            NodeGroup, uuid=get_mandatory_param(request.data, 'nodegroup'))
+        if not request.user.is_superuser:
+            check_nodegroup_access(request, nodegroup)
+        definition = get_mandatory_param(request.data, 'definition')
+        if not TagRebuild.objects.start_rebuild(tag, nodegroup, definition):
+            return HttpResponse(
+                "Definition supplied '%s' "
+                "doesn't match current definition '%s'"
+                % (definition, tag.definition),
+                status=httplib.CONFLICT)
+        return {'started': tag.name}
+
+    @operation(idempotent=True)
+    def rebuilds(self, request, name):
+        """List the rebuilds of this tag on the cluster controllers.
+
+        Returns the rebuilds, newest first, with their status (see
+        `TAG_REBUILD_STATUS`).  The latency of a rebuild, in seconds, is the
+        time from queueing it until it was done; it is null for rebuilds
+        that are not done.
+        """
+        tag = Tag.objects.get_tag_or_404(name=name, user=request.user)
+        rebuilds = TagRebuild.objects.filter(tag=tag).select_related(
+            'nodegroup').order_by('-id')
+        return [
+            {
+                'nodegroup': rebuild.nodegroup.uuid,
+                'definition': rebuild.definition,
+                'status': rebuild.status,
+                'created': rebuild.created,
+                'started': rebuild.started,
+                'finished': rebuild.finished,
+                'latency': (
+                    None if rebuild.latency is None
+                    else rebuild.latency.total_seconds()),
+            }
+            for rebuild in rebuilds]
+
     @classmethod
     def resource_uri(cls, tag=None):
         # See the comment in NodeHandler.resource_uri
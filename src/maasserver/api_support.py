@@ -14,10 +14,18 @@ __all__ = [
     'AnonymousOperationsHandler',
     'operation',
     'OperationsHandler',
+    'StreamingResponse',
     ]
 
+import zlib
+
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponseBadRequest
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    )
+from django.middleware.gzip import re_accepts_gzip
+from django.utils.cache import patch_vary_headers
 from piston.handler import (
     AnonymousBaseHandler,
     BaseHandler,
@@ -26,6 +34,55 @@ from piston.handler import (
 from piston.resource import Resource
 
 
+class StreamingResponse(HttpResponse):
+    """A response whose content is sent as it is generated.
+
+    Django has no streaming responses before 1.5, so this marks a response
+    for the middleware that would otherwise read all of its content (see
+    `maasserver.middleware.GZipMiddleware`).
+
+    :param content: An iterable of byte strings.
+    """
+
+    streaming = True
+
+    def __init__(self, content, *args, **kwargs):
+        super(StreamingResponse, self).__init__(content, *args, **kwargs)
+        # Piston passes the content of responses with iterable content to
+        # an emitter, which would render the whole of it as one document.
+        # Returning a response that looks like it has no iterable content
+        # makes Piston pass it through as it is.
+        self._base_content_is_iter = False
+
+    @classmethod
+    def compressed_if_accepted(cls, request, content, *args, **kwargs):
+        """Return a response whose content is gzip-compressed if `request`
+        accepts that, as decided by Django's `GZipMiddleware`.
+
+        :param content: An iterable of uncompressed byte strings.
+        """
+        accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        compress = re_accepts_gzip.search(accept_encoding) is not None
+        if compress:
+            content = gzip_stream(content)
+        response = cls(content, *args, **kwargs)
+        if compress:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+
+def gzip_stream(chunks):
+    """Compress the byte strings `chunks` as a gzip stream, on the fly."""
+    # The extra 16 tells zlib to write a gzip header and trailer.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if len(data) > 0:
+            yield data
+    yield compressor.flush()
+
+
 class OperationsResource(Resource):
     """A resource supporting operation dispatch.
 
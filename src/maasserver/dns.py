@@ -12,7 +12,9 @@ from __future__ import (
 __metaclass__ = type
 __all__ = [
     'add_zone',
+    'change_dns_records',
     'change_dns_zones',
+    'dns_change_scheduler',
     'is_dns_enabled',
     'is_dns_managed',
     'next_zone_serial',
@@ -21,12 +23,14 @@ __all__ = [
 
 
 import collections
+from contextlib import contextmanager
 from itertools import (
     chain,
     groupby,
     )
 import logging
 import socket
+import threading
 
 from django.conf import settings
 from maasserver.enum import (
@@ -139,24 +143,6 @@ def sequence(thing):
         return [thing]
 
 
-class lazydict(dict):
-    """A `dict` that lazily populates itself.
-
-    Somewhat like a :class:`collections.defaultdict`, but that the factory
-    function is called with the missing key, and the value returned is saved.
-    """
-
-    __slots__ = ("factory", )
-
-    def __init__(self, factory):
-        super(lazydict, self).__init__()
-        self.factory = factory
-
-    def __missing__(self, key):
-        value = self[key] = self.factory(key)
-        return value
-
-
 class ZoneGenerator:
     """Generate zones describing those relating to the given node groups."""
 
@@ -172,35 +158,48 @@ class ZoneGenerator:
         """Return a set of all forward nodegroups.
 
         This is the set of all managed nodegroups with the same domain as the
-        domain of any of the given nodegroups.
+        domain of any of the given nodegroups.  Their interfaces are fetched
+        along with them, in a single extra query.
         """
         forward_domains = {nodegroup.name for nodegroup in nodegroups}
         forward_nodegroups = NodeGroup.objects.filter(name__in=forward_domains)
+        forward_nodegroups = forward_nodegroups.prefetch_related(
+            'nodegroupinterface_set')
         return {
             nodegroup for nodegroup in forward_nodegroups
             if is_dns_managed(nodegroup)
             }
 
     @staticmethod
-    def _get_reverse_nodegroups(nodegroups):
+    def _get_reverse_nodegroups(nodegroups, forward_nodegroups):
         """Return a set of all reverse nodegroups.
 
-        This is the subset of the given nodegroups that are managed.
+        This is the subset of the given nodegroups that are managed.  Every
+        managed nodegroup is among the forward nodegroups, which is where
+        they are taken from.
         """
+        nodegroup_ids = {nodegroup.id for nodegroup in nodegroups}
         return {
-            nodegroup for nodegroup in nodegroups
-            if is_dns_managed(nodegroup)
+            nodegroup for nodegroup in forward_nodegroups
+            if nodegroup.id in nodegroup_ids
             }
 
     @staticmethod
-    def _get_mappings():
-        """Return a lazily evaluated nodegroup:mapping dict."""
-        return lazydict(DHCPLease.objects.get_hostname_ip_mapping)
+    def _get_mappings(nodegroups):
+        """Return a nodegroup:mapping dict, from a single query."""
+        mappings = DHCPLease.objects.get_hostname_ip_mappings(nodegroups)
+        return {
+            nodegroup: mappings.get(nodegroup.id, {})
+            for nodegroup in nodegroups
+            }
 
     @staticmethod
-    def _get_networks():
-        """Return a lazily evaluated nodegroup:network dict."""
-        return lazydict(lambda ng: ng.get_managed_interface().network)
+    def _get_networks(nodegroups):
+        """Return a nodegroup:network dict."""
+        return {
+            nodegroup: nodegroup.get_managed_interface().network
+            for nodegroup in nodegroups
+            }
 
     @staticmethod
     def _gen_forward_zones(nodegroups, serial, mappings, networks):
@@ -237,9 +236,10 @@ class ZoneGenerator:
 
     def __iter__(self):
         forward_nodegroups = self._get_forward_nodegroups(self.nodegroups)
-        reverse_nodegroups = self._get_reverse_nodegroups(self.nodegroups)
-        mappings = self._get_mappings()
-        networks = self._get_networks()
+        reverse_nodegroups = self._get_reverse_nodegroups(
+            self.nodegroups, forward_nodegroups)
+        mappings = self._get_mappings(forward_nodegroups)
+        networks = self._get_networks(forward_nodegroups)
         serial = self.serial or next_zone_serial()
         return chain(
             self._gen_forward_zones(
@@ -253,36 +253,37 @@ class ZoneGenerator:
         return list(self)
 
 
-def change_dns_zones(nodegroups):
-    """Update the zone configuration for the given list of Nodegroups.
-
-    :param nodegroups: The list of nodegroups (or the nodegroup) for which the
-        zone should be updated.
-    :type nodegroups: list (or :class:`NodeGroup`)
-    """
+def _change_dns_zones(nodegroups):
+    """Update the zone configuration for the given list of Nodegroups."""
     if not (is_dns_enabled() and is_dns_in_use()):
         return
     serial = next_zone_serial()
     for zone in ZoneGenerator(nodegroups, serial):
-        zone_reload_subtask = tasks.rndc_command.subtask(
-            args=[['reload', zone.zone_name]])
-        tasks.write_dns_zone_config.delay(
-            zones=[zone], callback=zone_reload_subtask)
+        # The zones accept dynamic updates, so the task freezes each
+        # zone while rewriting it; thawing it then reloads it.
+        tasks.write_dns_zone_config.delay(zones=[zone])
 
 
-def add_zone(nodegroup):
-    """Add to the DNS server a new zone for the given `nodegroup`.
+def _change_dns_records(nodegroup, ips, removed_hostnames=()):
+    """Update the DNS records for newly leased and released addresses."""
+    if not (is_dns_enabled() and is_dns_managed(nodegroup)):
+        return
+    mapping = DHCPLease.objects.get_hostname_ip_mapping(nodegroup, ips)
+    # A host that got another address keeps its records.
+    removed_hostnames = set(removed_hostnames).difference(mapping)
+    if len(mapping) == 0 and len(removed_hostnames) == 0:
+        return
+    zone = DNSForwardZoneConfig(
+        nodegroup.name, serial=next_zone_serial(), mapping=mapping,
+        removed_hostnames=removed_hostnames)
+    tasks.update_dns_zone_records.delay(zones=[zone])
 
-    To do this we have to write a new configuration file for the zone
-    and update the master config to include this new configuration.
-    These are done in turn by chaining Celery subtasks.
 
-    :param nodegroup: The nodegroup for which the zone should be added.
-    :type nodegroup: :class:`NodeGroup`
-    """
+def _add_zones(nodegroups):
+    """Add to the DNS server new zones for the given `nodegroups`."""
     if not (is_dns_enabled() and is_dns_in_use()):
         return
-    zones_to_write = ZoneGenerator(nodegroup).as_list()
+    zones_to_write = ZoneGenerator(nodegroups).as_list()
     if len(zones_to_write) == 0:
         return None
     serial = next_zone_serial()
@@ -295,6 +296,214 @@ def add_zone(nodegroup):
         zones=zones_to_write, callback=write_dns_config_subtask)
 
 
+def _write_full_dns_config(reload_retry=False, force=False):
+    """Write the DNS configuration."""
+    write_conf = (
+        is_dns_enabled() and (force or is_dns_in_use()))
+    if not write_conf:
+        return
+    zones = ZoneGenerator(NodeGroup.objects.all()).as_list()
+    tasks.write_full_dns_config.delay(
+        zones=zones,
+        callback=tasks.rndc_command.subtask(
+            args=[['reload'], reload_retry]))
+
+
+class DNSChanges:
+    """The DNS changes requested in a batch, merged."""
+
+    def __init__(self):
+        self.full_config = False
+        self.reload_retry = False
+        self.force = False
+        self.added_nodegroups = set()
+        self.changed_nodegroups = set()
+        # Newly leased IP addresses, by nodegroup.
+        self.leased_ips = collections.defaultdict(set)
+        # Hosts whose leases were released, by nodegroup.
+        self.removed_hostnames = collections.defaultdict(set)
+
+
+class DNSChangeScheduler:
+    """Coalesce the DNS changes that the region asks for.
+
+    Changes are made straight away, unless a batch is in progress in the
+    current thread (see :meth:`batch`).  The changes requested during a
+    batch are merged, and made when the batch ends: a full write of the
+    DNS configuration supersedes all other changes, each affected zone is
+    written just once, and the changed zones share a single serial.
+
+    `requested` and `executed` count the changes asked for and those
+    actually made, by the name of the function that asks for them.
+    """
+
+    def __init__(self):
+        self.requested = collections.Counter()
+        self.executed = collections.Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _count(self, counter, name):
+        with self._lock:
+            counter[name] += 1
+
+    @property
+    def _changes(self):
+        """The changes requested in the current batch, if any."""
+        return getattr(self._local, 'changes', None)
+
+    def begin(self):
+        """Start a batch of changes, or nest one in the current batch."""
+        if self._changes is None:
+            self._local.changes = DNSChanges()
+            self._local.depth = 0
+        self._local.depth += 1
+
+    def end(self):
+        """End a batch; make its changes if it is the outermost one."""
+        if self._changes is None:
+            return
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            changes, self._local.changes = self._local.changes, None
+            self.execute(changes)
+
+    def discard(self):
+        """Drop the current batch (even if nested) without making changes.
+
+        This is for when the transaction that the changes were part of
+        has been rolled back.
+        """
+        self._local.changes = None
+
+    @contextmanager
+    def batch(self):
+        """Context manager: collect the changes, and make them at the end.
+
+        If the block fails, the changes are dropped.
+        """
+        self.begin()
+        try:
+            yield
+        except:
+            self.discard()
+            raise
+        else:
+            self.end()
+
+    def change_zones(self, nodegroups):
+        self._count(self.requested, 'change_dns_zones')
+        if self._changes is None:
+            self._count(self.executed, 'change_dns_zones')
+            _change_dns_zones(nodegroups)
+        else:
+            self._changes.changed_nodegroups.update(sequence(nodegroups))
+
+    def change_records(self, nodegroup, ips, removed_hostnames=()):
+        self._count(self.requested, 'change_dns_records')
+        if self._changes is None:
+            self._count(self.executed, 'change_dns_records')
+            _change_dns_records(nodegroup, ips, removed_hostnames)
+        else:
+            self._changes.leased_ips[nodegroup].update(ips)
+            self._changes.removed_hostnames[nodegroup].update(
+                removed_hostnames)
+
+    def add_zone(self, nodegroup):
+        self._count(self.requested, 'add_zone')
+        if self._changes is None:
+            self._count(self.executed, 'add_zone')
+            _add_zones([nodegroup])
+        else:
+            self._changes.added_nodegroups.add(nodegroup)
+
+    def write_full_config(self, reload_retry=False, force=False):
+        self._count(self.requested, 'write_full_dns_config')
+        if self._changes is None:
+            self._count(self.executed, 'write_full_dns_config')
+            _write_full_dns_config(reload_retry=reload_retry, force=force)
+        else:
+            self._changes.full_config = True
+            self._changes.reload_retry |= reload_retry
+            self._changes.force |= force
+
+    def execute(self, changes):
+        """Make the merged `changes`."""
+        if changes.full_config:
+            self._count(self.executed, 'write_full_dns_config')
+            _write_full_dns_config(
+                reload_retry=changes.reload_retry, force=changes.force)
+            return
+        if len(changes.added_nodegroups) != 0:
+            self._count(self.executed, 'add_zone')
+            _add_zones(changes.added_nodegroups)
+        changed_nodegroups = (
+            changes.changed_nodegroups - changes.added_nodegroups)
+        if len(changed_nodegroups) != 0:
+            self._count(self.executed, 'change_dns_zones')
+            _change_dns_zones(changed_nodegroups)
+        # Rewritten zones have the new records already.
+        rewritten_domains = {
+            nodegroup.name
+            for nodegroup in chain(
+                changes.added_nodegroups, changes.changed_nodegroups)
+            }
+        for nodegroup in set(changes.leased_ips).union(
+                changes.removed_hostnames):
+            if nodegroup.name not in rewritten_domains:
+                self._count(self.executed, 'change_dns_records')
+                _change_dns_records(
+                    nodegroup, changes.leased_ips[nodegroup],
+                    changes.removed_hostnames[nodegroup])
+
+
+dns_change_scheduler = DNSChangeScheduler()
+
+
+def change_dns_zones(nodegroups):
+    """Update the zone configuration for the given list of Nodegroups.
+
+    Like the other DNS changes, this goes through the
+    :class:`DNSChangeScheduler`.
+
+    :param nodegroups: The list of nodegroups (or the nodegroup) for which the
+        zone should be updated.
+    :type nodegroups: list (or :class:`NodeGroup`)
+    """
+    dns_change_scheduler.change_zones(nodegroups)
+
+
+def change_dns_records(nodegroup, ips, removed_hostnames=()):
+    """Update the DNS records for newly leased and released IP addresses.
+
+    Unlike :func:`change_dns_zones`, this does not rewrite any zones: the
+    changed records are sent to the DNS server as a dynamic update.  Only
+    the CNAME records of the nodes that got or lost the addresses change;
+    the A and PTR records cover every address in the network already.
+
+    :param nodegroup: The nodegroup whose leases changed.
+    :type nodegroup: :class:`NodeGroup`
+    :param ips: The newly leased IP addresses.
+    :param removed_hostnames: The hostnames of the nodes whose leases were
+        released.  Their CNAME records are deleted, unless they hold one
+        of `ips` now.
+    """
+    dns_change_scheduler.change_records(nodegroup, ips, removed_hostnames)
+
+
+def add_zone(nodegroup):
+    """Add to the DNS server a new zone for the given `nodegroup`.
+
+    To do this we have to write a new configuration file for the zone
+    and update the master config to include this new configuration.
+    These are done in turn by chaining Celery subtasks.
+
+    :param nodegroup: The nodegroup for which the zone should be added.
+    :type nodegroup: :class:`NodeGroup`
+    """
+    dns_change_scheduler.add_zone(nodegroup)
+
+
 def write_full_dns_config(reload_retry=False, force=False):
     """Write the DNS configuration.
 
@@ -305,12 +514,5 @@ def write_full_dns_config(reload_retry=False, force=False):
         configured to manage DNS.
     :type force: bool
     """
-    write_conf = (
-        is_dns_enabled() and (force or is_dns_in_use()))
-    if not write_conf:
-        return
-    zones = ZoneGenerator(NodeGroup.objects.all()).as_list()
-    tasks.write_full_dns_config.delay(
-        zones=zones,
-        callback=tasks.rndc_command.subtask(
-            args=[['reload'], reload_retry]))
+    dns_change_scheduler.write_full_config(
+        reload_retry=reload_retry, force=force)
@@ -27,6 +27,8 @@ __all__ = [
     'PRESEED_TYPE',
     'DISTRO_SERIES',
     'DISTRO_SERIES_CHOICES',
+    'TAG_REBUILD_STATUS',
+    'TAG_REBUILD_STATUS_CHOICES',
     ]
 
 from collections import OrderedDict
@@ -206,3 +208,29 @@ NODEGROUPINTERFACE_MANAGEMENT_CHOICES = (
 
 NODEGROUPINTERFACE_MANAGEMENT_CHOICES_DICT = (
     OrderedDict(NODEGROUPINTERFACE_MANAGEMENT_CHOICES))
+
+
+class TAG_REBUILD_STATUS:
+    """The vocabulary of a `TagRebuild`'s possible statuses."""
+    # A rebuild starts out as PENDING.
+    DEFAULT_STATUS = 0
+
+    #: The rebuild is queued for the cluster's worker.
+    PENDING = 0
+    #: The cluster's worker is matching its nodes.
+    RUNNING = 1
+    #: The cluster's worker has posted its results.
+    DONE = 2
+    #: The tag's definition changed, or the rebuild was queued again,
+    #: before it was done.
+    SUPERSEDED = 3
+
+
+# Django choices for TAG_REBUILD_STATUS: sequence of tuples (key, UI
+# representation).
+TAG_REBUILD_STATUS_CHOICES = (
+    (TAG_REBUILD_STATUS.PENDING, "Pending"),
+    (TAG_REBUILD_STATUS.RUNNING, "Running"),
+    (TAG_REBUILD_STATUS.DONE, "Done"),
+    (TAG_REBUILD_STATUS.SUPERSEDED, "Superseded"),
+    )
@@ -12,6 +12,7 @@ from __future__ import (
 __metaclass__ = type
 __all__ = [
     "ExternalComponentException",
+    "LeasesOutOfSync",
     "MAASException",
     "MAASAPIBadRequest",
     "MAASAPIException",
@@ -84,6 +85,14 @@ class NodesNotAvailable(NodeStateViolation):
     api_error = httplib.CONFLICT
 
 
+class LeasesOutOfSync(MAASAPIException):
+    """DHCP lease changes were based on a version the region doesn't have.
+
+    The cluster controller should send the full set of leases instead.
+    """
+    api_error = httplib.CONFLICT
+
+
 class InvalidConstraint(MAASAPIBadRequest):
     """Node allocation constraint given cannot be interpreted."""
 
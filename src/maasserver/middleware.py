@@ -13,8 +13,10 @@ __metaclass__ = type
 __all__ = [
     "AccessMiddleware",
     "APIErrorsMiddleware",
+    "DNSChangesMiddleware",
     "ErrorsMiddleware",
     "ExceptionMiddleware",
+    "GZipMiddleware",
     ]
 
 from abc import (
@@ -33,6 +35,7 @@ from django.core.exceptions import (
     ValidationError,
     )
 from django.core.urlresolvers import reverse
+from django.middleware import gzip
 from django.http import (
     HttpResponse,
     HttpResponseBadRequest,
@@ -40,10 +43,12 @@ from django.http import (
     HttpResponseRedirect,
     )
 from django.utils.http import urlquote_plus
+from maasserver.dns import dns_change_scheduler
 from maasserver.exceptions import (
     ExternalComponentException,
     MAASAPIException,
     )
+from maasserver.pxeconfig_connect import pxe_config_invalidator
 
 
 def get_relative_path(path):
@@ -204,6 +209,45 @@ class ErrorsMiddleware:
             return None
 
 
+class DNSChangesMiddleware:
+    """Make the DNS changes that a request asks for once it is done.
+
+    Changes are batched (see `DNSChangeScheduler`), so that a request
+    that affects many nodes updates each DNS zone just once.  This must
+    come before TransactionMiddleware, so that the changes are made once
+    the transaction is committed, and dropped if it is rolled back.
+    """
+
+    def process_request(self, request):
+        dns_change_scheduler.begin()
+
+    def process_response(self, request, response):
+        dns_change_scheduler.end()
+        return response
+
+    def process_exception(self, request, exception):
+        dns_change_scheduler.discard()
+
+
+class PXEConfigInvalidationMiddleware:
+    """Invalidate the PXE configs that a request changes once it is done.
+
+    Invalidations are batched (see `PXEConfigInvalidator`), so that each
+    cluster controller is told just once per request.  Like
+    DNSChangesMiddleware, this must come before TransactionMiddleware.
+    """
+
+    def process_request(self, request):
+        pxe_config_invalidator.begin()
+
+    def process_response(self, request, response):
+        pxe_config_invalidator.end()
+        return response
+
+    def process_exception(self, request, exception):
+        pxe_config_invalidator.discard()
+
+
 class ExceptionLoggerMiddleware:
 
     def process_exception(self, request, exception):
@@ -213,3 +257,18 @@ class ExceptionLoggerMiddleware:
         logger = logging.getLogger('maas.maasserver')
         logger.error(" Exception: %s ".center(79, "#") % unicode(exception))
         logger.error(''.join(traceback.format_exception(*exc_info)))
+
+
+class GZipMiddleware(gzip.GZipMiddleware):
+    """Compress responses, except those that are streamed.
+
+    Django's middleware reads the whole content of a response to compress
+    it.  Streaming responses (see `maasserver.api_support.StreamingResponse`)
+    are left alone; they do their own compression if they want it.
+    """
+
+    def process_response(self, request, response):
+        if getattr(response, 'streaming', False):
+            return response
+        return super(GZipMiddleware, self).process_response(
+            request, response)
@@ -16,6 +16,7 @@ __all__ = [
     'Config',
     'DHCPLease',
     'FileStorage',
+    'HardwareFact',
     'logger',
     'MACAddress',
     'Node',
@@ -23,6 +24,7 @@ __all__ = [
     'NodeGroupInterface',
     'SSHKey',
     'Tag',
+    'TagRebuild',
     'UserProfile',
     ]
 
@@ -43,12 +45,14 @@ from maasserver.models.component_error import ComponentError
 from maasserver.models.config import Config
 from maasserver.models.dhcplease import DHCPLease
 from maasserver.models.filestorage import FileStorage
+from maasserver.models.hardwarefact import HardwareFact
 from maasserver.models.macaddress import MACAddress
 from maasserver.models.node import Node
 from maasserver.models.nodegroup import NodeGroup
 from maasserver.models.nodegroupinterface import NodeGroupInterface
 from maasserver.models.sshkey import SSHKey
 from maasserver.models.tag import Tag
+from maasserver.models.tagrebuild import TagRebuild
 from maasserver.models.user import create_user
 from maasserver.models.userprofile import UserProfile
 from maasserver.utils import ignore_unused
@@ -62,8 +66,8 @@ logger = getLogger('maasserver')
 # Suppress warning about symbols being imported, but only used for
 # export in __all__.
 ignore_unused(
-    ComponentError, Config, DHCPLease, FileStorage, MACAddress, NodeGroup,
-    SSHKey, Tag, UserProfile, NodeGroupInterface)
+    ComponentError, Config, DHCPLease, FileStorage, HardwareFact, MACAddress,
+    NodeGroup, SSHKey, Tag, TagRebuild, UserProfile, NodeGroupInterface)
 
 
 # Connect the 'create_user' method to the post save signal of User.
@@ -173,3 +177,6 @@ ignore_unused(dns_connect)
 
 from maasserver import dhcp_connect
 ignore_unused(dhcp_connect)
+
+from maasserver import pxeconfig_connect
+ignore_unused(pxeconfig_connect)
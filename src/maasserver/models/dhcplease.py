@@ -15,6 +15,9 @@ __all__ = [
     ]
 
 
+from collections import defaultdict
+from io import StringIO
+
 from django.db import connection
 from django.db.models import (
     ForeignKey,
@@ -23,11 +26,19 @@ from django.db.models import (
     Model,
     )
 from maasserver import DefaultMeta
+from maasserver.exceptions import LeasesOutOfSync
 from maasserver.fields import MACAddressField
 from maasserver.models.cleansave import CleanSave
 from maasserver.utils import strip_domain
 
 
+def escape_copy_value(value):
+    """Escape `value` for use in PostgreSQL's COPY text format."""
+    return (
+        value.replace("\\", "\\\\").replace("\t", "\\t")
+        .replace("\n", "\\n").replace("\r", "\\r"))
+
+
 class DHCPLeaseManager(Manager):
     """Utility that manages :class:`DHCPLease` objects.
 
@@ -35,60 +46,107 @@ class DHCPLeaseManager(Manager):
     operations in bulk, using this manager class, where at all possible.
     """
 
-    def _delete_obsolete_leases(self, nodegroup, current_leases):
-        """Delete leases for `nodegroup` that aren't in `current_leases`."""
+    def _stage_leases(self, leases):
+        """Load `leases` into a temporary staging table.
+
+        The staging table is `dhcplease_staging`.  It lasts until the end
+        of the transaction.  Any leases that were staged earlier in the
+        same transaction are replaced.
+        """
         cursor = connection.cursor()
-        clauses = ["nodegroup_id = %s" % nodegroup.id]
-        if len(current_leases) > 0:
-            leases = tuple(current_leases.items())
-        if len(current_leases) == 0:
-            pass
-        elif len(current_leases) == 1:
-            clauses.append(cursor.mogrify("(ip, mac) <> %s", leases))
-        else:
-            clauses.append(cursor.mogrify("(ip, mac) NOT IN %s", [leases]))
-        cursor.execute(
-            "DELETE FROM maasserver_dhcplease WHERE %s"
-            % " AND ".join(clauses)),
+        cursor.execute("""
+            CREATE TEMPORARY TABLE IF NOT EXISTS dhcplease_staging (
+                ip inet NOT NULL,
+                mac macaddr NOT NULL
+            ) ON COMMIT DROP
+            """)
+        cursor.execute("TRUNCATE dhcplease_staging")
+        rows = StringIO("".join(
+            "%s\t%s\n" % (escape_copy_value(ip), escape_copy_value(mac))
+            for ip, mac in leases.items()))
+        cursor.copy_from(rows, 'dhcplease_staging', columns=('ip', 'mac'))
+
+    def _delete_obsolete_leases(self, nodegroup):
+        """Delete leases for `nodegroup` that aren't in the staging table.
 
-    def _get_leased_ips(self, nodegroup):
-        """Query the currently leased IP addresses for `nodegroup`."""
+        This is assumed to be run right after :meth:`_stage_leases`.
+        """
         cursor = connection.cursor()
-        cursor.execute(
-            "SELECT ip FROM maasserver_dhcplease WHERE nodegroup_id = %s"
-            % nodegroup.id)
-        return frozenset(ip for ip, in cursor.fetchall())
+        cursor.execute("""
+            DELETE FROM maasserver_dhcplease AS lease
+            WHERE lease.nodegroup_id = %s
+            AND NOT EXISTS (
+                SELECT 1 FROM dhcplease_staging AS staging
+                WHERE staging.ip = lease.ip AND staging.mac = lease.mac
+            )
+            """, [nodegroup.id])
 
-    def _add_missing_leases(self, nodegroup, leases):
-        """Add items from `leases` that aren't in the database yet.
+    def _add_missing_leases(self, nodegroup):
+        """Add staged leases that aren't in the database yet.
 
-        This is assumed to be run right after _delete_obsolete_leases,
-        so that a lease from `leases` is in the database if and only if
-        `nodegroup` has a DHCPLease with the same `ip` field.  There
-        can't be any DHCPLease entries with the same `ip` as in `leases`
-        but a different `mac`.
+        This is assumed to be run right after _delete_obsolete_leases, or
+        _delete_changed_leases for the staged addresses, so that a staged
+        lease is in the database if and only if `nodegroup` has a
+        DHCPLease with the same `ip` field.  There can't be any DHCPLease
+        entries with the same `ip` as a staged lease but a different
+        `mac`.
 
         :return: Iterable of newly-leased IP addresses.
         """
-        leased_ips = self._get_leased_ips(nodegroup)
-        new_leases = tuple(
-            (nodegroup.id, ip, mac)
-            for ip, mac in leases.items() if ip not in leased_ips)
-        if len(new_leases) > 0:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO maasserver_dhcplease (nodegroup_id, ip, mac)
+            SELECT %s, staging.ip, staging.mac
+            FROM dhcplease_staging AS staging
+            WHERE NOT EXISTS (
+                SELECT 1 FROM maasserver_dhcplease AS lease
+                WHERE lease.nodegroup_id = %s AND lease.ip = staging.ip
+            )
+            RETURNING ip
+            """, [nodegroup.id, nodegroup.id])
+        return [ip for ip, in cursor.fetchall()]
+
+    def _lock_leases_generation(self, nodegroup):
+        """Lock `nodegroup`'s leases version; return its current value.
+
+        This serializes concurrent updates to the node group's leases
+        until the end of the transaction.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT leases_generation FROM maasserver_nodegroup "
+            "WHERE id = %s FOR UPDATE", [nodegroup.id])
+        [generation] = cursor.fetchone()
+        return generation
+
+    def _bump_leases_generation(self, nodegroup):
+        """Increment `nodegroup`'s leases version.
+
+        The new version is also set on `nodegroup` itself.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE maasserver_nodegroup "
+            "SET leases_generation = leases_generation + 1 "
+            "WHERE id = %s RETURNING leases_generation", [nodegroup.id])
+        [nodegroup.leases_generation] = cursor.fetchone()
+
+    def _delete_changed_leases(self, nodegroup, ips):
+        """Delete leases for `nodegroup` on any of the addresses `ips`."""
+        if len(ips) > 0:
             cursor = connection.cursor()
-            new_tuples = ", ".join(
-                cursor.mogrify("%s", [lease]) for lease in new_leases)
-            cursor.execute("""
-                INSERT INTO maasserver_dhcplease (nodegroup_id, ip, mac)
-                VALUES %s
-                """ % new_tuples)
-        return [ip for nodegroup_id, ip, mac in new_leases]
+            cursor.execute(
+                "DELETE FROM maasserver_dhcplease "
+                "WHERE nodegroup_id = %s AND ip IN %s",
+                [nodegroup.id, tuple(ips)])
 
     def update_leases(self, nodegroup, leases):
         """Refresh our knowledge of a node group's IP mappings.
 
         This deletes entries that are no longer current, adds new ones,
-        and updates or replaces ones that have changed.
+        and updates or replaces ones that have changed.  It also starts a
+        new version of the node group's leases (see
+        :meth:`update_leases_incrementally`).
 
         :param nodegroup: The node group that these updates are for.
         :param leases: A dict describing all current IP/MAC mappings as
@@ -101,13 +159,66 @@ class DHCPLeaseManager(Manager):
         # Avoid circular imports.
         from maasserver import dns
 
-        self._delete_obsolete_leases(nodegroup, leases)
-        new_leases = self._add_missing_leases(nodegroup, leases)
+        self._lock_leases_generation(nodegroup)
+        self._stage_leases(leases)
+        self._delete_obsolete_leases(nodegroup)
+        new_leases = self._add_missing_leases(nodegroup)
+        self._bump_leases_generation(nodegroup)
         if len(new_leases) > 0:
             dns.change_dns_zones([nodegroup])
         return new_leases
 
-    def get_hostname_ip_mapping(self, nodegroup):
+    def update_leases_incrementally(self, nodegroup, generation, added,
+                                    removed):
+        """Apply changes to a node group's IP mappings.
+
+        Each update to a node group's leases produces a new version of
+        them, identified by the node group's `leases_generation`.  The
+        cluster controller remembers which version the region controller
+        has acknowledged, and sends just the changes since that version.
+        If those don't apply to the current version, e.g. because another
+        update got in first, the cluster controller must send all of its
+        leases to :meth:`update_leases` instead.
+
+        :param nodegroup: The node group that these updates are for.
+        :param generation: The version of `nodegroup`'s leases that the
+            changes are relative to.
+        :param added: A dict of IP/MAC mappings that are new or that have
+            changed since `generation`.  Keys are IP addresses, values are
+            MAC addresses.
+        :param removed: Iterable of IP addresses that are no longer
+            leased.
+        :raise LeasesOutOfSync: If `generation` is not the current version
+            of `nodegroup`'s leases.
+        :return: Iterable of IP addresses that were newly leased.
+        """
+        # Avoid circular imports.
+        from maasserver import dns
+
+        current_generation = self._lock_leases_generation(nodegroup)
+        if generation != current_generation:
+            raise LeasesOutOfSync(
+                "Lease changes are relative to version %d of the leases for "
+                "%s, but the current version is %d."
+                % (generation, nodegroup.uuid, current_generation))
+        # Whatever the database had for the added addresses is obsolete.
+        changed_ips = set(added.keys()).union(removed)
+        # The nodes that held those addresses lose their DNS records,
+        # unless they are given new ones.
+        released = self.get_hostname_ip_mapping(nodegroup, changed_ips)
+        self._delete_changed_leases(nodegroup, changed_ips)
+        if len(added) > 0:
+            self._stage_leases(added)
+            new_leases = self._add_missing_leases(nodegroup)
+        else:
+            new_leases = []
+        self._bump_leases_generation(nodegroup)
+        if len(new_leases) > 0 or len(released) > 0:
+            dns.change_dns_records(
+                nodegroup, new_leases, removed_hostnames=list(released))
+        return new_leases
+
+    def get_hostname_ip_mapping(self, nodegroup, ips=None):
         """Return a mapping {hostnames -> ips} for the currently leased
         IP addresses for the nodes in `nodegroup`.
 
@@ -115,14 +226,40 @@ class DHCPLeaseManager(Manager):
         MAC Address) associated with each node withing the given
         `nodegroup`.
         If the hostnames contain a domain, it gets removed.
+
+        :param ips: If given, only consider leases for these IP addresses.
         """
+        mappings = self.get_hostname_ip_mappings([nodegroup], ips)
+        return mappings.get(nodegroup.id, {})
+
+    def get_hostname_ip_mappings(self, nodegroups, ips=None):
+        """Return the {hostnames -> ips} mappings for several nodegroups.
+
+        This works like :meth:`get_hostname_ip_mapping`, but for any
+        number of nodegroups, in a single query.
+
+        :param ips: If given, only consider leases for these IP addresses.
+        :return: A dict {nodegroup id -> {hostname -> ip}}.  Nodegroups
+            without any leased nodes are left out.
+        """
+        nodegroup_ids = tuple(nodegroup.id for nodegroup in nodegroups)
+        if len(nodegroup_ids) == 0:
+            return {}
+        params = [nodegroup_ids]
+        if ips is None:
+            ip_clause = ""
+        elif len(ips) == 0:
+            return {}
+        else:
+            ip_clause = "AND lease.ip IN %s"
+            params.append(tuple(ips))
         cursor = connection.cursor()
         # The subquery fetches the IDs of the first MAC Address for
-        # all the nodes in this nodegroup.
+        # all the nodes in these nodegroups.
         # Then the main query returns the hostname -> ip mapping for
         # these MAC Addresses.
         cursor.execute("""
-        SELECT node.hostname, lease.ip
+        SELECT node.nodegroup_id, node.hostname, lease.ip
         FROM maasserver_macaddress as mac,
              maasserver_node as node,
              maasserver_dhcplease as lease
@@ -130,17 +267,17 @@ class DHCPLeaseManager(Manager):
             SELECT DISTINCT ON (node_id) mac.id
             FROM maasserver_macaddress as mac,
                  maasserver_node as node
-            WHERE node.nodegroup_id = %s AND mac.node_id = node.id
+            WHERE node.nodegroup_id IN %s AND mac.node_id = node.id
             ORDER BY node_id, mac.id
         )
         AND mac.node_id = node.id
         AND mac.mac_address = lease.mac
-        AND lease.nodegroup_id = %s
-        """, (nodegroup.id, nodegroup.id))
-        return dict(
-            (strip_domain(hostname), ip)
-            for hostname, ip in cursor.fetchall()
-            )
+        AND lease.nodegroup_id = node.nodegroup_id
+        """ + ip_clause, params)
+        mappings = defaultdict(dict)
+        for nodegroup_id, hostname, ip in cursor.fetchall():
+            mappings[nodegroup_id][strip_domain(hostname)] = ip
+        return dict(mappings)
 
 
 class DHCPLease(CleanSave, Model):
@@ -0,0 +1,226 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Facts about a node's hardware, extracted from its lshw output."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = [
+    'extract_hardware_facts',
+    'get_facts_query',
+    'HardwareFact',
+    ]
+
+import re
+
+from django.db.models import (
+    BigIntegerField,
+    CharField,
+    ForeignKey,
+    Manager,
+    Model,
+    Q,
+    )
+from maasserver import DefaultMeta
+from maasserver.models.cleansave import CleanSave
+
+
+FACT_MAX_LENGTH = 255
+
+
+def limit_length(value):
+    """Return `value`, or None if it is too long to store in a fact.
+
+    Truncated values could match the wrong literals, so values that don't
+    fit are left out.  Only XPath can match those.
+    """
+    if value is None or len(value) > FACT_MAX_LENGTH:
+        return None
+    return value
+
+
+def get_text(element, tag):
+    """Return the text of `element`'s first `tag` child, or None."""
+    child = element.find(tag)
+    if child is None:
+        return None
+    return limit_length(''.join(child.itertext()))
+
+
+def extract_hardware_facts(doc):
+    """Extract facts from `doc`, the parsed output of `lshw -xml`.
+
+    Every `node` element in the output describes a device.  There is a
+    fact for each device, and one for each of its capabilities.  The
+    capabilities' facts repeat the device's details, so that one row can
+    match them all.
+
+    :return: An iterable of dicts, each holding one fact's fields.
+    """
+    for element in doc.iter('node'):
+        size = element.find('size')
+        if size is None:
+            size_value = units = None
+        else:
+            try:
+                size_value = int(size.text)
+            except (TypeError, ValueError):
+                size_value = None
+            units = limit_length(size.get('units'))
+        fact = {
+            'lshw_id': limit_length(element.get('id')),
+            'lshw_class': limit_length(element.get('class')),
+            'vendor': get_text(element, 'vendor'),
+            'product': get_text(element, 'product'),
+            'size': size_value,
+            'units': units,
+            'capability': None,
+            }
+        yield fact
+        for capability in element.iterfind('capabilities/capability'):
+            yield dict(
+                fact, capability=limit_length(capability.get('id')))
+
+
+class HardwareFactManager(Manager):
+    """Manager for `HardwareFact`."""
+
+    def update_facts(self, node, doc):
+        """Replace `node`'s facts with those extracted from `doc`."""
+        self.filter(node=node).delete()
+        self.bulk_create([
+            HardwareFact(node=node, **fact)
+            for fact in extract_hardware_facts(doc)])
+
+
+class HardwareFact(CleanSave, Model):
+    """A fact about a node's hardware, as reported by lshw.
+
+    Queries against facts can use indexes, where XPath expressions have to
+    scan the hardware details of every node.
+
+    :ivar node: The node that has the hardware.
+    :ivar lshw_id: The id of the lshw element for the device, e.g. "cpu:0".
+    :ivar lshw_class: The device's class, e.g. "processor".
+    :ivar vendor: The device's vendor.
+    :ivar product: The device's product name.
+    :ivar size: The device's size, e.g. its memory size.
+    :ivar units: The units of `size`, e.g. "bytes".
+    :ivar capability: The id of one of the device's capabilities, or None
+        for the fact describing the device itself.
+    """
+
+    class Meta(DefaultMeta):
+        """Needed for South to recognize this model."""
+
+    objects = HardwareFactManager()
+
+    node = ForeignKey('maasserver.Node', null=False, editable=False)
+    lshw_id = CharField(
+        max_length=FACT_MAX_LENGTH, null=True, editable=False, db_index=True)
+    lshw_class = CharField(
+        max_length=FACT_MAX_LENGTH, null=True, editable=False, db_index=True)
+    vendor = CharField(
+        max_length=FACT_MAX_LENGTH, null=True, editable=False, db_index=True)
+    product = CharField(
+        max_length=FACT_MAX_LENGTH, null=True, editable=False, db_index=True)
+    size = BigIntegerField(null=True, editable=False)
+    units = CharField(max_length=FACT_MAX_LENGTH, null=True, editable=False)
+    capability = CharField(
+        max_length=FACT_MAX_LENGTH, null=True, editable=False, db_index=True)
+
+    def __unicode__(self):
+        return "%s: %s" % (self.node_id, self.lshw_id)
+
+
+_literal = r'''(?:'([^']*)'|"([^"]*)")'''
+
+# A condition on a device, and the fact field it is about.
+_condition = re.compile(
+    r'\s*(@id|@class|vendor|product)\s*=\s*%s\s*$' % _literal)
+
+_condition_fields = {
+    '@id': 'lshw_id',
+    '@class': 'lshw_class',
+    'vendor': 'vendor',
+    'product': 'product',
+    }
+
+# Definitions that can be answered from facts: a device with the given
+# conditions, optionally with a given capability, or any device with a
+# given capability.
+_device_definition = re.compile(
+    r'^\s*//node((?:\[[^\[\]]*\])*)'
+    r'(?:/capabilities/capability\[\s*@id\s*=\s*%s\s*\])?\s*$' % _literal)
+_capability_definition = re.compile(
+    r'^\s*//capability\[\s*@id\s*=\s*%s\s*\]\s*$' % _literal)
+
+
+def _get_literal(match, group):
+    """Return the literal matched by `_literal` at `group`, or None."""
+    single, double = match.group(group, group + 1)
+    return single if single is not None else double
+
+
+def _get_conditions(predicates):
+    """Turn the predicates on a device into filters on its facts.
+
+    :return: A dict of filters, or None if any of the predicates can't be
+        answered from facts.
+    """
+    filters = {}
+    for predicate in re.findall(r'\[([^\[\]]*)\]', predicates):
+        for condition in re.split(r'\s+and\s+', predicate):
+            match = _condition.match(condition)
+            if match is None:
+                return None
+            field = _condition_fields[match.group(1)]
+            value = _get_literal(match, 2)
+            if field in filters and filters[field] != value:
+                # A device can't have two different values; leave that to
+                # XPath rather than reasoning about it here.
+                return None
+            filters[field] = value
+    return filters
+
+
+def get_facts_query(definition):
+    """Compile a tag definition into a query against hardware facts.
+
+    Only common shapes of XPath expression can be compiled: devices with
+    conditions on their id, class, vendor, or product, such as
+    ``//node[@class='network' and vendor='Intel Corporation']``, and
+    capabilities, such as
+    ``//node[@class='processor']/capabilities/capability[@id='vmx']`` or
+    ``//capability[@id='vmx']``.
+
+    :return: A `Q` object that selects the nodes matching `definition`, for
+        filtering `Node` querysets, or None if the definition can't be
+        compiled.  It must then be evaluated as XPath.
+    """
+    match = _device_definition.match(definition)
+    if match is not None:
+        filters = _get_conditions(match.group(1))
+        if filters is None:
+            return None
+        capability = _get_literal(match, 2)
+        if capability is None:
+            filters['capability__isnull'] = True
+        else:
+            filters['capability'] = capability
+    else:
+        match = _capability_definition.match(definition)
+        if match is None:
+            return None
+        filters = {'capability': _get_literal(match, 1)}
+    for value in filters.values():
+        if isinstance(value, unicode) and len(value) > FACT_MAX_LENGTH:
+            # No fact holds a value this long.
+            return None
+    facts = HardwareFact.objects.filter(**filters)
+    return Q(id__in=facts.values('node_id'))
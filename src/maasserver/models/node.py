@@ -18,6 +18,7 @@ __all__ = [
     "update_hardware_details",
     ]
 
+from collections import defaultdict
 from itertools import (
     imap,
     islice,
@@ -33,9 +34,14 @@ from django.core.exceptions import (
     PermissionDenied,
     ValidationError,
     )
+from django.db import (
+    connection,
+    transaction,
+    )
 from django.db.models import (
     BooleanField,
     CharField,
+    DateTimeField,
     ForeignKey,
     IntegerField,
     Manager,
@@ -65,8 +71,16 @@ from maasserver.fields import (
 from maasserver.models.cleansave import CleanSave
 from maasserver.models.config import Config
 from maasserver.models.dhcplease import DHCPLease
-from maasserver.models.tag import Tag
-from maasserver.models.timestampedmodel import TimestampedModel
+from maasserver.models.hardwarefact import HardwareFact
+from maasserver.models.macaddress import MACAddress
+from maasserver.models.tag import (
+    compile_definition,
+    Tag,
+    )
+from maasserver.models.timestampedmodel import (
+    now,
+    TimestampedModel,
+    )
 from maasserver.utils import (
     get_db_state,
     strip_domain,
@@ -76,17 +90,56 @@ from maasserver.utils.orm import (
     get_one,
     )
 from piston.models import Token
+from psycopg2 import Error as PostgresError
+from psycopg2.errorcodes import LOCK_NOT_AVAILABLE
 from provisioningserver.enum import (
+    POWER_STATE,
+    POWER_STATE_CHOICES,
     POWER_TYPE,
     POWER_TYPE_CHOICES,
     )
 from provisioningserver.tasks import (
-    power_off,
-    power_on,
+    power_off_nodes,
+    power_on_nodes,
     remove_dhcp_host_map,
     )
 
 
+def lock_ready_nodes(node_ids):
+    """Lock the rows of those of the given nodes that are ready.
+
+    This does not wait for other transactions' locks: if any of the rows
+    are locked already, none are locked.  The status is checked on the
+    locked rows themselves, so a node that another transaction has just
+    acquired is left out.
+
+    PostgreSQL 9.1 has no `SKIP LOCKED`, so the lock is taken with `NOWAIT`
+    in a savepoint, which is rolled back if it fails.
+
+    :param node_ids: A non-empty list of node ids.
+    :return: The ids of the nodes that were locked, or None if another
+        transaction held a lock on any of them.
+    """
+    query = (
+        "SELECT id FROM maasserver_node WHERE status = %%s AND id IN (%s) "
+        "FOR UPDATE NOWAIT" % ', '.join(['%s'] * len(node_ids)))
+    # Django's cursor wraps database errors without their error codes, so
+    # this uses psycopg2's own cursor to tell lock failures apart.  Getting
+    # Django's cursor first makes sure the connection is open.
+    connection.cursor()
+    cursor = connection.connection.cursor()
+    savepoint = transaction.savepoint()
+    try:
+        cursor.execute(query, [NODE_STATUS.READY] + list(node_ids))
+    except PostgresError as error:
+        if error.pgcode != LOCK_NOT_AVAILABLE:
+            raise
+        transaction.savepoint_rollback(savepoint)
+        return None
+    transaction.savepoint_commit(savepoint)
+    return [node_id for node_id, in cursor.fetchall()]
+
+
 def generate_node_system_id():
     return 'node-%s' % uuid1()
 
@@ -289,11 +342,111 @@ class NodeManager(Manager):
         :type constraints: :class:`dict`
         :return: A matching `Node`, or None if none are available.
         """
+        return get_first(self.get_available_nodes_for_acquisition(
+            for_user, 1, constraints=constraints))
+
+    def get_available_nodes_for_acquisition(self, for_user, count,
+                                            constraints=None):
+        """Find and lock up to `count` `Node`s to be acquired by a user.
+
+        The nodes' rows are locked until the end of the transaction, so that
+        concurrent requests can't acquire the same nodes.  Nodes that other
+        transactions have locked are skipped rather than waited for, so
+        concurrent requests get different nodes.
+
+        :param for_user: The user who is to acquire the nodes.
+        :type for_user: :class:`django.contrib.auth.models.User`
+        :param count: The maximum number of nodes to find.
+        :param constraints: Optional selection constraints.  If given, only
+            nodes matching these constraints are considered.
+        :type constraints: :class:`dict`
+        :return: A list of matching `Node`s, which may be shorter than
+            `count`, or empty, if not enough nodes are available.
+        """
         from maasserver.models.node_constraint_filter import constrain_nodes
         available_nodes = self.get_nodes(for_user, NODE_PERMISSION.VIEW)
         available_nodes = available_nodes.filter(status=NODE_STATUS.READY)
         available_nodes = constrain_nodes(available_nodes, constraints)
-        return get_first(available_nodes)
+        candidates = list(
+            available_nodes.order_by('id').values_list('id', flat=True))
+        locked = []
+        while len(locked) < count and len(candidates) > 0:
+            batch = candidates[:count - len(locked)]
+            del candidates[:len(batch)]
+            locked_batch = lock_ready_nodes(batch)
+            if locked_batch is None:
+                # Another transaction holds some of these; lock the others
+                # one at a time.
+                locked_batch = []
+                for node_id in batch:
+                    locked_batch.extend(lock_ready_nodes([node_id]) or [])
+            locked.extend(locked_batch)
+        return list(self.filter(id__in=locked).order_by('id'))
+
+    def get_primary_macs(self, nodes):
+        """Return the primary MAC addresses of `nodes`, in one query.
+
+        :return: A dict mapping the ids of those of `nodes` that have MAC
+            addresses to their primary MAC addresses, as strings.
+        """
+        macs = MACAddress.objects.filter(node__in=nodes).order_by(
+            '-created', '-id').values_list('node_id', 'mac_address')
+        # The oldest MAC address of each node comes last, and wins.
+        return dict(macs)
+
+    def compose_power_actions(self, nodes):
+        """Compose the power types and parameters of `nodes`.
+
+        The nodes' primary MAC addresses, their cluster controllers, and
+        the default power type are looked up once for all of the nodes,
+        rather than once for each node.
+
+        :param nodes: A QuerySet of Nodes.
+        :return: A list of (node, power type, power parameters) tuples.
+        """
+        nodes = list(nodes.select_related('nodegroup'))
+        primary_macs = self.get_primary_macs(nodes)
+        default_power_type = Config.objects.get_config('node_power_type')
+        return [
+            (
+                node,
+                node.get_effective_power_type(default_power_type),
+                node.get_effective_power_parameters(primary_macs),
+            )
+            for node in nodes]
+
+    def dispatch_power_actions(self, task, power_actions):
+        """Send `task` for `power_actions`, once to each cluster controller.
+
+        :param task: The power task: `power_on_nodes` or `power_off_nodes`.
+        :param power_actions: A list of (node, power type, power parameters)
+            tuples, as returned by `compose_power_actions`.
+        """
+        actions_by_queue = defaultdict(list)
+        for node, power_type, power_params in power_actions:
+            actions_by_queue[node.work_queue].append(
+                (power_type, power_params))
+        # The nodes' power is about to change, and isn't known until their
+        # cluster controllers poll it again.
+        if len(power_actions) > 0:
+            self.filter(
+                id__in=[node.id for node, _, _ in power_actions]).update(
+                power_state=POWER_STATE.UNKNOWN, power_state_updated=now())
+        for queue, actions in sorted(actions_by_queue.items()):
+            task.apply_async(queue=queue, args=[actions])
+
+    def update_power_states(self, nodegroup, power_states):
+        """Record the power states of `nodegroup`'s nodes.
+
+        :param power_states: A dict mapping the nodes' system_ids to their
+            `POWER_STATE`s.  Nodes that are not in `nodegroup` are ignored.
+        """
+        system_ids_by_state = defaultdict(list)
+        for system_id, power_state in power_states.items():
+            system_ids_by_state[power_state].append(system_id)
+        for power_state, system_ids in system_ids_by_state.items():
+            self.filter(nodegroup=nodegroup, system_id__in=system_ids).update(
+                power_state=power_state, power_state_updated=now())
 
     def stop_nodes(self, ids, by_user):
         """Request on given user's behalf that the given nodes be shut down.
@@ -309,17 +462,15 @@ class NodeManager(Manager):
         :rtype: list
         """
         nodes = self.get_nodes(by_user, NODE_PERMISSION.EDIT, ids=ids)
-        processed_nodes = []
-        for node in nodes:
-            power_params = node.get_effective_power_parameters()
-            node_power_type = node.get_effective_power_type()
-            # WAKE_ON_LAN does not support poweroff.
-            if node_power_type != POWER_TYPE.WAKE_ON_LAN:
-                power_off.apply_async(
-                    queue=node.work_queue, args=[node_power_type],
-                    kwargs=power_params)
-            processed_nodes.append(node)
-        return processed_nodes
+        power_actions = self.compose_power_actions(nodes)
+        # WAKE_ON_LAN does not support poweroff.  Nodes are powered off
+        # even when the last poll found them off: they may have been
+        # switched on since.
+        self.dispatch_power_actions(power_off_nodes, [
+            (node, power_type, power_params)
+            for node, power_type, power_params in power_actions
+            if power_type != POWER_TYPE.WAKE_ON_LAN])
+        return [node for node, _, _ in power_actions]
 
     def start_nodes(self, ids, by_user, user_data=None):
         """Request on given user's behalf that the given nodes be started up.
@@ -342,23 +493,20 @@ class NodeManager(Manager):
         from metadataserver.models import NodeUserData
 
         nodes = self.get_nodes(by_user, NODE_PERMISSION.EDIT, ids=ids)
-        for node in nodes:
-            NodeUserData.objects.set_user_data(node, user_data)
-        processed_nodes = []
-        for node in nodes:
-            power_params = node.get_effective_power_parameters()
-            node_power_type = node.get_effective_power_type()
-            if node_power_type == POWER_TYPE.WAKE_ON_LAN:
+        power_actions = self.compose_power_actions(nodes)
+        NodeUserData.objects.bulk_set_user_data(
+            [node for node, _, _ in power_actions], user_data)
+        startable_actions = []
+        for node, power_type, power_params in power_actions:
+            if power_type == POWER_TYPE.WAKE_ON_LAN:
                 mac = power_params.get('mac_address')
                 do_start = (mac != '' and mac is not None)
             else:
                 do_start = True
             if do_start:
-                power_on.apply_async(
-                    queue=node.work_queue, args=[node_power_type],
-                    kwargs=power_params)
-                processed_nodes.append(node)
-        return processed_nodes
+                startable_actions.append((node, power_type, power_params))
+        self.dispatch_power_actions(power_on_nodes, startable_actions)
+        return [node for node, _, _ in startable_actions]
 
 
 _xpath_processor_count = "count(//node[@id='core']/node[@class='processor'])"
@@ -380,6 +528,8 @@ def update_hardware_details(node, xmlbytes, tag_manager):
     This is a helper function just so it can be used in the south migration
     to do the correct updates to mem and cpu_count when hardware_details is
     first set.
+
+    :return: The parsed XML document.
     """
     try:
         doc = etree.XML(xmlbytes)
@@ -395,13 +545,23 @@ def update_hardware_details(node, xmlbytes, tag_manager):
         memory = 0
     node.cpu_count = cpu_count or 0
     node.memory = memory
+    matched_tags = set()
+    unmatched_tags = set()
     for tag in tag_manager.all():
-        has_tag = evaluator(tag.definition)
-        if has_tag:
-            node.tags.add(tag)
+        if compile_definition(tag)(doc):
+            matched_tags.add(tag.id)
         else:
-            node.tags.remove(tag)
+            unmatched_tags.add(tag.id)
+    # Write only the difference with the node's current tags.
+    current_tags = set(node.tags.values_list('id', flat=True))
+    removed_tags = current_tags & unmatched_tags
+    added_tags = matched_tags - current_tags
+    if len(removed_tags) > 0:
+        node.tags.remove(*removed_tags)
+    if len(added_tags) > 0:
+        node.tags.add(*added_tags)
     node.save()
+    return doc
 
 
 # Non-ambiguous characters (i.e. without 'ilousvz1250').
@@ -429,6 +589,9 @@ class Node(CleanSave, TimestampedModel):
     :ivar power_type: The :class:`POWER_TYPE` that determines how this
         node will be powered on.  If not given, the default will be used as
         configured in the `node_power_type` setting.
+    :ivar power_state: The last known :class:`POWER_STATE` of the node, as
+        polled by its cluster controller.
+    :ivar power_state_updated: When `power_state` was last changed.
     :ivar nodegroup: The `NodeGroup` this `Node` belongs to.
     :ivar tags: The list of :class:`Tag`s associated with this `Node`.
     :ivar objects: The :class:`NodeManager`.
@@ -483,6 +646,12 @@ class Node(CleanSave, TimestampedModel):
     # JSON-encoded set of parameters for power control.
     power_parameters = JSONObjectField(blank=True, default="")
 
+    power_state = CharField(
+        max_length=10, choices=POWER_STATE_CHOICES, editable=False,
+        default=POWER_STATE.UNKNOWN)
+
+    power_state_updated = DateTimeField(null=True, editable=False)
+
     token = ForeignKey(
         Token, db_index=True, null=True, editable=False, unique=False)
 
@@ -693,14 +862,20 @@ class Node(CleanSave, TimestampedModel):
             else:
                 break
 
-    def get_effective_power_type(self):
+    def get_effective_power_type(self, default_power_type=None):
         """Get power-type to use for this node.
 
         If no power type has been set for the node, get the configured
         default.
+
+        :param default_power_type: The configured default, if the caller
+            has looked it up already.
         """
         if self.power_type == POWER_TYPE.DEFAULT:
-            power_type = Config.objects.get_config('node_power_type')
+            if default_power_type is None:
+                default_power_type = Config.objects.get_config(
+                    'node_power_type')
+            power_type = default_power_type
             if power_type == POWER_TYPE.DEFAULT:
                 raise ValueError(
                     "Node power type is set to the default, but "
@@ -758,8 +933,13 @@ class Node(CleanSave, TimestampedModel):
         self.distro_series = series
         self.save()
 
-    def get_effective_power_parameters(self):
-        """Return effective power parameters, including any defaults."""
+    def get_effective_power_parameters(self, primary_macs=None):
+        """Return effective power parameters, including any defaults.
+
+        :param primary_macs: The primary MAC addresses of nodes, as
+            returned by `NodeManager.get_primary_macs`, if the caller has
+            looked them up already.
+        """
         if self.power_parameters:
             power_params = self.power_parameters.copy()
         else:
@@ -781,9 +961,12 @@ class Node(CleanSave, TimestampedModel):
         # The "mac" parameter defaults to the node's primary MAC
         # address, but only if no power parameters were set at all.
         if not self.power_parameters:
-            primary_mac = self.get_primary_mac()
-            if primary_mac is not None:
-                power_params['mac_address'] = primary_mac.mac_address
+            if primary_macs is None:
+                primary_mac = self.get_primary_mac()
+                if primary_mac is not None:
+                    power_params['mac_address'] = primary_mac.mac_address
+            elif self.id in primary_macs:
+                power_params['mac_address'] = primary_macs[self.id]
         return power_params
 
     def acquire(self, user, token=None):
@@ -810,5 +993,6 @@ class Node(CleanSave, TimestampedModel):
         self.save()
 
     def set_hardware_details(self, xmlbytes):
-        """Set the `lshw -xml` output"""
-        update_hardware_details(self, xmlbytes, Tag.objects)
+        """Set the `lshw -xml` output, and extract facts from it."""
+        doc = update_hardware_details(self, xmlbytes, Tag.objects)
+        HardwareFact.objects.update_facts(self, doc)
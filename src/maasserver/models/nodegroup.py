@@ -180,6 +180,11 @@ class NodeGroup(TimestampedModel):
     maas_url = CharField(
         blank=True, editable=False, max_length=255, default='')
 
+    # Version of the DHCP leases that the region controller has for
+    # this node group.  The cluster controller sends lease changes
+    # relative to a version; see `DHCPLeaseManager`.
+    leases_generation = IntegerField(editable=False, default=0)
+
     def __repr__(self):
         return "<NodeGroup %s>" % self.uuid
 
@@ -11,6 +11,7 @@ from __future__ import (
 
 __metaclass__ = type
 __all__ = [
+    "compile_definition",
     "Tag",
     ]
 
@@ -30,6 +31,17 @@ from lxml import etree
 from maasserver import DefaultMeta
 from maasserver.models.cleansave import CleanSave
 from maasserver.models.timestampedmodel import TimestampedModel
+from provisioningserver.utils import compile_xpath
+
+
+def compile_definition(tag):
+    """Return `tag`'s definition compiled as an `etree.XPath`.
+
+    Recently used definitions are cached; see `compile_xpath`.
+
+    :raises: `etree.XPathSyntaxError` if the definition is invalid.
+    """
+    return compile_xpath(tag.definition)
 
 
 # Permission model for tags. Everyone can see all tags, but only superusers can
@@ -121,20 +133,23 @@ class Tag(CleanSave, TimestampedModel):
     def __unicode__(self):
         return self.name
 
-    def populate_nodes(self):
-        """Find all nodes that match this tag, and update them."""
+    def populate_nodes(self, force=False):
+        """Find all nodes that match this tag, and update them.
+
+        :param force: Ask all cluster controllers to rebuild the tag, even
+            those that have a rebuild queued already.
+        """
         from maasserver.populate_tags import populate_tags
         if not self.definition:
             return
         # before we pass off any work, ensure the definition is valid XPATH
         try:
-            etree.XPath(self.definition)
+            compile_definition(self)
         except etree.XPathSyntaxError as e:
             msg = 'Invalid xpath expression: %s' % (e,)
             raise ValidationError({'definition': [msg]})
-        # Now delete the existing tags
-        self.node_set.clear()
-        populate_tags(self)
+        # Existing tags stay in place until they are found not to match.
+        populate_tags(self, force=force)
 
     def save(self, *args, **kwargs):
         super(Tag, self).save(*args, **kwargs)
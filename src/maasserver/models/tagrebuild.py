@@ -0,0 +1,164 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Tracking of the rebuilds of tags on cluster controllers."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = [
+    'TagRebuild',
+    ]
+
+from datetime import timedelta
+from logging import getLogger
+
+from django.db.models import (
+    DateTimeField,
+    ForeignKey,
+    IntegerField,
+    Manager,
+    TextField,
+    )
+from maasserver import DefaultMeta
+from maasserver.enum import (
+    TAG_REBUILD_STATUS,
+    TAG_REBUILD_STATUS_CHOICES,
+    )
+from maasserver.models.cleansave import CleanSave
+from maasserver.models.timestampedmodel import (
+    now,
+    TimestampedModel,
+    )
+
+
+logger = getLogger('maasserver')
+
+
+UNFINISHED_STATUSES = (TAG_REBUILD_STATUS.PENDING, TAG_REBUILD_STATUS.RUNNING)
+
+# A rebuild still pending after this long is assumed to be lost, e.g.
+# because the cluster's worker was down, and is queued again.
+PENDING_REBUILD_EXPIRY = timedelta(hours=1)
+
+
+class TagRebuildManager(Manager):
+    """Manager for `TagRebuild`.
+
+    Don't import or instantiate this directly; access as
+    `TagRebuild.objects`.
+    """
+
+    def queue_rebuilds(self, tag, nodegroups, force=False):
+        """Record rebuilds of `tag` for `nodegroups`.
+
+        Unfinished rebuilds for earlier definitions of the tag are
+        superseded, so that their workers skip them.  A nodegroup that has
+        a rebuild for the current definition queued already doesn't need
+        another one, unless that rebuild has been pending for longer than
+        `PENDING_REBUILD_EXPIRY`, in which case it is superseded too.
+
+        :param force: Queue a rebuild for every one of `nodegroups`,
+            superseding any rebuilds they have pending.
+        :return: The nodegroups whose workers need to be asked to rebuild
+            the tag.
+        """
+        unfinished = self.filter(tag=tag, status__in=UNFINISHED_STATUSES)
+        unfinished.exclude(definition=tag.definition).update(
+            status=TAG_REBUILD_STATUS.SUPERSEDED, finished=now())
+        pending = unfinished.filter(status=TAG_REBUILD_STATUS.PENDING)
+        if force:
+            superseded = pending
+        else:
+            superseded = pending.filter(
+                created__lt=now() - PENDING_REBUILD_EXPIRY)
+        superseded.update(
+            status=TAG_REBUILD_STATUS.SUPERSEDED, finished=now())
+        queued_nodegroup_ids = set(
+            pending.values_list('nodegroup_id', flat=True))
+        nodegroups = [
+            nodegroup for nodegroup in nodegroups
+            if nodegroup.id not in queued_nodegroup_ids]
+        for nodegroup in nodegroups:
+            TagRebuild(
+                tag=tag, nodegroup=nodegroup,
+                definition=tag.definition).save()
+        return nodegroups
+
+    def start_rebuild(self, tag, nodegroup, definition):
+        """Record that `nodegroup`'s worker is starting to rebuild `tag`.
+
+        :return: Whether `definition` is the tag's current definition.  If
+            not, the rebuild has been superseded, and the worker should
+            not bother.
+        """
+        if definition != tag.definition:
+            return False
+        self.filter(
+            tag=tag, nodegroup=nodegroup, definition=definition,
+            status=TAG_REBUILD_STATUS.PENDING).update(
+            status=TAG_REBUILD_STATUS.RUNNING, started=now())
+        return True
+
+    def finish_rebuild(self, tag, nodegroup, definition):
+        """Record that `nodegroup`'s worker has rebuilt `tag`.
+
+        This completes the oldest of the unfinished rebuilds for
+        `definition`, if there is one.
+        """
+        rebuilds = self.filter(
+            tag=tag, nodegroup=nodegroup, definition=definition,
+            status__in=UNFINISHED_STATUSES).order_by('-status', 'id')
+        for rebuild in rebuilds[:1]:
+            rebuild.status = TAG_REBUILD_STATUS.DONE
+            rebuild.finished = now()
+            rebuild.save()
+            logger.info(
+                "Rebuilt tag %s on %s in %s."
+                % (tag.name, nodegroup.name, rebuild.latency))
+
+
+class TagRebuild(CleanSave, TimestampedModel):
+    """A rebuild of a tag's nodes on a cluster controller.
+
+    When a tag's definition can only be evaluated by the workers, each
+    cluster controller's worker matches its own nodes, and posts the
+    results.  Each of those rebuilds is recorded, from when it is queued
+    until it is done, or superseded by a newer rebuild.
+
+    :ivar tag: The tag being rebuilt.
+    :ivar nodegroup: The cluster controller doing the rebuild.
+    :ivar definition: The definition of the tag being evaluated.
+    :ivar status: The rebuild's progress; see `TAG_REBUILD_STATUS`.
+    :ivar started: When the worker started, if it has.
+    :ivar finished: When the rebuild was done or superseded, if it has
+        been.
+    """
+
+    class Meta(DefaultMeta):
+        """Needed for South to recognize this model."""
+
+    objects = TagRebuildManager()
+
+    tag = ForeignKey('maasserver.Tag', null=False, editable=False)
+    nodegroup = ForeignKey('maasserver.NodeGroup', null=False, editable=False)
+    definition = TextField(editable=False)
+    status = IntegerField(
+        choices=TAG_REBUILD_STATUS_CHOICES, editable=False, db_index=True,
+        default=TAG_REBUILD_STATUS.DEFAULT_STATUS)
+    started = DateTimeField(null=True, editable=False)
+    finished = DateTimeField(null=True, editable=False)
+
+    @property
+    def latency(self):
+        """The time from queueing the rebuild to it being done, or None."""
+        if self.status != TAG_REBUILD_STATUS.DONE:
+            return None
+        return self.finished - self.created
+
+    def __unicode__(self):
+        return "%s on %s" % (self.tag_id, self.nodegroup_id)
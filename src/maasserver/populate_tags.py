@@ -12,19 +12,138 @@ from __future__ import (
 __metaclass__ = type
 __all__ = [
     'populate_tags',
+    'populate_tags_from_facts',
+    'populate_tags_in_database',
     ]
 
+from django.db import (
+    connection,
+    DatabaseError,
+    transaction,
+    )
+from django.db.models import Q
 from maasserver.models import (
     logger,
+    Node,
     NodeGroup,
+    TagRebuild,
     )
+from maasserver.models.hardwarefact import get_facts_query
+from maasserver.pxeconfig_connect import invalidate_pxe_configs
 from maasserver.refresh_worker import refresh_worker
 from provisioningserver.tasks import update_node_tags
 
 
-def populate_tags(tag):
-    """Send worker for all nodegroups an update_node_tags request.
+def populate_tags_from_facts(tag):
+    """Tag exactly the nodes that match `tag`'s definition, using facts.
+
+    Common shapes of definition can be answered from the nodes' hardware
+    facts, using indexes, instead of evaluating them as XPath.
+
+    :return: Whether the definition could be answered from facts.  If not,
+        nothing is changed.
+    """
+    query = get_facts_query(tag.definition)
+    if query is None:
+        return False
+    node_tag_model = Node.tags.through
+    matching_nodes = Node.objects.filter(query)
+    node_tag_model.objects.filter(tag=tag).exclude(
+        node__in=matching_nodes).delete()
+    new_node_ids = matching_nodes.exclude(tags=tag).values_list(
+        'id', flat=True)
+    node_tag_model.objects.bulk_create([
+        node_tag_model(node_id=node_id, tag=tag)
+        for node_id in new_node_ids])
+    return True
+
+
+# Evaluate a tag definition the way lxml would on a worker: with the root
+# element of the node's hardware details as the context node, and matching
+# if the result is true in XPath terms (a non-empty node-set or string, or
+# a non-zero number) rather than if the expression yields anything at all.
+# Then tag the nodes that match but aren't tagged yet, and untag the ones
+# that are tagged but no longer match.
+populate_tags_sql = """
+    WITH matches AS (
+        SELECT
+            node.id AS node_id,
+            coalesce(
+                xpath_exists(
+                    '/*[boolean(' || %(definition)s || ')]',
+                    node.hardware_details),
+                false) AS matched
+        FROM maasserver_node AS node
+    ), removed AS (
+        DELETE FROM maasserver_node_tags AS node_tag
+        USING matches
+        WHERE
+            node_tag.tag_id = %(tag_id)s AND
+            node_tag.node_id = matches.node_id AND
+            NOT matches.matched
+    )
+    INSERT INTO maasserver_node_tags (node_id, tag_id)
+    SELECT matches.node_id, %(tag_id)s
+    FROM matches
+    WHERE
+        matches.matched AND
+        NOT EXISTS (
+            SELECT 1 FROM maasserver_node_tags AS node_tag
+            WHERE node_tag.node_id = matches.node_id AND
+                node_tag.tag_id = %(tag_id)s)
+    """
+
+
+def populate_tags_in_database(tag):
+    """Tag exactly the nodes that match `tag`'s definition, in the database.
+
+    PostgreSQL evaluates the definition against the hardware details of
+    every node, and the nodes' tags are brought up to date in a single
+    statement.  Nodes that already have the tag keep it, unless they no
+    longer match.
+
+    :return: Whether the database could evaluate the definition.  It can't
+        if the definition uses XPath features that PostgreSQL does not
+        support (such as the EXSLT extensions that lxml offers), or if
+        PostgreSQL was built without XML support.  In that case nothing
+        is changed.
+    """
+    savepoint = transaction.savepoint()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            populate_tags_sql,
+            {'tag_id': tag.id, 'definition': tag.definition})
+    except DatabaseError as error:
+        transaction.savepoint_rollback(savepoint)
+        logger.debug(
+            "Can't evaluate tag definition for %s in the database: %s"
+            % (tag.name, error))
+        return False
+    transaction.savepoint_commit(savepoint)
+    transaction.commit_unless_managed()
+    return True
+
+
+def populate_tags(tag, force=False):
+    """Tag the nodes that match `tag`'s definition.
+
+    Where possible this is done from the nodes' hardware facts, or else
+    in the database, in one go.  Otherwise, send the workers for all
+    nodegroups an update_node_tags request, unless they have one queued for
+    the current definition already and `force` is not set.  The rebuilds
+    are tracked as `TagRebuild`s.
     """
+    # Tagging nodes in bulk sends no m2m_changed signals, so if the tag
+    # has kernel options, the PXE configs of the nodes it had and the
+    # nodes it has now are invalidated here.
+    if tag.kernel_opts:
+        tagged_before = list(tag.node_set.values_list('id', flat=True))
+    if populate_tags_from_facts(tag) or populate_tags_in_database(tag):
+        if tag.kernel_opts:
+            invalidate_pxe_configs(
+                Node.objects.filter(Q(id__in=tagged_before) | Q(tags=tag)))
+        return
     items = {
         'tag_name': tag.name,
         'tag_definition': tag.definition,
@@ -35,6 +154,8 @@ def populate_tags(tag):
     # worker for a given nodegroup, before we have that worker process the
     # request.
     logger.debug('Refreshing tag definition for %s' % (items,))
-    for nodegroup in NodeGroup.objects.all():
+    nodegroups = TagRebuild.objects.queue_rebuilds(
+        tag, NodeGroup.objects.all(), force=force)
+    for nodegroup in nodegroups:
         refresh_worker(nodegroup)
         update_node_tags.apply_async(queue=nodegroup.work_queue, kwargs=items)
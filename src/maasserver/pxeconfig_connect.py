@@ -0,0 +1,244 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""PXE config caches: tell cluster controllers when boot configs change.
+
+Cluster controllers cache the kernel parameters that the `pxeconfig`
+view gives them, for a short while.  When something that goes into a
+node's kernel parameters changes, its cluster is told to forget them.
+During a request, those invalidations are collected, and each cluster
+is told just once, at the end (see `PXEConfigInvalidator`).
+"""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = [
+    'invalidate_all_pxe_configs',
+    'invalidate_pxe_configs',
+    'pxe_config_invalidator',
+    ]
+
+
+from collections import defaultdict
+from contextlib import contextmanager
+import threading
+
+from django.db.models.query import QuerySet
+from django.db.models.signals import m2m_changed
+from maasserver.models import (
+    Config,
+    MACAddress,
+    Node,
+    NodeGroup,
+    Tag,
+    )
+from maasserver.signals import connect_to_field_change
+from provisioningserver import tasks
+
+
+def _invalidate_pxe_configs(node_ids):
+    """Tell the nodes' cluster controllers to forget their PXE configs.
+
+    One task is sent to each cluster controller involved.
+    """
+    if len(node_ids) == 0:
+        return
+    mac_addresses = MACAddress.objects.filter(
+        node_id__in=node_ids).order_by('id').values_list(
+        'mac_address', 'node__nodegroup__uuid')
+    macs_by_queue = defaultdict(list)
+    for mac_address, queue in mac_addresses:
+        if queue is not None:
+            macs_by_queue[queue].append(mac_address)
+    for queue, macs in sorted(macs_by_queue.items()):
+        tasks.invalidate_pxe_configs.apply_async(queue=queue, args=[macs])
+
+
+def _invalidate_all_pxe_configs():
+    """Tell all cluster controllers to forget all their PXE configs."""
+    for nodegroup in NodeGroup.objects.all():
+        tasks.invalidate_pxe_configs.apply_async(
+            queue=nodegroup.work_queue, args=[None])
+
+
+class PXEConfigInvalidations:
+    """The PXE config invalidations requested in a batch, merged."""
+
+    def __init__(self):
+        self.everything = False
+        self.node_ids = set()
+
+
+class PXEConfigInvalidator:
+    """Coalesce the PXE config invalidations that the region asks for.
+
+    This works like `maasserver.dns.DNSChangeScheduler`: invalidations
+    are sent straight away, unless a batch is in progress in the current
+    thread.  Those requested during a batch are sent when it ends, with
+    just one task for each cluster controller involved.  Invalidating
+    all PXE configs supersedes invalidating those of particular nodes.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def _invalidations(self):
+        """The invalidations requested in the current batch, if any."""
+        return getattr(self._local, 'invalidations', None)
+
+    def begin(self):
+        """Start a batch, or nest one in the current batch."""
+        if self._invalidations is None:
+            self._local.invalidations = PXEConfigInvalidations()
+            self._local.depth = 0
+        self._local.depth += 1
+
+    def end(self):
+        """End a batch; send its invalidations if it is the outermost."""
+        if self._invalidations is None:
+            return
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            invalidations = self._local.invalidations
+            self._local.invalidations = None
+            self.execute(invalidations)
+
+    def discard(self):
+        """Drop the current batch (even if nested) without sending it.
+
+        This is for when the transaction that the changes were part of
+        has been rolled back.
+        """
+        self._local.invalidations = None
+
+    @contextmanager
+    def batch(self):
+        """Context manager: collect invalidations, send them at the end.
+
+        If the block fails, the invalidations are dropped.
+        """
+        self.begin()
+        try:
+            yield
+        except:
+            self.discard()
+            raise
+        else:
+            self.end()
+
+    def invalidate_nodes(self, nodes):
+        # The nodes are identified now: by the end of the batch, a
+        # queryset may match different nodes.
+        if isinstance(nodes, QuerySet):
+            node_ids = set(nodes.values_list('id', flat=True))
+        else:
+            node_ids = {node.id for node in nodes}
+        if self._invalidations is None:
+            _invalidate_pxe_configs(node_ids)
+        else:
+            self._invalidations.node_ids.update(node_ids)
+
+    def invalidate_all(self):
+        if self._invalidations is None:
+            _invalidate_all_pxe_configs()
+        else:
+            self._invalidations.everything = True
+
+    def execute(self, invalidations):
+        """Send the merged `invalidations`."""
+        if invalidations.everything:
+            _invalidate_all_pxe_configs()
+        else:
+            _invalidate_pxe_configs(invalidations.node_ids)
+
+
+pxe_config_invalidator = PXEConfigInvalidator()
+
+
+def invalidate_pxe_configs(nodes):
+    """Tell the nodes' cluster controllers to forget their PXE configs.
+
+    This goes through the :class:`PXEConfigInvalidator`.
+
+    :param nodes: A list or queryset of nodes.
+    """
+    pxe_config_invalidator.invalidate_nodes(nodes)
+
+
+def invalidate_all_pxe_configs():
+    """Tell all cluster controllers to forget all their PXE configs.
+
+    This goes through the :class:`PXEConfigInvalidator`.
+    """
+    pxe_config_invalidator.invalidate_all()
+
+
+def pxeconfig_post_edit_Node(instance, old_field, deleted):
+    """A field that goes into the node's PXE config changed."""
+    invalidate_pxe_configs([instance])
+
+
+for field_name in ('status', 'netboot', 'distro_series'):
+    connect_to_field_change(pxeconfig_post_edit_Node, Node, field_name)
+
+
+def pxeconfig_post_edit_kernel_opts_Tag(instance, old_field, deleted):
+    """The kernel options of a tag changed."""
+    invalidate_pxe_configs(instance.node_set.all())
+
+
+connect_to_field_change(
+    pxeconfig_post_edit_kernel_opts_Tag, Tag, 'kernel_opts')
+
+
+def with_kernel_opts(tags):
+    """Filter a queryset of tags down to those with kernel options."""
+    return tags.exclude(kernel_opts__isnull=True).exclude(kernel_opts='')
+
+
+def pxeconfig_m2m_changed_Node_tags(sender, instance, action, reverse,
+                                    model, pk_set, **kwargs):
+    """Nodes gained or lost tags, which may have kernel options.
+
+    Nodes' tags can be changed from either side: `instance` is a node,
+    and `pk_set` holds the ids of tags, or the other way around if
+    `reverse`.  Before a clear, `pk_set` is None: the related objects
+    are the ones about to be removed.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        if instance.kernel_opts:
+            if action == 'pre_clear':
+                invalidate_pxe_configs(instance.node_set.all())
+            else:
+                invalidate_pxe_configs(Node.objects.filter(id__in=pk_set))
+    else:
+        if action == 'pre_clear':
+            tags = instance.tags.all()
+        else:
+            tags = Tag.objects.filter(id__in=pk_set)
+        if with_kernel_opts(tags).exists():
+            invalidate_pxe_configs([instance])
+
+
+m2m_changed.connect(
+    pxeconfig_m2m_changed_Node_tags, sender=Node.tags.through)
+
+
+def pxeconfig_post_save_Config(sender, instance, created, **kwargs):
+    """A setting that goes into every PXE config changed."""
+    invalidate_all_pxe_configs()
+
+
+for config_name in (
+        'kernel_opts', 'default_distro_series',
+        'commissioning_distro_series'):
+    Config.objects.config_changed_connect(
+        config_name, pxeconfig_post_save_Config)
@@ -32,6 +32,7 @@ import random
 import shutil
 import sys
 from urlparse import urlparse
+import zlib
 
 from apiclient.maas_client import MAASClient
 from celery.app import app_or_default
@@ -69,6 +70,7 @@ from maasserver.enum import (
     NODE_STATUS_CHOICES_DICT,
     NODEGROUP_STATUS,
     NODEGROUPINTERFACE_MANAGEMENT,
+    TAG_REBUILD_STATUS,
     )
 from maasserver.exceptions import MAASAPIBadRequest
 from maasserver.fields import mac_error_msg
@@ -83,6 +85,7 @@ from maasserver.models import (
     nodegroup as nodegroup_module,
     NodeGroupInterface,
     Tag,
+    TagRebuild,
     )
 from maasserver.models.node import generate_node_system_id
 from maasserver.models.user import (
@@ -136,6 +139,7 @@ from provisioningserver import (
 from provisioningserver.auth import get_recorded_nodegroup_uuid
 from provisioningserver.dhcp.leases import send_leases
 from provisioningserver.enum import (
+    POWER_STATE,
     POWER_TYPE,
     POWER_TYPE_CHOICES,
     )
@@ -785,6 +789,7 @@ class AnonymousEnlistmentAPITest(APIv10TestMixin, TestCase):
                 'status',
                 'netboot',
                 'power_type',
+                'power_state',
                 'tag_names',
                 'resource_uri',
             ],
@@ -861,6 +866,7 @@ class SimpleUserLoggedInEnlistmentAPITest(APIv10TestMixin, LoggedInTestCase):
                 'status',
                 'netboot',
                 'power_type',
+                'power_state',
                 'resource_uri',
                 'tag_names',
             ],
@@ -1001,6 +1007,7 @@ class AdminLoggedInEnlistmentAPITest(APIv10TestMixin, AdminLoggedInTestCase):
                 'status',
                 'netboot',
                 'power_type',
+                'power_state',
                 'resource_uri',
                 'tag_names',
             ],
@@ -2155,6 +2162,62 @@ class TestNodesAPI(APITestCase):
         oauth_key = self.client.token.key
         self.assertEqual(oauth_key, node.token.key)
 
+    def test_POST_acquire_many_allocates_nodes(self):
+        nodes = [
+            factory.make_node(status=NODE_STATUS.READY, owner=None)
+            for counter in range(3)]
+        response = self.client.post(
+            self.get_uri('nodes/'), {'op': 'acquire_many', 'count': 2})
+        self.assertEqual(httplib.OK, response.status_code)
+        acquired_ids = extract_system_ids(json.loads(response.content))
+        self.assertEqual(2, len(acquired_ids))
+        self.assertEqual(
+            [self.logged_in_user] * 2,
+            [node.owner for node in Node.objects.filter(
+                system_id__in=acquired_ids)])
+        self.assertEqual(
+            1, Node.objects.filter(
+                id__in=[node.id for node in nodes],
+                status=NODE_STATUS.READY).count())
+
+    def test_POST_acquire_many_returns_fewer_nodes_if_short(self):
+        node = factory.make_node(status=NODE_STATUS.READY, owner=None)
+        response = self.client.post(
+            self.get_uri('nodes/'), {'op': 'acquire_many', 'count': 5})
+        self.assertEqual(httplib.OK, response.status_code)
+        self.assertEqual(
+            [node.system_id],
+            extract_system_ids(json.loads(response.content)))
+
+    def test_POST_acquire_many_applies_constraints(self):
+        factory.make_node(status=NODE_STATUS.READY, owner=None)
+        node = factory.make_node(status=NODE_STATUS.READY, owner=None)
+        response = self.client.post(
+            self.get_uri('nodes/'),
+            {'op': 'acquire_many', 'count': 2, 'name': node.hostname})
+        self.assertEqual(httplib.OK, response.status_code)
+        self.assertEqual(
+            [node.system_id],
+            extract_system_ids(json.loads(response.content)))
+
+    def test_POST_acquire_many_fails_if_no_node_present(self):
+        response = self.client.post(
+            self.get_uri('nodes/'), {'op': 'acquire_many', 'count': 2})
+        self.assertEqual(httplib.CONFLICT, response.status_code)
+
+    def test_POST_acquire_many_requires_valid_count(self):
+        factory.make_node(status=NODE_STATUS.READY, owner=None)
+        response = self.client.post(
+            self.get_uri('nodes/'), {'op': 'acquire_many', 'count': 0})
+        self.assertEqual(httplib.BAD_REQUEST, response.status_code)
+
+    def test_POST_acquire_many_sets_a_token(self):
+        node = factory.make_node(status=NODE_STATUS.READY, owner=None)
+        self.client.post(
+            self.get_uri('nodes/'), {'op': 'acquire_many', 'count': 1})
+        node = Node.objects.get(system_id=node.system_id)
+        self.assertEqual(self.client.token.key, node.token.key)
+
     def test_POST_accept_gets_node_out_of_declared_state(self):
         # This will change when we add provisioning.  Until then,
         # acceptance gets a node straight to Ready state.
@@ -2981,6 +3044,74 @@ class TestTagAPI(APITestCase):
         self.assertItemsEqual([], tag.node_set.all())
         self.assertItemsEqual([], node.tags.all())
 
+    def test_POST_update_nodes_finishes_rebuild(self):
+        tag = factory.make_tag()
+        nodegroup = factory.make_node_group()
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        client = make_worker_client(nodegroup)
+        response = client.post(self.get_tag_uri(tag),
+            {'op': 'update_nodes',
+             'nodegroup': nodegroup.uuid,
+             'definition': tag.definition,
+            })
+        self.assertEqual(httplib.OK, response.status_code)
+        rebuild = TagRebuild.objects.get(tag=tag, nodegroup=nodegroup)
+        self.assertEqual(TAG_REBUILD_STATUS.DONE, rebuild.status)
+
+    def test_POST_start_rebuild_marks_rebuild_running(self):
+        tag = factory.make_tag()
+        nodegroup = factory.make_node_group()
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        client = make_worker_client(nodegroup)
+        response = client.post(self.get_tag_uri(tag),
+            {'op': 'start_rebuild',
+             'nodegroup': nodegroup.uuid,
+             'definition': tag.definition,
+            })
+        self.assertEqual(httplib.OK, response.status_code)
+        self.assertEqual({'started': tag.name}, json.loads(response.content))
+        rebuild = TagRebuild.objects.get(tag=tag, nodegroup=nodegroup)
+        self.assertEqual(TAG_REBUILD_STATUS.RUNNING, rebuild.status)
+
+    def test_POST_start_rebuild_refuses_superseded_definition(self):
+        tag = factory.make_tag()
+        nodegroup = factory.make_node_group()
+        client = make_worker_client(nodegroup)
+        response = client.post(self.get_tag_uri(tag),
+            {'op': 'start_rebuild',
+             'nodegroup': nodegroup.uuid,
+             'definition': '//old/definition',
+            })
+        self.assertEqual(httplib.CONFLICT, response.status_code)
+
+    def test_POST_start_rebuild_refuses_non_nodegroup_worker(self):
+        tag = factory.make_tag()
+        nodegroup = factory.make_node_group()
+        response = self.client.post(self.get_tag_uri(tag),
+            {'op': 'start_rebuild',
+             'nodegroup': nodegroup.uuid,
+             'definition': tag.definition,
+            })
+        self.assertEqual(httplib.FORBIDDEN, response.status_code)
+
+    def test_GET_rebuilds_lists_rebuilds_with_latency(self):
+        tag = factory.make_tag()
+        TagRebuild.objects.filter(tag=tag).delete()
+        nodegroups = [factory.make_node_group() for i in range(2)]
+        TagRebuild.objects.queue_rebuilds(tag, nodegroups)
+        TagRebuild.objects.finish_rebuild(
+            tag, nodegroups[0], tag.definition)
+        response = self.client.get(
+            self.get_tag_uri(tag), {'op': 'rebuilds'})
+        self.assertEqual(httplib.OK, response.status_code)
+        parsed_result = json.loads(response.content)
+        self.assertEqual(
+            [(nodegroups[1].uuid, TAG_REBUILD_STATUS.PENDING, False),
+             (nodegroups[0].uuid, TAG_REBUILD_STATUS.DONE, True)],
+            [(rebuild['nodegroup'], rebuild['status'],
+              rebuild['latency'] is not None)
+             for rebuild in parsed_result])
+
     def test_POST_rebuild_rebuilds_node_mapping(self):
         tag = factory.make_tag(definition='/foo/bar')
         # Only one node matches the tag definition, rebuilding should notice
@@ -3011,6 +3142,14 @@ class TestTagAPI(APITestCase):
         self.assertEqual({'rebuilding': tag.name}, parsed_result)
         self.assertItemsEqual([node], tag.node_set.all())
 
+    def test_POST_rebuild_requeues_pending_rebuilds(self):
+        tag = factory.make_tag(definition='/foo/bar')
+        populate_nodes = self.patch(Tag, 'populate_nodes')
+        self.become_admin()
+        response = self.client.post(self.get_tag_uri(tag), {'op': 'rebuild'})
+        self.assertEqual(httplib.OK, response.status_code)
+        populate_nodes.assert_called_once_with(force=True)
+
     def test_POST_rebuild_unknown_404(self):
         self.become_admin()
         response = self.client.post(
@@ -4100,8 +4239,8 @@ class TestNodeGroupAPI(APITestCase):
                 'leases': json.dumps({}),
             })
         self.assertEqual(
-            (httplib.OK, "Leases updated."),
-            (response.status_code, response.content))
+            (httplib.OK, {'generation': 1}),
+            (response.status_code, json.loads(response.content)))
         self.assertItemsEqual(
             [], DHCPLease.objects.filter(nodegroup=nodegroup))
 
@@ -4117,8 +4256,8 @@ class TestNodeGroupAPI(APITestCase):
                 'leases': json.dumps(lease),
             })
         self.assertEqual(
-            (httplib.OK, "Leases updated."),
-            (response.status_code, response.content))
+            (httplib.OK, {'generation': 1}),
+            (response.status_code, json.loads(response.content)))
         self.assertItemsEqual(
             lease.keys(), [
                 lease.ip
@@ -4136,8 +4275,8 @@ class TestNodeGroupAPI(APITestCase):
                 'leases': json.dumps(new_leases),
             })
         self.assertEqual(
-            (httplib.OK, "Leases updated."),
-            (response.status_code, response.content))
+            (httplib.OK, {'generation': 1}),
+            (response.status_code, json.loads(response.content)))
         self.assertEqual(
             [(new_leases.keys()[0], new_leases.values()[0])],
             Omshell.create.extract_args())
@@ -4154,10 +4293,66 @@ class TestNodeGroupAPI(APITestCase):
                 'leases': json.dumps(factory.make_random_leases()),
             })
         self.assertEqual(
-            (httplib.OK, "Leases updated."),
-            (response.status_code, response.content))
+            (httplib.OK, {'generation': 1}),
+            (response.status_code, json.loads(response.content)))
         self.assertEqual([], tasks.add_new_dhcp_host_map.calls)
 
+    def test_update_leases_applies_lease_changes(self):
+        self.patch(Omshell, 'create')
+        nodegroup = factory.make_node_group()
+        removed_lease = factory.make_dhcp_lease(nodegroup=nodegroup)
+        kept_lease = factory.make_dhcp_lease(nodegroup=nodegroup)
+        new_leases = factory.make_random_leases()
+        client = make_worker_client(nodegroup)
+        response = client.post(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {
+                'op': 'update_leases',
+                'generation': 0,
+                'added': json.dumps(new_leases),
+                'removed': json.dumps([removed_lease.ip]),
+            })
+        self.assertEqual(
+            (httplib.OK, {'generation': 1}),
+            (response.status_code, json.loads(response.content)))
+        self.assertItemsEqual(
+            [kept_lease.ip] + new_leases.keys(),
+            [lease.ip for lease in DHCPLease.objects.filter(
+                nodegroup=nodegroup)])
+
+    def test_update_leases_adds_changed_leases_on_worker(self):
+        nodegroup = factory.make_node_group()
+        client = make_worker_client(nodegroup)
+        self.patch(Omshell, 'create', FakeMethod())
+        new_leases = factory.make_random_leases()
+        client.post(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {
+                'op': 'update_leases',
+                'generation': 0,
+                'added': json.dumps(new_leases),
+                'removed': json.dumps([]),
+            })
+        self.assertEqual(new_leases.items(), Omshell.create.extract_args())
+
+    def test_update_leases_rejects_changes_to_stale_generation(self):
+        nodegroup = factory.make_node_group()
+        client = make_worker_client(nodegroup)
+        DHCPLease.objects.update_leases(nodegroup, {})
+        response = client.post(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {
+                'op': 'update_leases',
+                'generation': 0,
+                'added': json.dumps(factory.make_random_leases()),
+                'removed': json.dumps([]),
+            })
+        self.assertEqual(
+            httplib.CONFLICT, response.status_code,
+            explain_unexpected_response(httplib.CONFLICT, response))
+        self.assertItemsEqual(
+            [], DHCPLease.objects.filter(nodegroup=nodegroup))
+
     def test_worker_calls_update_leases(self):
         # In bug 1041158, the worker's upload_leases task tried to call
         # the update_leases API at the wrong URL path.  It has the right
@@ -4167,6 +4362,8 @@ class TestNodeGroupAPI(APITestCase):
         nodegroup = factory.make_node_group(status=NODEGROUP_STATUS.ACCEPTED)
         refresh_worker(nodegroup)
         self.patch(MAASClient, 'post', Mock())
+        MAASClient.post.return_value.read.return_value = json.dumps(
+            {'generation': 1})
         leases = factory.make_random_leases()
         send_leases(leases)
         nodegroup_path = reverse(
@@ -4341,6 +4538,22 @@ class TestNodeGroupAPIAuth(APIv10TestMixin, TestCase):
         parsed_result = json.loads(response.content)
         self.assertItemsEqual([node.system_id], parsed_result)
 
+    def test_nodegroup_list_nodes_lists_nodes_with_tag(self):
+        nodegroup = factory.make_node_group()
+        tag = factory.make_tag(definition='')
+        node = factory.make_node(nodegroup=nodegroup)
+        node.tags.add(tag)
+        factory.make_node(nodegroup=nodegroup)
+        client = make_worker_client(nodegroup)
+        response = client.get(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {'op': 'list_nodes', 'tag': tag.name})
+        self.assertEqual(
+            httplib.OK, response.status_code,
+            explain_unexpected_response(httplib.OK, response))
+        parsed_result = json.loads(response.content)
+        self.assertItemsEqual([node.system_id], parsed_result)
+
     def test_nodegroup_list_nodes_works_for_admin(self):
         nodegroup = factory.make_node_group()
         admin = factory.make_admin()
@@ -4457,6 +4670,161 @@ class TestNodeGroupAPIAuth(APIv10TestMixin, TestCase):
         node_system_id = parsed_result[0][0]
         self.assertEqual([[node_system_id, None]], parsed_result)
 
+    def stream_node_hardware_details(self, client, nodegroup, nodes,
+                                     accept_encoding='gzip'):
+        return client.post(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {'op': 'stream_node_hardware_details',
+             'system_ids': [node.system_id for node in nodes]},
+            HTTP_ACCEPT_ENCODING=accept_encoding)
+
+    def parse_streamed_details(self, response):
+        self.assertEqual('gzip', response['Content-Encoding'])
+        content = zlib.decompress(response.content, 16 + zlib.MAX_WBITS)
+        return [json.loads(line) for line in content.splitlines()]
+
+    def test_stream_node_hardware_details_refuses_nonworker(self):
+        log_in_as_normal_user(self.client)
+        nodegroup = factory.make_node_group()
+        node = factory.make_node(nodegroup=nodegroup)
+        response = self.stream_node_hardware_details(
+            self.client, nodegroup, [node])
+        self.assertEqual(
+            httplib.FORBIDDEN, response.status_code,
+            explain_unexpected_response(httplib.FORBIDDEN, response))
+
+    def test_stream_node_hardware_details_streams_records(self):
+        self.patch(api, 'HARDWARE_DETAILS_STREAM_BATCH_SIZE', 2)
+        nodegroup = factory.make_node_group()
+        nodes = [factory.make_node(nodegroup=nodegroup) for i in range(3)]
+        response = self.stream_node_hardware_details(
+            make_worker_client(nodegroup), nodegroup, nodes)
+        self.assertEqual(httplib.OK, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertItemsEqual(
+            [[node.system_id, None] for node in nodes],
+            self.parse_streamed_details(response))
+
+    def test_stream_node_hardware_details_compresses_only_if_accepted(self):
+        nodegroup = factory.make_node_group()
+        node = factory.make_node(nodegroup=nodegroup)
+        response = self.stream_node_hardware_details(
+            make_worker_client(nodegroup), nodegroup, [node],
+            accept_encoding='identity')
+        self.assertEqual(httplib.OK, response.status_code)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(
+            [[node.system_id, None]],
+            [json.loads(line) for line in response.content.splitlines()])
+
+    def test_stream_node_hardware_details_does_not_see_other_groups(self):
+        nodegroup_mine = factory.make_node_group()
+        node_mine = factory.make_node(nodegroup=nodegroup_mine)
+        node_theirs = factory.make_node()
+        response = self.stream_node_hardware_details(
+            make_worker_client(nodegroup_mine), nodegroup_mine,
+            [node_mine, node_theirs])
+        self.assertEqual(httplib.OK, response.status_code)
+        self.assertEqual(
+            [[node_mine.system_id, None]],
+            self.parse_streamed_details(response))
+
+    def test_list_power_parameters_refuses_nonworker(self):
+        log_in_as_normal_user(self.client)
+        nodegroup = factory.make_node_group()
+        response = self.client.get(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {'op': 'list_power_parameters'})
+        self.assertEqual(
+            httplib.FORBIDDEN, response.status_code,
+            explain_unexpected_response(httplib.FORBIDDEN, response))
+
+    def test_list_power_parameters_lists_queryable_nodes(self):
+        nodegroup = factory.make_node_group()
+        node = factory.make_node(
+            nodegroup=nodegroup, power_type=POWER_TYPE.VIRSH,
+            power_parameters={'power_address': 'qemu://example.com/'})
+        factory.make_node(
+            nodegroup=nodegroup, power_type=POWER_TYPE.WAKE_ON_LAN)
+        factory.make_node(power_type=POWER_TYPE.VIRSH)
+        response = make_worker_client(nodegroup).get(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {'op': 'list_power_parameters'})
+        self.assertEqual(
+            httplib.OK, response.status_code,
+            explain_unexpected_response(httplib.OK, response))
+        self.assertEqual(
+            [{
+                'system_id': node.system_id,
+                'power_type': POWER_TYPE.VIRSH,
+                'power_parameters': node.get_effective_power_parameters(),
+                'power_state': POWER_STATE.UNKNOWN,
+            }],
+            json.loads(response.content))
+
+    def test_list_power_parameters_skips_nodes_without_power_config(self):
+        Config.objects.set_config('node_power_type', POWER_TYPE.DEFAULT)
+        nodegroup = factory.make_node_group()
+        node = factory.make_node(
+            nodegroup=nodegroup, power_type=POWER_TYPE.VIRSH,
+            power_parameters={'power_address': 'qemu://example.com/'})
+        factory.make_node(nodegroup=nodegroup, power_type=POWER_TYPE.VIRSH)
+        factory.make_node(
+            nodegroup=nodegroup, power_type=POWER_TYPE.DEFAULT,
+            power_parameters={'power_address': 'qemu://example.com/'})
+        response = make_worker_client(nodegroup).get(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {'op': 'list_power_parameters'})
+        self.assertEqual(
+            httplib.OK, response.status_code,
+            explain_unexpected_response(httplib.OK, response))
+        self.assertEqual(
+            [node.system_id],
+            [item['system_id'] for item in json.loads(response.content)])
+
+    def test_update_power_states_refuses_other_worker(self):
+        nodegroup = factory.make_node_group()
+        response = make_worker_client(factory.make_node_group()).post(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {'op': 'update_power_states', 'states': json.dumps({})})
+        self.assertEqual(
+            httplib.FORBIDDEN, response.status_code,
+            explain_unexpected_response(httplib.FORBIDDEN, response))
+
+    def test_update_power_states_records_power_states(self):
+        nodegroup = factory.make_node_group()
+        nodes = [factory.make_node(nodegroup=nodegroup) for i in range(2)]
+        response = make_worker_client(nodegroup).post(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {
+                'op': 'update_power_states',
+                'states': json.dumps({
+                    nodes[0].system_id: POWER_STATE.ON,
+                    nodes[1].system_id: POWER_STATE.ERROR,
+                    }),
+            })
+        self.assertEqual(
+            httplib.OK, response.status_code,
+            explain_unexpected_response(httplib.OK, response))
+        self.assertEqual(
+            [POWER_STATE.ON, POWER_STATE.ERROR],
+            [reload_object(node).power_state for node in nodes])
+
+    def test_update_power_states_rejects_unknown_state(self):
+        nodegroup = factory.make_node_group()
+        node = factory.make_node(nodegroup=nodegroup)
+        response = make_worker_client(nodegroup).post(
+            reverse('nodegroup_handler', args=[nodegroup.uuid]),
+            {
+                'op': 'update_power_states',
+                'states': json.dumps({node.system_id: 'sideways'}),
+            })
+        self.assertEqual(
+            httplib.BAD_REQUEST, response.status_code,
+            explain_unexpected_response(httplib.BAD_REQUEST, response))
+        self.assertEqual(POWER_STATE.UNKNOWN, reload_object(node).power_state)
+
 
 class TestBootImagesAPI(APITestCase):
 
@@ -28,6 +28,7 @@ from maasserver.enum import (
     NODEGROUPINTERFACE_MANAGEMENT,
     )
 from provisioningserver import tasks
+from provisioningserver.dns import config as dns_config_module
 from testtools.matchers import (
     FileExists,
     )
@@ -41,6 +42,7 @@ class TestWriteDNSConfigCommand(TestCase):
         self.patch(settings, 'DNS_CONNECT', True)
         # Prevent rndc task dispatch.
         self.patch(tasks, "rndc_command")
+        self.patch(dns_config_module, "execute_rndc_command")
         domain = factory.getRandomString()
         factory.make_node_group(
             name=domain,
@@ -13,9 +13,12 @@ __metaclass__ = type
 __all__ = []
 
 from maasserver import dns
+from maasserver.exceptions import LeasesOutOfSync
 from maasserver.models import DHCPLease
+from maasserver.models.dhcplease import escape_copy_value
 from maasserver.testing.factory import factory
 from maasserver.testing.testcase import TestCase
+from maasserver.testing import reload_object
 from maasserver.utils import ignore_unused
 
 
@@ -46,6 +49,18 @@ class TestDHCPLease(TestCase):
         self.assertEqual(mac, lease.mac)
 
 
+class TestEscapeCopyValue(TestCase):
+    """Tests for :func:`escape_copy_value`."""
+
+    def test_leaves_normal_values_alone(self):
+        ip = factory.getRandomIPAddress()
+        self.assertEqual(ip, escape_copy_value(ip))
+
+    def test_escapes_special_characters(self):
+        self.assertEqual(
+            "a\\\\b\\tc\\nd\\re", escape_copy_value("a\\b\tc\nd\re"))
+
+
 class TestDHCPLeaseManager(TestCase):
     """Tests for :class:`DHCPLeaseManager`."""
 
@@ -150,6 +165,24 @@ class TestDHCPLeaseManager(TestCase):
             },
             map_leases(nodegroup))
 
+    def test_update_leases_handles_many_leases(self):
+        nodegroup = factory.make_node_group()
+        leases = {
+            '10.0.%d.%d' % divmod(number, 256): factory.getRandomMACAddress()
+            for number in range(1000)
+            }
+        new_leases = DHCPLease.objects.update_leases(nodegroup, leases)
+        self.assertItemsEqual(leases.keys(), new_leases)
+        self.assertEqual(leases, map_leases(nodegroup))
+
+    def test_update_leases_can_run_repeatedly_in_one_transaction(self):
+        nodegroup = factory.make_node_group()
+        old_leases = factory.make_random_leases()
+        new_leases = factory.make_random_leases()
+        DHCPLease.objects.update_leases(nodegroup, old_leases)
+        DHCPLease.objects.update_leases(nodegroup, new_leases)
+        self.assertEqual(new_leases, map_leases(nodegroup))
+
     def test_update_leases_updates_dns_zone(self):
         self.patch(dns, 'change_dns_zones')
         nodegroup = factory.make_node_group()
@@ -163,6 +196,112 @@ class TestDHCPLeaseManager(TestCase):
         DHCPLease.objects.update_leases(nodegroup, {})
         self.assertFalse(dns.change_dns_zones.called)
 
+    def test_update_leases_starts_new_leases_generation(self):
+        nodegroup = factory.make_node_group()
+        DHCPLease.objects.update_leases(nodegroup, {})
+        DHCPLease.objects.update_leases(nodegroup, {})
+        self.assertEqual(
+            (2, 2), (
+                nodegroup.leases_generation,
+                reload_object(nodegroup).leases_generation,
+            ))
+
+    def test_update_leases_incrementally_adds_leases(self):
+        nodegroup = factory.make_node_group()
+        lease = factory.make_dhcp_lease(nodegroup=nodegroup)
+        new_leases = factory.make_random_leases(3)
+        DHCPLease.objects.update_leases_incrementally(
+            nodegroup, 0, new_leases, [])
+        expected_leases = dict(new_leases, **{lease.ip: lease.mac})
+        self.assertEqual(expected_leases, map_leases(nodegroup))
+
+    def test_update_leases_incrementally_returns_new_leases(self):
+        nodegroup = factory.make_node_group()
+        new_leases = factory.make_random_leases(3)
+        self.assertItemsEqual(
+            new_leases.keys(),
+            DHCPLease.objects.update_leases_incrementally(
+                nodegroup, 0, new_leases, []))
+
+    def test_update_leases_incrementally_replaces_reassigned_ip(self):
+        nodegroup = factory.make_node_group()
+        lease = factory.make_dhcp_lease(nodegroup=nodegroup)
+        new_mac = factory.getRandomMACAddress()
+        DHCPLease.objects.update_leases_incrementally(
+            nodegroup, 0, {lease.ip: new_mac}, [])
+        self.assertEqual({lease.ip: new_mac}, map_leases(nodegroup))
+
+    def test_update_leases_incrementally_deletes_removed_leases(self):
+        nodegroup = factory.make_node_group()
+        removed_lease = factory.make_dhcp_lease(nodegroup=nodegroup)
+        kept_lease = factory.make_dhcp_lease(nodegroup=nodegroup)
+        DHCPLease.objects.update_leases_incrementally(
+            nodegroup, 0, {}, [removed_lease.ip])
+        self.assertEqual(
+            {kept_lease.ip: kept_lease.mac}, map_leases(nodegroup))
+
+    def test_update_leases_incrementally_leaves_other_nodegroups_alone(self):
+        innocent_lease = factory.make_dhcp_lease()
+        DHCPLease.objects.update_leases_incrementally(
+            factory.make_node_group(), 0, {}, [innocent_lease.ip])
+        self.assertItemsEqual(
+            [innocent_lease], get_leases(innocent_lease.nodegroup))
+
+    def test_update_leases_incrementally_starts_new_leases_generation(self):
+        nodegroup = factory.make_node_group()
+        DHCPLease.objects.update_leases_incrementally(nodegroup, 0, {}, [])
+        DHCPLease.objects.update_leases_incrementally(nodegroup, 1, {}, [])
+        self.assertEqual(
+            (2, 2), (
+                nodegroup.leases_generation,
+                reload_object(nodegroup).leases_generation,
+            ))
+
+    def test_update_leases_incrementally_rejects_stale_generation(self):
+        nodegroup = factory.make_node_group()
+        lease = factory.make_dhcp_lease(nodegroup=nodegroup)
+        DHCPLease.objects.update_leases(nodegroup, {lease.ip: lease.mac})
+        self.assertRaises(
+            LeasesOutOfSync,
+            DHCPLease.objects.update_leases_incrementally,
+            nodegroup, 0, {}, [lease.ip])
+        self.assertEqual(
+            ({lease.ip: lease.mac}, 1),
+            (
+                map_leases(nodegroup),
+                reload_object(nodegroup).leases_generation,
+            ))
+
+    def test_update_leases_incrementally_updates_dns_records(self):
+        self.patch(dns, 'change_dns_records')
+        self.patch(dns, 'change_dns_zones')
+        nodegroup = factory.make_node_group()
+        leases = factory.make_random_leases()
+        DHCPLease.objects.update_leases_incrementally(
+            nodegroup, 0, leases, [])
+        dns.change_dns_records.assert_called_once_with(
+            nodegroup, list(leases), removed_hostnames=[])
+        self.assertFalse(dns.change_dns_zones.called)
+
+    def test_update_leases_incrementally_removes_released_dns_records(self):
+        nodegroup = factory.make_node_group()
+        node = factory.make_node(nodegroup=nodegroup)
+        mac = factory.make_mac_address(node=node)
+        lease = factory.make_dhcp_lease(
+            nodegroup=nodegroup, mac=mac.mac_address)
+        self.patch(dns, 'change_dns_records')
+        DHCPLease.objects.update_leases_incrementally(
+            nodegroup, 0, {}, [lease.ip])
+        dns.change_dns_records.assert_called_once_with(
+            nodegroup, [], removed_hostnames=[node.hostname])
+
+    def test_update_leases_incrementally_skips_dns_if_nothing_added(self):
+        self.patch(dns, 'change_dns_records')
+        lease = factory.make_dhcp_lease()
+        DHCPLease.objects.update_leases_incrementally(
+            lease.nodegroup, 0, {}, [lease.ip])
+        self.assertFalse(dns.change_dns_records.called)
+
     def test_get_hostname_ip_mapping_returns_mapping(self):
         nodegroup = factory.make_node_group()
         expected_mapping = {}
@@ -202,6 +341,41 @@ class TestDHCPLeaseManager(TestCase):
         mapping = DHCPLease.objects.get_hostname_ip_mapping(nodegroup)
         self.assertEqual({}, mapping)
 
+    def test_get_hostname_ip_mapping_considers_only_given_ips(self):
+        nodegroup = factory.make_node_group()
+        leases = []
+        for i in range(2):
+            node = factory.make_node(nodegroup=nodegroup)
+            mac = factory.make_mac_address(node=node)
+            lease = factory.make_dhcp_lease(
+                nodegroup=nodegroup, mac=mac.mac_address)
+            leases.append((node.hostname, lease.ip))
+        (hostname, ip), (other_hostname, other_ip) = leases
+        self.assertEqual(
+            ({hostname: ip}, {}),
+            (
+                DHCPLease.objects.get_hostname_ip_mapping(nodegroup, [ip]),
+                DHCPLease.objects.get_hostname_ip_mapping(nodegroup, []),
+            ))
+
+    def test_get_hostname_ip_mappings_maps_each_nodegroup(self):
+        nodegroups = [factory.make_node_group() for i in range(3)]
+        expected_mappings = {}
+        for nodegroup in nodegroups[:2]:
+            node = factory.make_node(nodegroup=nodegroup)
+            mac = factory.make_mac_address(node=node)
+            lease = factory.make_dhcp_lease(
+                nodegroup=nodegroup, mac=mac.mac_address)
+            expected_mappings[nodegroup.id] = {node.hostname: lease.ip}
+        with self.assertNumQueries(1):
+            mappings = DHCPLease.objects.get_hostname_ip_mappings(nodegroups)
+        self.assertEqual(expected_mappings, mappings)
+
+    def test_get_hostname_ip_mappings_without_nodegroups(self):
+        with self.assertNumQueries(0):
+            mappings = DHCPLease.objects.get_hostname_ip_mappings([])
+        self.assertEqual({}, mappings)
+
     def test_get_hostname_ip_mapping_considers_given_nodegroup(self):
         nodegroup = factory.make_node_group()
         node = factory.make_node(
@@ -17,6 +17,7 @@ from functools import partial
 from itertools import islice
 import logging
 import socket
+import threading
 
 from celery.task import task
 from django.conf import settings
@@ -29,7 +30,10 @@ from maasserver.enum import (
     NODEGROUP_STATUS,
     NODEGROUPINTERFACE_MANAGEMENT,
     )
-from maasserver.models import node as node_module
+from maasserver.models import (
+    node as node_module,
+    NodeGroup,
+    )
 from maasserver.testing.factory import factory
 from maasserver.testing.testcase import TestCase
 from maastesting.bindfixture import BINDServer
@@ -60,6 +64,7 @@ from testtools.matchers import (
     MatchesListwise,
     MatchesStructure,
     )
+from testtools.testcase import ExpectedException
 
 
 class TestDNSUtilities(TestCase):
@@ -150,6 +155,244 @@ class TestDNSUtilities(TestCase):
         self.assertEqual(nodegroups_with_expected_results, results)
 
 
+class TestDNSChangeScheduler(TestCase):
+
+    def patch_changes(self):
+        """Patch out the functions that make the DNS changes.
+
+        Do this after creating any node groups, whose creation changes
+        DNS as well.
+        """
+        return {
+            name: self.patch(dns, '_%s' % name, Mock())
+            for name in [
+                'change_dns_zones', 'change_dns_records', 'add_zones',
+                'write_full_dns_config',
+                ]
+            }
+
+    def test_makes_changes_straight_away_outside_batch(self):
+        scheduler = dns.DNSChangeScheduler()
+        nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        scheduler.change_zones([nodegroup])
+        scheduler.change_records(nodegroup, ['10.0.0.1'])
+        scheduler.add_zone(nodegroup)
+        scheduler.write_full_config(reload_retry=True)
+        self.assertEqual(
+            (
+                [call([nodegroup])],
+                [call(nodegroup, ['10.0.0.1'], ())],
+                [call([nodegroup])],
+                [call(reload_retry=True, force=False)],
+            ),
+            (
+                changes['change_dns_zones'].mock_calls,
+                changes['change_dns_records'].mock_calls,
+                changes['add_zones'].mock_calls,
+                changes['write_full_dns_config'].mock_calls,
+            ))
+        self.assertEqual(scheduler.requested, scheduler.executed)
+
+    def test_batch_changes_each_zone_once(self):
+        scheduler = dns.DNSChangeScheduler()
+        nodegroups = [factory.make_node_group() for i in range(3)]
+        changes = self.patch_changes()
+        with scheduler.batch():
+            for nodegroup in nodegroups * 2:
+                scheduler.change_zones(nodegroup)
+            self.assertEqual(
+                [], changes['change_dns_zones'].mock_calls)
+        changes['change_dns_zones'].assert_called_once_with(set(nodegroups))
+        self.assertEqual(
+            (6, 1),
+            (
+                scheduler.requested['change_dns_zones'],
+                scheduler.executed['change_dns_zones'],
+            ))
+
+    def test_batch_full_config_supersedes_other_changes(self):
+        scheduler = dns.DNSChangeScheduler()
+        nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        with scheduler.batch():
+            scheduler.change_zones([nodegroup])
+            scheduler.add_zone(nodegroup)
+            scheduler.change_records(nodegroup, ['10.0.0.1'])
+            scheduler.write_full_config(reload_retry=True)
+            scheduler.write_full_config(force=True)
+        self.assertEqual(
+            ([], [], [], [call(reload_retry=True, force=True)]),
+            (
+                changes['change_dns_zones'].mock_calls,
+                changes['change_dns_records'].mock_calls,
+                changes['add_zones'].mock_calls,
+                changes['write_full_dns_config'].mock_calls,
+            ))
+
+    def test_batch_does_not_change_added_zones_again(self):
+        scheduler = dns.DNSChangeScheduler()
+        added_nodegroup = factory.make_node_group()
+        changed_nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        with scheduler.batch():
+            scheduler.add_zone(added_nodegroup)
+            scheduler.change_zones([added_nodegroup, changed_nodegroup])
+        self.assertEqual(
+            ([call({added_nodegroup})], [call({changed_nodegroup})]),
+            (
+                changes['add_zones'].mock_calls,
+                changes['change_dns_zones'].mock_calls,
+            ))
+
+    def test_batch_merges_record_changes(self):
+        scheduler = dns.DNSChangeScheduler()
+        nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        with scheduler.batch():
+            scheduler.change_records(nodegroup, ['10.0.0.1'])
+            scheduler.change_records(nodegroup, ['10.0.0.2'])
+        changes['change_dns_records'].assert_called_once_with(
+            nodegroup, {'10.0.0.1', '10.0.0.2'}, set())
+
+    def test_batch_merges_removed_hostnames(self):
+        scheduler = dns.DNSChangeScheduler()
+        nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        with scheduler.batch():
+            scheduler.change_records(nodegroup, [], ['host1'])
+            scheduler.change_records(nodegroup, ['10.0.0.2'], ['host2'])
+        changes['change_dns_records'].assert_called_once_with(
+            nodegroup, {'10.0.0.2'}, {'host1', 'host2'})
+
+    def test_batch_skips_record_changes_for_rewritten_zones(self):
+        scheduler = dns.DNSChangeScheduler()
+        nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        with scheduler.batch():
+            scheduler.change_records(nodegroup, ['10.0.0.1'])
+            scheduler.change_zones([nodegroup])
+        self.assertEqual([], changes['change_dns_records'].mock_calls)
+
+    def test_nested_batches_make_changes_at_the_end(self):
+        scheduler = dns.DNSChangeScheduler()
+        nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        with scheduler.batch():
+            with scheduler.batch():
+                scheduler.change_zones([nodegroup])
+            self.assertEqual([], changes['change_dns_zones'].mock_calls)
+        changes['change_dns_zones'].assert_called_once_with({nodegroup})
+
+    def test_failed_batch_drops_changes(self):
+        scheduler = dns.DNSChangeScheduler()
+        nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        with ExpectedException(ZeroDivisionError):
+            with scheduler.batch():
+                scheduler.change_zones([nodegroup])
+                1 / 0
+        self.assertEqual(
+            ([], 0),
+            (
+                changes['change_dns_zones'].mock_calls,
+                scheduler.executed['change_dns_zones'],
+            ))
+        # The next change is made straight away.
+        scheduler.change_zones([nodegroup])
+        changes['change_dns_zones'].assert_called_once_with([nodegroup])
+
+    def test_batches_are_per_thread(self):
+        scheduler = dns.DNSChangeScheduler()
+        nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        with scheduler.batch():
+            thread = threading.Thread(
+                target=scheduler.change_zones, args=([nodegroup], ))
+            thread.start()
+            thread.join()
+            changes['change_dns_zones'].assert_called_once_with([nodegroup])
+
+    def test_dns_functions_use_scheduler(self):
+        nodegroup = factory.make_node_group()
+        changes = self.patch_changes()
+        with dns.dns_change_scheduler.batch():
+            dns.change_dns_zones(nodegroup)
+            dns.change_dns_zones(nodegroup)
+            self.assertEqual([], changes['change_dns_zones'].mock_calls)
+        changes['change_dns_zones'].assert_called_once_with({nodegroup})
+
+
+class TestChangeDNSRecords(TestCase):
+
+    def make_leased_node(self, nodegroup):
+        node = factory.make_node(nodegroup=nodegroup)
+        mac = factory.make_mac_address(node=node)
+        lease = factory.make_dhcp_lease(
+            nodegroup=nodegroup, mac=mac.mac_address)
+        return node, lease
+
+    def test_change_dns_records_updates_only_given_ips(self):
+        nodegroup = factory.make_node_group(
+            status=NODEGROUP_STATUS.ACCEPTED,
+            management=NODEGROUPINTERFACE_MANAGEMENT.DHCP_AND_DNS)
+        node, lease = self.make_leased_node(nodegroup)
+        self.make_leased_node(nodegroup)
+        self.patch(settings, 'DNS_CONNECT', True)
+        update_task = self.patch(tasks, 'update_dns_zone_records')
+        dns.change_dns_records(nodegroup, [lease.ip])
+        [zone] = update_task.delay.call_args[1]['zones']
+        self.assertEqual(
+            (nodegroup.name, {node.hostname: lease.ip}),
+            (zone.domain, zone.mapping))
+
+    def test_change_dns_records_removes_released_hosts(self):
+        nodegroup = factory.make_node_group(
+            status=NODEGROUP_STATUS.ACCEPTED,
+            management=NODEGROUPINTERFACE_MANAGEMENT.DHCP_AND_DNS)
+        self.patch(settings, 'DNS_CONNECT', True)
+        update_task = self.patch(tasks, 'update_dns_zone_records')
+        hostname = factory.make_name('host')
+        dns.change_dns_records(nodegroup, [], [hostname])
+        [zone] = update_task.delay.call_args[1]['zones']
+        self.assertEqual(
+            (nodegroup.name, {}, [hostname]),
+            (zone.domain, zone.mapping, zone.removed_hostnames))
+
+    def test_change_dns_records_keeps_hosts_with_new_leases(self):
+        nodegroup = factory.make_node_group(
+            status=NODEGROUP_STATUS.ACCEPTED,
+            management=NODEGROUPINTERFACE_MANAGEMENT.DHCP_AND_DNS)
+        node, lease = self.make_leased_node(nodegroup)
+        self.patch(settings, 'DNS_CONNECT', True)
+        update_task = self.patch(tasks, 'update_dns_zone_records')
+        dns.change_dns_records(nodegroup, [lease.ip], [node.hostname])
+        [zone] = update_task.delay.call_args[1]['zones']
+        self.assertEqual(
+            ({node.hostname: lease.ip}, []),
+            (zone.mapping, zone.removed_hostnames))
+
+    def test_change_dns_records_skips_unmanaged_nodegroup(self):
+        nodegroup = factory.make_node_group(
+            status=NODEGROUP_STATUS.ACCEPTED,
+            management=NODEGROUPINTERFACE_MANAGEMENT.DHCP)
+        node, lease = self.make_leased_node(nodegroup)
+        self.patch(settings, 'DNS_CONNECT', True)
+        update_task = self.patch(tasks, 'update_dns_zone_records')
+        dns.change_dns_records(nodegroup, [lease.ip])
+        self.assertEqual(0, update_task.delay.call_count)
+
+    def test_change_dns_records_skips_if_no_node_has_ips(self):
+        nodegroup = factory.make_node_group(
+            status=NODEGROUP_STATUS.ACCEPTED,
+            management=NODEGROUPINTERFACE_MANAGEMENT.DHCP_AND_DNS)
+        lease = factory.make_dhcp_lease(nodegroup=nodegroup)
+        self.patch(settings, 'DNS_CONNECT', True)
+        update_task = self.patch(tasks, 'update_dns_zone_records')
+        dns.change_dns_records(nodegroup, [lease.ip])
+        self.assertEqual(0, update_task.delay.call_count)
+
+
 class TestDNSConfigModifications(TestCase):
 
     resources = (
@@ -163,6 +406,8 @@ class TestDNSConfigModifications(TestCase):
 
         # Use a random port for rndc.
         self.patch(conf, 'DNS_RNDC_PORT', allocate_ports(1)[0])
+        # Send dynamic updates to the test server.
+        self.patch(conf, 'DNS_SERVER_PORT', self.bind.config.port)
         # This simulates what should happen when the package is
         # installed:
         # Create MAAS-specific DNS configuration files.
@@ -250,6 +495,17 @@ class TestDNSConfigModifications(TestCase):
         dns.change_dns_zones(nodegroup)
         self.assertDNSMatches(new_node.hostname, nodegroup.name, new_lease.ip)
 
+    def test_change_dns_records_updates_dns_records(self):
+        nodegroup, _, _ = self.create_nodegroup_with_lease()
+        self.patch(settings, 'DNS_CONNECT', True)
+        dns.write_full_dns_config()
+        self.patch(dns, 'change_dns_zones')
+        nodegroup, new_node, new_lease = (
+            self.create_nodegroup_with_lease(
+                nodegroup=nodegroup, lease_number=2))
+        dns.change_dns_records(nodegroup, [new_lease.ip])
+        self.assertDNSMatches(new_node.hostname, nodegroup.name, new_lease.ip)
+
     def test_is_dns_enabled_return_false_if_DNS_CONNECT_False(self):
         self.patch(settings, 'DNS_CONNECT', False)
         self.assertFalse(dns.is_dns_enabled())
@@ -464,3 +720,20 @@ class TestZoneGenerator(TestCase):
         self.assertThat(
             dns.ZoneGenerator(nodegroups).as_list(),
             MatchesListwise(expected_zones))
+
+    def test_number_of_queries_does_not_depend_on_nodegroups(self):
+        nodegroups = [
+            self.make_node_group(
+                name="one", network=IPNetwork("10.0.%d.0/24" % i))
+            for i in range(5)
+            ]
+        for nodegroup in nodegroups:
+            node = factory.make_node(nodegroup=nodegroup)
+            mac = factory.make_mac_address(node=node)
+            factory.make_dhcp_lease(nodegroup=nodegroup, mac=mac.mac_address)
+        nodegroups = NodeGroup.objects.all()
+        # The given nodegroups, the forward nodegroups and their
+        # interfaces, the leases, and a serial.
+        with self.assertNumQueries(5):
+            zones = dns.ZoneGenerator(nodegroups).as_list()
+        self.assertEqual(6, len(zones))
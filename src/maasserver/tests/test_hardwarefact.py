@@ -0,0 +1,152 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Tests for `HardwareFact`."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = []
+
+from lxml import etree
+from maasserver.models import (
+    HardwareFact,
+    Node,
+    )
+from maasserver.models.hardwarefact import (
+    extract_hardware_facts,
+    get_facts_query,
+    )
+from maasserver.testing.factory import factory
+from maasserver.testing.testcase import TestCase
+
+
+lshw_output = """\
+<list>
+  <node id="core" class="bus">
+    <product>Motherboard</product>
+    <node id="cpu:0" class="processor">
+      <vendor>Intel Corp.</vendor>
+      <product>Xeon</product>
+      <size units="Hz">2400000000</size>
+      <capabilities>
+        <capability id="vmx">Virtualisation</capability>
+        <capability id="x86-64">64bits extensions</capability>
+      </capabilities>
+    </node>
+    <node id="memory" class="memory">
+      <size units="bytes">4294967296</size>
+    </node>
+    <node id="network" class="network">
+      <vendor>Broadcom Corporation</vendor>
+    </node>
+  </node>
+</list>
+"""
+
+
+def make_fact(**fields):
+    fact = dict.fromkeys(
+        ['lshw_id', 'lshw_class', 'vendor', 'product', 'size', 'units',
+         'capability'])
+    fact.update(fields)
+    return fact
+
+
+class TestExtractHardwareFacts(TestCase):
+
+    def test_extracts_devices_and_capabilities(self):
+        facts = list(extract_hardware_facts(etree.XML(lshw_output)))
+        cpu = make_fact(
+            lshw_id='cpu:0', lshw_class='processor', vendor='Intel Corp.',
+            product='Xeon', size=2400000000, units='Hz')
+        self.assertEqual(
+            [
+                make_fact(
+                    lshw_id='core', lshw_class='bus', product='Motherboard'),
+                cpu,
+                dict(cpu, capability='vmx'),
+                dict(cpu, capability='x86-64'),
+                make_fact(
+                    lshw_id='memory', lshw_class='memory', size=4294967296,
+                    units='bytes'),
+                make_fact(
+                    lshw_id='network', lshw_class='network',
+                    vendor='Broadcom Corporation'),
+            ],
+            facts)
+
+    def test_leaves_out_values_too_long_to_store(self):
+        doc = etree.XML(
+            '<node id="%s"><vendor>%s</vendor></node>'
+            % ('x' * 256, 'y' * 256))
+        self.assertEqual(
+            [make_fact()], list(extract_hardware_facts(doc)))
+
+    def test_leaves_out_invalid_sizes(self):
+        doc = etree.XML('<node><size units="bytes">lots</size></node>')
+        self.assertEqual(
+            [make_fact(units='bytes')], list(extract_hardware_facts(doc)))
+
+
+class TestHardwareFactManager(TestCase):
+
+    def test_update_facts_replaces_facts(self):
+        node = factory.make_node()
+        HardwareFact.objects.update_facts(
+            node, etree.XML('<node id="old" />'))
+        HardwareFact.objects.update_facts(
+            node, etree.XML('<node id="new" />'))
+        self.assertEqual(
+            ['new'],
+            list(HardwareFact.objects.filter(node=node).values_list(
+                'lshw_id', flat=True)))
+
+
+class TestGetFactsQuery(TestCase):
+
+    supported_definitions = [
+        "//node",
+        "//node[@class='processor']",
+        '//node[@class="processor"]',
+        "//node[@id='cpu:0' and vendor='Intel Corp.']",
+        "//node[@class='processor'][product='Xeon']",
+        "//node[vendor='Broadcom Corporation']",
+        "//node[@class='memory' and vendor='Broadcom Corporation']",
+        "//node[@class='processor']/capabilities/capability[@id='vmx']",
+        "//node[@class='network']/capabilities/capability[@id='vmx']",
+        "//capability[@id='x86-64']",
+        "//capability[@id='missing']",
+        ]
+
+    unsupported_definitions = [
+        "/list/node",
+        "count(//node) > 1",
+        "//node[@class='processor' or @class='memory']",
+        "//node[@class='processor'][@class='memory']",
+        "//node[size > 1024]",
+        "//node[vendor='%s']" % ('x' * 256),
+        ]
+
+    def test_compiles_supported_definitions(self):
+        for definition in self.supported_definitions:
+            self.assertIsNotNone(get_facts_query(definition), definition)
+
+    def test_does_not_compile_unsupported_definitions(self):
+        for definition in self.unsupported_definitions:
+            self.assertIsNone(get_facts_query(definition), definition)
+
+    def test_query_matches_like_xpath(self):
+        doc = etree.XML(lshw_output)
+        node = factory.make_node()
+        HardwareFact.objects.update_facts(node, doc)
+        factory.make_node()
+        for definition in self.supported_definitions:
+            expected = [node] if etree.XPath(definition)(doc) else []
+            self.assertItemsEqual(
+                expected, Node.objects.filter(get_facts_query(definition)),
+                definition)
@@ -21,7 +21,13 @@ from django.core.exceptions import (
     PermissionDenied,
     ValidationError,
     )
+from django.http import HttpResponse
 from django.test.client import RequestFactory
+from maasserver import (
+    dns,
+    pxeconfig_connect,
+    )
+from maasserver.api_support import StreamingResponse
 from maasserver.exceptions import (
     ExternalComponentException,
     MAASAPIException,
@@ -30,9 +36,12 @@ from maasserver.exceptions import (
     )
 from maasserver.middleware import (
     APIErrorsMiddleware,
+    DNSChangesMiddleware,
     ErrorsMiddleware,
     ExceptionLoggerMiddleware,
     ExceptionMiddleware,
+    GZipMiddleware,
+    PXEConfigInvalidationMiddleware,
     )
 from maasserver.testing import extract_redirect
 from maasserver.testing.factory import factory
@@ -40,6 +49,7 @@ from maasserver.testing.testcase import (
     LoggedInTestCase,
     TestCase,
     )
+from mock import Mock
 from testtools.matchers import (
     Contains,
     FileContains,
@@ -176,6 +186,81 @@ class APIErrorsMiddlewareTest(TestCase):
             middleware.process_exception(non_api_request, exception))
 
 
+class DNSChangesMiddlewareTest(TestCase):
+
+    def test_makes_dns_changes_once_request_is_done(self):
+        change_dns_zones = self.patch(dns, '_change_dns_zones', Mock())
+        nodegroups = [factory.make_node_group() for i in range(2)]
+        middleware = DNSChangesMiddleware()
+        request = fake_request(factory.getRandomString())
+        middleware.process_request(request)
+        for nodegroup in nodegroups:
+            dns.change_dns_zones(nodegroup)
+        self.assertEqual([], change_dns_zones.mock_calls)
+        response = HttpResponse()
+        self.assertIs(response, middleware.process_response(request, response))
+        change_dns_zones.assert_called_once_with(set(nodegroups))
+
+    def test_drops_dns_changes_if_request_fails(self):
+        change_dns_zones = self.patch(dns, '_change_dns_zones', Mock())
+        middleware = DNSChangesMiddleware()
+        request = fake_request(factory.getRandomString())
+        middleware.process_request(request)
+        dns.change_dns_zones(factory.make_node_group())
+        middleware.process_exception(request, ZeroDivisionError())
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual([], change_dns_zones.mock_calls)
+
+
+class PXEConfigInvalidationMiddlewareTest(TestCase):
+
+    def test_invalidates_pxe_configs_once_request_is_done(self):
+        invalidate = self.patch(
+            pxeconfig_connect, '_invalidate_pxe_configs', Mock())
+        nodes = [factory.make_node() for i in range(2)]
+        middleware = PXEConfigInvalidationMiddleware()
+        request = fake_request(factory.getRandomString())
+        middleware.process_request(request)
+        for node in nodes:
+            pxeconfig_connect.invalidate_pxe_configs([node])
+        self.assertEqual([], invalidate.mock_calls)
+        response = HttpResponse()
+        self.assertIs(response, middleware.process_response(request, response))
+        invalidate.assert_called_once_with({node.id for node in nodes})
+
+    def test_drops_invalidations_if_request_fails(self):
+        invalidate = self.patch(
+            pxeconfig_connect, '_invalidate_pxe_configs', Mock())
+        middleware = PXEConfigInvalidationMiddleware()
+        request = fake_request(factory.getRandomString())
+        middleware.process_request(request)
+        pxeconfig_connect.invalidate_pxe_configs([factory.make_node()])
+        middleware.process_exception(request, ZeroDivisionError())
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual([], invalidate.mock_calls)
+
+
+class GZipMiddlewareTest(TestCase):
+
+    def make_request(self):
+        return RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+
+    def test_compresses_responses(self):
+        response = HttpResponse(factory.getRandomString(500))
+        response = GZipMiddleware().process_response(
+            self.make_request(), response)
+        self.assertEqual('gzip', response['Content-Encoding'])
+
+    def test_leaves_streaming_responses_alone(self):
+        content = iter([factory.getRandomString(500)])
+        response = StreamingResponse(content)
+        self.assertIs(
+            response,
+            GZipMiddleware().process_response(self.make_request(), response))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIs(content, response._container)
+
+
 class ExceptionLoggerMiddlewareTest(TestCase):
 
     def set_up_logger(self, filename):
@@ -19,6 +19,8 @@ from django.core.exceptions import (
     PermissionDenied,
     ValidationError,
     )
+from django.core.cache import cache as django_cache
+from django.db import connection
 from maasserver.enum import (
     ARCHITECTURE,
     DISTRO_SERIES,
@@ -48,13 +50,19 @@ from maasserver.utils import (
     ignore_unused,
     map_enum,
     )
+from maastesting.celery import CeleryFixture
+from maastesting.djangotestcase import TransactionTestCase
 from maastesting.testcase import TestCase as DjangoLessTestCase
 from metadataserver import commissioning
 from metadataserver.models import (
     NodeCommissionResult,
     NodeUserData,
     )
-from provisioningserver.enum import POWER_TYPE
+import psycopg2
+from provisioningserver.enum import (
+    POWER_STATE,
+    POWER_TYPE,
+    )
 from provisioningserver.power.poweraction import PowerAction
 from testtools.matchers import (
     AllMatch,
@@ -247,6 +255,13 @@ class NodeTest(TestCase):
         self.assertEqual(
             power_types, [node.get_effective_power_type() for node in nodes])
 
+    def test_get_effective_power_type_uses_given_default(self):
+        node = factory.make_node(power_type=POWER_TYPE.DEFAULT)
+        Config.objects.set_config('node_power_type', POWER_TYPE.DEFAULT)
+        self.assertEqual(
+            POWER_TYPE.VIRSH,
+            node.get_effective_power_type(POWER_TYPE.VIRSH))
+
     def test_get_effective_power_type_rejects_default_as_config_value(self):
         node = factory.make_node(power_type=POWER_TYPE.DEFAULT)
         Config.objects.set_config('node_power_type', POWER_TYPE.DEFAULT)
@@ -284,6 +299,14 @@ class NodeTest(TestCase):
         self.assertEqual(
             mac, node.get_effective_power_parameters()['mac_address'])
 
+    def test_get_effective_power_parameters_uses_given_primary_macs(self):
+        node = factory.make_node()
+        mac = factory.getRandomMACAddress()
+        self.assertEqual(
+            mac,
+            node.get_effective_power_parameters(
+                {node.id: mac})['mac_address'])
+
     def test_get_effective_power_parameters_adds_no_mac_if_params_set(self):
         node = factory.make_node(power_parameters={'foo': 'bar'})
         mac = factory.getRandomMACAddress()
@@ -394,7 +417,7 @@ class NodeTest(TestCase):
         self.assertTrue(node.netboot)
 
     def test_release_powers_off_node(self):
-        # Test that releasing a node causes a 'power_off' celery job.
+        # Test that releasing a node causes a 'power_off_nodes' celery job.
         node = factory.make_node(
             status=NODE_STATUS.ALLOCATED, owner=factory.make_user(),
             power_type=POWER_TYPE.VIRSH)
@@ -402,7 +425,7 @@ class NodeTest(TestCase):
         self.patch(PowerAction, 'run_shell', lambda *args, **kwargs: ('', ''))
         node.release()
         self.assertEqual(
-            (1, 'provisioningserver.tasks.power_off'),
+            (1, 'provisioningserver.tasks.power_off_nodes'),
             (len(self.celery.tasks), self.celery.tasks[0]['task'].name))
 
     def test_accept_enlistment_gets_node_out_of_declared_state(self):
@@ -477,9 +500,13 @@ class NodeTest(TestCase):
             'owner': user,
         }
         self.assertAttributes(node, expected_attrs)
+        # The node's cluster is also told that its PXE config changed.
         self.assertEqual(
-            (1, 'provisioningserver.tasks.power_on'),
-            (len(self.celery.tasks), self.celery.tasks[0]['task'].name))
+            [
+                'provisioningserver.tasks.invalidate_pxe_configs',
+                'provisioningserver.tasks.power_on_nodes',
+            ],
+            [task['task'].name for task in self.celery.tasks])
 
     def test_start_commissioning_sets_user_data(self):
         node = factory.make_node(status=NODE_STATUS.DECLARED)
@@ -638,6 +665,23 @@ class NodeTest(TestCase):
         node = reload_object(node)
         self.assertEqual([], list(node.tags.all()))
 
+    def test_set_hardware_details_extracts_facts(self):
+        node = factory.make_node()
+        node.set_hardware_details('<node id="core" />')
+        self.assertEqual(
+            ['core'],
+            list(node.hardwarefact_set.values_list('lshw_id', flat=True)))
+
+    def test_hardware_updates_tags_keeps_matching_tags(self):
+        tag1 = factory.make_tag(factory.getRandomString(10), "/node")
+        tag2 = factory.make_tag(factory.getRandomString(10), "/missing")
+        node = factory.make_node()
+        node.tags = [tag1, tag2]
+        node.save()
+        node.set_hardware_details('<node/>')
+        node = reload_object(node)
+        self.assertEqual([tag1], list(node.tags.all()))
+
     def test_fqdn_returns_hostname_if_dns_not_managed(self):
         nodegroup = factory.make_node_group(
             name=factory.getRandomString(),
@@ -886,6 +930,31 @@ class NodeManagerTest(TestCase):
                 user, {'tags': "strong"})
         self.assertEqual(nodes[1], available_node)
 
+    def test_get_available_nodes_for_acquisition_limits_count(self):
+        user = factory.make_user()
+        nodes = [self.make_node() for counter in range(3)]
+        self.assertEqual(
+            nodes[:2],
+            Node.objects.get_available_nodes_for_acquisition(user, 2))
+
+    def test_get_available_nodes_for_acquisition_returns_fewer_if_short(self):
+        user = factory.make_user()
+        node = self.make_node()
+        factory.make_node(status=NODE_STATUS.ALLOCATED)
+        self.assertEqual(
+            [node], Node.objects.get_available_nodes_for_acquisition(user, 5))
+
+    def test_get_available_nodes_for_acquisition_applies_constraints(self):
+        user = factory.make_user()
+        nodes = [self.make_node() for counter in range(3)]
+        tag = factory.make_tag('strong')
+        nodes[0].tags.add(tag)
+        nodes[2].tags.add(tag)
+        self.assertEqual(
+            [nodes[0], nodes[2]],
+            Node.objects.get_available_nodes_for_acquisition(
+                user, 5, {'tags': "strong"}))
+
     def test_stop_nodes_stops_nodes(self):
         # We don't actually want to fire off power events, but we'll go
         # through the motions right up to the point where we'd normally
@@ -897,7 +966,7 @@ class NodeManagerTest(TestCase):
 
         self.assertItemsEqual([node], output)
         self.assertEqual(
-            (1, 'provisioningserver.tasks.power_off'),
+            (1, 'provisioningserver.tasks.power_off_nodes'),
             (
                 len(self.celery.tasks),
                 self.celery.tasks[0]['task'].name,
@@ -906,7 +975,7 @@ class NodeManagerTest(TestCase):
     def test_stop_nodes_task_routed_to_nodegroup_worker(self):
         user = factory.make_user()
         node, mac = self.make_node_with_mac(user, power_type=POWER_TYPE.VIRSH)
-        task = self.patch(node_module, 'power_off')
+        task = self.patch(node_module, 'power_off_nodes')
         Node.objects.stop_nodes([node.system_id], user)
         args, kwargs = task.apply_async.call_args
         self.assertEqual(node.work_queue, kwargs['queue'])
@@ -930,18 +999,18 @@ class NodeManagerTest(TestCase):
 
         self.assertItemsEqual([node], output)
         self.assertEqual(
-            (1, 'provisioningserver.tasks.power_on', mac.mac_address),
+            (1, 'provisioningserver.tasks.power_on_nodes', mac.mac_address),
             (
                 len(self.celery.tasks),
                 self.celery.tasks[0]['task'].name,
-                self.celery.tasks[0]['kwargs']['mac_address'],
+                self.celery.tasks[0]['args'][0][0][1]['mac_address'],
             ))
 
     def test_start_nodes_task_routed_to_nodegroup_worker(self):
         user = factory.make_user()
         node, mac = self.make_node_with_mac(
             user, power_type=POWER_TYPE.WAKE_ON_LAN)
-        task = self.patch(node_module, 'power_on')
+        task = self.patch(node_module, 'power_on_nodes')
         Node.objects.start_nodes([node.system_id], user)
         args, kwargs = task.apply_async.call_args
         self.assertEqual(node.work_queue, kwargs['queue'])
@@ -958,7 +1027,7 @@ class NodeManagerTest(TestCase):
 
         self.assertItemsEqual([node], output)
         self.assertEqual(
-            (1, 'provisioningserver.tasks.power_on'),
+            (1, 'provisioningserver.tasks.power_on_nodes'),
             (len(self.celery.tasks), self.celery.tasks[0]['task'].name))
 
     def test_start_nodes_wakeonlan_prefers_power_parameters(self):
@@ -973,11 +1042,11 @@ class NodeManagerTest(TestCase):
 
         self.assertItemsEqual([node], output)
         self.assertEqual(
-            (1, 'provisioningserver.tasks.power_on', preferred_mac),
+            (1, 'provisioningserver.tasks.power_on_nodes', preferred_mac),
             (
                 len(self.celery.tasks),
                 self.celery.tasks[0]['task'].name,
-                self.celery.tasks[0]['kwargs']['mac_address'],
+                self.celery.tasks[0]['args'][0][0][1]['mac_address'],
             ))
 
     def test_start_nodes_wakeonlan_ignores_invalid_parameters(self):
@@ -1052,6 +1121,104 @@ class NodeManagerTest(TestCase):
             [node.system_id], node.owner, user_data=user_data)
         self.assertEqual(user_data, NodeUserData.objects.get_user_data(node))
 
+    def test_start_nodes_sends_one_task_per_nodegroup(self):
+        user = factory.make_user()
+        nodegroups = [factory.make_node_group() for counter in range(2)]
+        nodes = [
+            self.make_node_with_mac(
+                user, nodegroup=nodegroup,
+                power_type=POWER_TYPE.WAKE_ON_LAN)[0]
+            for nodegroup in nodegroups + nodegroups[:1]]
+        task = self.patch(node_module, 'power_on_nodes')
+        Node.objects.start_nodes([node.system_id for node in nodes], user)
+        self.assertItemsEqual(
+            [(nodegroups[0].work_queue, 2), (nodegroups[1].work_queue, 1)],
+            [
+                (kwargs['queue'], len(kwargs['args'][0]))
+                for args, kwargs in task.apply_async.call_args_list])
+
+    def test_start_nodes_queries_do_not_grow_with_nodes(self):
+        user = factory.make_user()
+        nodegroup = factory.make_node_group()
+        nodes = [
+            self.make_node_with_mac(
+                user, nodegroup=nodegroup,
+                power_type=POWER_TYPE.WAKE_ON_LAN)[0]
+            for counter in range(5)]
+        self.patch(node_module, 'power_on_nodes')
+        self.assertNumQueries(
+            8, Node.objects.start_nodes,
+            [node.system_id for node in nodes], user,
+            user_data=self.make_user_data())
+
+    def test_stop_nodes_sends_one_task_per_nodegroup(self):
+        user = factory.make_user()
+        nodegroup = factory.make_node_group()
+        nodes = [
+            self.make_node_with_mac(
+                user, nodegroup=nodegroup, power_type=POWER_TYPE.VIRSH)[0]
+            for counter in range(3)]
+        task = self.patch(node_module, 'power_off_nodes')
+        Node.objects.stop_nodes([node.system_id for node in nodes], user)
+        [(args, kwargs)] = task.apply_async.call_args_list
+        self.assertItemsEqual(
+            [node.system_id for node in nodes],
+            [params['system_id'] for _, params in kwargs['args'][0]])
+
+    def test_start_nodes_forgets_power_state(self):
+        user = factory.make_user()
+        node, mac = self.make_node_with_mac(
+            user, power_type=POWER_TYPE.WAKE_ON_LAN,
+            power_state=POWER_STATE.OFF)
+        self.patch(node_module, 'power_on_nodes')
+        Node.objects.start_nodes([node.system_id], user)
+        node = reload_object(node)
+        self.assertEqual(POWER_STATE.UNKNOWN, node.power_state)
+        self.assertIsNotNone(node.power_state_updated)
+
+    def test_stop_nodes_stops_nodes_last_seen_off(self):
+        # A node may have been switched on since it was last polled.
+        user = factory.make_user()
+        node, mac = self.make_node_with_mac(
+            user, power_type=POWER_TYPE.VIRSH, power_state=POWER_STATE.OFF)
+        task = self.patch(node_module, 'power_off_nodes')
+        output = Node.objects.stop_nodes([node.system_id], user)
+        self.assertItemsEqual([node], output)
+        [(args, kwargs)] = task.apply_async.call_args_list
+        self.assertEqual(
+            [node.system_id],
+            [params['system_id'] for _, params in kwargs['args'][0]])
+        self.assertEqual(POWER_STATE.UNKNOWN, reload_object(node).power_state)
+
+    def test_update_power_states_records_power_states(self):
+        nodegroup = factory.make_node_group()
+        nodes = [factory.make_node(nodegroup=nodegroup) for i in range(3)]
+        Node.objects.update_power_states(nodegroup, {
+            nodes[0].system_id: POWER_STATE.ON,
+            nodes[1].system_id: POWER_STATE.OFF,
+            })
+        nodes = [reload_object(node) for node in nodes]
+        self.assertEqual(
+            [POWER_STATE.ON, POWER_STATE.OFF, POWER_STATE.UNKNOWN],
+            [node.power_state for node in nodes])
+        self.assertEqual(
+            [True, True, False],
+            [node.power_state_updated is not None for node in nodes])
+
+    def test_update_power_states_ignores_other_nodegroups(self):
+        node = factory.make_node()
+        Node.objects.update_power_states(
+            factory.make_node_group(), {node.system_id: POWER_STATE.ON})
+        self.assertEqual(POWER_STATE.UNKNOWN, reload_object(node).power_state)
+
+    def test_get_primary_macs_returns_oldest_mac_of_each_node(self):
+        nodes = [factory.make_node() for counter in range(2)]
+        macs = [factory.make_mac_address(node=node) for node in nodes]
+        factory.make_mac_address(node=nodes[0])
+        self.assertEqual(
+            {node.id: mac.mac_address for node, mac in zip(nodes, macs)},
+            Node.objects.get_primary_macs(nodes))
+
     def test_netboot_on(self):
         node = factory.make_node(netboot=False)
         node.set_netboot(True)
@@ -1061,3 +1228,49 @@ class NodeManagerTest(TestCase):
         node = factory.make_node(netboot=True)
         node.set_netboot(False)
         self.assertFalse(node.netboot)
+
+
+class NodeAcquisitionLockingTest(TransactionTestCase):
+    """Acquiring nodes skips those that other transactions have locked."""
+
+    def setUp(self):
+        super(NodeAcquisitionLockingTest, self).setUp()
+        self.useFixture(CeleryFixture())
+        # The worker user is cached, but the database is flushed.
+        self.addCleanup(django_cache.clear)
+
+    def acquire_with_nodes_locked_elsewhere(self, locked_nodes, count):
+        """Acquire `count` nodes while another connection locks some.
+
+        :return: The nodes that `get_available_nodes_for_acquisition`
+            found.
+        """
+        settings = connection.settings_dict
+        params = {'database': settings['NAME']}
+        for key in ('user', 'password', 'host', 'port'):
+            if settings[key.upper()]:
+                params[key] = settings[key.upper()]
+        other_connection = psycopg2.connect(**params)
+        self.addCleanup(other_connection.close)
+        other_connection.cursor().execute(
+            "SELECT id FROM maasserver_node WHERE id IN %s FOR UPDATE",
+            [tuple(node.id for node in locked_nodes)])
+        try:
+            return Node.objects.get_available_nodes_for_acquisition(
+                factory.make_user(), count)
+        finally:
+            other_connection.rollback()
+
+    def test_skips_nodes_locked_by_other_transactions(self):
+        nodes = [
+            factory.make_node(status=NODE_STATUS.READY) for i in range(4)]
+        self.assertEqual(
+            [nodes[0], nodes[2], nodes[3]],
+            self.acquire_with_nodes_locked_elsewhere([nodes[1]], 3))
+
+    def test_returns_fewer_if_others_are_locked(self):
+        nodes = [
+            factory.make_node(status=NODE_STATUS.READY) for i in range(2)]
+        self.assertEqual(
+            [nodes[1]],
+            self.acquire_with_nodes_locked_elsewhere([nodes[0]], 2))
@@ -193,9 +193,9 @@ class TestNodeAction(TestCase):
         action = AcceptAndCommission(node, factory.make_admin())
         action.execute()
         self.assertEqual(NODE_STATUS.COMMISSIONING, node.status)
-        self.assertEqual(
-            'provisioningserver.tasks.power_on',
-            self.celery.tasks[0]['task'].name)
+        self.assertIn(
+            'provisioningserver.tasks.power_on_nodes',
+            [task['task'].name for task in self.celery.tasks])
 
     def test_RetryCommissioning_starts_commissioning(self):
         node = factory.make_node(
@@ -204,9 +204,9 @@ class TestNodeAction(TestCase):
         action = RetryCommissioning(node, factory.make_admin())
         action.execute()
         self.assertEqual(NODE_STATUS.COMMISSIONING, node.status)
-        self.assertEqual(
-            'provisioningserver.tasks.power_on',
-            self.celery.tasks[0]['task'].name)
+        self.assertIn(
+            'provisioningserver.tasks.power_on_nodes',
+            [task['task'].name for task in self.celery.tasks])
 
     def test_StartNode_inhibit_allows_user_with_SSH_key(self):
         user_with_key = factory.make_user()
@@ -229,6 +229,6 @@ class TestNodeAction(TestCase):
         StartNode(node, user).execute()
         self.assertEqual(NODE_STATUS.ALLOCATED, node.status)
         self.assertEqual(user, node.owner)
-        self.assertEqual(
-            'provisioningserver.tasks.power_on',
-            self.celery.tasks[0]['task'].name)
+        self.assertIn(
+            'provisioningserver.tasks.power_on_nodes',
+            [task['task'].name for task in self.celery.tasks])
@@ -14,7 +14,10 @@ __all__ = []
 
 from maasserver.enum import ARCHITECTURE
 from maasserver.exceptions import InvalidConstraint
-from maasserver.models import Node
+from maasserver.models import (
+    Node,
+    Tag,
+    )
 from maasserver.models.node_constraint_filter import (
     constrain_nodes,
     generate_architecture_wildcards,
@@ -111,6 +114,26 @@ class TestConstrainNodes(TestCase):
         self.assertRaises(InvalidConstraint,
             self.assertConstrainedNodes, [], {'tags': 'big unknown'})
 
+    def test_tags_ignores_repeated_tags(self):
+        tag_big = factory.make_tag(name='big')
+        node_big = factory.make_node()
+        node_big.tags.add(tag_big)
+        self.assertConstrainedNodes([node_big], {'tags': 'big big'})
+
+    def test_tags_ignores_empty_expression(self):
+        node = factory.make_node()
+        self.assertConstrainedNodes([node], {'tags': ' , '})
+
+    def test_tags_looks_up_all_tags_in_one_query(self):
+        tag_names = [factory.make_tag().name for counter in range(5)]
+        node = factory.make_node()
+        self.assertNumQueries(
+            1, constrain_nodes, Node.objects.all(),
+            {'tags': ' '.join(tag_names)})
+        self.assertConstrainedNodes([], {'tags': ' '.join(tag_names)})
+        node.tags.add(*Tag.objects.filter(name__in=tag_names))
+        self.assertConstrainedNodes([node], {'tags': ' '.join(tag_names)})
+
     def test_combined_constraints(self):
         tag_big = factory.make_tag(name='big')
         node_big = factory.make_node(architecture=ARCHITECTURE.i386)
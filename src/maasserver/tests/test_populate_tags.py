@@ -14,13 +14,145 @@ __all__ = []
 
 import mock
 from maasserver import populate_tags as populate_tags_module
-from maasserver.populate_tags import populate_tags
+from lxml import etree
+from maasserver.enum import TAG_REBUILD_STATUS
+from maasserver.models import (
+    HardwareFact,
+    TagRebuild,
+    )
+from maasserver.populate_tags import (
+    populate_tags,
+    populate_tags_from_facts,
+    populate_tags_in_database,
+    )
 from maasserver.testing.factory import factory
 from maasserver.testing.testcase import TestCase
+from maastesting.fakemethod import FakeMethod
+
+
+class TestPopulateTagsFromFacts(TestCase):
+
+    def make_node_with_facts(self, xmlbytes):
+        node = factory.make_node()
+        HardwareFact.objects.update_facts(node, etree.XML(xmlbytes))
+        return node
+
+    def make_tag_without_nodes(self, definition):
+        # Creating a tag populates it; start from scratch instead.
+        tag = factory.make_tag(definition=definition)
+        tag.node_set.clear()
+        return tag
+
+    def test_tags_matching_nodes(self):
+        node = self.make_node_with_facts('<node class="processor" />')
+        self.make_node_with_facts('<node class="memory" />')
+        tag = self.make_tag_without_nodes("//node[@class='processor']")
+        self.assertTrue(populate_tags_from_facts(tag))
+        self.assertItemsEqual([node], tag.node_set.all())
+
+    def test_keeps_matching_nodes_and_untags_others(self):
+        node1 = self.make_node_with_facts('<node class="processor" />')
+        node2 = self.make_node_with_facts('<node class="memory" />')
+        tag = self.make_tag_without_nodes("//node[@class='processor']")
+        node1.tags.add(tag)
+        node2.tags.add(tag)
+        self.assertTrue(populate_tags_from_facts(tag))
+        self.assertItemsEqual([node1], tag.node_set.all())
+
+    def test_returns_False_for_unsupported_definition(self):
+        node = self.make_node_with_facts('<node class="processor" />')
+        tag = self.make_tag_without_nodes("count(//node) > 0")
+        node.tags.add(tag)
+        self.assertFalse(populate_tags_from_facts(tag))
+        self.assertItemsEqual([node], tag.node_set.all())
+
+
+class TestPopulateTagsInDatabase(TestCase):
+
+    def make_tag_without_nodes(self, definition):
+        # Creating a tag populates it; start from scratch instead.
+        tag = factory.make_tag(definition=definition)
+        tag.node_set.clear()
+        return tag
+
+    def test_tags_matching_nodes(self):
+        node1 = factory.make_node()
+        node1.set_hardware_details('<node><child/></node>')
+        node2 = factory.make_node()
+        node2.set_hardware_details('<node />')
+        tag = self.make_tag_without_nodes('//node/child')
+        self.assertTrue(populate_tags_in_database(tag))
+        self.assertItemsEqual([node1], tag.node_set.all())
+
+    def test_evaluates_relative_to_root_element(self):
+        node = factory.make_node()
+        node.set_hardware_details('<node><child/></node>')
+        tag = self.make_tag_without_nodes('child')
+        self.assertTrue(populate_tags_in_database(tag))
+        self.assertItemsEqual([node], tag.node_set.all())
+
+    def test_matches_on_truth_of_result(self):
+        node = factory.make_node()
+        node.set_hardware_details('<node><child/></node>')
+        tag = self.make_tag_without_nodes('count(//child) > 1')
+        self.assertTrue(populate_tags_in_database(tag))
+        self.assertItemsEqual([], tag.node_set.all())
+
+    def test_leaves_existing_tags(self):
+        node = factory.make_node()
+        node.set_hardware_details('<node><child/></node>')
+        tag = self.make_tag_without_nodes('//node/child')
+        node.tags.add(tag)
+        self.assertTrue(populate_tags_in_database(tag))
+        self.assertItemsEqual([node], tag.node_set.all())
+
+    def test_untags_nodes_that_no_longer_match(self):
+        node = factory.make_node()
+        node.set_hardware_details('<node />')
+        tag = self.make_tag_without_nodes('//node/child')
+        node.tags.add(tag)
+        self.assertTrue(populate_tags_in_database(tag))
+        self.assertItemsEqual([], tag.node_set.all())
+
+    def test_returns_False_for_unsupported_definition(self):
+        node = factory.make_node()
+        node.set_hardware_details('<node><child/></node>')
+        tag = self.make_tag_without_nodes('re:test(name(/*), "node")')
+        self.assertFalse(populate_tags_in_database(tag))
+        self.assertItemsEqual([], tag.node_set.all())
 
 
 class TestPopulateTags(TestCase):
 
+    def setUp(self):
+        super(TestPopulateTags, self).setUp()
+        self.patch(
+            populate_tags_module, 'populate_tags_from_facts',
+            FakeMethod(result=False))
+        self.patch(
+            populate_tags_module, 'populate_tags_in_database',
+            FakeMethod(result=False))
+
+    def test_populate_tags_uses_facts_if_possible(self):
+        tag = factory.make_tag()
+        self.patch(
+            populate_tags_module, 'populate_tags_from_facts',
+            FakeMethod(result=True))
+        in_database = self.patch(
+            populate_tags_module, 'populate_tags_in_database', FakeMethod())
+        populate_tags(tag)
+        self.assertEqual([], in_database.calls)
+
+    def test_populate_tags_does_not_involve_workers_if_possible(self):
+        factory.make_node_group()
+        tag = factory.make_tag()
+        self.patch(
+            populate_tags_module, 'populate_tags_in_database',
+            FakeMethod(result=True))
+        task = self.patch(populate_tags_module, 'update_node_tags')
+        populate_tags(tag)
+        self.assertEqual([], task.apply_async.call_args_list)
+
     def test_populate_tags_task_routed_to_nodegroup_worker(self):
         nodegroup = factory.make_node_group()
         tag = factory.make_tag()
@@ -44,3 +176,29 @@ class TestPopulateTags(TestCase):
                                  })
                      for nodegroup in nodegroups]
         task.apply_async.assert_has_calls(task_calls, any_order=True)
+
+    def test_populate_tags_records_rebuilds(self):
+        nodegroup = factory.make_node_group()
+        tag = factory.make_tag()
+        self.patch(populate_tags_module, 'update_node_tags')
+        populate_tags(tag)
+        rebuild = TagRebuild.objects.filter(tag=tag).latest('id')
+        self.assertEqual(
+            (nodegroup, tag.definition, TAG_REBUILD_STATUS.PENDING),
+            (rebuild.nodegroup, rebuild.definition, rebuild.status))
+
+    def test_populate_tags_does_not_queue_duplicate_rebuilds(self):
+        factory.make_node_group()
+        tag = factory.make_tag()
+        task = self.patch(populate_tags_module, 'update_node_tags')
+        populate_tags(tag)
+        populate_tags(tag)
+        self.assertEqual(1, len(task.apply_async.call_args_list))
+
+    def test_populate_tags_forced_queues_rebuild_again(self):
+        factory.make_node_group()
+        tag = factory.make_tag()
+        task = self.patch(populate_tags_module, 'update_node_tags')
+        populate_tags(tag)
+        populate_tags(tag, force=True)
+        self.assertEqual(2, len(task.apply_async.call_args_list))
@@ -0,0 +1,235 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Tests for invalidating the PXE config caches of cluster controllers."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = []
+
+from lxml import etree
+from maasserver.enum import (
+    DISTRO_SERIES,
+    NODE_STATUS,
+    )
+from maasserver.models import (
+    Config,
+    HardwareFact,
+    )
+from maasserver.pxeconfig_connect import (
+    invalidate_all_pxe_configs,
+    invalidate_pxe_configs,
+    pxe_config_invalidator,
+    )
+from maasserver.testing.factory import factory
+from maasserver.testing.testcase import TestCase
+from provisioningserver import tasks
+from testtools.testcase import ExpectedException
+
+
+class TestPXEConfigInvalidation(TestCase):
+
+    def setUp(self):
+        super(TestPXEConfigInvalidation, self).setUp()
+        self.apply_async = self.patch(
+            tasks.invalidate_pxe_configs, 'apply_async')
+
+    def get_invalidations(self):
+        """Return the MAC addresses invalidated, by queue."""
+        return {
+            kwargs['queue']: kwargs['args'][0]
+            for args, kwargs in self.apply_async.call_args_list}
+
+    def test_invalidate_pxe_configs_sends_one_task_per_cluster(self):
+        nodegroup = factory.make_node_group()
+        nodes = [factory.make_node(nodegroup=nodegroup) for i in range(2)]
+        macs = [
+            factory.make_mac_address(node=node).mac_address
+            for node in nodes]
+        other_node = factory.make_node(mac=True)
+        invalidate_pxe_configs(nodes + [other_node])
+        self.assertEqual(
+            {
+                nodegroup.work_queue: macs,
+                other_node.work_queue: [
+                    other_node.get_primary_mac().mac_address],
+            },
+            self.get_invalidations())
+
+    def test_invalidate_pxe_configs_sends_nothing_for_no_macs(self):
+        invalidate_pxe_configs([factory.make_node()])
+        self.assertEqual(0, self.apply_async.call_count)
+
+    def test_invalidate_all_pxe_configs_invalidates_every_cluster(self):
+        nodegroup = factory.make_node_group()
+        invalidate_all_pxe_configs()
+        self.assertIsNone(self.get_invalidations()[nodegroup.work_queue])
+
+    def test_changing_node_status_invalidates_pxe_config(self):
+        node = factory.make_node(mac=True, status=NODE_STATUS.READY)
+        self.apply_async.reset_mock()
+        node.status = NODE_STATUS.ALLOCATED
+        node.save()
+        self.assertEqual(
+            {node.work_queue: [node.get_primary_mac().mac_address]},
+            self.get_invalidations())
+
+    def test_changing_node_netboot_invalidates_pxe_config(self):
+        node = factory.make_node(mac=True)
+        self.apply_async.reset_mock()
+        node.set_netboot(False)
+        self.assertEqual(1, self.apply_async.call_count)
+
+    def test_changing_node_distro_series_invalidates_pxe_config(self):
+        node = factory.make_node(mac=True)
+        self.apply_async.reset_mock()
+        node.set_distro_series(DISTRO_SERIES.quantal)
+        self.assertEqual(1, self.apply_async.call_count)
+
+    def test_other_node_changes_do_not_invalidate_pxe_config(self):
+        node = factory.make_node(mac=True)
+        self.apply_async.reset_mock()
+        node.hostname = factory.make_name('host')
+        node.save()
+        self.assertEqual(0, self.apply_async.call_count)
+
+    def test_changing_tag_kernel_opts_invalidates_tagged_nodes(self):
+        tag = factory.make_tag()
+        node = factory.make_node(mac=True)
+        node.tags.add(tag)
+        factory.make_node(mac=True)
+        self.apply_async.reset_mock()
+        tag.kernel_opts = 'console=ttyS0'
+        tag.save()
+        self.assertEqual(
+            {node.work_queue: [node.get_primary_mac().mac_address]},
+            self.get_invalidations())
+
+    def test_tagging_node_invalidates_pxe_config(self):
+        tag = factory.make_tag(kernel_opts='console=ttyS0')
+        node = factory.make_node(mac=True)
+        self.apply_async.reset_mock()
+        node.tags.add(tag)
+        self.assertEqual(
+            {node.work_queue: [node.get_primary_mac().mac_address]},
+            self.get_invalidations())
+
+    def test_untagging_node_invalidates_pxe_config(self):
+        tag = factory.make_tag(kernel_opts='console=ttyS0')
+        node = factory.make_node(mac=True)
+        node.tags.add(tag)
+        self.apply_async.reset_mock()
+        node.tags.remove(tag)
+        self.assertEqual(1, self.apply_async.call_count)
+
+    def test_clearing_node_tags_invalidates_pxe_config(self):
+        tag = factory.make_tag(kernel_opts='console=ttyS0')
+        node = factory.make_node(mac=True)
+        node.tags.add(tag)
+        self.apply_async.reset_mock()
+        node.tags.clear()
+        self.assertEqual(1, self.apply_async.call_count)
+
+    def test_adding_nodes_to_tag_invalidates_their_pxe_configs(self):
+        tag = factory.make_tag(kernel_opts='console=ttyS0')
+        node = factory.make_node(mac=True)
+        factory.make_node(mac=True)
+        self.apply_async.reset_mock()
+        tag.node_set.add(node)
+        self.assertEqual(
+            {node.work_queue: [node.get_primary_mac().mac_address]},
+            self.get_invalidations())
+
+    def test_tags_without_kernel_opts_do_not_invalidate_pxe_config(self):
+        tag = factory.make_tag()
+        node = factory.make_node(mac=True)
+        self.apply_async.reset_mock()
+        node.tags.add(tag)
+        tag.node_set.remove(node)
+        self.assertEqual(0, self.apply_async.call_count)
+
+    def test_rebuilding_tag_invalidates_old_and_new_nodes(self):
+        # Rebuilding a tag from hardware facts changes which nodes have it
+        # in bulk, without m2m_changed signals.
+        nodegroup = factory.make_node_group()
+        nodes = [
+            factory.make_node(nodegroup=nodegroup, mac=True)
+            for i in range(2)]
+        HardwareFact.objects.update_facts(
+            nodes[1], etree.XML('<node class="memory" />'))
+        tag = factory.make_tag(
+            definition="//node[@class='processor']",
+            kernel_opts='console=ttyS0')
+        tag.node_set.add(nodes[0])
+        self.apply_async.reset_mock()
+        tag.definition = "//node[@class='memory']"
+        tag.save()
+        self.assertEqual([nodes[1]], list(tag.node_set.all()))
+        self.assertItemsEqual(
+            [node.get_primary_mac().mac_address for node in nodes],
+            self.get_invalidations()[nodegroup.work_queue])
+
+    def test_changing_kernel_opts_config_invalidates_everything(self):
+        nodegroup = factory.make_node_group()
+        Config.objects.set_config('kernel_opts', 'console=ttyS0')
+        self.assertIsNone(self.get_invalidations()[nodegroup.work_queue])
+
+
+class TestPXEConfigInvalidator(TestCase):
+
+    def setUp(self):
+        super(TestPXEConfigInvalidator, self).setUp()
+        self.apply_async = self.patch(
+            tasks.invalidate_pxe_configs, 'apply_async')
+
+    def test_batch_sends_one_task_per_cluster_at_the_end(self):
+        nodegroup = factory.make_node_group()
+        nodes = [
+            factory.make_node(nodegroup=nodegroup, mac=True)
+            for i in range(3)]
+        with pxe_config_invalidator.batch():
+            for node in nodes:
+                node.set_netboot(False)
+            self.assertEqual(0, self.apply_async.call_count)
+        [(args, kwargs)] = self.apply_async.call_args_list
+        self.assertEqual(nodegroup.work_queue, kwargs['queue'])
+        self.assertItemsEqual(
+            [node.get_primary_mac().mac_address for node in nodes],
+            kwargs['args'][0])
+
+    def test_batch_invalidating_everything_supersedes_nodes(self):
+        nodegroup = factory.make_node_group()
+        node = factory.make_node(nodegroup=nodegroup, mac=True)
+        with pxe_config_invalidator.batch():
+            invalidate_pxe_configs([node])
+            invalidate_all_pxe_configs()
+        self.assertEqual(
+            [None],
+            [kwargs['args'][0]
+             for args, kwargs in self.apply_async.call_args_list
+             if kwargs['queue'] == nodegroup.work_queue])
+
+    def test_batch_identifies_nodes_when_invalidation_is_requested(self):
+        tag = factory.make_tag(definition='', kernel_opts='console=ttyS0')
+        node = factory.make_node(mac=True)
+        node.tags.add(tag)
+        self.apply_async.reset_mock()
+        with pxe_config_invalidator.batch():
+            tag.node_set.clear()
+        self.assertEqual(
+            [[node.get_primary_mac().mac_address]],
+            [kwargs['args'][0]
+             for args, kwargs in self.apply_async.call_args_list])
+
+    def test_failed_batch_sends_nothing(self):
+        node = factory.make_node(mac=True)
+        with ExpectedException(ZeroDivisionError):
+            with pxe_config_invalidator.batch():
+                invalidate_pxe_configs([node])
+                1 / 0
+        self.assertEqual(0, self.apply_async.call_count)
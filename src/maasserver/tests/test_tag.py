@@ -13,7 +13,9 @@ __metaclass__ = type
 __all__ = []
 
 from django.core.exceptions import ValidationError
+from lxml import etree
 from maasserver.models import Tag
+from maasserver.models.tag import compile_definition
 from maasserver.testing.factory import factory
 from maasserver.testing.testcase import TestCase
 
@@ -159,3 +161,24 @@ class TagTest(TestCase):
         tag.definition = 'invalid::tag'
         self.assertRaises(ValidationError, tag.save)
         self.assertItemsEqual([tag.name], node.tag_names())
+
+
+class TestCompileDefinition(TestCase):
+
+    def test_compiles_definition(self):
+        tag = factory.make_tag(definition='/node/foo')
+        xpath = compile_definition(tag)
+        self.assertEqual('/node/foo', xpath.path)
+        self.assertTrue(xpath(etree.XML('<node><foo /></node>')))
+
+    def test_caches_compiled_definition(self):
+        tag = factory.make_tag(definition='/node/foo')
+        self.assertIs(compile_definition(tag), compile_definition(tag))
+
+    def test_recompiles_changed_definition(self):
+        tag = factory.make_tag(definition='/node/foo')
+        xpath = compile_definition(tag)
+        tag.definition = '/node/bar'
+        tag.save()
+        self.assertEqual('/node/bar', compile_definition(tag).path)
+        self.assertIsNot(xpath, compile_definition(tag))
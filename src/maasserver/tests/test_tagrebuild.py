@@ -0,0 +1,157 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Tests for `TagRebuild`."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = []
+
+from datetime import timedelta
+
+from maasserver.enum import TAG_REBUILD_STATUS
+from maasserver.models import TagRebuild
+from maasserver.models.tagrebuild import PENDING_REBUILD_EXPIRY
+from maasserver.testing.factory import factory
+from maasserver.testing.testcase import TestCase
+
+
+class TestTagRebuildManager(TestCase):
+
+    def make_tag(self):
+        # Creating a tag rebuilds it; forget about that.
+        tag = factory.make_tag()
+        TagRebuild.objects.all().delete()
+        return tag
+
+    def get_statuses(self, tag):
+        return list(TagRebuild.objects.filter(tag=tag).order_by(
+            'id').values_list('nodegroup_id', 'definition', 'status'))
+
+    def test_queue_rebuilds_records_rebuild_per_nodegroup(self):
+        nodegroups = [factory.make_node_group() for i in range(2)]
+        tag = self.make_tag()
+        self.assertEqual(
+            nodegroups, TagRebuild.objects.queue_rebuilds(tag, nodegroups))
+        self.assertEqual(
+            [(nodegroup.id, tag.definition, TAG_REBUILD_STATUS.PENDING)
+             for nodegroup in nodegroups],
+            self.get_statuses(tag))
+
+    def test_queue_rebuilds_skips_nodegroups_with_rebuild_queued(self):
+        nodegroup = factory.make_node_group()
+        tag = self.make_tag()
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        self.assertEqual(
+            [], TagRebuild.objects.queue_rebuilds(tag, [nodegroup]))
+        self.assertEqual(1, TagRebuild.objects.filter(tag=tag).count())
+
+    def test_queue_rebuilds_supersedes_expired_pending_rebuilds(self):
+        nodegroup = factory.make_node_group()
+        tag = self.make_tag()
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        [rebuild] = TagRebuild.objects.filter(tag=tag)
+        expired = rebuild.created - PENDING_REBUILD_EXPIRY
+        TagRebuild.objects.filter(id=rebuild.id).update(
+            created=expired - timedelta(seconds=1))
+        self.assertEqual(
+            [nodegroup], TagRebuild.objects.queue_rebuilds(tag, [nodegroup]))
+        self.assertEqual(
+            [TAG_REBUILD_STATUS.SUPERSEDED, TAG_REBUILD_STATUS.PENDING],
+            [status for _, _, status in self.get_statuses(tag)])
+
+    def test_queue_rebuilds_forced_supersedes_pending_rebuilds(self):
+        nodegroup = factory.make_node_group()
+        tag = self.make_tag()
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        self.assertEqual(
+            [nodegroup],
+            TagRebuild.objects.queue_rebuilds(tag, [nodegroup], force=True))
+        self.assertEqual(
+            [TAG_REBUILD_STATUS.SUPERSEDED, TAG_REBUILD_STATUS.PENDING],
+            [status for _, _, status in self.get_statuses(tag)])
+
+    def test_queue_rebuilds_requeues_once_rebuild_has_started(self):
+        nodegroup = factory.make_node_group()
+        tag = self.make_tag()
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        TagRebuild.objects.start_rebuild(tag, nodegroup, tag.definition)
+        self.assertEqual(
+            [nodegroup], TagRebuild.objects.queue_rebuilds(tag, [nodegroup]))
+        self.assertEqual(
+            [TAG_REBUILD_STATUS.RUNNING, TAG_REBUILD_STATUS.PENDING],
+            [status for _, _, status in self.get_statuses(tag)])
+
+    def test_queue_rebuilds_supersedes_rebuilds_of_old_definitions(self):
+        nodegroup = factory.make_node_group()
+        tag = self.make_tag()
+        old_definition = tag.definition
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        tag.definition = '//node[@id="new"]'
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        self.assertEqual(
+            [(nodegroup.id, old_definition, TAG_REBUILD_STATUS.SUPERSEDED),
+             (nodegroup.id, tag.definition, TAG_REBUILD_STATUS.PENDING)],
+            self.get_statuses(tag))
+
+    def test_start_rebuild_marks_rebuild_running(self):
+        nodegroup = factory.make_node_group()
+        tag = self.make_tag()
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        self.assertTrue(
+            TagRebuild.objects.start_rebuild(tag, nodegroup, tag.definition))
+        rebuild = TagRebuild.objects.get(tag=tag)
+        self.assertEqual(TAG_REBUILD_STATUS.RUNNING, rebuild.status)
+        self.assertIsNotNone(rebuild.started)
+
+    def test_start_rebuild_refuses_old_definition(self):
+        nodegroup = factory.make_node_group()
+        tag = self.make_tag()
+        self.assertFalse(
+            TagRebuild.objects.start_rebuild(tag, nodegroup, '//old'))
+
+    def test_finish_rebuild_marks_rebuild_done(self):
+        nodegroup = factory.make_node_group()
+        tag = self.make_tag()
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        TagRebuild.objects.start_rebuild(tag, nodegroup, tag.definition)
+        TagRebuild.objects.finish_rebuild(tag, nodegroup, tag.definition)
+        rebuild = TagRebuild.objects.get(tag=tag)
+        self.assertEqual(TAG_REBUILD_STATUS.DONE, rebuild.status)
+        self.assertIsNotNone(rebuild.finished)
+
+    def test_finish_rebuild_finishes_running_rebuild_first(self):
+        nodegroup = factory.make_node_group()
+        tag = self.make_tag()
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        TagRebuild.objects.start_rebuild(tag, nodegroup, tag.definition)
+        TagRebuild.objects.queue_rebuilds(tag, [nodegroup])
+        TagRebuild.objects.finish_rebuild(tag, nodegroup, tag.definition)
+        self.assertEqual(
+            [TAG_REBUILD_STATUS.DONE, TAG_REBUILD_STATUS.PENDING],
+            [status for _, _, status in self.get_statuses(tag)])
+
+
+class TestTagRebuild(TestCase):
+
+    def test_latency_is_time_until_done(self):
+        tag = factory.make_tag()
+        rebuild = TagRebuild(
+            tag=tag, nodegroup=factory.make_node_group(),
+            definition=tag.definition, status=TAG_REBUILD_STATUS.DONE)
+        rebuild.save()
+        rebuild.finished = rebuild.created + timedelta(seconds=5)
+        self.assertEqual(timedelta(seconds=5), rebuild.latency)
+
+    def test_latency_is_None_until_done(self):
+        tag = factory.make_tag()
+        rebuild = TagRebuild(
+            tag=tag, nodegroup=factory.make_node_group(),
+            definition=tag.definition, status=TAG_REBUILD_STATUS.RUNNING)
+        rebuild.save()
+        self.assertIsNone(rebuild.latency)
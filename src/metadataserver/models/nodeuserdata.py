@@ -41,6 +41,23 @@ class NodeUserDataManager(Manager):
         else:
             self._set(node, data)
 
+    def bulk_set_user_data(self, nodes, data):
+        """Set the same user data for all of `nodes`, in a few queries.
+
+        If `data` is None, remove user data for the nodes.
+        """
+        existing_entries = self.filter(node__in=nodes)
+        if data is None:
+            existing_entries.delete()
+            return
+        wrapped_data = Bin(data)
+        existing_node_ids = set(
+            existing_entries.values_list('node_id', flat=True))
+        existing_entries.update(data=wrapped_data)
+        self.bulk_create([
+            NodeUserData(node=node, data=wrapped_data)
+            for node in nodes if node.id not in existing_node_ids])
+
     def get_user_data(self, node):
         """Retrieve user data for the given node."""
         return self.get(node=node).data
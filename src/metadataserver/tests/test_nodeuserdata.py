@@ -50,6 +50,28 @@ class TestNodeUserDataManager(DjangoTestCase):
         NodeUserData.objects.set_user_data(node, None)
         self.assertItemsEqual([], NodeUserData.objects.filter(node=node))
 
+    def test_bulk_set_user_data_creates_and_overwrites_userdata(self):
+        nodes = [factory.make_node() for counter in range(2)]
+        NodeUserData.objects.set_user_data(nodes[0], b'old')
+        NodeUserData.objects.bulk_set_user_data(nodes, b'new')
+        self.assertEqual(
+            [b'new', b'new'],
+            [NodeUserData.objects.get_user_data(node) for node in nodes])
+
+    def test_bulk_set_user_data_leaves_data_for_other_nodes_alone(self):
+        node = factory.make_node()
+        NodeUserData.objects.set_user_data(node, b'unchanged')
+        NodeUserData.objects.bulk_set_user_data([factory.make_node()], b'new')
+        self.assertEqual(
+            b'unchanged', NodeUserData.objects.get_user_data(node))
+
+    def test_bulk_set_user_data_to_None_removes_user_data(self):
+        nodes = [factory.make_node() for counter in range(2)]
+        NodeUserData.objects.bulk_set_user_data(nodes, b'data')
+        NodeUserData.objects.bulk_set_user_data(nodes, None)
+        self.assertItemsEqual(
+            [], NodeUserData.objects.filter(node__in=nodes))
+
     def test_get_user_data_retrieves_data(self):
         node = factory.make_node()
         data = b'splat'
@@ -0,0 +1,78 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Helpers for the cluster's workers to talk to the region's API."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = [
+    'check_response',
+    'get_cached_knowledge',
+    'process_response',
+    ]
+
+import httplib
+from logging import getLogger
+
+from apiclient.maas_client import (
+    MAASClient,
+    MAASDispatcher,
+    MAASOAuth,
+    )
+from provisioningserver.auth import (
+    get_recorded_api_credentials,
+    get_recorded_nodegroup_uuid,
+    )
+from provisioningserver.cluster_config import get_maas_url
+import simplejson as json
+
+
+logger = getLogger(__name__)
+
+
+def get_cached_knowledge():
+    """Get the information needed to talk to the region controller.
+
+    :return: (client, nodegroup_uuid), or (None, None) if it is not known
+        yet.
+    """
+    api_credentials = get_recorded_api_credentials()
+    if api_credentials is None:
+        logger.debug("Don't have API key yet.")
+        return None, None
+    nodegroup_uuid = get_recorded_nodegroup_uuid()
+    if nodegroup_uuid is None:
+        logger.debug("Don't have UUID yet.")
+        return None, None
+    client = MAASClient(
+        MAASOAuth(*api_credentials), MAASDispatcher(), get_maas_url())
+    return client, nodegroup_uuid
+
+
+def check_response(response):
+    """All responses should be httplib.OK.
+
+    :param response: The result of MAASClient.get/post/etc.
+    :type response: urllib2.addinfourl (a file-like object that has a .code
+        attribute.)
+    """
+    if response.code != httplib.OK:
+        text_status = httplib.responses.get(response.code, '<unknown>')
+        raise AssertionError('Unexpected HTTP status: %s %s, expected 200 OK'
+            % (response.code, text_status))
+
+
+def process_response(response):
+    """All responses should be httplib.OK and contain JSON content.
+
+    :param response: The result of MAASClient.get/post/etc.
+    :type response: urllib2.addinfourl (a file-like object that has a .code
+        attribute.)
+    """
+    check_response(response)
+    return json.loads(response.read())
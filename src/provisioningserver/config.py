@@ -23,6 +23,7 @@ from formencode import Schema
 from formencode.declarative import DeclarativeMeta
 from formencode.validators import (
     Int,
+    Number,
     RequireIfPresent,
     String,
     )
@@ -62,6 +63,18 @@ class ConfigTFTP(Schema):
     root = String(if_missing="/var/lib/maas/tftp")
     port = Int(min=1, max=65535, if_missing=69)
     generator = String(if_missing=b"http://localhost/MAAS/api/1.0/pxeconfig/")
+    generator_connections = Int(min=1, if_missing=10)
+    cache_ttl = Number(min=0, if_missing=60)
+    invalidation_port = Int(min=1, max=65535, if_missing=5249)
+
+
+class ConfigDHCP(Schema):
+    """Configuration validator for watching the DHCP server."""
+
+    if_key_missing = None
+
+    leases_file = String(if_missing="/var/lib/maas/dhcp/dhcpd.leases")
+    debounce = Number(min=0, if_missing=1)
 
 
 class ConfigBootEphemeral(Schema):
@@ -124,6 +137,7 @@ class Config(Schema):
     broker = ConfigBroker
     tftp = ConfigTFTP
     boot = ConfigBoot
+    dhcp = ConfigDHCP
 
     @classmethod
     def parse(cls, stream):
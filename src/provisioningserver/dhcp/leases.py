@@ -17,6 +17,17 @@ if an upload takes too long for whatever reason, subsequent updates
 should not be uploaded until the first upload is done.  Some uploads may
 be lost due to concurrency or failures, but the situation will right
 itself eventually.
+
+Uploads are incremental as well: the server numbers each version of
+the leases it receives, and the last version that the server has
+acknowledged is cached along with its number.  Subsequent uploads
+contain only the changes relative to that version.  If the server no
+longer has that version, it rejects the changes and all leases are
+uploaded instead.
+
+Each worker process reads the leases file incrementally: dhcpd only
+appends to it until it rewrites the file as a whole, so after the first
+full parse only the newly appended entries need to be parsed.
 """
 
 from __future__ import (
@@ -33,12 +44,14 @@ __all__ = [
 
 
 import errno
+import httplib
 import json
 from logging import getLogger
 from os import (
     fstat,
     stat,
     )
+import urllib2
 
 from apiclient.maas_client import (
     MAASClient,
@@ -52,7 +65,7 @@ from provisioningserver.auth import (
     get_recorded_nodegroup_uuid,
     )
 from provisioningserver.cluster_config import get_maas_url
-from provisioningserver.dhcp.leases_parser import parse_leases
+from provisioningserver.dhcp.leases_parser import IncrementalLeasesParser
 
 
 logger = getLogger(__name__)
@@ -66,6 +79,10 @@ LEASES_TIME_CACHE_KEY = 'leases_time'
 LEASES_CACHE_KEY = 'recorded_leases'
 
 
+# Cache key for the leases as last acknowledged by the server.
+SYNCED_LEASES_CACHE_KEY = 'synced_leases'
+
+
 def get_leases_file():
     """Get the location of the DHCP leases file from the config."""
     return app_or_default().conf.DHCP_LEASES_FILE
@@ -87,22 +104,92 @@ def get_leases_timestamp():
             raise
 
 
+class LeasesFileReader:
+    """Incremental reader for the DHCP leases file.
+
+    Remembers how far into the leases file it got last time, and parses
+    only what has been appended since.  If the file has been rewritten in
+    the meantime (it is a different file, or it has been truncated or
+    otherwise modified) the reader starts over with a full parse.
+    """
+
+    # Number of bytes just before the read position that are checked to
+    # see whether the file is still the one we read before.
+    fingerprint_size = 128
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, path=None, inode=None):
+        """Forget everything read so far."""
+        self.path = path
+        self.inode = inode
+        # Offset, in bytes, of the first byte that has not been parsed.
+        self.offset = 0
+        # The bytes just before `offset`.
+        self.fingerprint = b''
+        self.parser = IncrementalLeasesParser()
+
+    def is_continuation(self, path, leases_file):
+        """Can reading of `leases_file` resume where it left off?"""
+        stats = fstat(leases_file.fileno())
+        if path != self.path or stats.st_ino != self.inode:
+            return False
+        if stats.st_size < self.offset:
+            return False
+        leases_file.seek(self.offset - len(self.fingerprint))
+        return leases_file.read(len(self.fingerprint)) == self.fingerprint
+
+    def read(self, path):
+        """Read the leases file at `path`.
+
+        :return: A tuple: (timestamp, leases).  The `timestamp` is the last
+            modification time of the leases file, and `leases` is a dict
+            mapping leased IP addresses to their associated MAC addresses.
+        """
+        with open(path, 'rb') as leases_file:
+            if not self.is_continuation(path, leases_file):
+                self.reset(path, fstat(leases_file.fileno()).st_ino)
+                leases_file.seek(0)
+            new_data = leases_file.read()
+            timestamp = fstat(leases_file.fileno()).st_mtime
+        # dhcpd may be halfway through writing a line.  A partial line
+        # can end inside a quoted string or a comment, where a closing
+        # brace does not end the entry, so only complete lines are parsed.
+        # Stopping at a newline also means we never split a multi-byte
+        # character.
+        new_data = new_data[:new_data.rfind(b'\n') + 1]
+        contents = new_data.decode('utf-8')
+        consumed = self.parser.feed(contents)
+        consumed_data = contents[:consumed].encode('utf-8')
+        self.offset += len(consumed_data)
+        self.fingerprint = (
+            self.fingerprint + consumed_data)[-self.fingerprint_size:]
+        return timestamp, self.parser.get_leases()
+
+
+# The leases file reader for this process.
+leases_file_reader = LeasesFileReader()
+
+
 def parse_leases_file():
     """Parse the DHCP leases file.
 
+    Only the part of the file that was appended since the previous call
+    is actually parsed, unless the file was rewritten in the meantime.
+
     :return: A tuple: (timestamp, leases).  The `timestamp` is the last
         modification time of the leases file, and `leases` is a dict
         mapping leased IP addresses to their associated MAC addresses.
         None will be returned if the DHCP lease file cannot be found.
     """
     try:
-        with open(get_leases_file(), 'rb') as leases_file:
-            contents = leases_file.read().decode('utf-8')
-            return fstat(leases_file.fileno()).st_mtime, parse_leases(contents)
+        return leases_file_reader.read(get_leases_file())
     except IOError as exception:
         # Return None only if the exception is a "No such file or
         # directory" exception.
         if exception.errno == errno.ENOENT:
+            leases_file_reader.reset()
             return None
         else:
             raise
@@ -146,8 +233,64 @@ def list_missing_items(knowledge):
     return sorted(name for name, value in knowledge.items() if value is None)
 
 
+def get_synced_leases(nodegroup_uuid):
+    """Return the leases as last acknowledged by the server.
+
+    :param nodegroup_uuid: The node group that the leases are for.
+    :return: A tuple (generation, leases), where `generation` is the
+        server's version number for `leases`; or None if the server has
+        not acknowledged any leases for `nodegroup_uuid`.
+    """
+    synced_leases = cache.cache.get(SYNCED_LEASES_CACHE_KEY)
+    if synced_leases is None:
+        return None
+    uuid, generation, leases = synced_leases
+    if uuid != nodegroup_uuid:
+        return None
+    return generation, leases
+
+
+def record_synced_leases(nodegroup_uuid, response, leases):
+    """Record the leases that the server has just acknowledged.
+
+    :param nodegroup_uuid: The node group that the leases are for.
+    :param response: The server's response to the upload of `leases`.
+        It contains the server's version number for them.
+    :param leases: A dict mapping each leased IP address to the MAC address
+        that it has been assigned to.
+    """
+    try:
+        generation = json.loads(response.read())['generation']
+    except (ValueError, TypeError, KeyError):
+        # The server does not support incremental updates.
+        cache.cache.set(SYNCED_LEASES_CACHE_KEY, None)
+    else:
+        cache.cache.set(
+            SYNCED_LEASES_CACHE_KEY, (nodegroup_uuid, generation, leases))
+
+
+def diff_leases(old_leases, new_leases):
+    """Compare two sets of leases.
+
+    :return: A tuple (added, removed): `added` is a dict of the leases in
+        `new_leases` that are not in `old_leases`, or that map to a
+        different MAC address there.  `removed` is a list of the IP
+        addresses in `old_leases` that are not in `new_leases`.
+    """
+    added = {
+        ip: mac
+        for ip, mac in new_leases.items()
+            if old_leases.get(ip) != mac}
+    removed = [ip for ip in old_leases if ip not in new_leases]
+    return added, removed
+
+
 def send_leases(leases):
-    """Send lease updates to the server API."""
+    """Send lease updates to the server API.
+
+    If the server has acknowledged earlier leases, only the changes since
+    then are sent.
+    """
     # Items that the server must have sent us before we can do this.
     knowledge = {
         'maas_url': get_maas_url(),
@@ -164,10 +307,28 @@ def send_leases(leases):
             % ', '.join(list_missing_items(knowledge)))
         return
 
-    api_path = 'api/1.0/nodegroups/%s/' % knowledge['nodegroup_uuid']
+    nodegroup_uuid = knowledge['nodegroup_uuid']
+    api_path = 'api/1.0/nodegroups/%s/' % nodegroup_uuid
     oauth = MAASOAuth(*knowledge['api_credentials'])
-    MAASClient(oauth, MAASDispatcher(), knowledge['maas_url']).post(
-        api_path, 'update_leases', leases=json.dumps(leases))
+    client = MAASClient(oauth, MAASDispatcher(), knowledge['maas_url'])
+    response = None
+    synced_leases = get_synced_leases(nodegroup_uuid)
+    if synced_leases is not None:
+        generation, old_leases = synced_leases
+        added, removed = diff_leases(old_leases, leases)
+        try:
+            response = client.post(
+                api_path, 'update_leases', generation=generation,
+                added=json.dumps(added), removed=json.dumps(removed))
+        except urllib2.HTTPError as error:
+            if error.code != httplib.CONFLICT:
+                raise
+            logger.info(
+                "Server's DHCP leases are out of sync.  Sending all leases.")
+    if response is None:
+        response = client.post(
+            api_path, 'update_leases', leases=json.dumps(leases))
+    record_synced_leases(nodegroup_uuid, response, leases)
 
 
 def process_leases(timestamp, leases):
@@ -182,7 +343,9 @@ def upload_leases():
     Run this periodically just so no changes slip through the cracks.
     Examples of such cracks would be: subtle races, failure to upload,
     server restarts, or zone-file update commands getting lost on their
-    way to the DNS server.
+    way to the DNS server.  Even if there are no changes to send, the
+    server gets to check that its leases are still the ones that this
+    cluster last sent it.
     """
     parse_result = parse_leases_file()
     if parse_result:
@@ -7,6 +7,11 @@ The parser is very minimal.  All we really care about is which IP
 addresses are currently associated with which respective MAC addresses.
 The parser works out no other information than that, and does not
 pretend to parse the full format of the leases file faithfully.
+
+It makes a single pass over the file, line by line, and produces the
+`lease` and `host` entries it finds as :class:`LeaseEntry` tuples.  An
+entry containing a statement that the parser does not recognise is
+skipped as a whole, as is an incomplete entry at the end of the file.
 """
 
 from __future__ import (
@@ -17,54 +22,44 @@ from __future__ import (
 
 __metaclass__ = type
 __all__ = [
+    'IncrementalLeasesParser',
+    'LeaseEntry',
+    'parse_entries',
     'parse_leases',
     ]
 
+from collections import namedtuple
 from datetime import datetime
+import re
 
-from pyparsing import (
-    CaselessKeyword,
-    Dict,
-    Group,
-    oneOf,
-    QuotedString,
-    Regex,
-    restOfLine,
-    Suppress,
-    ZeroOrMore,
-    )
+# A host or lease entry from the leases file.  The `kind` is either
+# 'lease' or 'host'; `mac` and `ends` are None if the entry does not say.
+LeaseEntry = namedtuple(
+    'LeaseEntry', ['kind', 'ip', 'mac', 'ends', 'deleted'])
 
 
-ip = Regex("[0-9]{1,3}(\.[0-9]{1,3}){3}")
-mac = Regex("[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5}")
-hardware_type = Regex('[A-Za-z0-9_-]+')
-args = Regex('[^"{;]+') | QuotedString('"')
-expiry = Regex('[0-9]\s+[0-9/-]+\s+[0-9:]+') | 'never'
-identifier = Regex("[A-Za-z_][0-9A-Za-z_-]*")
-set_statement = (
-    CaselessKeyword('set') +
-    identifier +
-    Suppress('=') +
-    QuotedString('"'))
+# Start of a lease or host entry: "lease <ip> {" or "host <ip> {".
+entry_header = re.compile(
+    r"\b(lease|host)\s+([0-9]{1,3}(?:\.[0-9]{1,3}){3})\s*\{", re.IGNORECASE)
 
-# For our purposes, leases and host declarations are similar enough that
-# we can parse them as the same construct with different names.
-lease_or_host = oneOf(['lease', 'host'], caseless=True)
+# Tokens in an entry line that cannot simply be split on semicolons.
+line_token = re.compile(r'"[^"]*"|"|#.*|[;{}]|[^";{}#]+')
 
-hardware = CaselessKeyword("hardware") + hardware_type("type") + mac("mac")
-ends = CaselessKeyword("ends") + expiry("expiry")
-deleted = CaselessKeyword("deleted")
+hardware_args = re.compile(
+    r"[A-Za-z0-9_-]+\s+([0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5})\s*$")
+expiry_args = re.compile(r"(?:[0-9]\s+[0-9/-]+\s+[0-9:]+|never)\s*$")
+set_args = re.compile(r'[A-Za-z_][0-9A-Za-z_-]*\s*=\s*"[^"]*"\s*$')
+quoted_args = re.compile(r'"[^"]*"\s*$')
 
-lone_statement_names = [
+lone_statement_names = frozenset([
     'abandoned',
     'bootp',
     'deleted',
     'dynamic',
     'reserved',
-    ]
-lone_statement = oneOf(lone_statement_names, caseless=True)
+    ])
 
-other_statement_names = [
+other_statement_names = frozenset([
     'atsfp',
     'binding',
     'bootp',
@@ -84,28 +79,182 @@ other_statement_names = [
     'tsfp',
     'uid',
     'vendor-class-identifier',
-    ]
-other_statement = oneOf(other_statement_names, caseless=True) + args
-
-lease_statement = (
-    hardware | deleted | ends | set_statement | lone_statement |
-    other_statement
-    ) + Suppress(';')
-lease_parser = (
-    lease_or_host("lease_or_host") + ip("ip") +
-    Suppress('{') +
-    Dict(ZeroOrMore(Group(lease_statement))) +
-    Suppress('}')
-    )
-lease_parser.ignore('#' + restOfLine)
+    ])
+
+
+def interpret_statement(statement):
+    """Interpret one statement (without its semicolon) in an entry.
+
+    :return: A tuple (name, value) for the statements that matter to us:
+        ('hardware', <mac>), ('ends', <expiry>), or ('deleted', True).
+        Any other valid statement yields (None, None).  If the statement
+        is not recognised at all, the return value is None.
+    """
+    words = statement.split(None, 1)
+    if len(words) == 0:
+        return None
+    keyword = words[0].lower()
+    if len(words) == 1:
+        if keyword in lone_statement_names:
+            if keyword == 'deleted':
+                return 'deleted', True
+            return None, None
+        return None
+    args = words[1]
+    if keyword == 'hardware':
+        match = hardware_args.match(args)
+        if match is None:
+            return None
+        return 'hardware', match.group(1)
+    elif keyword == 'ends':
+        if expiry_args.match(args) is None:
+            return None
+        return 'ends', args.rstrip()
+    elif keyword == 'set':
+        if set_args.match(args) is None:
+            return None
+        return None, None
+    elif keyword in other_statement_names:
+        if '"' in args or '{' in args:
+            if quoted_args.match(args) is None:
+                return None
+        return None, None
+    else:
+        return None
+
+
+def is_cut_short(line):
+    """Does `line` start a new entry before ending the current one?"""
+    match = entry_header.search(line)
+    return match is not None and '}' not in line[:match.start()]
+
+
+def scan_entries(leases_contents):
+    """Find the lease and host entries in the contents of a leases file.
+
+    :param leases_contents: Contents (as unicode) of a leases file.
+    :return: A generator of tuples (entry, end).  The `entry` is a
+        :class:`LeaseEntry`, or None if the entry was not understood.
+        `end` is the position in `leases_contents` just past the entry.
+        An incomplete entry at the end of the contents is not produced.
+    """
+    length = len(leases_contents)
+    position = 0
+    # The entry we're in, if any.
+    kind = None
+    while position < length:
+        line_end = leases_contents.find('\n', position)
+        if line_end == -1:
+            line_end = length
+        # Where in the line we are.  A line may contain the end of one
+        # entry and the start of another, so it may take several passes
+        # through the loop below to process it.
+        start = position
+        while start is not None:
+            line = leases_contents[start:line_end]
+            if kind is None:
+                # Outside of any entry.  Look for the start of one.
+                if '#' in line:
+                    line = line.split('#', 1)[0]
+                if '{' not in line:
+                    break
+                match = entry_header.search(line)
+                if match is None:
+                    break
+                kind = match.group(1).lower()
+                ip = match.group(2)
+                mac = None
+                ends = None
+                deleted = False
+                valid = True
+                pending = ''
+                start += match.end()
+            elif '{' in line and is_cut_short(line):
+                # The start of a new entry before the end of the current
+                # one.  The current one was cut short, e.g. because dhcpd
+                # died while writing it; forget it.
+                kind = None
+            elif '"' not in line and '#' not in line and '}' not in line:
+                # The common case: complete statements, with no quoted
+                # strings or comments to confuse things.
+                statements = line.split(';')
+                statements[0] = pending + statements[0]
+                pending = statements.pop() + '\n'
+                if valid:
+                    for statement in statements:
+                        meaning = interpret_statement(statement)
+                        if meaning is None:
+                            valid = False
+                            break
+                        elif meaning[0] == 'hardware':
+                            mac = meaning[1]
+                        elif meaning[0] == 'ends':
+                            ends = meaning[1]
+                        elif meaning[0] == 'deleted':
+                            deleted = True
+                start = None
+            else:
+                # Tokenise the line: quoted strings and comments may
+                # contain semicolons and braces.
+                end_of_entry = None
+                for token in line_token.finditer(line):
+                    text = token.group()
+                    if text == ';':
+                        meaning = interpret_statement(pending)
+                        pending = ''
+                        if meaning is None:
+                            valid = False
+                        elif meaning[0] == 'hardware':
+                            mac = meaning[1]
+                        elif meaning[0] == 'ends':
+                            ends = meaning[1]
+                        elif meaning[0] == 'deleted':
+                            deleted = True
+                    elif text == '}':
+                        end_of_entry = start + token.end()
+                        break
+                    elif text[0] == '#':
+                        break
+                    elif text == '"' or text == '{':
+                        # An unterminated quoted string, or a nested
+                        # block; neither is something we understand.
+                        valid = False
+                        pending += text
+                    else:
+                        pending += text
+                if end_of_entry is None:
+                    pending += '\n'
+                    start = None
+                else:
+                    if pending.strip() != '':
+                        # An unterminated statement.
+                        valid = False
+                    if valid:
+                        entry = LeaseEntry(kind, ip, mac, ends, deleted)
+                    else:
+                        entry = None
+                    yield entry, end_of_entry
+                    kind = None
+                    start = end_of_entry
+        position = line_end + 1
+
+
+def parse_entries(leases_contents):
+    """Parse the lease and host entries in the contents of a leases file.
+
+    :param leases_contents: Contents (as unicode) of a leases file.
+    :return: A generator of :class:`LeaseEntry`, in file order.
+    """
+    for entry, end in scan_entries(leases_contents):
+        if entry is not None:
+            yield entry
 
 
 def is_lease(entry):
     """Is `entry` a lease declaration?"""
-    entry_type = entry.lease_or_host.lower()
-    assert entry_type in {'host', 'lease'}, (
-        "Unknown entry type (not a host or lease): %s" % entry_type)
-    return entry_type == 'lease'
+    assert entry.kind in {'host', 'lease'}, (
+        "Unknown entry type (not a host or lease): %s" % entry.kind)
+    return entry.kind == 'lease'
 
 
 def is_host(entry):
@@ -121,7 +270,7 @@ def get_expiry_date(lease):
         expiry, or None if the lease has no expiry date.
     """
     assert is_lease(lease)
-    ends = getattr(lease, 'ends', None)
+    ends = lease.ends
     if ends is None or len(ends) == 0 or ends.lower() == 'never':
         return None
     else:
@@ -148,23 +297,20 @@ def gather_leases(hosts_and_leases):
     now = datetime.utcnow()
     # If multiple leases for the same address are valid at the same
     # time, for whatever reason, the dict will contain the one that was
-    # last appended to the leases file.
+    # last appended to the leases file.  A lease without a MAC address
+    # is not associated with anything, so it does not count.
     return {
-        lease.ip: lease.hardware.mac
+        lease.ip: lease.mac
         for lease in filter(is_lease, hosts_and_leases)
-            if not has_expired(lease, now)}
+            if lease.mac is not None and not has_expired(lease, now)}
 
 
 def get_host_mac(host):
     """Get the MAC address from a host declaration.  A rubout has none."""
     assert is_host(host)
-    if 'deleted' in host:
-        return None
-    hardware = getattr(host, 'hardware', None)
-    if hardware in (None, '', b''):
+    if host.deleted:
         return None
-    else:
-        return hardware.mac
+    return host.mac
 
 
 def gather_hosts(hosts_and_leases):
@@ -185,14 +331,17 @@ def gather_hosts(hosts_and_leases):
 def combine_entries(entries):
     """Combine the hosts and leases declarations in a parsed leases file.
 
+    This gives the same result as combining :func:`gather_leases` and
+    :func:`gather_hosts`, but it consumes `entries` in a single pass.
+
     :param entries: Parsed host/leases entries from a leases file.
     :return: A dict mapping leased IP addresses to the respective MAC
         addresses that currently own them (regardless of whether they
         were found in a lease or in a host declaration).
     """
-    leases = gather_leases(entries)
-    leases.update(gather_hosts(entries))
-    return leases
+    parser = IncrementalLeasesParser()
+    parser.add_entries(entries)
+    return parser.get_leases()
 
 
 def parse_leases(leases_contents):
@@ -202,5 +351,97 @@ def parse_leases(leases_contents):
     :return: A dict mapping each currently leased IP address to the MAC
         address that it is associated with.
     """
-    entries = lease_parser.searchString(leases_contents)
-    return combine_entries(entries)
+    return combine_entries(parse_entries(leases_contents))
+
+
+class IncrementalLeasesParser:
+    """Parse a leases file piece by piece, as dhcpd appends to it.
+
+    The ISC dhcpd leases file is a journal: dhcpd only ever appends
+    entries to it, until it decides to rewrite the file from scratch.
+    Feed the appended text to :meth:`feed` as it comes in, and this
+    object will keep just enough of the state of the entries it has seen
+    to produce the same result as :func:`parse_leases` would for the
+    whole file.
+    """
+
+    def __init__(self):
+        # Per IP address, the lease entries (as (expiry, mac) tuples) that
+        # may still become the current one, oldest first.  A lease
+        # entry that expires no later than one that was appended after it
+        # can never be current again, so it gets dropped.  That keeps the
+        # expiry dates in these lists in strictly descending order.
+        self.leases = {}
+        # Per IP address, the MAC address of the last host declaration,
+        # or None if the last one was a rubout.
+        self.hosts = {}
+
+    def add_lease(self, lease):
+        """Record a lease entry."""
+        if lease.mac is None:
+            return
+        expiry = get_expiry_date(lease)
+        candidates = [
+            (candidate_expiry, candidate_mac)
+            for candidate_expiry, candidate_mac in self.leases.get(
+                lease.ip, [])
+            if expiry is not None and (
+                candidate_expiry is None or candidate_expiry > expiry)
+            ]
+        candidates.append((expiry, lease.mac))
+        self.leases[lease.ip] = candidates
+
+    def add_host(self, host):
+        """Record a host declaration (or rubout)."""
+        self.hosts[host.ip] = get_host_mac(host)
+
+    def add_entries(self, entries):
+        """Record parsed host and lease entries, in file order."""
+        for entry in entries:
+            if is_lease(entry):
+                self.add_lease(entry)
+            else:
+                self.add_host(entry)
+
+    def feed(self, leases_contents):
+        """Parse the complete entries in a piece of a leases file.
+
+        :param leases_contents: Text (as unicode) appended to the leases
+            file since the previous call.  It may end in an incomplete
+            entry, e.g. because dhcpd was still writing it, but it must
+            end in a complete line: a quoted string or comment that is cut
+            short could make a brace in it look like the end of the entry.
+        :return: The number of characters in `leases_contents` that have
+            been consumed.  Anything after that has not been parsed, and
+            should be passed in again, with the text that follows it,
+            on the next call.
+        """
+        consumed = 0
+        for entry, end in scan_entries(leases_contents):
+            if entry is not None:
+                self.add_entries([entry])
+            consumed = end
+        return consumed
+
+    def get_leases(self, now=None):
+        """Return the current leases.
+
+        :param now: The current UTC-based timestamp to check expiry
+            against.  Defaults to the actual current time.
+        :return: A dict mapping each currently leased IP address to the
+            MAC address that it is associated with.
+        """
+        if now is None:
+            now = datetime.utcnow()
+        leases = {}
+        for ip, candidates in self.leases.items():
+            # The newest entry that has not expired yet is the current
+            # one.  Since the newest entries expire first, that is the
+            # last one that has not expired.
+            for expiry, mac in reversed(candidates):
+                if expiry is None or not expiry < now:
+                    leases[ip] = mac
+                    break
+        leases.update(
+            (ip, mac) for ip, mac in self.hosts.items() if mac is not None)
+        return leases
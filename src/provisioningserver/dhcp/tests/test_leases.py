@@ -17,8 +17,12 @@ from datetime import (
     timedelta,
     )
 import errno
+import httplib
+import json
 import os
+from random import randint
 from textwrap import dedent
+import urllib2
 
 from apiclient.maas_client import MAASClient
 from maastesting.factory import factory
@@ -27,18 +31,28 @@ from maastesting.utils import (
     age_file,
     get_write_time,
     )
-from mock import Mock
+from mock import (
+    call,
+    Mock,
+    )
 from provisioningserver import cache
-from provisioningserver.auth import NODEGROUP_UUID_CACHE_KEY
+from provisioningserver.auth import (
+    get_recorded_nodegroup_uuid,
+    NODEGROUP_UUID_CACHE_KEY,
+    )
 from provisioningserver.dhcp import leases as leases_module
 from provisioningserver.dhcp.leases import (
     check_lease_changes,
+    diff_leases,
+    get_synced_leases,
     LEASES_CACHE_KEY,
     LEASES_TIME_CACHE_KEY,
+    LeasesFileReader,
     parse_leases_file,
     process_leases,
     record_lease_state,
     send_leases,
+    SYNCED_LEASES_CACHE_KEY,
     update_leases,
     upload_leases,
     )
@@ -59,6 +73,121 @@ class TestHelpers(PservTestCase):
                 ))
 
 
+def make_lease_entry(ip=None, mac=None):
+    """Compose a leases-file entry for `ip` and `mac`."""
+    if ip is None:
+        ip = factory.getRandomIPAddress()
+    if mac is None:
+        mac = factory.getRandomMACAddress()
+    return "lease %s {\n  hardware ethernet %s;\n}\n" % (ip, mac)
+
+
+class TestLeasesFileReader(PservTestCase):
+
+    def append_to_file(self, path, contents):
+        with open(path, 'ab') as leases_file:
+            leases_file.write(contents.encode('utf-8'))
+
+    def test_read_returns_timestamp_and_leases(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        leases_file = self.make_file(contents=make_lease_entry(ip, mac))
+        self.assertEqual(
+            (get_write_time(leases_file), {ip: mac}),
+            LeasesFileReader().read(leases_file))
+
+    def test_read_parses_only_appended_entries(self):
+        leases_file = self.make_file(contents=make_lease_entry())
+        reader = LeasesFileReader()
+        reader.read(leases_file)
+        new_entry = make_lease_entry()
+        self.append_to_file(leases_file, new_entry)
+        self.patch(reader.parser, 'feed', Mock(return_value=0))
+        reader.read(leases_file)
+        # The newline after the last entry that was parsed before is all
+        # that the parser sees again.
+        reader.parser.feed.assert_called_once_with('\n' + new_entry)
+
+    def test_read_combines_old_and_appended_entries(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        new_ip = factory.getRandomIPAddress()
+        new_mac = factory.getRandomMACAddress()
+        leases_file = self.make_file(contents=make_lease_entry(ip, mac))
+        reader = LeasesFileReader()
+        reader.read(leases_file)
+        self.append_to_file(leases_file, make_lease_entry(new_ip, new_mac))
+        self.assertEqual(
+            {ip: mac, new_ip: new_mac}, reader.read(leases_file)[1])
+
+    def test_read_picks_up_entry_once_it_is_complete(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        entry = make_lease_entry(ip, mac)
+        leases_file = self.make_file(contents=entry[:-5])
+        reader = LeasesFileReader()
+        self.assertEqual({}, reader.read(leases_file)[1])
+        self.append_to_file(leases_file, entry[-5:])
+        self.assertEqual({ip: mac}, reader.read(leases_file)[1])
+
+    def test_read_does_not_end_entry_at_brace_in_partial_quoted_string(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        entry = (
+            'lease %s {\n'
+            '  client-hostname "host}name";\n'
+            '  hardware ethernet %s;\n'
+            '}\n' % (ip, mac))
+        # The first read ends just after the brace in the quoted string.
+        cut = entry.index('}') + 1
+        leases_file = self.make_file(contents=entry[:cut])
+        reader = LeasesFileReader()
+        self.assertEqual({}, reader.read(leases_file)[1])
+        self.append_to_file(leases_file, entry[cut:])
+        self.assertEqual({ip: mac}, reader.read(leases_file)[1])
+
+    def test_read_starts_over_if_file_was_replaced(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        leases_file = self.make_file(contents=make_lease_entry())
+        reader = LeasesFileReader()
+        reader.read(leases_file)
+        new_file = self.make_file(
+            contents=make_lease_entry(ip, mac) + make_lease_entry(ip, mac))
+        os.rename(new_file, leases_file)
+        self.assertEqual({ip: mac}, reader.read(leases_file)[1])
+
+    def test_read_starts_over_if_file_was_truncated(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        leases_file = self.make_file(
+            contents=make_lease_entry() + make_lease_entry())
+        reader = LeasesFileReader()
+        reader.read(leases_file)
+        with open(leases_file, 'wb') as new_file:
+            new_file.write(make_lease_entry(ip, mac).encode('utf-8'))
+        self.assertEqual({ip: mac}, reader.read(leases_file)[1])
+
+    def test_read_starts_over_if_file_was_rewritten_in_place(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        leases_file = self.make_file(contents=make_lease_entry())
+        reader = LeasesFileReader()
+        reader.read(leases_file)
+        with open(leases_file, 'wb') as new_file:
+            new_file.write(
+                (make_lease_entry(ip, mac) * 2).encode('utf-8'))
+        self.assertEqual({ip: mac}, reader.read(leases_file)[1])
+
+    def test_read_starts_over_for_different_file(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        reader = LeasesFileReader()
+        reader.read(self.make_file(contents=make_lease_entry()))
+        other_file = self.make_file(contents=make_lease_entry(ip, mac))
+        self.assertEqual({ip: mac}, reader.read(other_file)[1])
+
+
 class StopExecuting(BaseException):
     """Exception class to stop execution at a desired point.
 
@@ -344,3 +473,117 @@ class TestUpdateLeases(PservTestCase):
         leases = factory.make_random_leases()
         send_leases(leases)
         self.assertEqual([], MAASClient.post.calls)
+
+    def make_response(self, generation):
+        """Fake a response from the update_leases API call."""
+        response = Mock()
+        response.read.return_value = json.dumps({'generation': generation})
+        return response
+
+    def test_send_leases_sends_all_leases_if_none_synced(self):
+        self.set_items_needed_for_lease_update()
+        self.patch(MAASClient, 'post', Mock(
+            return_value=self.make_response(1)))
+        leases = factory.make_random_leases()
+        send_leases(leases)
+        MAASClient.post.assert_called_once_with(
+            'api/1.0/nodegroups/%s/' % get_recorded_nodegroup_uuid(),
+            'update_leases', leases=json.dumps(leases))
+
+    def test_send_leases_records_synced_leases(self):
+        self.set_items_needed_for_lease_update()
+        generation = randint(1, 100)
+        self.patch(MAASClient, 'post', Mock(
+            return_value=self.make_response(generation)))
+        leases = factory.make_random_leases()
+        send_leases(leases)
+        self.assertEqual(
+            (generation, leases),
+            get_synced_leases(get_recorded_nodegroup_uuid()))
+
+    def test_send_leases_sends_only_changes_to_synced_leases(self):
+        self.set_items_needed_for_lease_update()
+        old_leases = factory.make_random_leases(2)
+        [kept_ip, removed_ip] = old_leases.keys()
+        cache.cache.set(
+            SYNCED_LEASES_CACHE_KEY,
+            (get_recorded_nodegroup_uuid(), 5, old_leases))
+        self.patch(MAASClient, 'post', Mock(
+            return_value=self.make_response(6)))
+        added = factory.make_random_leases()
+        leases = dict(added, **{kept_ip: old_leases[kept_ip]})
+        send_leases(leases)
+        MAASClient.post.assert_called_once_with(
+            'api/1.0/nodegroups/%s/' % get_recorded_nodegroup_uuid(),
+            'update_leases', generation=5, added=json.dumps(added),
+            removed=json.dumps([removed_ip]))
+        self.assertEqual(
+            (6, leases), get_synced_leases(get_recorded_nodegroup_uuid()))
+
+    def test_send_leases_sends_all_leases_if_server_is_out_of_sync(self):
+        self.set_items_needed_for_lease_update()
+        cache.cache.set(
+            SYNCED_LEASES_CACHE_KEY, (
+                get_recorded_nodegroup_uuid(), 5,
+                factory.make_random_leases()))
+        conflict = urllib2.HTTPError(
+            factory.getRandomString(), httplib.CONFLICT,
+            factory.getRandomString(), None, None)
+        self.patch(MAASClient, 'post', Mock(
+            side_effect=[conflict, self.make_response(8)]))
+        leases = factory.make_random_leases()
+        send_leases(leases)
+        self.assertEqual(
+            call(
+                'api/1.0/nodegroups/%s/' % get_recorded_nodegroup_uuid(),
+                'update_leases', leases=json.dumps(leases)),
+            MAASClient.post.call_args)
+        self.assertEqual(
+            (8, leases), get_synced_leases(get_recorded_nodegroup_uuid()))
+
+    def test_send_leases_propagates_other_errors(self):
+        self.set_items_needed_for_lease_update()
+        cache.cache.set(
+            SYNCED_LEASES_CACHE_KEY, (
+                get_recorded_nodegroup_uuid(), 5,
+                factory.make_random_leases()))
+        error = urllib2.HTTPError(
+            factory.getRandomString(), httplib.INTERNAL_SERVER_ERROR,
+            factory.getRandomString(), None, None)
+        self.patch(MAASClient, 'post', Mock(side_effect=error))
+        self.assertRaises(
+            urllib2.HTTPError, send_leases, factory.make_random_leases())
+
+    def test_send_leases_copes_with_server_without_lease_versions(self):
+        self.set_items_needed_for_lease_update()
+        response = Mock()
+        response.read.return_value = "Leases updated."
+        self.patch(MAASClient, 'post', Mock(return_value=response))
+        send_leases(factory.make_random_leases())
+        self.assertIsNone(get_synced_leases(get_recorded_nodegroup_uuid()))
+
+    def test_get_synced_leases_ignores_leases_for_other_nodegroup(self):
+        cache.cache.set(
+            SYNCED_LEASES_CACHE_KEY, (
+                factory.getRandomUUID(), 5, factory.make_random_leases()))
+        self.assertIsNone(get_synced_leases(factory.getRandomUUID()))
+
+    def test_diff_leases_finds_added_changed_and_removed_leases(self):
+        [unchanged_ip, changed_ip, removed_ip] = factory.make_random_leases(
+            3).keys()
+        new_ip = factory.getRandomIPAddress()
+        old_mac = factory.getRandomMACAddress()
+        new_mac = factory.getRandomMACAddress()
+        old_leases = {
+            unchanged_ip: old_mac,
+            changed_ip: old_mac,
+            removed_ip: old_mac,
+            }
+        new_leases = {
+            unchanged_ip: old_mac,
+            changed_ip: new_mac,
+            new_ip: new_mac,
+            }
+        self.assertEqual(
+            ({changed_ip: new_mac, new_ip: new_mac}, [removed_ip]),
+            diff_leases(old_leases, new_leases))
@@ -12,7 +12,6 @@ from __future__ import (
 __metaclass__ = type
 __all__ = []
 
-from collections import namedtuple
 from datetime import datetime
 from textwrap import dedent
 
@@ -25,9 +24,11 @@ from provisioningserver.dhcp.leases_parser import (
     get_expiry_date,
     get_host_mac,
     has_expired,
+    IncrementalLeasesParser,
     is_host,
     is_lease,
-    lease_parser,
+    LeaseEntry,
+    parse_entries,
     parse_leases,
     )
 
@@ -41,10 +42,7 @@ class TestLeasesParser(TestCase):
             ip = factory.getRandomIPAddress()
         if mac is None:
             mac = factory.getRandomMACAddress()
-        Hardware = namedtuple('Hardware', ['mac'])
-        Lease = namedtuple(
-            'Lease', ['lease_or_host', 'ip', 'hardware', 'ends'])
-        return Lease(entry_type, ip, Hardware(mac), ends)
+        return LeaseEntry(entry_type, ip, mac, ends, False)
 
     def fake_parsed_host(self, ip=None, mac=None):
         """Fake a host declaration as produced by the parser."""
@@ -54,8 +52,7 @@ class TestLeasesParser(TestCase):
         """Fake a "rubout" host declaration."""
         if ip is None:
             ip = factory.getRandomIPAddress()
-        Rubout = namedtuple('Rubout', ['lease_or_host', 'ip'])
-        return Rubout('host', ip)
+        return LeaseEntry('host', ip, None, None, True)
 
     def test_get_expiry_date_parses_expiry_date(self):
         lease = self.fake_parsed_lease(ends='0 2011/01/02 03:04:05')
@@ -90,7 +87,7 @@ class TestLeasesParser(TestCase):
     def test_gather_leases_finds_current_leases(self):
         lease = self.fake_parsed_lease()
         self.assertEqual(
-            {lease.ip: lease.hardware.mac},
+            {lease.ip: lease.mac},
             gather_leases([lease]))
 
     def test_gather_leases_ignores_expired_leases(self):
@@ -125,7 +122,7 @@ class TestLeasesParser(TestCase):
 
     def test_gather_hosts_finds_hosts(self):
         host = self.fake_parsed_host()
-        self.assertEqual({host.ip: host.hardware.mac}, gather_hosts([host]))
+        self.assertEqual({host.ip: host.mac}, gather_hosts([host]))
 
     def test_gather_hosts_ignores_unaccompanied_rubouts(self):
         self.assertEqual({}, gather_hosts([self.fake_parsed_rubout()]))
@@ -153,7 +150,7 @@ class TestLeasesParser(TestCase):
             'ip': factory.getRandomIPAddress(),
             'mac': factory.getRandomMACAddress(),
         }
-        [parsed_lease] = lease_parser.searchString(dedent("""\
+        [parsed_lease] = parse_entries(dedent("""\
             lease %(ip)s {
                 hardware ethernet %(mac)s;
             }
@@ -167,7 +164,7 @@ class TestLeasesParser(TestCase):
             'ip': factory.getRandomIPAddress(),
             'mac': factory.getRandomMACAddress(),
         }
-        [parsed_host] = lease_parser.searchString(dedent("""\
+        [parsed_host] = parse_entries(dedent("""\
             host %(ip)s {
                 hardware ethernet %(mac)s;
             }
@@ -181,7 +178,7 @@ class TestLeasesParser(TestCase):
             'ip': factory.getRandomIPAddress(),
             'mac': factory.getRandomMACAddress(),
         }
-        [parsed_host] = lease_parser.searchString(dedent("""\
+        [parsed_host] = parse_entries(dedent("""\
             host %(ip)s {
                 hardware ethernet %(mac)s;
             }
@@ -190,7 +187,7 @@ class TestLeasesParser(TestCase):
 
     def test_get_host_mac_returns_None_for_rubout(self):
         ip = factory.getRandomIPAddress()
-        [parsed_host] = lease_parser.searchString(dedent("""\
+        [parsed_host] = parse_entries(dedent("""\
             host %s {
                 deleted;
             }
@@ -202,7 +199,7 @@ class TestLeasesParser(TestCase):
             'ip': factory.getRandomIPAddress(),
             'mac': factory.getRandomMACAddress(),
         }
-        [parsed_host] = lease_parser.searchString(dedent("""\
+        [parsed_host] = parse_entries(dedent("""\
             host %(ip)s {
                 deleted;
                 hardware ethernet %(mac)s;
@@ -210,6 +207,169 @@ class TestLeasesParser(TestCase):
             """ % params))
         self.assertIsNone(get_host_mac(parsed_host))
 
+    def test_parse_entries_produces_entry_tuples(self):
+        params = {
+            'ip': factory.getRandomIPAddress(),
+            'mac': factory.getRandomMACAddress(),
+        }
+        entries = parse_entries(dedent("""\
+            lease %(ip)s {
+                hardware ethernet %(mac)s;
+                ends 0 2011/01/02 03:04:05;
+            }
+            host %(ip)s {
+                deleted;
+            }
+            """ % params))
+        self.assertEqual(
+            [
+                ('lease', params['ip'], params['mac'],
+                 '0 2011/01/02 03:04:05', False),
+                ('host', params['ip'], None, None, True),
+            ],
+            list(entries))
+
+    def test_parse_entries_is_a_generator(self):
+        entries = parse_entries(
+            "lease %s {\n}\n" % factory.getRandomIPAddress())
+        self.assertEqual(entries, iter(entries))
+
+    def test_parse_entries_skips_entry_with_unknown_statement(self):
+        params = {
+            'ip': factory.getRandomIPAddress(),
+            'mac': factory.getRandomMACAddress(),
+        }
+        entries = parse_entries(dedent("""\
+            lease %(ip)s {
+                hardware ethernet %(mac)s;
+                frobnicate now;
+            }
+            """ % params))
+        self.assertEqual([], list(entries))
+
+    def test_parse_entries_skips_entry_with_unterminated_statement(self):
+        params = {
+            'ip': factory.getRandomIPAddress(),
+            'mac': factory.getRandomMACAddress(),
+        }
+        entries = parse_entries(dedent("""\
+            lease %(ip)s {
+                hardware ethernet %(mac)s
+            }
+            """ % params))
+        self.assertEqual([], list(entries))
+
+    def test_parse_entries_skips_entry_cut_short_by_next_entry(self):
+        params = {
+            'ip': factory.getRandomIPAddress(),
+            'mac': factory.getRandomMACAddress(),
+        }
+        entries = parse_entries(dedent("""\
+            lease %(ip)s {
+                starts 5 2010/01/01 00:00:05;
+            lease %(ip)s {
+                hardware ethernet %(mac)s;
+            }
+            """ % params))
+        self.assertEqual(
+            [('lease', params['ip'], params['mac'], None, False)],
+            list(entries))
+
+    def test_parse_entries_copes_with_quoted_strings(self):
+        params = {
+            'ip': factory.getRandomIPAddress(),
+            'mac': factory.getRandomMACAddress(),
+        }
+        entries = parse_entries(dedent("""\
+            lease %(ip)s {
+                uid "#};{";
+                set vendorclass = "PXEClient;Arch:00000";
+                hardware ethernet %(mac)s;
+            }
+            """ % params))
+        self.assertEqual(
+            [('lease', params['ip'], params['mac'], None, False)],
+            list(entries))
+
+    def test_parse_entries_copes_with_single_line_entries(self):
+        params = {
+            'ip': factory.getRandomIPAddress(),
+            'mac': factory.getRandomMACAddress(),
+        }
+        entries = parse_entries(
+            "host %(ip)s { hardware ethernet %(mac)s; } "
+            "host %(ip)s { deleted; }\n" % params)
+        self.assertEqual(
+            [
+                ('host', params['ip'], params['mac'], None, False),
+                ('host', params['ip'], None, None, True),
+            ],
+            list(entries))
+
+    def test_parse_entries_copes_with_statements_across_lines(self):
+        params = {
+            'ip': factory.getRandomIPAddress(),
+            'mac': factory.getRandomMACAddress(),
+        }
+        entries = parse_entries(dedent("""\
+            lease %(ip)s {
+                binding
+                    state free;
+                hardware ethernet
+                    %(mac)s;
+            }
+            """ % params))
+        self.assertEqual(
+            [('lease', params['ip'], params['mac'], None, False)],
+            list(entries))
+
+    def test_parse_entries_ignores_keyword_case(self):
+        params = {
+            'ip': factory.getRandomIPAddress(),
+            'mac': factory.getRandomMACAddress(),
+        }
+        entries = parse_entries(dedent("""\
+            LEASE %(ip)s {
+                Hardware ethernet %(mac)s;
+                ENDS never;
+            }
+            """ % params))
+        self.assertEqual(
+            [('lease', params['ip'], params['mac'], 'never', False)],
+            list(entries))
+
+    def test_parse_entries_ignores_commented_out_entries(self):
+        entries = parse_entries(
+            "# lease %s { }\n" % factory.getRandomIPAddress())
+        self.assertEqual([], list(entries))
+
+    def test_parse_entries_skips_other_top_level_statements(self):
+        params = {
+            'ip': factory.getRandomIPAddress(),
+            'mac': factory.getRandomMACAddress(),
+        }
+        entries = parse_entries(dedent("""\
+            authoring-byte-order little-endian;
+            server-duid "\\000\\001";
+            failover peer "peer" state {
+                my state normal at 4 2012/11/22 10:00:00;
+            }
+            lease %(ip)s {
+                hardware ethernet %(mac)s;
+            }
+            """ % params))
+        self.assertEqual(
+            [('lease', params['ip'], params['mac'], None, False)],
+            list(entries))
+
+    def test_parse_leases_ignores_lease_without_mac(self):
+        leases = parse_leases(dedent("""\
+            lease %s {
+                binding state free;
+            }
+            """ % factory.getRandomIPAddress()))
+        self.assertEqual({}, leases)
+
     def test_parse_leases_copes_with_empty_file(self):
         self.assertEqual({}, parse_leases(""))
 
@@ -452,3 +612,100 @@ class TestLeasesParser(TestCase):
             self.fake_parsed_host(ip=ip, mac=mac),
             ]
         self.assertEqual({ip: mac}, combine_entries(entries))
+
+
+class TestIncrementalLeasesParser(TestCase):
+
+    def make_lease_entry(self, ip=None, mac=None, ends=None):
+        """Compose a lease entry as dhcpd writes it."""
+        if ip is None:
+            ip = factory.getRandomIPAddress()
+        if mac is None:
+            mac = factory.getRandomMACAddress()
+        entry = "lease %s {\n  hardware ethernet %s;\n" % (ip, mac)
+        if ends is not None:
+            entry += "  ends %s;\n" % ends
+        return entry + "}\n"
+
+    def make_host_entry(self, ip=None, mac=None):
+        """Compose a host declaration as dhcpd writes it."""
+        if ip is None:
+            ip = factory.getRandomIPAddress()
+        if mac is None:
+            mac = factory.getRandomMACAddress()
+        return "host %s {\n  hardware ethernet %s;\n}\n" % (ip, mac)
+
+    def make_rubout_entry(self, ip):
+        """Compose a host rubout as dhcpd writes it."""
+        return "host %s {\n  deleted;\n}\n" % ip
+
+    def test_feed_consumes_complete_entries(self):
+        contents = self.make_lease_entry() + self.make_host_entry()
+        self.assertEqual(
+            len(contents.rstrip()), IncrementalLeasesParser().feed(contents))
+
+    def test_feed_does_not_consume_incomplete_entry(self):
+        complete = self.make_lease_entry()
+        incomplete = self.make_lease_entry()[:-3]
+        self.assertEqual(
+            len(complete.rstrip()),
+            IncrementalLeasesParser().feed(complete + incomplete))
+
+    def test_feed_consumes_nothing_if_no_entry_is_complete(self):
+        self.assertEqual(
+            0, IncrementalLeasesParser().feed(self.make_lease_entry()[:-3]))
+
+    def test_get_leases_returns_empty_dict_initially(self):
+        self.assertEqual({}, IncrementalLeasesParser().get_leases())
+
+    def test_get_leases_matches_parse_leases_when_fed_in_pieces(self):
+        ip = factory.getRandomIPAddress()
+        host_ip = factory.getRandomIPAddress()
+        earlier = '1 2001/01/01 00:00:00'
+        entries = [
+            self.make_lease_entry(ip=ip),
+            self.make_lease_entry(),
+            self.make_host_entry(ip=host_ip),
+            self.make_lease_entry(ip=ip, ends=earlier),
+            self.make_rubout_entry(host_ip),
+            self.make_lease_entry(ends='never'),
+            self.make_host_entry(),
+            ]
+        contents = ''.join(entries)
+        parser = IncrementalLeasesParser()
+        consumed = 0
+        # Feed the text in pieces that cut entries in arbitrary places.
+        for end in range(0, len(contents) + 1, 7) + [len(contents)]:
+            consumed += parser.feed(contents[consumed:end])
+        self.assertEqual(parse_leases(contents), parser.get_leases())
+
+    def test_get_leases_reverts_to_earlier_lease_if_later_one_expired(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        parser = IncrementalLeasesParser()
+        parser.feed(self.make_lease_entry(
+            ip=ip, mac=mac, ends='1 2035/12/31 23:59:59'))
+        parser.feed(self.make_lease_entry(
+            ip=ip, ends='1 2001/01/01 00:00:00'))
+        self.assertEqual({ip: mac}, parser.get_leases())
+
+    def test_get_leases_evaluates_expiry_at_time_of_call(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        parser = IncrementalLeasesParser()
+        parser.feed(self.make_lease_entry(
+            ip=ip, mac=mac, ends='1 2020/01/01 00:00:00'))
+        self.assertEqual(
+            ({ip: mac}, {}),
+            (
+                parser.get_leases(now=datetime(2019, 12, 31)),
+                parser.get_leases(now=datetime(2020, 01, 02)),
+            ))
+
+    def test_add_lease_drops_leases_that_cannot_become_current(self):
+        ip = factory.getRandomIPAddress()
+        mac = factory.getRandomMACAddress()
+        parser = IncrementalLeasesParser()
+        parser.feed(self.make_lease_entry(ip=ip, ends='never'))
+        parser.feed(self.make_lease_entry(ip=ip, mac=mac, ends='never'))
+        self.assertEqual([(None, mac)], parser.leases[ip])
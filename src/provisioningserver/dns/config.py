@@ -14,7 +14,9 @@ __all__ = [
     'DNSConfig',
     'DNSForwardZoneConfig',
     'DNSReverseZoneConfig',
+    'execute_nsupdate',
     'setup_rndc',
+    'zone_frozen',
     ]
 
 
@@ -22,20 +24,26 @@ from abc import (
     ABCMeta,
     abstractproperty,
     )
+from contextlib import contextmanager
 from datetime import datetime
 import errno
+from hashlib import sha1
 from itertools import (
-    chain,
     imap,
     islice,
     )
 import os.path
+import re
 from subprocess import (
+    CalledProcessError,
     check_call,
     check_output,
+    PIPE,
+    Popen,
     )
 
 from celery.conf import conf
+from netaddr import IPAddress
 from provisioningserver.dns.utils import generated_hostname
 from provisioningserver.utils import (
     atomic_write,
@@ -48,6 +56,13 @@ MAAS_NAMED_CONF_NAME = 'named.conf.maas'
 MAAS_NAMED_RNDC_CONF_NAME = 'named.conf.rndc.maas'
 MAAS_RNDC_CONF_NAME = 'rndc.conf.maas'
 
+# Name of the key that rndc uses.  Dynamic updates to the zones are signed
+# with the same key.
+MAAS_RNDC_KEY_NAME = 'rndc-maas-key'
+
+# Time to live of the records in the zones.  Same as in zone.template.
+ZONE_TTL = 300
+
 
 class DNSConfigDirectoryMissing(Exception):
     """The directory where the config was about to be written is missing."""
@@ -66,7 +81,7 @@ controls {
 """
 
 
-def generate_rndc(port=953, key_name='rndc-maas-key',
+def generate_rndc(port=953, key_name=MAAS_RNDC_KEY_NAME,
                   include_default_controls=True):
     """Use `rndc-confgen` (from bind9utils) to generate a rndc+named
     configuration.
@@ -131,13 +146,101 @@ def execute_rndc_command(arguments):
             stdout=devnull)
 
 
+@contextmanager
+def zone_frozen(zone_name=None):
+    """Suspend dynamic updates to a zone (or to all zones) in this context.
+
+    The file of a zone that accepts dynamic updates must not be rewritten
+    while BIND may be updating it.  Thawing the zone afterwards makes BIND
+    reload it from its file.  A zone that BIND has not loaded (because it
+    is new, or because BIND is not running) cannot be frozen; it is left
+    alone.
+    """
+    arguments = [] if zone_name is None else [zone_name]
+    try:
+        execute_rndc_command(['freeze'] + arguments)
+    except CalledProcessError:
+        yield
+    else:
+        try:
+            yield
+        finally:
+            execute_rndc_command(['thaw'] + arguments)
+
+
+def get_update_key():
+    """Return the key with which to sign dynamic updates, for `nsupdate`.
+
+    This is the key that rndc uses, as found in the named configuration
+    written by `setup_rndc`.
+
+    :return: A string of the form "algorithm:name secret".
+    """
+    with open(get_named_rndc_conf_path(), "rb") as f:
+        named_conf = f.read()
+    match = re.search(
+        r'key\s+"([^"]+)"\s*{\s*algorithm\s+([\w-]+);'
+        r'\s*secret\s+"([^"]+)";', named_conf)
+    if match is None:
+        raise DNSConfigFail(
+            "No key found in %s." % get_named_rndc_conf_path())
+    name, algorithm, secret = match.groups()
+    return '%s:%s %s' % (algorithm, name, secret)
+
+
+def execute_nsupdate(commands):
+    """Send a dynamic update (RFC 2136) to the DNS server.
+
+    The update is signed with the rndc key, and sent with `nsupdate`.
+
+    :param commands: A sequence of `nsupdate` commands, such as
+        "zone example.com" or "update delete host.example.com. CNAME".
+        They are sent as a single update.
+    """
+    script = [
+        'server 127.0.0.1 %d' % conf.DNS_SERVER_PORT,
+        'key %s' % get_update_key(),
+        ]
+    script.extend(commands)
+    script.append('send')
+    process = Popen(['nsupdate'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = process.communicate(
+        ''.join('%s\n' % command for command in script).encode('ascii'))
+    if process.returncode != 0:
+        raise CalledProcessError(process.returncode, 'nsupdate', stderr)
+
+
 # Directory where the DNS configuration template files can be found.
 TEMPLATES_PATH = os.path.join(os.path.dirname(__file__), 'templates')
 
 
+def read_content_hash(filename):
+    """Return the content hash recorded in the config file `filename`.
+
+    :return: The hash, or None if the file does not exist or does not
+        record a hash.
+    """
+    try:
+        with open(filename, "rb") as f:
+            content = f.read()
+    except IOError as error:
+        if error.errno == errno.ENOENT:
+            return None
+        raise
+    match = re.search(b'Content hash: ([0-9a-f]+)', content)
+    if match is None:
+        return None
+    return match.group(1).decode('ascii')
+
+
 class DNSConfigBase:
     __metaclass__ = ABCMeta
 
+    # Context entries that differ every time the config is rendered,
+    # without making a difference to the config itself.  They are left
+    # out of the content hash.
+    volatile_context = ('modified', 'content_hash')
+
     @abstractproperty
     def template_path(self):
         """Return the full path of the template to be used."""
@@ -174,15 +277,39 @@ class DNSConfigBase:
         parameters used when rendering the template."""
         return {}
 
+    def get_content_hash(self, template, **kwargs):
+        """Return a hash of the config, ignoring the `volatile_context`."""
+        kwargs.update(self.get_context())
+        kwargs.update((name, '') for name in self.volatile_context)
+        rendered = self.render_template(template, **kwargs)
+        return sha1(rendered.encode('utf-8')).hexdigest()
+
+    def render_config(self, **kwargs):
+        """Render this DNS config, unless it is unchanged.
+
+        :return: The rendered config, or None if the target file already
+            holds the same config.
+        """
+        template = self.get_template()
+        content_hash = self.get_content_hash(template, **kwargs)
+        if content_hash == read_content_hash(self.target_path):
+            return None
+        kwargs.update(self.get_context())
+        kwargs['content_hash'] = content_hash
+        return self.render_template(template, **kwargs)
+
     def write_config(self, overwrite=True, **kwargs):
         """Write out this DNS config file.
 
         This raises DNSConfigDirectoryMissing if any
         "No such file or directory" error is raised because that would mean
         that the directory containing the write to be written does not exist.
+
+        :return: Whether the config changed.  An unchanged config is not
+            written, so that BIND need not reload it.
         """
         try:
-            self.inner_write_config(overwrite=overwrite, **kwargs)
+            return self.inner_write_config(overwrite=overwrite, **kwargs)
         except OSError as exception:
             # Only raise a DNSConfigDirectoryMissing exception if this error
             # is a "No such file or directory" exception.
@@ -196,12 +323,13 @@ class DNSConfigBase:
 
     def inner_write_config(self, overwrite=True, **kwargs):
         """Write out this DNS config file."""
-        template = self.get_template()
-        kwargs.update(self.get_context())
-        rendered = self.render_template(template, **kwargs)
+        rendered = self.render_config(**kwargs)
+        if rendered is None:
+            return False
         atomic_write(
             rendered, self.target_path, overwrite=overwrite,
             mode=self.access_permissions)
+        return True
 
 
 class DNSConfig(DNSConfigBase):
@@ -230,6 +358,7 @@ class DNSConfig(DNSConfigBase):
             'zones': self.zones,
             'DNS_CONFIG_DIR': conf.DNS_CONFIG_DIR,
             'named_rndc_conf_path':  get_named_rndc_conf_path(),
+            'update_key_name': MAAS_RNDC_KEY_NAME,
             'modified': unicode(datetime.today()),
         }
 
@@ -253,11 +382,30 @@ def shortened_reversed_ip(ip, byte_num):
     return '.'.join(imap(unicode, significant_octets))
 
 
+def get_generate_ranges(network):
+    """Split `network` into ranges that suit BIND's $GENERATE directive.
+
+    A $GENERATE directive can only vary one number, so the addresses in a
+    range differ only in their last octet.
+
+    :type network: :class:`netaddr.IPNetwork`
+    :return: A generator of tuples: (first address, last address).
+    """
+    first = network.first
+    while first <= network.last:
+        last = min(first | 0xff, network.last)
+        yield IPAddress(first), IPAddress(last)
+        first = last + 1
+
+
 class DNSZoneConfigBase(DNSConfigBase):
     """Base class for zone writers."""
 
     template_file_name = 'zone.template'
 
+    # A zone that has the same records keeps its serial.
+    volatile_context = DNSConfigBase.volatile_context + ('serial', )
+
     def __init__(self, domain, serial=None, mapping=None, dns_ip=None):
         """
         :param domain: The domain name of the forward zone.
@@ -290,11 +438,12 @@ class DNSZoneConfigBase(DNSConfigBase):
 
     def inner_write_config(self, **kwargs):
         """Write out the DNS config file for this zone."""
-        template = self.get_template()
-        kwargs.update(self.get_context())
-        rendered = self.render_template(template, **kwargs)
+        rendered = self.render_config(**kwargs)
+        if rendered is None:
+            return False
         incremental_write(
             rendered, self.target_path, mode=self.access_permissions)
+        return True
 
 
 class DNSForwardZoneConfig(DNSZoneConfigBase):
@@ -305,9 +454,14 @@ class DNSForwardZoneConfig(DNSZoneConfigBase):
 
         :param networks: The networks that the mapping exists within.
         :type networks: Sequence of :class:`netaddr.IPNetwork`
+        :param removed_hostnames: Hosts that no longer have an address, and
+            whose records are to be removed by a dynamic update.
         """
         networks = kwargs.pop("networks", None)
         self.networks = [] if networks is None else networks
+        removed_hostnames = kwargs.pop("removed_hostnames", None)
+        self.removed_hostnames = (
+            [] if removed_hostnames is None else sorted(removed_hostnames))
         super(DNSForwardZoneConfig, self).__init__(*args, **kwargs)
 
     @property
@@ -329,18 +483,57 @@ class DNSForwardZoneConfig(DNSZoneConfigBase):
             if generated_name != hostname:
                 yield (hostname, generated_name)
 
+    def get_update_commands(self):
+        """Return the `nsupdate` commands that put the mapping into DNS.
+
+        Rather than rewriting the whole zone, this updates the CNAME records
+        of just the hosts in the mapping, deletes those of the hosts in
+        `removed_hostnames`, and updates the zone's serial.  The A records
+        cover every address in the networks already.
+
+        :return: A list of commands for `execute_nsupdate`.
+        """
+        commands = [
+            'zone %s' % self.domain,
+            # Same SOA as in zone.template, only with the new serial.
+            'update add %s. %d IN SOA %s. nobody.example.com. '
+            '%s 600 1800 604800 300' % (
+                self.domain, ZONE_TTL, self.domain, self.serial),
+            ]
+        for hostname, generated_name in self.get_cname_mapping():
+            fqdn = '%s.%s.' % (hostname, self.domain)
+            commands.append('update delete %s CNAME' % fqdn)
+            commands.append('update add %s %d IN CNAME %s.%s.' % (
+                fqdn, ZONE_TTL, generated_name, self.domain))
+        for hostname in self.removed_hostnames:
+            commands.append(
+                'update delete %s.%s. CNAME' % (hostname, self.domain))
+        return commands
+
     def get_static_mapping(self):
-        """Return a generator with the mapping fqdn->ip for the generated ips.
+        """Return a generator with the mapping fqdn->ip for the name server.
+
+        The A records for the generated hostnames are not part of this
+        mapping: see `get_generate_directives`.
+        """
+        return iter([('%s.' % self.domain, self.dns_ip)])
+
+    def get_generate_directives(self):
+        """Return the $GENERATE directives for the generated hostnames.
+
+        Each directive maps the generated hostnames to the IP addresses in
+        one range of the zone's networks, as A records.
 
-        The generated mapping is the mapping between the generated hostnames
-        and the IP addresses for all the possible IP addresses in zone.
-        Note that we return a list of tuples instead of a dictionary in order
-        to be able to return a generator.
+        :return: A generator of tuples: (range, generated hostname, ip),
+            where the hostname and ip contain a '$' that BIND replaces with
+            each number in the range.
         """
-        ips = imap(unicode, chain.from_iterable(self.networks))
-        static_mapping = ((generated_hostname(ip), ip) for ip in ips)
-        # Add A record for the name server's IP.
-        return chain([('%s.' % self.domain, self.dns_ip)], static_mapping)
+        for network in self.networks:
+            for first, last in get_generate_ranges(network):
+                ip = '%d.%d.%d.$' % first.words[:3]
+                yield (
+                    '%d-%d' % (first.words[3], last.words[3]),
+                    generated_hostname(ip), ip)
 
     def get_context(self):
         """Return the dict used to render the DNS zone file.
@@ -354,7 +547,10 @@ class DNSForwardZoneConfig(DNSZoneConfigBase):
             'mappings': {
                 'CNAME': self.get_cname_mapping(),
                 'A': self.get_static_mapping(),
-                }
+                },
+            'generate_directives': {
+                'A': self.get_generate_directives(),
+                },
             }
 
 
@@ -377,18 +573,23 @@ class DNSReverseZoneConfig(DNSZoneConfigBase):
         octets = broadcast.words[:netmask.words.count(255)]
         return '%s.in-addr.arpa' % '.'.join(imap(unicode, reversed(octets)))
 
-    def get_static_mapping(self):
-        """Return the reverse generated mapping: (shortened) ip->fqdn.
+    def get_generate_directives(self):
+        """Return the $GENERATE directives for the generated hostnames.
+
+        Each directive maps the (shortened) IP addresses in one range of
+        the network to their generated hostnames, as PTR records.
 
-        The reverse generated mapping is the mapping between the IP addresses
-        and the generated hostnames for all the possible IP addresses in zone.
+        :return: A generator of tuples: (range, shortened ip, fqdn), where
+            the shortened ip and fqdn contain a '$' that BIND replaces with
+            each number in the range.
         """
         byte_num = 4 - self.network.netmask.words.count(255)
-        return (
-            (shortened_reversed_ip(ip, byte_num),
+        for first, last in get_generate_ranges(self.network):
+            ip = '%d.%d.%d.$' % first.words[:3]
+            yield (
+                '%d-%d' % (first.words[3], last.words[3]),
+                '.'.join(islice(reversed(ip.split('.')), byte_num)),
                 '%s.%s.' % (generated_hostname(ip), self.domain))
-            for ip in self.network
-            )
 
     def get_context(self):
         """Return the dict used to render the DNS reverse zone file.
@@ -399,7 +600,8 @@ class DNSReverseZoneConfig(DNSZoneConfigBase):
             'domain': self.domain,
             'serial': self.serial,
             'modified': unicode(datetime.today()),
-            'mappings': {
-                'PTR': self.get_static_mapping(),
-                }
+            'mappings': {},
+            'generate_directives': {
+                'PTR': self.get_generate_directives(),
+                },
             }
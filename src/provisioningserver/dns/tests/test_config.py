@@ -17,8 +17,11 @@ from collections import (
     Sequence,
     )
 import errno
+from hashlib import sha1
 import os.path
 import random
+from subprocess import CalledProcessError
+from textwrap import dedent
 
 from celery.conf import conf
 from maastesting.factory import factory
@@ -41,14 +44,20 @@ from provisioningserver.dns.config import (
     DNSConfigFail,
     DNSForwardZoneConfig,
     DNSReverseZoneConfig,
+    execute_nsupdate,
     execute_rndc_command,
     generate_rndc,
+    get_generate_ranges,
+    get_update_key,
     MAAS_NAMED_CONF_NAME,
     MAAS_NAMED_RNDC_CONF_NAME,
     MAAS_RNDC_CONF_NAME,
+    MAAS_RNDC_KEY_NAME,
+    read_content_hash,
     setup_rndc,
     shortened_reversed_ip,
     TEMPLATES_PATH,
+    zone_frozen,
     )
 from provisioningserver.dns.utils import generated_hostname
 import tempita
@@ -62,6 +71,7 @@ from testtools.matchers import (
     Not,
     StartsWith,
     )
+from testtools.testcase import ExpectedException
 from twisted.python.filepath import FilePath
 
 
@@ -108,6 +118,114 @@ class TestRNDCUtilities(TestCase):
         expected_command = ['rndc', '-c', rndc_conf_path, command]
         self.assertEqual((expected_command,), recorder.calls[0][0])
 
+    def test_zone_frozen_freezes_and_thaws_zone(self):
+        recorder = self.patch(config, 'execute_rndc_command', FakeMethod())
+        zone_name = factory.make_name('zone')
+        with zone_frozen(zone_name):
+            self.assertEqual(
+                [(['freeze', zone_name], )], recorder.extract_args())
+        self.assertEqual(
+            [(['freeze', zone_name], ), (['thaw', zone_name], )],
+            recorder.extract_args())
+
+    def test_zone_frozen_freezes_all_zones_by_default(self):
+        recorder = self.patch(config, 'execute_rndc_command', FakeMethod())
+        with zone_frozen():
+            pass
+        self.assertEqual(
+            [(['freeze'], ), (['thaw'], )], recorder.extract_args())
+
+    def test_zone_frozen_thaws_zone_after_failure(self):
+        recorder = self.patch(config, 'execute_rndc_command', FakeMethod())
+        zone_name = factory.make_name('zone')
+        with ExpectedException(ZeroDivisionError):
+            with zone_frozen(zone_name):
+                1 / 0
+        self.assertEqual(
+            [(['freeze', zone_name], ), (['thaw', zone_name], )],
+            recorder.extract_args())
+
+    def test_zone_frozen_leaves_alone_zone_that_cannot_be_frozen(self):
+        recorder = self.patch(
+            config, 'execute_rndc_command',
+            FakeMethod(failure=CalledProcessError(1, 'rndc')))
+        zone_name = factory.make_name('zone')
+        with zone_frozen(zone_name):
+            pass
+        self.assertEqual(
+            [(['freeze', zone_name], )], recorder.extract_args())
+
+
+class TestDynamicUpdates(TestCase):
+
+    named_rndc_conf = dedent("""\
+        key "%s" {
+        \talgorithm hmac-md5;
+        \tsecret "%s";
+        };
+
+        controls {
+        \tinet 127.0.0.1 port 954
+        \t\tallow { 127.0.0.1; } keys { "%s"; };
+        };
+        """)
+
+    def make_named_rndc_conf(self, key_name, secret):
+        dns_conf_dir = self.make_dir()
+        self.patch(conf, 'DNS_CONFIG_DIR', dns_conf_dir)
+        factory.make_file(
+            dns_conf_dir, MAAS_NAMED_RNDC_CONF_NAME,
+            self.named_rndc_conf % (key_name, secret, key_name))
+
+    def patch_nsupdate(self, returncode=0, stderr=''):
+        popen = self.patch(config, 'Popen')
+        popen.return_value.returncode = returncode
+        popen.return_value.communicate.return_value = ('', stderr)
+        return popen
+
+    def test_get_update_key_returns_rndc_key(self):
+        secret = factory.getRandomString()
+        self.make_named_rndc_conf(MAAS_RNDC_KEY_NAME, secret)
+        self.assertEqual(
+            'hmac-md5:%s %s' % (MAAS_RNDC_KEY_NAME, secret),
+            get_update_key())
+
+    def test_get_update_key_fails_if_no_key(self):
+        dns_conf_dir = self.make_dir()
+        self.patch(conf, 'DNS_CONFIG_DIR', dns_conf_dir)
+        factory.make_file(dns_conf_dir, MAAS_NAMED_RNDC_CONF_NAME, '')
+        self.assertRaises(DNSConfigFail, get_update_key)
+
+    def test_execute_nsupdate_sends_signed_update(self):
+        secret = factory.getRandomString()
+        self.make_named_rndc_conf(MAAS_RNDC_KEY_NAME, secret)
+        port = random.randint(1, 65535)
+        self.patch(conf, 'DNS_SERVER_PORT', port)
+        popen = self.patch_nsupdate()
+        command = factory.make_name('command')
+        execute_nsupdate([command])
+        self.assertEqual(
+            (
+                ['nsupdate'],
+                'server 127.0.0.1 %d\n'
+                'key hmac-md5:%s %s\n'
+                '%s\n'
+                'send\n' % (port, MAAS_RNDC_KEY_NAME, secret, command),
+            ),
+            (
+                popen.call_args[0][0],
+                popen.return_value.communicate.call_args[0][0],
+            ))
+
+    def test_execute_nsupdate_raises_if_update_fails(self):
+        secret = factory.getRandomString()
+        self.make_named_rndc_conf(MAAS_RNDC_KEY_NAME, secret)
+        error = factory.make_name('error')
+        self.patch_nsupdate(returncode=2, stderr=error)
+        exception = self.assertRaises(
+            CalledProcessError, execute_nsupdate, [])
+        self.assertEqual((2, error), (exception.returncode, exception.output))
+
 
 class TestDNSConfig(TestCase):
     """Tests for DNSConfig."""
@@ -182,6 +300,33 @@ class TestDNSConfig(TestCase):
             os.path.join(target_dir, MAAS_NAMED_CONF_NAME),
             FileExists())
 
+    def test_write_config_reports_change(self):
+        self.patch(DNSConfig, 'target_dir', self.make_dir())
+        self.assertEqual(
+            (True, False),
+            (DNSConfig().write_config(), DNSConfig().write_config()))
+
+    def test_write_config_skips_unchanged_config(self):
+        target_dir = self.make_dir()
+        self.patch(DNSConfig, 'target_dir', target_dir)
+        DNSConfig().write_config()
+        target = os.path.join(target_dir, MAAS_NAMED_CONF_NAME)
+        with open(target, "rb") as f:
+            content = f.read()
+        DNSConfig().write_config()
+        self.assertThat(target, FileContains(content))
+
+    def test_write_config_writes_changed_config(self):
+        target_dir = self.make_dir()
+        self.patch(DNSConfig, 'target_dir', target_dir)
+        DNSConfig().write_config()
+        zone = DNSForwardZoneConfig(
+            factory.make_name('zone'), networks=[factory.getRandomNetwork()])
+        self.assertTrue(DNSConfig([zone]).write_config())
+        self.assertThat(
+            os.path.join(target_dir, MAAS_NAMED_CONF_NAME),
+            FileContains(matcher=Contains(zone.target_path)))
+
     def test_write_config_writes_config(self):
         target_dir = self.make_dir()
         self.patch(DNSConfig, 'target_dir', target_dir)
@@ -204,6 +349,7 @@ class TestDNSConfig(TestCase):
                         'zone.%s' % domain,
                         'zone.0.168.192.in-addr.arpa',
                         MAAS_NAMED_RNDC_CONF_NAME,
+                        'allow-update { key "%s"; };' % MAAS_RNDC_KEY_NAME,
                     ])))
 
     def test_write_config_makes_config_world_readable(self):
@@ -229,6 +375,32 @@ class TestDNSConfig(TestCase):
 
 class TestUtilities(TestCase):
 
+    def test_read_content_hash_returns_hash(self):
+        content_hash = sha1(factory.getRandomString()).hexdigest()
+        filename = self.make_file(
+            contents='; Content hash: %s\n' % content_hash)
+        self.assertEqual(content_hash, read_content_hash(filename))
+
+    def test_read_content_hash_returns_None_without_hash(self):
+        self.assertIsNone(read_content_hash(self.make_file()))
+
+    def test_read_content_hash_returns_None_if_file_missing(self):
+        filename = os.path.join(self.make_dir(), factory.make_name('file'))
+        self.assertIsNone(read_content_hash(filename))
+
+    def test_get_generate_ranges_splits_network_by_last_octet(self):
+        self.assertEqual(
+            [
+                (IPAddress('10.0.0.0'), IPAddress('10.0.0.255')),
+                (IPAddress('10.0.1.0'), IPAddress('10.0.1.255')),
+            ],
+            list(get_generate_ranges(IPNetwork('10.0.0.0/23'))))
+
+    def test_get_generate_ranges_handles_small_network(self):
+        self.assertEqual(
+            [(IPAddress('10.0.0.8'), IPAddress('10.0.0.15'))],
+            list(get_generate_ranges(IPNetwork('10.0.0.9/29'))))
+
     def test_shortened_reversed_ip_2(self):
         self.assertEqual(
             '3.0',
@@ -309,6 +481,34 @@ class TestDNSForwardZoneConfig(TestCase):
             generated_name,
             dict(dns_zone_config.get_cname_mapping()))
 
+    def test_get_update_commands_updates_cnames_and_serial(self):
+        domain = factory.make_name('zone')
+        serial = random.randint(1, 100)
+        hostname = factory.make_name('hostname')
+        ip = factory.getRandomIPAddress()
+        dns_zone_config = DNSForwardZoneConfig(
+            domain, serial=serial, mapping={hostname: ip})
+        self.assertEqual(
+            [
+                'zone %s' % domain,
+                'update add %s. 300 IN SOA %s. nobody.example.com. '
+                '%d 600 1800 604800 300' % (domain, domain, serial),
+                'update delete %s.%s. CNAME' % (hostname, domain),
+                'update add %s.%s. 300 IN CNAME %s.%s.' % (
+                    hostname, domain, generated_hostname(ip), domain),
+            ],
+            dns_zone_config.get_update_commands())
+
+    def test_get_update_commands_deletes_cnames_of_removed_hosts(self):
+        domain = factory.make_name('zone')
+        hostname = factory.make_name('hostname')
+        dns_zone_config = DNSForwardZoneConfig(
+            domain, serial=random.randint(1, 100),
+            removed_hostnames=[hostname])
+        self.assertEqual(
+            'update delete %s.%s. CNAME' % (hostname, domain),
+            dns_zone_config.get_update_commands()[-1])
+
     def test_get_static_mapping(self):
         name = factory.getRandomString()
         network = IPNetwork('192.12.0.1/30')
@@ -316,13 +516,7 @@ class TestDNSForwardZoneConfig(TestCase):
         dns_zone_config = DNSForwardZoneConfig(
             name, networks=[network], dns_ip=dns_ip)
         self.assertItemsEqual(
-            [
-                ('%s.' % name, dns_ip),
-                (generated_hostname('192.12.0.0'), '192.12.0.0'),
-                (generated_hostname('192.12.0.1'), '192.12.0.1'),
-                (generated_hostname('192.12.0.2'), '192.12.0.2'),
-                (generated_hostname('192.12.0.3'), '192.12.0.3'),
-             ],
+            [('%s.' % name, dns_ip)],
             dns_zone_config.get_static_mapping(),
             )
 
@@ -337,29 +531,39 @@ class TestDNSForwardZoneConfig(TestCase):
             MatchesAll(
                 IsInstance(Iterable), Not(IsInstance(Sequence))))
 
-    def test_get_static_mapping_multiple_networks(self):
-        name = factory.getRandomString()
-        networks = IPNetwork('11.11.11.11/31'), IPNetwork('22.22.22.22/31')
-        dns_ip = factory.getRandomIPInNetwork(networks[0])
+    def test_get_generate_directives(self):
         dns_zone_config = DNSForwardZoneConfig(
-            name, networks=networks, dns_ip=dns_ip)
-        self.assertItemsEqual(
+            factory.getRandomString(), networks=[IPNetwork('192.12.0.1/30')])
+        self.assertEqual(
+            [('0-3', '192-12-0-$', '192.12.0.$')],
+            list(dns_zone_config.get_generate_directives()))
+
+    def test_get_generate_directives_returns_iterator(self):
+        dns_zone_config = DNSForwardZoneConfig(
+            factory.getRandomString(), networks=[IPNetwork('192.12.0.1/30')])
+        self.assertThat(
+            dns_zone_config.get_generate_directives(),
+            MatchesAll(
+                IsInstance(Iterable), Not(IsInstance(Sequence))))
+
+    def test_get_generate_directives_multiple_networks(self):
+        networks = IPNetwork('11.11.11.11/31'), IPNetwork('22.22.0.0/23')
+        dns_zone_config = DNSForwardZoneConfig(
+            factory.getRandomString(), networks=networks)
+        self.assertEqual(
             [
-                ('%s.' % name, dns_ip),
-                (generated_hostname('11.11.11.10'), '11.11.11.10'),
-                (generated_hostname('11.11.11.11'), '11.11.11.11'),
-                (generated_hostname('22.22.22.22'), '22.22.22.22'),
-                (generated_hostname('22.22.22.23'), '22.22.22.23'),
+                ('10-11', '11-11-11-$', '11.11.11.$'),
+                ('0-255', '22-22-0-$', '22.22.0.$'),
+                ('0-255', '22-22-1-$', '22.22.1.$'),
             ],
-            dns_zone_config.get_static_mapping(),
-            )
+            list(dns_zone_config.get_generate_directives()))
 
     def test_writes_dns_zone_config(self):
         target_dir = self.make_dir()
         self.patch(DNSForwardZoneConfig, 'target_dir', target_dir)
         domain = factory.getRandomString()
         hostname = factory.getRandomString()
-        network = factory.getRandomNetwork()
+        network = IPNetwork('192.168.0.0/24')
         ip = factory.getRandomIPInNetwork(network)
         dns_zone_config = DNSForwardZoneConfig(
             domain, serial=random.randint(1, 100),
@@ -371,7 +575,7 @@ class TestDNSForwardZoneConfig(TestCase):
                 matcher=ContainsAll(
                     [
                         '%s IN CNAME %s' % (hostname, generated_hostname(ip)),
-                        '%s IN A %s' % (generated_hostname(ip), ip),
+                        '$GENERATE 0-255 192-168-0-$ IN A 192.168.0.$',
                     ])))
 
     def test_writes_dns_zone_config_with_NS_record(self):
@@ -392,6 +596,38 @@ class TestDNSForwardZoneConfig(TestCase):
                         '%s. IN A %s' % (dns_zone_config.domain, dns_ip),
                     ])))
 
+    def test_write_config_keeps_unchanged_zone_and_serial(self):
+        self.patch(DNSForwardZoneConfig, 'target_dir', self.make_dir())
+        domain = factory.make_name('zone')
+        network = factory.getRandomNetwork()
+        mapping = {
+            factory.make_name('host'): factory.getRandomIPInNetwork(network)}
+        DNSForwardZoneConfig(
+            domain, serial=1, mapping=mapping,
+            networks=[network]).write_config()
+        dns_zone_config = DNSForwardZoneConfig(
+            domain, serial=2, mapping=mapping, networks=[network])
+        self.assertFalse(dns_zone_config.write_config())
+        self.assertThat(
+            dns_zone_config.target_path,
+            FileContains(matcher=Contains('1 ; serial')))
+
+    def test_write_config_writes_zone_with_changed_records(self):
+        self.patch(DNSForwardZoneConfig, 'target_dir', self.make_dir())
+        domain = factory.make_name('zone')
+        network = factory.getRandomNetwork()
+        DNSForwardZoneConfig(
+            domain, serial=1, networks=[network]).write_config()
+        hostname = factory.make_name('host')
+        dns_zone_config = DNSForwardZoneConfig(
+            domain, serial=2, networks=[network],
+            mapping={hostname: factory.getRandomIPInNetwork(network)})
+        self.assertTrue(dns_zone_config.write_config())
+        self.assertThat(
+            dns_zone_config.target_path,
+            FileContains(
+                matcher=ContainsAll(['2 ; serial', '%s IN CNAME' % hostname])))
+
     def test_config_file_is_world_readable(self):
         self.patch(DNSForwardZoneConfig, 'target_dir', self.make_dir())
         network = factory.getRandomNetwork()
@@ -466,27 +702,32 @@ class TestDNSReverseZoneConfig(TestCase):
             '168.192.in-addr.arpa',
             dns_zone_config.zone_name)
 
-    def test_get_static_mapping_returns_iterator(self):
+    def test_get_generate_directives_returns_iterator(self):
         dns_zone_config = DNSReverseZoneConfig(
             factory.getRandomString(), network=IPNetwork('192.12.0.1/30'))
         self.assertThat(
-            dns_zone_config.get_static_mapping(),
+            dns_zone_config.get_generate_directives(),
             MatchesAll(
                 IsInstance(Iterable), Not(IsInstance(Sequence))))
 
-    def test_get_static_mapping(self):
+    def test_get_generate_directives(self):
         name = factory.getRandomString()
         network = IPNetwork('192.12.0.1/30')
         dns_zone_config = DNSReverseZoneConfig(name, network=network)
-        self.assertItemsEqual(
+        self.assertEqual(
+            [('0-3', '$', '192-12-0-$.%s.' % name)],
+            list(dns_zone_config.get_generate_directives()))
+
+    def test_get_generate_directives_slash_22(self):
+        name = factory.getRandomString()
+        network = IPNetwork('192.12.4.1/22')
+        dns_zone_config = DNSReverseZoneConfig(name, network=network)
+        self.assertEqual(
             [
-                ('0', '%s.' % generated_hostname('192.12.0.0', name)),
-                ('1', '%s.' % generated_hostname('192.12.0.1', name)),
-                ('2', '%s.' % generated_hostname('192.12.0.2', name)),
-                ('3', '%s.' % generated_hostname('192.12.0.3', name)),
+                ('0-255', '$.%d' % octet, '192-12-%d-$.%s.' % (octet, name))
+                for octet in range(4, 8)
             ],
-            dns_zone_config.get_static_mapping(),
-            )
+            list(dns_zone_config.get_generate_directives()))
 
     def test_writes_dns_zone_config_with_NS_record(self):
         target_dir = self.make_dir()
@@ -512,8 +753,11 @@ class TestDNSReverseZoneConfig(TestCase):
             domain, serial=random.randint(1, 100), network=network)
         dns_zone_config.write_config()
         reverse_file_name = 'zone.168.192.in-addr.arpa'
-        expected = Contains(
-            '10.0 IN PTR %s' % generated_hostname('192.168.0.10'))
+        expected = ContainsAll([
+            '$GENERATE 0-255 $.%d IN PTR 192-168-%d-$.%s.' % (
+                octet, octet, domain)
+            for octet in range(4)
+            ])
         self.assertThat(
             os.path.join(target_dir, reverse_file_name),
             FileContains(matcher=expected))
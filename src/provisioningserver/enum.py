@@ -14,6 +14,8 @@ __all__ = [
     'ARP_HTYPE',
     'IPMI_DRIVER',
     'IPMI_DRIVER_CHOICES',
+    'POWER_STATE',
+    'POWER_STATE_CHOICES',
     'POWER_TYPE',
     'POWER_TYPE_CHOICES',
     ]
@@ -50,6 +52,26 @@ POWER_TYPE_CHOICES = (
     )
 
 
+class POWER_STATE:
+    """The last known state of a node's power."""
+    # The state has not been queried, or a power change is under way.
+    UNKNOWN = 'unknown'
+    # The node is powered on.
+    ON = 'on'
+    # The node is powered off.
+    OFF = 'off'
+    # The power state could not be queried.
+    ERROR = 'error'
+
+
+POWER_STATE_CHOICES = (
+    (POWER_STATE.UNKNOWN, "Unknown"),
+    (POWER_STATE.ON, "On"),
+    (POWER_STATE.OFF, "Off"),
+    (POWER_STATE.ERROR, "Error"),
+    )
+
+
 class IPMI_DRIVER:
     DEFAULT = ''
     LAN = 'LAN'
@@ -13,18 +13,25 @@ __metaclass__ = type
 __all__ = []
 
 from provisioningserver.amqpclient import AMQFactory
+from provisioningserver.cluster_config import get_cluster_uuid
 from provisioningserver.config import Config
 from provisioningserver.services import (
+    LeasesWatcherService,
     LogService,
     OOPSService,
     )
-from provisioningserver.tftp import TFTPBackend
+from provisioningserver.tasks import update_dhcp_leases
+from provisioningserver.tftp import (
+    PXEConfigCacheInvalidator,
+    TFTPBackend,
+    )
 from provisioningserver.utils import get_all_interface_addresses
 from tftp.protocol import TFTP
 from twisted.application import internet
 from twisted.application.internet import (
     TCPClient,
     TCPServer,
+    TimerService,
     )
 from twisted.application.service import (
     IServiceMaker,
@@ -38,6 +45,7 @@ from twisted.internet.defer import (
     inlineCallbacks,
     returnValue,
     )
+from twisted.internet.threads import deferToThread
 from twisted.plugin import IPlugin
 from twisted.python import (
     log,
@@ -89,6 +97,24 @@ class ProvisioningRealm:
         raise NotImplementedError()
 
 
+def request_leases_update():
+    """Ask this cluster's workers to upload the DHCP leases.
+
+    The task goes through the message broker in this cluster's Celery
+    config, or the one that `CELERY_BROKER_URL` in the environment names
+    instead, just as for the workers themselves.
+
+    Calling this blocks, so it's best run in a thread.
+    """
+    app = update_dhcp_leases.app
+    connection = app.broker_connection(app.conf.BROKER_HOST)
+    try:
+        update_dhcp_leases.apply_async(
+            queue=get_cluster_uuid(), connection=connection)
+    finally:
+        connection.release()
+
+
 class Options(usage.Options):
     """Command line options for the provisioning server."""
 
@@ -150,7 +176,9 @@ class ProvisioningServiceMaker(object):
 
     def _makeTFTPService(self, tftp_config):
         """Create the dynamic TFTP service."""
-        backend = TFTPBackend(tftp_config["root"], tftp_config["generator"])
+        backend = TFTPBackend(
+            tftp_config["root"], tftp_config["generator"],
+            tftp_config["cache_ttl"], tftp_config["generator_connections"])
         # Create a UDP server individually for each discovered network
         # interface, so that we can detect the interface via which we have
         # received a datagram.
@@ -161,8 +189,31 @@ class ProvisioningServiceMaker(object):
                 tftp_config["port"], TFTP(backend), interface=address)
             tftp_service.setName(address)
             tftp_service.setServiceParent(tftp_services)
+        # This cluster's workers tell the TFTP server when the PXE configs
+        # it has cached are out of date.  Only listen locally.
+        cache = backend.kernel_params_cache
+        invalidation_service = internet.UDPServer(
+            tftp_config["invalidation_port"],
+            PXEConfigCacheInvalidator(cache), interface="127.0.0.1")
+        invalidation_service.setName("pxe-config-invalidation")
+        invalidation_service.setServiceParent(tftp_services)
+        report_service = TimerService(300, cache.report)
+        report_service.setName("pxe-config-cache-report")
+        report_service.setServiceParent(tftp_services)
         return tftp_services
 
+    def _makeLeasesWatcherService(self, dhcp_config):
+        """Create the DHCP leases watcher service.
+
+        The upload itself is left to this cluster's workers, which hold
+        the credentials for the region controller's API.
+        """
+        def upload():
+            return deferToThread(request_leases_update)
+
+        return LeasesWatcherService(
+            dhcp_config["leases_file"], upload, dhcp_config["debounce"])
+
     def makeService(self, options):
         """Construct a service."""
         services = MultiService()
@@ -184,4 +235,7 @@ class ProvisioningServiceMaker(object):
         tftp_service = self._makeTFTPService(config["tftp"])
         tftp_service.setServiceParent(services)
 
+        leases_service = self._makeLeasesWatcherService(config["dhcp"])
+        leases_service.setServiceParent(services)
+
         return services
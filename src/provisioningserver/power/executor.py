@@ -0,0 +1,299 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Concurrent execution of batches of power actions."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = [
+    "get_bmc_subnet",
+    "parse_power_state",
+    "PowerActionResult",
+    "PowerExecutor",
+    "summarise_results",
+    ]
+
+from collections import (
+    defaultdict,
+    deque,
+    namedtuple,
+    )
+from logging import getLogger
+import socket
+from threading import Thread
+from time import time
+from urlparse import urlparse
+
+from celery.app import app_or_default
+from netaddr import (
+    AddrFormatError,
+    IPNetwork,
+    )
+from provisioningserver.enum import (
+    POWER_STATE,
+    POWER_TYPE,
+    )
+from provisioningserver.power.poweraction import (
+    PowerAction,
+    PowerActionFail,
+    UnknownPowerType,
+    )
+from provisioningserver.power.wakeonlan import (
+    make_magic_packet,
+    send_magic_packets,
+    )
+
+
+logger = getLogger(__name__)
+
+
+class PowerActionResult(namedtuple('PowerActionResult', (
+        'system_id',
+        'power_type',
+        'power_change',
+        'attempts',
+        'latency',
+        'error',
+        'power_state',
+        ))):
+    """The outcome of a power action on one node.
+
+    :ivar attempts: How many times the action was tried.
+    :ivar latency: Seconds from the first attempt to the last one ending.
+    :ivar error: The exception that failed the last attempt, or None.
+    :ivar power_state: For a 'query', the node's `POWER_STATE`, if the
+        query succeeded; otherwise None.
+    """
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+def get_bmc_subnet(power_params, prefix_length):
+    """Return the subnet of the BMC that `power_params` address.
+
+    Power actions are limited per subnet, so as not to overwhelm a rack's
+    management network.
+
+    :return: The subnet, of the given prefix length, if the power address
+        is an IP address.  Otherwise, the host name in the power address;
+        or None if there is no power address at all.
+    """
+    address = power_params.get('power_address')
+    if not address:
+        return None
+    if '://' in address:
+        address = urlparse(address).hostname
+    try:
+        return unicode(IPNetwork('%s/%d' % (address, prefix_length)).cidr)
+    except (AddrFormatError, ValueError):
+        return address
+
+
+def parse_power_state(output):
+    """Read the power state from the output of a power 'query'.
+
+    :raise PowerActionFail: If the output is not a power state.
+    """
+    power_state = output.strip()
+    if power_state not in (POWER_STATE.ON, POWER_STATE.OFF):
+        raise PowerActionFail("Unexpected power state: %r" % power_state)
+    return power_state
+
+
+def summarise_results(results):
+    """Compute statistics for a batch of `PowerActionResult`s.
+
+    :return: A dict with the numbers of nodes, failures, and retried
+        actions, and the mean and maximum latency in seconds.
+    """
+    latencies = [result.latency for result in results]
+    return {
+        'nodes': len(results),
+        'failures': len(
+            [result for result in results if not result.succeeded]),
+        'retried': len([result for result in results if result.attempts > 1]),
+        'mean_latency': sum(latencies) / len(latencies) if latencies else 0,
+        'max_latency': max(latencies) if latencies else 0,
+        }
+
+
+class PowerExecutor:
+    """Run batches of power actions concurrently.
+
+    Each BMC subnet gets up to `actions_per_subnet` turns at a time, which
+    take the subnet's actions one after the other.  So the actions for
+    different racks proceed in parallel, without any one management
+    network having to take more than a few at a time.  The turns are dealt
+    out to at most `actions_total` threads, each subnet's first turn
+    before any subnet's second, and a thread takes its turns in order.
+
+    Wake-on-LAN needs no power script: the magic packets for all the
+    nodes in a batch are sent at once, see `send_magic_packets`.
+
+    The settings default to the POWER_* values in the Celery config.
+
+    :param actions_per_subnet: Maximum number of actions running at the
+        same time against BMCs in the same subnet.
+    :param actions_total: Maximum number of actions running at the same
+        time, across all subnets.
+    :param prefix_length: Prefix length of the BMC subnets.
+    :param timeout: Seconds to allow each attempt at an action.
+    :param attempts: Number of attempts at each action before giving up.
+    """
+
+    def __init__(self, actions_per_subnet=None, prefix_length=None,
+                 timeout=None, attempts=None, actions_total=None):
+        conf = app_or_default().conf
+        if actions_per_subnet is None:
+            actions_per_subnet = conf.POWER_ACTIONS_PER_SUBNET
+        if actions_total is None:
+            actions_total = conf.POWER_ACTIONS_TOTAL
+        if prefix_length is None:
+            prefix_length = conf.POWER_SUBNET_PREFIX_LENGTH
+        if timeout is None:
+            timeout = conf.POWER_ACTION_TIMEOUT
+        if attempts is None:
+            attempts = conf.POWER_ACTION_ATTEMPTS
+        self.actions_per_subnet = actions_per_subnet
+        self.actions_total = actions_total
+        self.prefix_length = prefix_length
+        self.timeout = timeout
+        self.attempts = attempts
+
+    def run_action(self, power_type, power_change, power_params):
+        """Run one power action, with retries.
+
+        :return: A `PowerActionResult`.
+        """
+        start = time()
+        power_state = None
+        for attempt in range(1, self.attempts + 1):
+            try:
+                action = PowerAction(power_type, timeout=self.timeout)
+                output = action.execute(
+                    power_change=power_change, **power_params)
+                if power_change == 'query':
+                    power_state = parse_power_state(output)
+            except UnknownPowerType as error:
+                # Trying again won't help.
+                break
+            except PowerActionFail as error:
+                logger.debug(
+                    "Attempt %d to power %s node %s failed: %s", attempt,
+                    power_change, power_params.get('system_id'), error)
+            except Exception as error:
+                # Record the failure, rather than let it kill the thread
+                # and leave the rest of its actions undone.
+                logger.exception(
+                    "Could not power %s node %s.",
+                    power_change, power_params.get('system_id'))
+                break
+            else:
+                error = None
+                break
+        return PowerActionResult(
+            system_id=power_params.get('system_id'), power_type=power_type,
+            power_change=power_change, attempts=attempt,
+            latency=time() - start, error=error, power_state=power_state)
+
+    def wake_nodes(self, actions, power_change, results):
+        """Wake up the nodes for Wake-on-LAN `actions`, all at once.
+
+        :param actions: A list of (index, power type, power parameters)
+            tuples.
+        :param results: The list of results, to store each result at its
+            action's index.
+        """
+        start = time()
+        errors = {}
+        if power_change != 'on':
+            error = PowerActionFail(
+                "Wake-on-LAN can only power nodes on; it cannot %s them." % (
+                    'query' if power_change == 'query' else 'power down'))
+            errors = {index: error for index, _, _ in actions}
+        else:
+            mac_addresses = {}
+            for index, _, power_params in actions:
+                mac_address = power_params.get('mac_address')
+                try:
+                    make_magic_packet(mac_address or '')
+                except ValueError as e:
+                    errors[index] = PowerActionFail(e)
+                else:
+                    mac_addresses[index] = mac_address
+            if len(mac_addresses) > 0:
+                try:
+                    send_magic_packets(mac_addresses.values())
+                except socket.error as e:
+                    error = PowerActionFail(e)
+                    errors.update((index, error) for index in mac_addresses)
+        latency = time() - start
+        for index, power_type, power_params in actions:
+            results[index] = PowerActionResult(
+                system_id=power_params.get('system_id'),
+                power_type=power_type, power_change=power_change, attempts=1,
+                latency=latency, error=errors.get(index), power_state=None)
+
+    def run_actions(self, turns, power_change, results):
+        """Run actions one after the other, until there are none left.
+
+        :param turns: A list of deques of (index, power type, power
+            parameters) tuples, one deque for each turn, shared with other
+            threads.  Each is emptied before moving on to the next.
+        :param results: The list of results, to store each result at its
+            action's index.
+        """
+        for actions in turns:
+            while True:
+                try:
+                    index, power_type, power_params = actions.popleft()
+                except IndexError:
+                    break
+                results[index] = self.run_action(
+                    power_type, power_change, power_params)
+
+    def execute(self, power_actions, power_change):
+        """Run `power_actions`, and wait for all of them to finish.
+
+        :param power_actions: A list of (power type, power parameters)
+            pairs, one for each node.
+        :param power_change: The change to request: 'on' or 'off'; or
+            'query' to find out the nodes' power states.
+        :return: A list of `PowerActionResult`s, in the same order as
+            `power_actions`.
+        """
+        wake_on_lan_actions = []
+        actions_by_subnet = defaultdict(deque)
+        for index, (power_type, power_params) in enumerate(power_actions):
+            if power_type == POWER_TYPE.WAKE_ON_LAN:
+                wake_on_lan_actions.append((index, power_type, power_params))
+            else:
+                subnet = get_bmc_subnet(power_params, self.prefix_length)
+                actions_by_subnet[subnet].append(
+                    (index, power_type, power_params))
+        results = [None] * len(power_actions)
+        turns = [
+            actions
+            for turn in range(self.actions_per_subnet)
+            for actions in actions_by_subnet.values()
+            if turn < len(actions)]
+        num_threads = min(self.actions_total, len(turns))
+        threads = [
+            Thread(
+                target=self.run_actions,
+                args=(turns[thread::num_threads], power_change, results))
+            for thread in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        if len(wake_on_lan_actions) > 0:
+            self.wake_nodes(wake_on_lan_actions, power_change, results)
+        for thread in threads:
+            thread.join()
+        return results
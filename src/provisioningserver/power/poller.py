@@ -0,0 +1,106 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Periodic checks of the power states of a cluster's nodes.
+
+The cluster controller's worker gets the power parameters of its nodes
+from the region controller, queries all of their power states at once,
+and reports back only the states that changed.
+"""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = [
+    'poll_power_states',
+    ]
+
+from logging import getLogger
+
+from provisioningserver.api_client import (
+    check_response,
+    get_cached_knowledge,
+    process_response,
+    )
+from provisioningserver.enum import POWER_STATE
+from provisioningserver.power.executor import PowerExecutor
+from provisioningserver.utils import split_chunks
+import simplejson as json
+
+
+logger = getLogger(__name__)
+
+
+# How many nodes' power states are reported to the region controller in
+# one request.
+DEFAULT_BATCH_SIZE = 100
+
+
+def get_power_parameters(client, nodegroup_uuid):
+    """Get the power parameters of the nodegroup's nodes.
+
+    :return: A list of dicts, each with a node's system_id, power_type,
+        power_parameters, and last known power_state.
+    """
+    path = '/api/1.0/nodegroups/%s/' % nodegroup_uuid
+    return process_response(client.get(path, op='list_power_parameters'))
+
+
+def post_power_states(client, nodegroup_uuid, power_states):
+    """Report changed power states to the region controller.
+
+    :param power_states: A dict mapping system_ids to power states.
+    """
+    path = '/api/1.0/nodegroups/%s/' % nodegroup_uuid
+    check_response(client.post(
+        path, op='update_power_states', states=json.dumps(power_states)))
+
+
+def query_power_states(nodes):
+    """Query the power states of `nodes`, all at once.
+
+    :param nodes: A list of dicts, as returned by `get_power_parameters`.
+    :return: A dict mapping the nodes' system_ids to their power states.
+        Nodes whose power states could not be queried are in
+        `POWER_STATE.ERROR`.
+    """
+    results = PowerExecutor().execute(
+        [(node['power_type'], node['power_parameters']) for node in nodes],
+        'query')
+    power_states = {}
+    for node, result in zip(nodes, results):
+        if result.succeeded:
+            power_states[node['system_id']] = result.power_state
+        else:
+            logger.warning(
+                "Could not query power state of node %s: %s",
+                node['system_id'], result.error)
+            power_states[node['system_id']] = POWER_STATE.ERROR
+    return power_states
+
+
+def poll_power_states(batch_size=DEFAULT_BATCH_SIZE):
+    """Check the power states of this cluster's nodes, and report changes.
+
+    :param batch_size: How many nodes' power states to report in each
+        request to the region controller.
+    """
+    client, nodegroup_uuid = get_cached_knowledge()
+    if client is None:
+        logger.debug("Not polling power states: not registered yet.")
+        return
+    nodes = get_power_parameters(client, nodegroup_uuid)
+    power_states = query_power_states(nodes)
+    changes = sorted(
+        (node['system_id'], power_states[node['system_id']])
+        for node in nodes
+        if power_states[node['system_id']] != node['power_state'])
+    for chunk in split_chunks(changes, batch_size):
+        post_power_states(client, nodegroup_uuid, dict(chunk))
+    logger.info(
+        "Polled power states of %d nodes: %d changed.",
+        len(nodes), len(changes))
@@ -13,12 +13,15 @@ __metaclass__ = type
 __all__ = [
     "PowerAction",
     "PowerActionFail",
+    "PowerActionTimeout",
     "UnknownPowerType",
     ]
 
 
 import os
+import signal
 import subprocess
+from threading import Timer
 
 from celery.app import app_or_default
 from provisioningserver.utils import ShellTemplate
@@ -32,6 +35,15 @@ class PowerActionFail(Exception):
     """Raised when there's a problem executing a power script."""
 
 
+class PowerActionTimeout(PowerActionFail):
+    """Raised when a power script takes too long, and has been killed."""
+
+
+# Compiled power templates, by path, with the modification times of the
+# files they were compiled from: {path: (mtime, template)}.
+template_cache = {}
+
+
 def get_power_templates_dir():
     """Get the power-templates directory from the config."""
     return app_or_default().conf.POWER_TEMPLATES_DIR
@@ -46,19 +58,22 @@ class PowerAction:
     """Actions for power-related operations.
 
     :param power_type: A value from :class:`POWER_TYPE`.
+    :param timeout: Optional number of seconds after which the power
+        script is killed.
 
     The class is intended to be used in two phases:
     1. Instantiation, passing the power_type.
     2. .execute(), passing any template parameters required by the template.
     """
 
-    def __init__(self, power_type):
+    def __init__(self, power_type, timeout=None):
         self.path = os.path.join(
             self.template_basedir, power_type + ".template")
         if not os.path.exists(self.path):
             raise UnknownPowerType(power_type)
 
         self.power_type = power_type
+        self.timeout = timeout
 
     @property
     def template_basedir(self):
@@ -85,8 +100,18 @@ class PowerAction:
             return power_config_dir
 
     def get_template(self):
-        with open(self.path, "rb") as f:
-            return ShellTemplate(f.read(), name=self.path)
+        """Return the compiled template.
+
+        Templates are compiled once, and then only again if their file
+        changes.
+        """
+        mtime = os.path.getmtime(self.path)
+        cached = template_cache.get(self.path)
+        if cached is None or cached[0] != mtime:
+            with open(self.path, "rb") as f:
+                template = ShellTemplate(f.read(), name=self.path)
+            cached = template_cache[self.path] = (mtime, template)
+        return cached[1]
 
     def get_extra_context(self):
         """Extra context used when rending the power templates."""
@@ -114,11 +139,25 @@ class PowerAction:
         try:
             proc = subprocess.Popen(
                 commands, shell=True, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, close_fds=True)
+                stderr=subprocess.PIPE, close_fds=True,
+                preexec_fn=os.setsid)
         except OSError as e:
             raise PowerActionFail(e)
 
-        stdout, stderr = proc.communicate()
+        # The script runs in a process group of its own, so that it can be
+        # killed along with any commands it is waiting for.
+        killed = []
+        if self.timeout is not None:
+            timer = Timer(self.timeout, self.kill, [proc, killed])
+            timer.start()
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            if self.timeout is not None:
+                timer.cancel()
+        if len(killed) > 0:
+            raise PowerActionTimeout("%s timed out after %s seconds" % (
+                self.power_type, self.timeout))
         # TODO: log output on errors
         code = proc.returncode
         if code != 0:
@@ -126,12 +165,26 @@ class PowerAction:
                 self.power_type, code))
         return stdout, stderr
 
+    def kill(self, proc, killed):
+        """Kill `proc`'s process group, and note that in `killed`."""
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            # It has finished already.
+            pass
+        else:
+            killed.append(proc.pid)
+
     def execute(self, **kwargs):
         """Execute the template.
 
         Any supplied parameters will be passed to the template as substitution
         values.
+
+        :return: The script's output.  When `power_change` is 'query', that
+            is the node's power state.
         """
         template = self.get_template()
         rendered = self.render_template(template, **kwargs)
-        self.run_shell(rendered)
+        stdout, stderr = self.run_shell(rendered)
+        return stdout
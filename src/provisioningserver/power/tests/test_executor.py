@@ -0,0 +1,327 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Tests for `provisioningserver.power.executor`."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = []
+
+import socket
+from threading import (
+    Event,
+    Lock,
+    )
+
+from maastesting.factory import factory
+from maastesting.testcase import TestCase
+from mock import Mock
+from provisioningserver.enum import (
+    POWER_STATE,
+    POWER_TYPE,
+    )
+from provisioningserver.power import executor as executor_module
+from provisioningserver.power.executor import (
+    get_bmc_subnet,
+    parse_power_state,
+    PowerActionResult,
+    PowerExecutor,
+    summarise_results,
+    )
+from provisioningserver.power.poweraction import (
+    PowerAction,
+    PowerActionFail,
+    PowerActionTimeout,
+    )
+
+
+arbitrary_mac = "AA:BB:CC:DD:EE:FF"
+
+
+class TestGetBMCSubnet(TestCase):
+
+    def test_returns_subnet_of_ip_address(self):
+        self.assertEqual(
+            '10.1.2.0/24',
+            get_bmc_subnet({'power_address': '10.1.2.3'}, 24))
+
+    def test_returns_subnet_of_host_in_url(self):
+        self.assertEqual(
+            '10.1.0.0/16',
+            get_bmc_subnet(
+                {'power_address': 'qemu+ssh://10.1.2.3/system'}, 16))
+
+    def test_returns_host_name(self):
+        self.assertEqual(
+            'localhost',
+            get_bmc_subnet({'power_address': 'qemu://localhost/system'}, 24))
+
+    def test_returns_None_without_power_address(self):
+        self.assertIsNone(get_bmc_subnet({}, 24))
+
+
+class TestParsePowerState(TestCase):
+
+    def test_returns_power_state(self):
+        self.assertEqual(
+            [POWER_STATE.ON, POWER_STATE.OFF],
+            [parse_power_state('on\n'), parse_power_state(' off')])
+
+    def test_rejects_other_output(self):
+        self.assertRaises(PowerActionFail, parse_power_state, 'running')
+
+
+class TestSummariseResults(TestCase):
+
+    def test_summarises_results(self):
+        results = [
+            PowerActionResult(
+                'node-1', POWER_TYPE.IPMI, 'on', 1, 1.0, None, None),
+            PowerActionResult(
+                'node-2', POWER_TYPE.IPMI, 'on', 2, 3.0, PowerActionFail(),
+                None),
+            ]
+        self.assertEqual(
+            {
+                'nodes': 2,
+                'failures': 1,
+                'retried': 1,
+                'mean_latency': 2.0,
+                'max_latency': 3.0,
+            },
+            summarise_results(results))
+
+    def test_summarises_no_results(self):
+        self.assertEqual(0, summarise_results([])['max_latency'])
+
+
+class TestPowerExecutor(TestCase):
+
+    def make_power_actions(self, count, power_address='10.0.0.1'):
+        return [
+            (POWER_TYPE.IPMI, {
+                'system_id': factory.make_name('node'),
+                'power_address': power_address,
+                })
+            for counter in range(count)]
+
+    def test_defaults_to_config(self):
+        executor = PowerExecutor()
+        self.assertEqual(
+            (10, 100, 24, 60, 2),
+            (
+                executor.actions_per_subnet, executor.actions_total,
+                executor.prefix_length, executor.timeout, executor.attempts,
+            ))
+
+    def test_run_action_executes_power_action(self):
+        execute = self.patch(PowerAction, 'execute')
+        executor = PowerExecutor(timeout=5)
+        [(power_type, power_params)] = self.make_power_actions(1)
+        result = executor.run_action(power_type, 'on', power_params)
+        execute.assert_called_once_with(power_change='on', **power_params)
+        self.assertEqual(
+            (power_params['system_id'], 1, True),
+            (result.system_id, result.attempts, result.succeeded))
+
+    def test_run_action_passes_timeout(self):
+        power_action = self.patch(executor_module, 'PowerAction')
+        PowerExecutor(timeout=5).run_action(POWER_TYPE.IPMI, 'on', {})
+        power_action.assert_called_once_with(POWER_TYPE.IPMI, timeout=5)
+
+    def test_run_action_queries_power_state(self):
+        self.patch(PowerAction, 'execute', Mock(return_value='off\n'))
+        result = PowerExecutor().run_action(POWER_TYPE.IPMI, 'query', {})
+        self.assertEqual(POWER_STATE.OFF, result.power_state)
+
+    def test_run_action_fails_query_with_unexpected_output(self):
+        self.patch(PowerAction, 'execute', Mock(return_value='maybe'))
+        result = PowerExecutor(attempts=1).run_action(
+            POWER_TYPE.IPMI, 'query', {})
+        self.assertEqual(
+            (False, None), (result.succeeded, result.power_state))
+
+    def test_run_action_does_not_set_power_state_for_power_change(self):
+        self.patch(PowerAction, 'execute', Mock(return_value='on'))
+        result = PowerExecutor().run_action(POWER_TYPE.IPMI, 'on', {})
+        self.assertIsNone(result.power_state)
+
+    def test_run_action_retries(self):
+        error = PowerActionTimeout()
+        self.patch(
+            PowerAction, 'execute', Mock(side_effect=[error, None]))
+        result = PowerExecutor(attempts=3).run_action(
+            POWER_TYPE.IPMI, 'on', {})
+        self.assertEqual((2, True), (result.attempts, result.succeeded))
+
+    def test_run_action_gives_up_after_attempts(self):
+        error = PowerActionFail()
+        execute = self.patch(PowerAction, 'execute', Mock(side_effect=error))
+        result = PowerExecutor(attempts=2).run_action(
+            POWER_TYPE.IPMI, 'on', {})
+        self.assertEqual(
+            (2, 2, error), (execute.call_count, result.attempts, result.error))
+
+    def test_run_action_does_not_retry_unknown_power_type(self):
+        result = PowerExecutor(attempts=3).run_action(
+            factory.make_name('power_type', sep=''), 'on', {})
+        self.assertEqual((1, False), (result.attempts, result.succeeded))
+
+    def test_run_action_fails_on_unexpected_error(self):
+        error = ZeroDivisionError()
+        self.patch(PowerAction, 'execute', Mock(side_effect=error))
+        result = PowerExecutor(attempts=3).run_action(
+            POWER_TYPE.IPMI, 'on', {})
+        self.assertEqual(
+            (1, False, error),
+            (result.attempts, result.succeeded, result.error))
+
+    def test_execute_returns_results_in_order(self):
+        self.patch(PowerAction, 'execute')
+        power_actions = (
+            self.make_power_actions(3, '10.0.0.1') +
+            self.make_power_actions(3, '10.9.0.1'))
+        results = PowerExecutor(actions_per_subnet=2).execute(
+            power_actions, 'off')
+        self.assertEqual(
+            [power_params['system_id'] for _, power_params in power_actions],
+            [result.system_id for result in results])
+
+    def test_execute_limits_concurrency_per_subnet(self):
+        lock = Lock()
+        running = {'now': 0, 'max': 0}
+        released = Event()
+
+        def execute(action, **kwargs):
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+                if running['now'] == 2:
+                    released.set()
+            released.wait(5)
+            with lock:
+                running['now'] -= 1
+
+        self.patch(PowerAction, 'execute', execute)
+        PowerExecutor(actions_per_subnet=2).execute(
+            self.make_power_actions(6), 'on')
+        self.assertEqual(2, running['max'])
+
+    def test_execute_limits_concurrency_in_total(self):
+        lock = Lock()
+        running = {'now': 0, 'max': 0}
+        released = Event()
+
+        def execute(action, **kwargs):
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+                if running['now'] == 3:
+                    released.set()
+            released.wait(5)
+            with lock:
+                running['now'] -= 1
+
+        self.patch(PowerAction, 'execute', execute)
+        power_actions = (
+            self.make_power_actions(4, '10.0.0.1') +
+            self.make_power_actions(4, '10.9.0.1'))
+        results = PowerExecutor(
+            actions_per_subnet=2, actions_total=3).execute(
+            power_actions, 'on')
+        self.assertEqual(3, running['max'])
+        self.assertEqual(
+            [True] * 8, [result.succeeded for result in results])
+
+    def test_execute_continues_after_unexpected_error(self):
+        self.patch(
+            PowerAction, 'execute',
+            Mock(side_effect=[ZeroDivisionError(), None, None]))
+        results = PowerExecutor(actions_per_subnet=1).execute(
+            self.make_power_actions(3), 'on')
+        self.assertEqual(
+            [False, True, True], [result.succeeded for result in results])
+        self.assertEqual(1, summarise_results(results)['failures'])
+
+    def test_execute_runs_subnets_in_parallel(self):
+        # Each subnet is limited to one action at a time, but the actions
+        # for the two subnets have to run at the same time, or neither
+        # gets to finish.
+        started = Event()
+        both_started = Event()
+        lock = Lock()
+
+        def execute(action, **kwargs):
+            with lock:
+                if started.is_set():
+                    both_started.set()
+                started.set()
+            if not both_started.wait(5):
+                raise PowerActionFail("Subnets ran one after the other.")
+
+        self.patch(PowerAction, 'execute', execute)
+        power_actions = (
+            self.make_power_actions(1, '10.0.0.1') +
+            self.make_power_actions(1, '10.9.0.1'))
+        results = PowerExecutor(actions_per_subnet=1, attempts=1).execute(
+            power_actions, 'on')
+        self.assertEqual(
+            [True, True], [result.succeeded for result in results])
+
+    def test_execute_wakes_nodes_in_one_batch(self):
+        send_magic_packets = self.patch(executor_module, 'send_magic_packets')
+        mac_addresses = [factory.getRandomMACAddress() for i in range(3)]
+        power_actions = [
+            (POWER_TYPE.WAKE_ON_LAN, {'mac_address': mac_address})
+            for mac_address in mac_addresses]
+        results = PowerExecutor().execute(power_actions, 'on')
+        [(args, kwargs)] = send_magic_packets.call_args_list
+        self.assertItemsEqual(mac_addresses, args[0])
+        self.assertEqual(
+            [True] * 3, [result.succeeded for result in results])
+
+    def test_execute_wake_on_lan_does_not_run_power_script(self):
+        self.patch(executor_module, 'send_magic_packets')
+        power_action = self.patch(executor_module, 'PowerAction')
+        PowerExecutor().execute(
+            [(POWER_TYPE.WAKE_ON_LAN, {'mac_address': arbitrary_mac})], 'on')
+        self.assertEqual(0, power_action.call_count)
+
+    def test_execute_wake_on_lan_fails_nodes_without_mac_address(self):
+        self.patch(executor_module, 'send_magic_packets')
+        power_actions = [
+            (POWER_TYPE.WAKE_ON_LAN, {'mac_address': arbitrary_mac}),
+            (POWER_TYPE.WAKE_ON_LAN, {}),
+            (POWER_TYPE.WAKE_ON_LAN, {'mac_address': 'not-a-mac'}),
+            ]
+        results = PowerExecutor().execute(power_actions, 'on')
+        self.assertEqual(
+            [True, False, False], [result.succeeded for result in results])
+
+    def test_execute_wake_on_lan_cannot_shut_down_node(self):
+        send_magic_packets = self.patch(executor_module, 'send_magic_packets')
+        [result] = PowerExecutor().execute(
+            [(POWER_TYPE.WAKE_ON_LAN, {'mac_address': arbitrary_mac})], 'off')
+        self.assertIsInstance(result.error, PowerActionFail)
+        self.assertEqual(0, send_magic_packets.call_count)
+
+    def test_execute_wake_on_lan_cannot_query_node(self):
+        send_magic_packets = self.patch(executor_module, 'send_magic_packets')
+        [result] = PowerExecutor().execute(
+            [(POWER_TYPE.WAKE_ON_LAN, {'mac_address': arbitrary_mac})],
+            'query')
+        self.assertIsInstance(result.error, PowerActionFail)
+        self.assertEqual(0, send_magic_packets.call_count)
+
+    def test_execute_wake_on_lan_fails_nodes_if_sending_fails(self):
+        self.patch(
+            executor_module, 'send_magic_packets',
+            Mock(side_effect=socket.error("Network is unreachable")))
+        [result] = PowerExecutor().execute(
+            [(POWER_TYPE.WAKE_ON_LAN, {'mac_address': arbitrary_mac})], 'on')
+        self.assertIsInstance(result.error, PowerActionFail)
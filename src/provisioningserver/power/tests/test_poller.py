@@ -0,0 +1,177 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Tests for `provisioningserver.power.poller`."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = []
+
+import httplib
+
+from apiclient.maas_client import MAASClient
+from fixtures import FakeLogger
+from maastesting.factory import factory
+from mock import MagicMock
+from provisioningserver.enum import (
+    POWER_STATE,
+    POWER_TYPE,
+    )
+from provisioningserver.power import poller
+from provisioningserver.power.executor import (
+    PowerActionResult,
+    PowerExecutor,
+    )
+from provisioningserver.power.poweraction import PowerActionFail
+from provisioningserver.testing.testcase import PservTestCase
+import simplejson as json
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content):
+        self.code = status_code
+        self.content = content
+
+    def read(self):
+        return self.content
+
+
+def make_node(power_state=POWER_STATE.UNKNOWN):
+    system_id = factory.make_name('node')
+    return {
+        'system_id': system_id,
+        'power_type': POWER_TYPE.IPMI,
+        'power_parameters': {
+            'system_id': system_id,
+            'power_address': '10.0.0.1',
+            },
+        'power_state': power_state,
+        }
+
+
+class TestPoller(PservTestCase):
+
+    def setUp(self):
+        super(TestPoller, self).setUp()
+        self.useFixture(FakeLogger())
+
+    def fake_client(self):
+        return MAASClient(None, None, self.make_maas_url())
+
+    def fake_query(self, power_states):
+        """Make queries find nodes in the given power states.
+
+        :param power_states: A dict mapping system_ids to power states.
+            A state of None makes the query fail.
+        """
+        def execute(executor, power_actions, power_change):
+            results = []
+            for power_type, power_params in power_actions:
+                system_id = power_params['system_id']
+                power_state = power_states[system_id]
+                error = PowerActionFail() if power_state is None else None
+                results.append(PowerActionResult(
+                    system_id, power_type, power_change, 1, 0.1, error,
+                    power_state))
+            return results
+
+        self.patch(PowerExecutor, 'execute', execute)
+
+    def test_get_power_parameters_calls_correct_api(self):
+        client = self.fake_client()
+        uuid = factory.make_name('nodegroupuuid')
+        nodes = [make_node()]
+        get = self.patch(
+            client, 'get',
+            MagicMock(return_value=FakeResponse(
+                httplib.OK, json.dumps(nodes))))
+        self.assertEqual(nodes, poller.get_power_parameters(client, uuid))
+        get.assert_called_once_with(
+            '/api/1.0/nodegroups/%s/' % uuid, op='list_power_parameters')
+
+    def test_post_power_states_calls_correct_api(self):
+        client = self.fake_client()
+        uuid = factory.make_name('nodegroupuuid')
+        post = self.patch(
+            client, 'post',
+            MagicMock(return_value=FakeResponse(httplib.OK, "Updated.")))
+        poller.post_power_states(client, uuid, {'node-1': POWER_STATE.ON})
+        post.assert_called_once_with(
+            '/api/1.0/nodegroups/%s/' % uuid, op='update_power_states',
+            states=json.dumps({'node-1': POWER_STATE.ON}))
+
+    def test_query_power_states_queries_nodes(self):
+        node = make_node()
+        execute = self.patch(
+            PowerExecutor, 'execute', MagicMock(return_value=[
+                PowerActionResult(
+                    node['system_id'], node['power_type'], 'query', 1, 0.1,
+                    None, POWER_STATE.ON),
+                ]))
+        self.assertEqual(
+            {node['system_id']: POWER_STATE.ON},
+            poller.query_power_states([node]))
+        execute.assert_called_once_with(
+            [(node['power_type'], node['power_parameters'])], 'query')
+
+    def test_query_power_states_reports_failures_as_errors(self):
+        node = make_node()
+        self.fake_query({node['system_id']: None})
+        self.assertEqual(
+            {node['system_id']: POWER_STATE.ERROR},
+            poller.query_power_states([node]))
+
+    def test_poll_power_states_does_nothing_without_credentials(self):
+        get_power_parameters = self.patch(poller, 'get_power_parameters')
+        poller.poll_power_states()
+        self.assertEqual(0, get_power_parameters.call_count)
+
+    def test_poll_power_states_reports_only_changes(self):
+        self.set_secrets()
+        unchanged = make_node(POWER_STATE.ON)
+        changed = make_node(POWER_STATE.ON)
+        failed = make_node(POWER_STATE.OFF)
+        self.patch(
+            poller, 'get_power_parameters',
+            MagicMock(return_value=[unchanged, changed, failed]))
+        self.fake_query({
+            unchanged['system_id']: POWER_STATE.ON,
+            changed['system_id']: POWER_STATE.OFF,
+            failed['system_id']: None,
+            })
+        post_power_states = self.patch(poller, 'post_power_states')
+        poller.poll_power_states()
+        [(args, kwargs)] = post_power_states.call_args_list
+        self.assertEqual(
+            {
+                changed['system_id']: POWER_STATE.OFF,
+                failed['system_id']: POWER_STATE.ERROR,
+            },
+            args[2])
+
+    def test_poll_power_states_reports_in_batches(self):
+        self.set_secrets()
+        nodes = [make_node(POWER_STATE.UNKNOWN) for i in range(5)]
+        self.patch(
+            poller, 'get_power_parameters', MagicMock(return_value=nodes))
+        self.fake_query({node['system_id']: POWER_STATE.ON for node in nodes})
+        post_power_states = self.patch(poller, 'post_power_states')
+        poller.poll_power_states(batch_size=2)
+        calls = post_power_states.call_args_list
+        self.assertEqual([2, 2, 1], [len(args[2]) for args, kwargs in calls])
+
+    def test_poll_power_states_posts_nothing_if_nothing_changed(self):
+        self.set_secrets()
+        node = make_node(POWER_STATE.ON)
+        self.patch(
+            poller, 'get_power_parameters', MagicMock(return_value=[node]))
+        self.fake_query({node['system_id']: POWER_STATE.ON})
+        post_power_states = self.patch(poller, 'post_power_states')
+        poller.poll_power_states()
+        self.assertEqual(0, post_power_states.call_count)
@@ -24,6 +24,7 @@ import provisioningserver.power.poweraction
 from provisioningserver.power.poweraction import (
     PowerAction,
     PowerActionFail,
+    PowerActionTimeout,
     UnknownPowerType,
     )
 from provisioningserver.utils import ShellTemplate
@@ -48,13 +49,13 @@ class TestPowerAction(TestCase):
             UnknownPowerType,
             PowerAction, powertype)
 
-    def test_init_stores_ether_wake_type(self):
-        pa = PowerAction(POWER_TYPE.WAKE_ON_LAN)
-        self.assertEqual(POWER_TYPE.WAKE_ON_LAN, pa.power_type)
+    def test_init_stores_power_type(self):
+        pa = PowerAction(POWER_TYPE.VIRSH)
+        self.assertEqual(POWER_TYPE.VIRSH, pa.power_type)
 
     def test_init_stores_template_path(self):
         self.configure_templates_dir()
-        power_type = POWER_TYPE.WAKE_ON_LAN
+        power_type = POWER_TYPE.VIRSH
         pa = PowerAction(power_type)
         path = os.path.join(pa.template_basedir, power_type + ".template")
         self.assertEqual(path, pa.path)
@@ -64,28 +65,28 @@ class TestPowerAction(TestCase):
         self.assertEqual(
             os.path.join(
                 os.path.dirname(os.path.dirname(__file__)), 'templates'),
-            PowerAction(POWER_TYPE.WAKE_ON_LAN).template_basedir)
+            PowerAction(POWER_TYPE.VIRSH).template_basedir)
 
     def test_template_basedir_prefers_configured_value(self):
-        power_type = POWER_TYPE.WAKE_ON_LAN
+        power_type = POWER_TYPE.VIRSH
         template_name = '%s.template' % power_type
         template = self.make_file(name=template_name)
         template_dir = os.path.dirname(template)
         self.configure_templates_dir(template_dir)
         self.assertEqual(
             template_dir,
-            PowerAction(POWER_TYPE.WAKE_ON_LAN).template_basedir)
+            PowerAction(POWER_TYPE.VIRSH).template_basedir)
 
     def test_get_template_retrieves_template(self):
         self.configure_templates_dir()
-        pa = PowerAction(POWER_TYPE.WAKE_ON_LAN)
+        pa = PowerAction(POWER_TYPE.VIRSH)
         template = pa.get_template()
         self.assertIsInstance(template, ShellTemplate)
         self.assertThat(pa.path, FileContains(template.content))
 
     def test_get_template_looks_for_template_in_template_basedir(self):
         contents = factory.getRandomString()
-        power_type = POWER_TYPE.WAKE_ON_LAN
+        power_type = POWER_TYPE.VIRSH
         template_name = '%s.template' % power_type
         template = self.make_file(name=template_name, contents=contents)
         self.configure_templates_dir(os.path.dirname(template))
@@ -93,10 +94,30 @@ class TestPowerAction(TestCase):
             contents,
             PowerAction(power_type).get_template().content)
 
+    def test_get_template_caches_template(self):
+        power_type = POWER_TYPE.VIRSH
+        template = self.make_file(name='%s.template' % power_type)
+        self.configure_templates_dir(os.path.dirname(template))
+        self.assertIs(
+            PowerAction(power_type).get_template(),
+            PowerAction(power_type).get_template())
+
+    def test_get_template_recompiles_changed_template(self):
+        power_type = POWER_TYPE.VIRSH
+        template = self.make_file(name='%s.template' % power_type)
+        self.configure_templates_dir(os.path.dirname(template))
+        PowerAction(power_type).get_template()
+        contents = factory.getRandomString()
+        with open(template, 'wb') as f:
+            f.write(contents.encode('ascii'))
+        os.utime(template, (0, 0))
+        self.assertEqual(
+            contents, PowerAction(power_type).get_template().content)
+
     def test_render_template(self):
         # render_template() should take a template string and substitue
         # its variables.
-        pa = PowerAction(POWER_TYPE.WAKE_ON_LAN)
+        pa = PowerAction(POWER_TYPE.VIRSH)
         template = ShellTemplate("template: {{mac}}")
         rendered = pa.render_template(template, mac="mymac")
         self.assertEqual("template: mymac", rendered)
@@ -104,7 +125,7 @@ class TestPowerAction(TestCase):
     def test_render_template_raises_PowerActionFail(self):
         # If not enough arguments are supplied to fill in template
         # variables then a PowerActionFail is raised.
-        pa = PowerAction(POWER_TYPE.WAKE_ON_LAN)
+        pa = PowerAction(POWER_TYPE.VIRSH)
         template_name = factory.getRandomString()
         template = ShellTemplate("template: {{mac}}", name=template_name)
         exception = self.assertRaises(
@@ -119,7 +140,7 @@ class TestPowerAction(TestCase):
         return self.make_file("testscript.sh", template)
 
     def run_action(self, path, **kwargs):
-        pa = PowerAction(POWER_TYPE.WAKE_ON_LAN)
+        pa = PowerAction(POWER_TYPE.VIRSH)
         pa.path = path
         pa.execute(**kwargs)
 
@@ -137,13 +158,21 @@ class TestPowerAction(TestCase):
         path = self._create_template_file("this_is_not_valid_shell")
         exception = self.assertRaises(PowerActionFail, self.run_action, path)
         self.assertEqual(
-            "ether_wake failed with return code 127", exception.message)
+            "virsh failed with return code 127", exception.message)
 
-    def test_wake_on_lan_cannot_shut_down_node(self):
-        pa = PowerAction(POWER_TYPE.WAKE_ON_LAN)
-        self.assertRaises(
-            PowerActionFail,
-            pa.execute, power_change='off', mac=factory.getRandomMACAddress())
+    def test_execute_kills_script_after_timeout(self):
+        path = self._create_template_file("sleep 10")
+        pa = PowerAction(POWER_TYPE.VIRSH, timeout=0.1)
+        pa.path = path
+        exception = self.assertRaises(PowerActionTimeout, pa.execute)
+        self.assertEqual(
+            "virsh timed out after 0.1 seconds", exception.message)
+
+    def test_execute_does_not_time_out_quick_script(self):
+        path = self._create_template_file("true")
+        pa = PowerAction(POWER_TYPE.VIRSH, timeout=10)
+        pa.path = path
+        pa.execute()
 
     def test_virsh_checks_vm_state(self):
         # We can't test the virsh template in detail (and it may be
@@ -159,6 +188,17 @@ class TestPowerAction(TestCase):
         stdout, stderr = action.run_shell(script)
         self.assertIn("Got unknown power state from virsh", stderr)
 
+    def test_virsh_queries_vm_state(self):
+        virsh = self.make_file(
+            name='fake-virsh', contents="#!/bin/sh\necho running\n")
+        os.chmod(virsh, 0o755)
+        action = PowerAction(POWER_TYPE.VIRSH)
+        output = action.execute(
+            power_change='query', power_address='qemu://example.com/',
+            system_id='mysystem', power_id='mysystem', username='me',
+            virsh=virsh)
+        self.assertEqual("on\n", output)
+
     def test_fence_cdu_checks_state(self):
         # We can't test the fence_cdu template in detail (and it may be
         # customized), but by making it use "echo" instead of a real
@@ -194,7 +234,7 @@ class TestPowerAction(TestCase):
         self.assertEqual(
             os.path.join(
                 os.path.dirname(os.path.dirname(__file__)), 'config'),
-            PowerAction(POWER_TYPE.WAKE_ON_LAN).config_basedir)
+            PowerAction(POWER_TYPE.VIRSH).config_basedir)
 
     def test_ipmi_script_includes_config_dir(self):
         conf_dir = factory.make_name('power_confi_dir')
@@ -0,0 +1,113 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Tests for `provisioningserver.power.wakeonlan`."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = []
+
+from binascii import unhexlify
+import socket
+
+from maastesting.factory import factory
+from maastesting.testcase import TestCase
+from provisioningserver.power import wakeonlan
+from provisioningserver.power.wakeonlan import (
+    make_magic_packet,
+    send_magic_packets,
+    )
+
+
+class TestMakeMagicPacket(TestCase):
+
+    def test_repeats_mac_address_after_synchronisation_stream(self):
+        self.assertEqual(
+            b'\xff' * 6 + unhexlify('0123456789ab') * 16,
+            make_magic_packet('01:23:45:67:89:ab'))
+
+    def test_accepts_dashes_and_upper_case(self):
+        self.assertEqual(
+            make_magic_packet('01:23:45:67:89:ab'),
+            make_magic_packet('01-23-45-67-89-AB'))
+
+    def test_rejects_invalid_mac_address(self):
+        self.assertRaises(ValueError, make_magic_packet, '01:23:45:67:89')
+
+
+class TestSendMagicPackets(TestCase):
+
+    def make_listener(self):
+        """Listen for UDP packets on a local port.
+
+        :return: The socket, and the port it listens on.
+        """
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        return listener, listener.getsockname()[1]
+
+    def receive(self, listener, count):
+        return [listener.recv(1024) for packet in range(count)]
+
+    def test_sends_packet_for_each_mac_address(self):
+        listener, port = self.make_listener()
+        mac_addresses = [factory.getRandomMACAddress() for i in range(3)]
+        send_magic_packets(
+            mac_addresses, address='127.0.0.1', port=port, repeat=1)
+        self.assertItemsEqual(
+            [make_magic_packet(mac_address) for mac_address in mac_addresses],
+            self.receive(listener, 3))
+
+    def test_repeats_packets(self):
+        listener, port = self.make_listener()
+        mac_address = factory.getRandomMACAddress()
+        send_magic_packets(
+            [mac_address], address='127.0.0.1', port=port, repeat=3,
+            spacing=0)
+        self.assertEqual(
+            [make_magic_packet(mac_address)] * 3, self.receive(listener, 3))
+
+    def test_waits_between_repeats(self):
+        listener, port = self.make_listener()
+        sleep = self.patch(wakeonlan, 'sleep')
+        send_magic_packets(
+            [factory.getRandomMACAddress()], address='127.0.0.1', port=port,
+            repeat=3, spacing=0.5)
+        self.assertEqual([((0.5, ), {})] * 2, sleep.call_args_list)
+
+    def test_sends_nothing_if_any_mac_address_is_invalid(self):
+        listener, port = self.make_listener()
+        listener.settimeout(0.1)
+        self.assertRaises(
+            ValueError, send_magic_packets,
+            [factory.getRandomMACAddress(), 'not-a-mac'],
+            address='127.0.0.1', port=port)
+        self.assertRaises(socket.timeout, listener.recv, 1024)
+
+    def test_defaults_to_config(self):
+        sendto = []
+
+        class FakeSocket:
+            def __init__(self, *args):
+                pass
+
+            def setsockopt(self, *args):
+                pass
+
+            def sendto(self, packet, address):
+                sendto.append(address)
+
+            def close(self):
+                pass
+
+        self.patch(wakeonlan.socket, 'socket', FakeSocket)
+        self.patch(wakeonlan, 'sleep')
+        send_magic_packets([factory.getRandomMACAddress()])
+        self.assertEqual([('255.255.255.255', 9)] * 3, sendto)
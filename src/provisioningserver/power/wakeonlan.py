@@ -0,0 +1,82 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Wake-on-LAN, sent from within the cluster controller.
+
+Rather than running a `wakeonlan` or `etherwake` program for each node,
+magic packets for a whole batch of nodes are sent through one UDP
+broadcast socket.
+"""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = [
+    "make_magic_packet",
+    "send_magic_packets",
+    ]
+
+from binascii import unhexlify
+from contextlib import closing
+import re
+import socket
+from time import sleep
+
+from celery.app import app_or_default
+
+
+mac_address_regex = re.compile(r'^[0-9a-f]{2}([-:]?[0-9a-f]{2}){5}$', re.I)
+
+
+def make_magic_packet(mac_address):
+    """Compose the Wake-on-LAN magic packet for `mac_address`.
+
+    That is six 0xff bytes, followed by the MAC address sixteen times.
+
+    :raise ValueError: If `mac_address` is not a MAC address.
+    """
+    if mac_address_regex.match(mac_address) is None:
+        raise ValueError("Not a MAC address: %r" % mac_address)
+    mac_bytes = unhexlify(re.sub('[-:]', '', mac_address))
+    return b'\xff' * 6 + mac_bytes * 16
+
+
+def send_magic_packets(mac_addresses, address=None, port=None, repeat=None,
+                       spacing=None):
+    """Send Wake-on-LAN magic packets for `mac_addresses`.
+
+    All packets go through one UDP socket.  As UDP is unreliable, the
+    whole batch can be sent more than once.  The settings default to the
+    WAKE_ON_LAN_* values in the Celery config.
+
+    :param mac_addresses: The MAC addresses of the nodes to wake up.
+    :param address: The address to send to; normally a broadcast address.
+    :param port: The UDP port to send to.
+    :param repeat: How many times to send each packet.
+    :param spacing: Seconds to wait between repeats.
+    :raise ValueError: If any of `mac_addresses` is not a MAC address.
+        Nothing is sent in that case.
+    :raise socket.error: If sending fails.
+    """
+    conf = app_or_default().conf
+    if address is None:
+        address = conf.WAKE_ON_LAN_ADDRESS
+    if port is None:
+        port = conf.WAKE_ON_LAN_PORT
+    if repeat is None:
+        repeat = conf.WAKE_ON_LAN_REPEAT
+    if spacing is None:
+        spacing = conf.WAKE_ON_LAN_SPACING
+    packets = [make_magic_packet(mac_address) for mac_address in mac_addresses]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    with closing(sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        for round in range(repeat):
+            if round > 0:
+                sleep(spacing)
+            for packet in packets:
+                sock.sendto(packet, (address, port))
@@ -11,6 +11,7 @@ from __future__ import (
 
 __metaclass__ = type
 __all__ = [
+    "LeasesWatcherService",
     "LogService",
     "OOPSService",
     ]
@@ -26,7 +27,13 @@ from oops_twisted import (
     OOPSObserver,
     )
 from twisted.application.service import Service
-from twisted.internet import reactor
+from twisted.internet import (
+    inotify,
+    reactor,
+    )
+from twisted.internet.defer import maybeDeferred
+from twisted.python import log
+from twisted.python.filepath import FilePath
 from twisted.python.log import (
     addObserver,
     FileLogObserver,
@@ -105,3 +112,95 @@ class OOPSService(Service):
         removeObserver(self.observer.emit)
         self.observer = None
         self.config = None
+
+
+class LeasesWatcherService(Service):
+    """Upload DHCP leases as soon as dhcpd changes its leases file.
+
+    The directory containing the leases file is watched with inotify,
+    because dhcpd does not just append to the leases file: every now and
+    then it writes a new one and renames it over the old one.
+
+    A burst of changes results in a single upload: the first change
+    starts a timer of `debounce` seconds, and the upload happens when it
+    runs out.  Changes made while an upload is in progress lead to one
+    more upload once it is done.
+
+    :param leases_file: Path to the DHCP leases file.
+    :param upload: Callable that uploads the leases.  It may return a
+        `Deferred`.
+    :param debounce: Delay, in seconds, between the first change and
+        the upload.
+    :param clock: Provider of `IReactorTime`; for testing.
+    """
+
+    name = "dhcp-leases"
+
+    # Events that may mean that the leases file has changed.
+    mask = (
+        inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE | inotify.IN_CREATE |
+        inotify.IN_MOVED_TO | inotify.IN_DELETE)
+
+    def __init__(self, leases_file, upload, debounce=1, clock=reactor):
+        self.leases_file = FilePath(leases_file)
+        self.upload = upload
+        self.debounce = debounce
+        self.clock = clock
+        self.notifier = None
+        # Pending call to start an upload, if any.
+        self.pending_upload = None
+        self.uploading = False
+        # Has the leases file changed since the current upload started?
+        self.changed = False
+
+    def startService(self):
+        Service.startService(self)
+        self.notifier = inotify.INotify()
+        self.notifier.startReading()
+        try:
+            self.notifier.watch(
+                self.leases_file.parent(), mask=self.mask,
+                callbacks=[self.notify])
+        except inotify.INotifyError as error:
+            # The directory does not exist.  Most likely this cluster
+            # controller does not manage a DHCP server.
+            log.msg(
+                "Not watching DHCP leases file %s: %s"
+                % (self.leases_file.path, error))
+
+    def stopService(self):
+        Service.stopService(self)
+        if self.pending_upload is not None:
+            self.pending_upload.cancel()
+            self.pending_upload = None
+        self.notifier.loseConnection()
+        self.notifier = None
+
+    def notify(self, ignored, path, mask):
+        """Handle an inotify event in the leases file's directory."""
+        if path.basename() == self.leases_file.basename():
+            self.schedule_upload()
+
+    def schedule_upload(self):
+        """Upload the leases soon, unless that is already planned."""
+        if self.uploading:
+            self.changed = True
+        elif self.pending_upload is None:
+            self.pending_upload = self.clock.callLater(
+                self.debounce, self.start_upload)
+
+    def start_upload(self):
+        """Upload the leases now."""
+        self.pending_upload = None
+        self.uploading = True
+        self.changed = False
+        d = maybeDeferred(self.upload)
+        d.addErrback(log.err, "Failed to upload DHCP leases.")
+        d.addBoth(self.finish_upload)
+        return d
+
+    def finish_upload(self, ignored):
+        """Clean up after an upload, and upload again if needed."""
+        self.uploading = False
+        if self.changed and self.running:
+            self.schedule_upload()
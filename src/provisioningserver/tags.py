@@ -18,21 +18,30 @@ __all__ = [
     ]
 
 
+from collections import deque
+from contextlib import contextmanager
 import httplib
 from logging import getLogger
+from multiprocessing import cpu_count
+import os
+from subprocess import (
+    CalledProcessError,
+    PIPE,
+    Popen,
+    )
+import sys
 import urllib2
 
-from apiclient.maas_client import (
-    MAASClient,
-    MAASDispatcher,
-    MAASOAuth,
-    )
 from lxml import etree
-from provisioningserver.auth import (
-    get_recorded_api_credentials,
-    get_recorded_nodegroup_uuid,
+from provisioningserver.api_client import (
+    check_response,
+    get_cached_knowledge,
+    process_response,
+    )
+from provisioningserver.utils import (
+    compile_xpath,
+    split_chunks,
     )
-from provisioningserver.cluster_config import get_maas_url
 import simplejson as json
 
 
@@ -45,60 +54,74 @@ class MissingCredentials(Exception):
 
 DEFAULT_BATCH_SIZE = 1000
 
-
-def get_cached_knowledge():
-    """Get all the information that we need to know, or raise an error.
-
-    :return: (client, nodegroup_uuid)
-    """
-    api_credentials = get_recorded_api_credentials()
-    if api_credentials is None:
-        logger.error("Not updating tags: don't have API key yet.")
-        return None, None
-    nodegroup_uuid = get_recorded_nodegroup_uuid()
-    if nodegroup_uuid is None:
-        logger.error("Not updating tags: don't have UUID yet.")
-        return None, None
-    client = MAASClient(MAASOAuth(*api_credentials), MAASDispatcher(),
-        get_maas_url())
-    return client, nodegroup_uuid
-
-
-def process_response(response):
-    """All responses should be httplib.OK and contain JSON content.
-
-    :param response: The result of MAASClient.get/post/etc.
-    :type response: urllib2.addinfourl (a file-like object that has a .code
-        attribute.)
-    """
-    if response.code != httplib.OK:
-        text_status = httplib.responses.get(response.code, '<unknown>')
-        raise AssertionError('Unexpected HTTP status: %s %s, expected 200 OK'
-            % (response.code, text_status))
-    return json.loads(response.read())
+# How many nodes' hardware details are matched at a time by a process in the
+# pool.  The details are streamed, so this is also about how many nodes'
+# details are held in memory for each process.
+DEFAULT_CHUNK_SIZE = 10
 
 
-def get_nodes_for_node_group(client, nodegroup_uuid):
+def get_nodes_for_node_group(client, nodegroup_uuid, tag_name=None):
     """Retrieve the UUIDs of nodes in a particular group.
 
     :param client: MAAS client instance
     :param nodegroup_uuid: Node group for which to retrieve nodes
+    :param tag_name: Optional name of a tag; if given, only retrieve the
+        nodes that have this tag
     :return: List of UUIDs for nodes in nodegroup
     """
     path = '/api/1.0/nodegroups/%s/' % (nodegroup_uuid)
-    return process_response(client.get(path, op='list_nodes'))
+    if tag_name is None:
+        return process_response(client.get(path, op='list_nodes'))
+    else:
+        return process_response(
+            client.get(path, op='list_nodes', tag=tag_name))
 
 
 def get_hardware_details_for_nodes(client, nodegroup_uuid, system_ids):
     """Retrieve the lshw output for a set of nodes.
 
+    The details are streamed, and parsed one node at a time as they arrive,
+    so that the details of all the nodes never have to be held at once.
+
     :param client: MAAS client
     :param system_ids: List of UUIDs of systems for which to fetch lshw data
-    :return: Dictionary mapping node UUIDs to lshw output
+    :return: Iterable of (node UUID, lshw output) pairs
     """
     path = '/api/1.0/nodegroups/%s/' % (nodegroup_uuid,)
-    return process_response(client.post(
-        path, op='node_hardware_details', as_json=True, system_ids=system_ids))
+    response = client.post(
+        path, op='stream_node_hardware_details', as_json=True,
+        system_ids=system_ids)
+    check_response(response)
+    for line in response:
+        yield json.loads(line)
+
+
+def post_rebuild_started(client, tag_name, tag_definition, uuid):
+    """Tell the region that this worker is starting to rebuild a tag.
+
+    :param client: MAAS client
+    :param tag_name: Name of tag
+    :param tag_definition: Definition of the tag that is to be evaluated.
+    :param uuid: NodeGroup uuid of this worker.
+    :return: Whether the rebuild should go ahead.  It shouldn't if the
+        tag's definition has changed since the rebuild was requested; a
+        rebuild for the new definition will have been requested instead.
+    """
+    path = '/api/1.0/tags/%s/' % (tag_name,)
+    try:
+        process_response(client.post(
+            path, op='start_rebuild', as_json=True, nodegroup=uuid,
+            definition=tag_definition))
+    except urllib2.HTTPError as e:
+        if e.code == httplib.CONFLICT:
+            if e.fp is not None:
+                msg = e.fp.read()
+            else:
+                msg = e.msg
+            logger.info("Skipping superseded rebuild of tag: %s", msg)
+            return False
+        raise
+    return True
 
 
 def post_updated_nodes(client, tag_name, tag_definition, uuid, added, removed):
@@ -157,26 +180,189 @@ def process_batch(xpath, hardware_details):
     return matched_nodes, unmatched_nodes
 
 
+def process_chunk(args):
+    """Process a chunk of hardware details in a process of the pool.
+
+    :param args: A tuple of the tag definition and the hardware details.
+    :return: The matched and unmatched nodes, as from `process_batch`.
+    """
+    tag_definition, hardware_details = args
+    # Compiled expressions can't be sent to other processes, so each helper
+    # compiles the definitions it is given.
+    return process_batch(compile_xpath(tag_definition), hardware_details)
+
+
+def match_chunks(requests, results):
+    """Match chunks of hardware details, as a `MatchingHelper` process.
+
+    :param requests: A file of JSON lines, each holding a tag definition
+        and a chunk of hardware details.
+    :param results: A file to write the matched and unmatched nodes of
+        each chunk to, as JSON lines, in the order of the requests.
+    """
+    for line in iter(requests.readline, b''):
+        results.write(json.dumps(process_chunk(json.loads(line))) + b'\n')
+        results.flush()
+
+
+class MatchingResult:
+    """The result of matching a chunk in a `MatchingHelper`."""
+
+    def __init__(self, helper):
+        self.helper = helper
+        self.ready = False
+        self.value = None
+
+    def get(self):
+        """Wait for, and return, the matched and unmatched nodes."""
+        while not self.ready:
+            self.helper.receive()
+        return self.value
+
+
+class MatchingHelper:
+    """A helper process that matches chunks of nodes, one at a time.
+
+    The helper is a fresh interpreter running `match_chunks`.  It is fed
+    the chunks over a pipe, and exits when that is closed.
+    """
+
+    def __init__(self):
+        self.command = [sys.executable, '-m', 'provisioningserver.tags']
+        self.process = Popen(
+            self.command, stdin=PIPE, stdout=PIPE,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        # Results of the chunks sent to the helper, oldest first.
+        self.outstanding = deque()
+
+    def match(self, tag_definition, hardware_details):
+        """Send a chunk of hardware details to be matched.
+
+        :return: A `MatchingResult`.
+        """
+        self.process.stdin.write(
+            json.dumps([tag_definition, hardware_details]) + b'\n')
+        result = MatchingResult(self)
+        self.outstanding.append(result)
+        return result
+
+    def receive(self):
+        """Receive the result of the oldest outstanding chunk."""
+        line = self.process.stdout.readline()
+        if len(line) == 0:
+            raise CalledProcessError(self.process.wait(), self.command)
+        result = self.outstanding.popleft()
+        result.value = json.loads(line)
+        result.ready = True
+
+    def stop(self):
+        """Let the helper finish any outstanding chunks, and exit."""
+        self.process.communicate()
+
+
+class MatchingPool:
+    """A pool of `MatchingHelper` processes to match nodes with.
+
+    Celery's worker processes are daemonic, and multiprocessing won't let
+    daemonic processes start children, lest they be left behind as
+    orphans.  The helpers aren't multiprocessing children, and they exit
+    as soon as their pipes are closed, even if the worker dies.
+    """
+
+    def __init__(self, processes):
+        self.helpers = []
+        try:
+            for i in range(processes):
+                self.helpers.append(MatchingHelper())
+        except:
+            self.stop()
+            raise
+
+    def match(self, tag_definition, hardware_details):
+        """Send a chunk to the helper with the fewest outstanding chunks.
+
+        :return: A `MatchingResult`.
+        """
+        helper = min(self.helpers, key=lambda helper: len(helper.outstanding))
+        return helper.match(tag_definition, hardware_details)
+
+    def stop(self):
+        """Stop all the helpers."""
+        for helper in self.helpers:
+            helper.stop()
+
+
+@contextmanager
+def matching_pool(processes):
+    """Provide a `MatchingPool` of `processes` processes."""
+    pool = MatchingPool(processes)
+    try:
+        yield pool
+    finally:
+        pool.stop()
+
+
 def process_all(client, tag_name, tag_definition, nodegroup_uuid, system_ids,
-                xpath, batch_size=None):
+                xpath, batch_size=None, processes=None, tagged_ids=None,
+                chunk_size=None):
+    """Match all of `system_ids` against `xpath`, and post the results.
+
+    The hardware details are requested in batches of `batch_size` nodes.
+    They are streamed, and handed out in chunks of `chunk_size` nodes to a
+    pool of `processes` helper processes (by default, one for each CPU) to
+    be matched.  Reading stops while each process has two chunks waiting, so
+    only a few chunks' worth of details are held in memory at a time,
+    however big the batches.
+
+    If `tagged_ids`, the nodes that have the tag already, are given, only
+    the changes to the tag's membership are posted.  Otherwise, all nodes
+    are posted as either added or removed.
+    """
     if batch_size is None:
         batch_size = DEFAULT_BATCH_SIZE
+    if processes is None:
+        processes = cpu_count()
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
     all_matched = []
     all_unmatched = []
     logger.debug(
         "processing %d system_ids for tag %s nodegroup %s"
         % (len(system_ids), tag_name, nodegroup_uuid))
-    for i in range(0, len(system_ids), batch_size):
-        selected_ids = system_ids[i:i + batch_size]
-        details = get_hardware_details_for_nodes(
-            client, nodegroup_uuid, selected_ids)
-        matched, unmatched = process_batch(xpath, details)
-        logger.debug(
-            "processing batch of %d ids received %d details"
-            " (%d matched, %d unmatched)"
-            % (len(selected_ids), len(details), len(matched), len(unmatched)))
-        all_matched.extend(matched)
-        all_unmatched.extend(unmatched)
+    with matching_pool(processes) as pool:
+        # Results of the chunks being matched, oldest first.
+        pending = deque()
+
+        def collect_oldest():
+            matched, unmatched = pending.popleft().get()
+            all_matched.extend(matched)
+            all_unmatched.extend(unmatched)
+
+        for i in range(0, len(system_ids), batch_size):
+            selected_ids = system_ids[i:i + batch_size]
+            details = get_hardware_details_for_nodes(
+                client, nodegroup_uuid, selected_ids)
+            num_details = 0
+            for chunk in split_chunks(details, chunk_size):
+                num_details += len(chunk)
+                if len(pending) >= 2 * processes:
+                    collect_oldest()
+                pending.append(pool.match(xpath.path, chunk))
+            logger.debug(
+                "processing batch of %d ids received %d details"
+                % (len(selected_ids), num_details))
+        while len(pending) > 0:
+            collect_oldest()
+    logger.debug(
+        "%d matched, %d unmatched" % (len(all_matched), len(all_unmatched)))
+    if tagged_ids is not None:
+        tagged_ids = set(tagged_ids)
+        all_matched = [
+            system_id for system_id in all_matched
+            if system_id not in tagged_ids]
+        all_unmatched = [
+            system_id for system_id in all_unmatched
+            if system_id in tagged_ids]
     # Upload all updates for one nodegroup at one time. This should be no more
     # than ~41*10,000 = 410kB. That should take <1s even on a 10Mbit network.
     # This also allows us to track if a nodegroup has been processed in the DB,
@@ -203,8 +389,16 @@ def process_node_tags(tag_name, tag_definition, batch_size=None):
     # We evaluate this early, so we can fail before sending a bunch of data to
     # the server
     xpath = etree.XPath(tag_definition)
-    # Get nodes to process
+    if not post_rebuild_started(
+            client, tag_name, tag_definition, nodegroup_uuid):
+        return
+    # Get nodes to process, and the ones that have the tag already.
     system_ids = get_nodes_for_node_group(client, nodegroup_uuid)
+    tagged_ids = get_nodes_for_node_group(client, nodegroup_uuid, tag_name)
     process_all(
         client, tag_name, tag_definition, nodegroup_uuid, system_ids, xpath,
-        batch_size=batch_size)
+        batch_size=batch_size, tagged_ids=tagged_ids)
+
+
+if __name__ == "__main__":
+    match_chunks(sys.stdin, sys.stdout)
@@ -11,11 +11,16 @@ from __future__ import (
 
 __metaclass__ = type
 __all__ = [
+    'invalidate_pxe_configs',
+    'poll_power_states',
     'power_off',
+    'power_off_nodes',
     'power_on',
+    'power_on_nodes',
     'refresh_secrets',
     'rndc_command',
     'setup_rndc_configuration',
+    'update_dns_zone_records',
     'restart_dhcp_server',
     'write_dhcp_config',
     'write_dns_config',
@@ -23,6 +28,7 @@ __all__ = [
     'write_full_dns_config',
     ]
 
+from logging import getLogger
 import os
 from subprocess import (
     CalledProcessError,
@@ -40,17 +46,24 @@ from provisioningserver.auth import (
     record_nodegroup_uuid,
     )
 from provisioningserver.dhcp import config
-from provisioningserver.dhcp.leases import upload_leases
+from provisioningserver.dhcp.leases import (
+    update_leases,
+    upload_leases,
+    )
 from provisioningserver.dns.config import (
     DNSConfig,
+    execute_nsupdate,
     execute_rndc_command,
     setup_rndc,
+    zone_frozen,
     )
 from provisioningserver.omshell import Omshell
-from provisioningserver.power.poweraction import (
-    PowerAction,
-    PowerActionFail,
+from provisioningserver.power import poller
+from provisioningserver.power.executor import (
+    PowerExecutor,
+    summarise_results,
     )
+from provisioningserver.power.poweraction import PowerActionFail
 from provisioningserver.utils import sudo_write_file
 
 # For each item passed to refresh_secrets, a refresh function to give it to.
@@ -62,6 +75,8 @@ refresh_functions = {
 
 celery_config = app_or_default().conf
 
+logger = getLogger(__name__)
+
 
 @task
 def refresh_secrets(**kwargs):
@@ -113,23 +128,20 @@ def refresh_secrets(**kwargs):
 def issue_power_action(power_type, power_change, **kwargs):
     """Issue a power action to a node.
 
-    :param power_type: The node's power type.  Must have a corresponding
-        power template.
+    :param power_type: The node's power type.  Must be Wake-on-LAN, or
+        have a corresponding power template.
     :param power_change: The change to request: 'on' or 'off'.
-    :param **kwargs: Keyword arguments are passed on to :class:`PowerAction`.
+    :param **kwargs: Power parameters, passed on to the power template.
     """
     assert power_change in ('on', 'off'), (
         "Unknown power change keyword: %s" % power_change)
-    kwargs['power_change'] = power_change
-    try:
-        pa = PowerAction(power_type)
-        pa.execute(**kwargs)
-    except PowerActionFail:
+    [result] = PowerExecutor().execute([(power_type, kwargs)], power_change)
+    if not result.succeeded:
         # TODO: signal to webapp that it failed
 
         # Re-raise, so the job is marked as failed.  Only currently
         # useful for tests.
-        raise
+        raise result.error
 
     # TODO: signal to webapp that it worked.
 
@@ -146,6 +158,64 @@ def power_off(power_type, **kwargs):
     issue_power_action(power_type, 'off', **kwargs)
 
 
+def issue_power_actions(power_actions, power_change):
+    """Issue the same power change to a batch of nodes.
+
+    The actions run concurrently, within the limits of the
+    `PowerExecutor`.  A failure to change one node's power does not stop
+    the others from being changed.  Each node's outcome and latency is
+    logged, followed by statistics for the whole batch.
+
+    :param power_actions: A list of (power type, power parameters) pairs,
+        one for each node.
+    :param power_change: The change to request: 'on' or 'off'.
+    :raise PowerActionFail: If any of the actions failed, once all of them
+        have finished.
+    """
+    assert power_change in ('on', 'off'), (
+        "Unknown power change keyword: %s" % power_change)
+    results = PowerExecutor().execute(power_actions, power_change)
+    for result in results:
+        if result.succeeded:
+            logger.info(
+                "Powered %s node %s in %.1f seconds (%d attempts).",
+                power_change, result.system_id, result.latency,
+                result.attempts)
+        else:
+            logger.error(
+                "Failed to power %s node %s after %.1f seconds "
+                "(%d attempts): %s", power_change, result.system_id,
+                result.latency, result.attempts, result.error)
+    stats = summarise_results(results)
+    logger.info(
+        "Powered %s %d nodes: %d failed, %d retried; latency mean %.1f, "
+        "max %.1f seconds.", power_change, stats['nodes'],
+        stats['failures'], stats['retried'], stats['mean_latency'],
+        stats['max_latency'])
+    if stats['failures'] > 0:
+        raise PowerActionFail(
+            "Failed to power %s %d out of %d nodes." % (
+                power_change, stats['failures'], stats['nodes']))
+
+
+@task
+def power_on_nodes(power_actions):
+    """Turn a batch of nodes on.  See `issue_power_actions`."""
+    issue_power_actions(power_actions, 'on')
+
+
+@task
+def power_off_nodes(power_actions):
+    """Turn a batch of nodes off.  See `issue_power_actions`."""
+    issue_power_actions(power_actions, 'off')
+
+
+@task
+def poll_power_states():
+    """Check the power states of the cluster's nodes, and report changes."""
+    poller.poll_power_states()
+
+
 # =====================================================================
 # DNS-related tasks
 # =====================================================================
@@ -183,19 +253,28 @@ def rndc_command(arguments, retry=False, callback=None):
 def write_full_dns_config(zones=None, callback=None, **kwargs):
     """Write out the DNS configuration files: the main configuration
     file and the zone files.
+
+    Files whose contents have not changed are left alone, and the
+    callback is only called if anything changed.  Each zone is frozen
+    while it is written; thawing it reloads it if it changed.
+
     :param zones: List of zones to write.
     :type zones: list of :class:`DNSZoneData`
     :param callback: Callback subtask.
     :type callback: callable
     :param **kwargs: Keyword args passed to DNSConfig.write_config()
     """
+    changed = False
     if zones is not None:
-        for zone in zones:
-            zone.write_config()
+        with zone_frozen():
+            for zone in zones:
+                if zone.write_config():
+                    changed = True
     # Write main config file.
     dns_config = DNSConfig(zones=zones)
-    dns_config.write_config(**kwargs)
-    if callback is not None:
+    if dns_config.write_config(**kwargs):
+        changed = True
+    if changed and callback is not None:
         callback.delay()
 
 
@@ -203,6 +282,9 @@ def write_full_dns_config(zones=None, callback=None, **kwargs):
 def write_dns_config(zones=(), callback=None, **kwargs):
     """Write out the DNS configuration file.
 
+    If its contents have not changed, the file is left alone and the
+    callback is not called.
+
     :param zones: List of zones to include as part of the main
         config.
     :type zones: list of :class:`DNSZoneData`
@@ -211,8 +293,7 @@ def write_dns_config(zones=(), callback=None, **kwargs):
     :param **kwargs: Keyword args passed to DNSConfig.write_config()
     """
     dns_config = DNSConfig(zones=zones)
-    dns_config.write_config(**kwargs)
-    if callback is not None:
+    if dns_config.write_config(**kwargs) and callback is not None:
         callback.delay()
 
 
@@ -220,6 +301,10 @@ def write_dns_config(zones=(), callback=None, **kwargs):
 def write_dns_zone_config(zones, callback=None, **kwargs):
     """Write out DNS zones.
 
+    Each zone is frozen while it is written; thawing it reloads it.  Zones
+    whose records have not changed are left alone, so they are not
+    reloaded.
+
     :param zone: The zone data to write the configuration for.
     :type zone: :class:`DNSZoneData`
     :param callback: Callback subtask.
@@ -227,7 +312,26 @@ def write_dns_zone_config(zones, callback=None, **kwargs):
     :param **kwargs: Keyword args passed to DNSZoneConfig.write_config()
     """
     for zone in zones:
-        zone.write_config()
+        with zone_frozen(zone.zone_name):
+            zone.write_config()
+    if callback is not None:
+        callback.delay()
+
+
+@task(queue=celery_config.WORKER_QUEUE_DNS)
+def update_dns_zone_records(zones, callback=None):
+    """Update records in DNS zones with dynamic updates.
+
+    The zone files are not rewritten; the DNS server applies the changes.
+
+    :param zones: The zones to update.  Their mappings hold only the hosts
+        whose records have changed.
+    :type zones: list of :class:`DNSForwardZoneConfig`
+    :param callback: Callback subtask.
+    :type callback: callable
+    """
+    for zone in zones:
+        execute_nsupdate(zone.get_update_commands())
     if callback is not None:
         callback.delay()
 
@@ -260,6 +364,16 @@ def upload_dhcp_leases():
     upload_leases()
 
 
+@task
+def update_dhcp_leases():
+    """Upload DHCP leases, but only if they have changed.
+
+    The provisioning server sends this whenever it notices that dhcpd
+    has written to its leases file.
+    """
+    update_leases()
+
+
 @task
 def add_new_dhcp_host_map(mappings, server_address, shared_key):
     """Add address mappings to the DHCP server.
@@ -339,6 +453,19 @@ def report_boot_images():
     boot_images.report_to_server()
 
 
+@task
+def invalidate_pxe_configs(mac_addresses=None):
+    """Tell this cluster's TFTP server that PXE configs have changed.
+
+    :param mac_addresses: The MAC addresses of the nodes whose boot
+        configuration changed, or None if all of them may have.
+    """
+    # The region imports this module too; it has no need for the TFTP
+    # server, nor for Twisted.
+    from provisioningserver.tftp import send_pxe_config_invalidation
+    send_pxe_config_invalidation(mac_addresses)
+
+
 # How many times should a update node tags task be retried?
 UPDATE_NODE_TAGS_MAX_RETRY = 10
 
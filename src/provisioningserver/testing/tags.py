@@ -9,6 +9,7 @@ from maasserver.testing.oauthclient import OAuthAuthenticatedClient
 from maasserver.utils.orm import get_one
 from maasserver.worker_user import get_worker_user
 from provisioningserver import tags
+from provisioningserver.auth import get_recorded_nodegroup_uuid
 from testtools.monkey import patch
 
 
@@ -22,7 +23,7 @@ def get_nodegroup_cached_knowledge():
     The MAASDjangoTestClient that is returned proxies to the Django testing
     Client, so we don't actually have to make HTTP calls.
     """
-    nodegroup_uuid = tags.get_recorded_nodegroup_uuid()
+    nodegroup_uuid = get_recorded_nodegroup_uuid()
     maas_client = get_nodegroup_worker_client(nodegroup_uuid)
     return maas_client, nodegroup_uuid
 
@@ -0,0 +1,75 @@
+# Copyright 2013 Canonical Ltd.  This software is licensed under the
+# GNU Affero General Public License version 3 (see the file LICENSE).
+
+"""Tests for `provisioningserver.api_client`."""
+
+from __future__ import (
+    absolute_import,
+    print_function,
+    unicode_literals,
+    )
+
+__metaclass__ = type
+__all__ = []
+
+import httplib
+
+from apiclient.maas_client import MAASClient
+from provisioningserver import api_client
+from provisioningserver.auth import get_recorded_nodegroup_uuid
+from provisioningserver.testing.testcase import PservTestCase
+import simplejson as json
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content):
+        self.code = status_code
+        self.content = content
+
+    def read(self):
+        return self.content
+
+
+class TestGetCachedKnowledge(PservTestCase):
+
+    def test_knows_nothing(self):
+        # If we haven't given it any secrets, we should get back nothing
+        self.assertEqual((None, None), api_client.get_cached_knowledge())
+
+    def test_with_only_url(self):
+        self.set_maas_url()
+        self.assertEqual((None, None), api_client.get_cached_knowledge())
+
+    def test_with_only_url_creds(self):
+        self.set_maas_url()
+        self.set_api_credentials()
+        self.assertEqual((None, None), api_client.get_cached_knowledge())
+
+    def test_with_all_info(self):
+        self.set_secrets()
+        client, uuid = api_client.get_cached_knowledge()
+        self.assertIsInstance(client, MAASClient)
+        self.assertEqual(get_recorded_nodegroup_uuid(), uuid)
+
+
+class TestResponses(PservTestCase):
+
+    def test_check_response_accepts_OK(self):
+        api_client.check_response(FakeResponse(httplib.OK, ''))
+
+    def test_check_response_rejects_other_statuses(self):
+        self.assertRaises(
+            AssertionError, api_client.check_response,
+            FakeResponse(httplib.NOT_FOUND, ''))
+
+    def test_process_response_parses_JSON(self):
+        self.assertEqual(
+            {'a': [1]},
+            api_client.process_response(
+                FakeResponse(httplib.OK, json.dumps({'a': [1]}))))
+
+    def test_process_response_checks_status(self):
+        self.assertRaises(
+            AssertionError, api_client.process_response,
+            FakeResponse(httplib.BAD_REQUEST, json.dumps({})))
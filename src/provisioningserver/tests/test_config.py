@@ -140,13 +140,20 @@ class TestConfig(TestCase):
             'password': 'test',
             'vhost': '/',
             },
+        'dhcp': {
+            'debounce': 1,
+            'leases_file': '/var/lib/maas/dhcp/dhcpd.leases',
+            },
         'logfile': 'pserv.log',
         'oops': {
             'directory': '',
             'reporter': '',
             },
         'tftp': {
+            'cache_ttl': 60,
             'generator': 'http://localhost/MAAS/api/1.0/pxeconfig/',
+            'generator_connections': 10,
+            'invalidation_port': 5249,
             'port': 69,
             'root': "/var/lib/maas/tftp",
             },
@@ -15,16 +15,27 @@ __all__ = []
 from functools import partial
 import os
 
+from fixtures import EnvironmentVariableFixture
 from maastesting.factory import factory
 from maastesting.testcase import TestCase
+from mock import (
+    call,
+    Mock,
+    )
 from provisioningserver import plugin
 from provisioningserver.plugin import (
     Options,
     ProvisioningRealm,
     ProvisioningServiceMaker,
+    request_leases_update,
     SingleUsernamePasswordChecker,
     )
-from provisioningserver.tftp import TFTPBackend
+from provisioningserver.services import LeasesWatcherService
+from provisioningserver.tasks import update_dhcp_leases
+from provisioningserver.tftp import (
+    PXEConfigCacheInvalidator,
+    TFTPBackend,
+    )
 from testtools.deferredruntest import (
     assert_fails_with,
     AsynchronousDeferredRunTest,
@@ -92,7 +103,7 @@ class TestProvisioningServiceMaker(TestCase):
 
     def test_makeService(self):
         """
-        Only the site service is created when no options are given.
+        Only the default services are created when no options are given.
         """
         options = Options()
         options["config-file"] = self.write_config({})
@@ -100,7 +111,7 @@ class TestProvisioningServiceMaker(TestCase):
         service = service_maker.makeService(options)
         self.assertIsInstance(service, MultiService)
         self.assertSequenceEqual(
-            ["log", "oops", "tftp"],
+            ["dhcp-leases", "log", "oops", "tftp"],
             sorted(service.namedServices))
         self.assertEqual(
             len(service.namedServices), len(service.services),
@@ -108,8 +119,8 @@ class TestProvisioningServiceMaker(TestCase):
 
     def test_makeService_with_broker(self):
         """
-        The log, oops, site, and amqp services are created when the broker
-        user and password options are given.
+        The amqp service is created as well when the broker user and
+        password options are given.
         """
         options = Options()
         options["config-file"] = self.write_config(
@@ -118,7 +129,7 @@ class TestProvisioningServiceMaker(TestCase):
         service = service_maker.makeService(options)
         self.assertIsInstance(service, MultiService)
         self.assertSequenceEqual(
-            ["amqp", "log", "oops", "tftp"],
+            ["amqp", "dhcp-leases", "log", "oops", "tftp"],
             sorted(service.namedServices))
         self.assertEqual(
             len(service.namedServices), len(service.services),
@@ -136,6 +147,7 @@ class TestProvisioningServiceMaker(TestCase):
         config = {
             "tftp": {
                 "generator": "http://candlemass/solitude",
+                "generator_connections": 7,
                 "root": self.tempdir,
                 "port": factory.getRandomPort(),
                 },
@@ -159,7 +171,10 @@ class TestProvisioningServiceMaker(TestCase):
                 Equals(config["tftp"]["root"])),
             AfterPreprocessing(
                 lambda backend: backend.generator_url.geturl(),
-                Equals(config["tftp"]["generator"])))
+                Equals(config["tftp"]["generator"])),
+            AfterPreprocessing(
+                lambda backend: backend.page_getter.pool.maxPersistentPerHost,
+                Equals(config["tftp"]["generator_connections"])))
         expected_protocol = MatchesAll(
             IsInstance(TFTP),
             AfterPreprocessing(
@@ -182,6 +197,83 @@ class TestProvisioningServiceMaker(TestCase):
             [service.kwargs for service in services],
             [{"interface": interface} for interface in interfaces])
 
+    def test_tftp_service_listens_locally_for_cache_invalidations(self):
+        self.patch(plugin, "get_all_interface_addresses", lambda: [])
+        port = factory.getRandomPort()
+        options = Options()
+        options["config-file"] = self.write_config(
+            {"tftp": {"invalidation_port": port, "cache_ttl": 30}})
+        service_maker = ProvisioningServiceMaker("Harry", "Hill")
+        service = service_maker.makeService(options)
+        tftp_services = service.getServiceNamed("tftp")
+        invalidation_service = tftp_services.getServiceNamed(
+            "pxe-config-invalidation")
+        self.assertEqual(
+            (port, {"interface": "127.0.0.1"}),
+            (invalidation_service.args[0], invalidation_service.kwargs))
+        invalidator = invalidation_service.args[1]
+        self.assertIsInstance(invalidator, PXEConfigCacheInvalidator)
+        self.assertEqual(30, invalidator.cache.ttl)
+        self.assertIsNotNone(
+            tftp_services.getServiceNamed("pxe-config-cache-report"))
+
+    def test_leases_watcher_service(self):
+        # A service that watches the DHCP leases file is configured and
+        # added to the top-level service.
+        config = {
+            "dhcp": {
+                "leases_file": os.path.join(self.tempdir, "dhcpd.leases"),
+                "debounce": 3,
+                },
+            }
+        options = Options()
+        options["config-file"] = self.write_config(config)
+        service_maker = ProvisioningServiceMaker("Harry", "Hill")
+        service = service_maker.makeService(options)
+        leases_service = service.getServiceNamed("dhcp-leases")
+        self.assertIsInstance(leases_service, LeasesWatcherService)
+        self.assertEqual(
+            (config["dhcp"]["leases_file"], config["dhcp"]["debounce"]),
+            (leases_service.leases_file.path, leases_service.debounce))
+
+    def test_leases_watcher_service_has_workers_update_leases(self):
+        request_update = self.patch(plugin, "request_leases_update", Mock())
+        service_maker = ProvisioningServiceMaker("Harry", "Hill")
+        leases_service = service_maker._makeLeasesWatcherService(
+            {"leases_file": "/var/lib/maas/dhcp/dhcpd.leases", "debounce": 1})
+        d = leases_service.upload()
+        d.addCallback(
+            lambda ignored: self.assertEqual(
+                [call()], request_update.mock_calls))
+        return d
+
+
+class TestRequestLeasesUpdate(TestCase):
+    """Tests for `request_leases_update`."""
+
+    def test_sends_task_through_configured_broker(self):
+        uuid = factory.getRandomUUID()
+        self.patch(plugin, "get_cluster_uuid", lambda: uuid)
+        broker_url = "amqp://%s@broker.example//" % factory.getRandomString()
+        self.useFixture(
+            EnvironmentVariableFixture("CELERY_BROKER_URL", broker_url))
+        app = update_dhcp_leases.app
+        broker_connection = self.patch(app, "broker_connection", Mock())
+        apply_async = self.patch(update_dhcp_leases, "apply_async", Mock())
+        request_leases_update()
+        connection = broker_connection.return_value
+        self.assertEqual(
+            (
+                [call(broker_url)],
+                [call(queue=uuid, connection=connection)],
+                [call()],
+            ),
+            (
+                broker_connection.call_args_list,
+                apply_async.mock_calls,
+                connection.release.mock_calls,
+            ))
+
 
 class TestSingleUsernamePasswordChecker(TestCase):
     """Tests for `SingleUsernamePasswordChecker`."""
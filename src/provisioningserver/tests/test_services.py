@@ -17,15 +17,26 @@ import signal
 import sys
 
 from maastesting.factory import factory
+from maastesting.fakemethod import FakeMethod
 from maastesting.testcase import TestCase
 from oops_twisted import OOPSObserver
 from provisioningserver.services import (
+    LeasesWatcherService,
     LogService,
     OOPSService,
     )
 from testtools.content import content_from_file
-from testtools.deferredruntest import AsynchronousDeferredRunTest
+from testtools.deferredruntest import (
+    AsynchronousDeferredRunTest,
+    flush_logged_errors,
+    )
 from twisted.application.service import MultiService
+from twisted.internet import inotify
+from twisted.internet.defer import (
+    Deferred,
+    fail,
+    )
+from twisted.internet.task import Clock
 from twisted.python.log import (
     FileLogObserver,
     theLogPublisher,
@@ -117,3 +128,110 @@ class TestOOPSService(TestServicesBase, TestCase):
         self.assertIsInstance(observer, OOPSObserver)
         self.assertEqual(1, len(observer.config.publishers))
         self.assertEqual({"reporter": "Sidebottom"}, observer.config.template)
+
+
+class TestLeasesWatcherService(TestCase):
+    """Tests for `provisioningserver.services.LeasesWatcherService`."""
+
+    run_tests_with = AsynchronousDeferredRunTest.make_factory(timeout=5)
+
+    def make_service(self, upload=None, debounce=1):
+        leases_file = os.path.join(self.make_dir(), "dhcpd.leases")
+        if upload is None:
+            upload = FakeMethod()
+        return LeasesWatcherService(
+            leases_file, upload, debounce=debounce, clock=Clock())
+
+    def notify(self, service, name=None):
+        if name is None:
+            path = service.leases_file
+        else:
+            path = service.leases_file.sibling(name)
+        service.notify(None, path, inotify.IN_MODIFY)
+
+    def test_watches_leases_file_directory(self):
+        service = self.make_service()
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.assertTrue(
+            service.notifier._isWatched(service.leases_file.parent()))
+
+    def test_survives_missing_directory(self):
+        service = LeasesWatcherService(
+            os.path.join(self.make_dir(), "missing", "dhcpd.leases"),
+            FakeMethod())
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.assertEqual({}, service.notifier._watchpoints)
+
+    def test_uploads_after_debounce_period(self):
+        service = self.make_service(debounce=2)
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.notify(service)
+        service.clock.advance(1)
+        self.assertEqual(0, service.upload.call_count)
+        service.clock.advance(1)
+        self.assertEqual(1, service.upload.call_count)
+
+    def test_uploads_once_for_burst_of_changes(self):
+        service = self.make_service()
+        service.startService()
+        self.addCleanup(service.stopService)
+        for counter in range(10):
+            self.notify(service)
+        service.clock.advance(service.debounce)
+        self.assertEqual(1, service.upload.call_count)
+
+    def test_ignores_other_files(self):
+        service = self.make_service()
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.notify(service, "dhcpd.leases~")
+        service.clock.advance(service.debounce)
+        self.assertEqual(0, service.upload.call_count)
+
+    def test_uploads_again_after_change_during_upload(self):
+        upload_done = Deferred()
+        upload = FakeMethod(result=upload_done)
+        service = self.make_service(upload=upload)
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.notify(service)
+        service.clock.advance(service.debounce)
+        self.notify(service)
+        self.notify(service)
+        service.clock.advance(service.debounce)
+        self.assertEqual(1, upload.call_count)
+        upload_done.callback(None)
+        service.clock.advance(service.debounce)
+        self.assertEqual(2, upload.call_count)
+
+    def test_survives_failed_upload(self):
+        upload = FakeMethod(result=fail(ValueError("Upload failed.")))
+        service = self.make_service(upload=upload)
+        service.startService()
+        self.addCleanup(service.stopService)
+        self.notify(service)
+        service.clock.advance(service.debounce)
+        self.assertEqual(1, len(flush_logged_errors(ValueError)))
+        self.assertFalse(service.uploading)
+
+    def test_stopService_cancels_pending_upload(self):
+        service = self.make_service()
+        service.startService()
+        self.notify(service)
+        service.stopService()
+        self.assertEqual([], service.clock.getDelayedCalls())
+        self.assertIsNone(service.notifier)
+
+    def test_detects_changes_to_leases_file(self):
+        # End-to-end test with real inotify events.
+        uploaded = Deferred()
+        service = LeasesWatcherService(
+            os.path.join(self.make_dir(), "dhcpd.leases"),
+            lambda: uploaded.callback(None), debounce=0)
+        service.startService()
+        self.addCleanup(service.stopService)
+        service.leases_file.setContent(factory.getRandomString())
+        return uploaded
@@ -12,7 +12,10 @@ from __future__ import (
 __metaclass__ = type
 __all__ = []
 
+from contextlib import contextmanager
 import httplib
+from multiprocessing import current_process
+from subprocess import CalledProcessError
 import urllib2
 
 from apiclient.maas_client import MAASClient
@@ -23,10 +26,14 @@ from maastesting.fakemethod import (
     FakeMethod,
     MultiFakeMethod,
     )
-from mock import MagicMock
+from mock import (
+    call,
+    MagicMock,
+    )
 from provisioningserver import tags
 from provisioningserver.auth import get_recorded_nodegroup_uuid
 from provisioningserver.testing.testcase import PservTestCase
+from testtools.testcase import ExpectedException
 
 
 class FakeResponse:
@@ -38,6 +45,34 @@ class FakeResponse:
     def read(self):
         return self.content
 
+    def __iter__(self):
+        return iter(self.content.splitlines(True))
+
+
+class FakeMatchingResult:
+    """A result of `FakeMatchingPool.match`, computed when collected."""
+
+    def __init__(self, pool, args):
+        self.pool = pool
+        self.args = args
+
+    def get(self):
+        self.pool.pending -= 1
+        return tags.process_chunk(self.args)
+
+
+class FakeMatchingPool:
+    """A matching pool that keeps track of how many results are waiting."""
+
+    def __init__(self):
+        self.pending = 0
+        self.max_pending = 0
+
+    def match(self, tag_definition, hardware_details):
+        self.pending += 1
+        self.max_pending = max(self.pending, self.max_pending)
+        return FakeMatchingResult(self, (tag_definition, hardware_details))
+
 
 class TestTagUpdating(PservTestCase):
 
@@ -45,29 +80,6 @@ class TestTagUpdating(PservTestCase):
         super(TestTagUpdating, self).setUp()
         self.useFixture(FakeLogger())
 
-    def test_get_cached_knowledge_knows_nothing(self):
-        # If we haven't given it any secrets, we should get back nothing
-        self.assertEqual((None, None), tags.get_cached_knowledge())
-
-    def test_get_cached_knowledge_with_only_url(self):
-        self.set_maas_url()
-        self.assertEqual((None, None), tags.get_cached_knowledge())
-
-    def test_get_cached_knowledge_with_only_url_creds(self):
-        self.set_maas_url()
-        self.set_api_credentials()
-        self.assertEqual((None, None), tags.get_cached_knowledge())
-
-    def test_get_cached_knowledge_with_all_info(self):
-        self.set_maas_url()
-        self.set_api_credentials()
-        self.set_node_group_uuid()
-        client, uuid = tags.get_cached_knowledge()
-        self.assertIsNot(None, client)
-        self.assertIsInstance(client, MAASClient)
-        self.assertIsNot(None, uuid)
-        self.assertEqual(get_recorded_nodegroup_uuid(), uuid)
-
     def fake_client(self):
         return MAASClient(None, None, self.make_maas_url())
 
@@ -85,21 +97,55 @@ class TestTagUpdating(PservTestCase):
         url = '/api/1.0/nodegroups/%s/' % (uuid,)
         mock.assert_called_once_with(url, op='list_nodes')
 
+    def test_get_nodes_with_tag_calls_correct_api(self):
+        client, uuid = self.fake_cached_knowledge()
+        response = FakeResponse(httplib.OK, '["system-id1"]')
+        mock = MagicMock(return_value=response)
+        self.patch(client, 'get', mock)
+        tag_name = factory.make_name('tag')
+        result = tags.get_nodes_for_node_group(client, uuid, tag_name)
+        self.assertEqual(['system-id1'], result)
+        url = '/api/1.0/nodegroups/%s/' % (uuid,)
+        mock.assert_called_once_with(url, op='list_nodes', tag=tag_name)
+
     def test_get_hardware_details_calls_correct_api_and_parses_result(self):
         client, uuid = self.fake_cached_knowledge()
         xml_data = "<test><data /></test>"
-        content = '[["system-id1", "%s"]]' % (xml_data,)
+        content = '["system-id1", "%s"]\n["system-id2", null]\n' % (
+            xml_data,)
         response = FakeResponse(httplib.OK, content)
         mock = MagicMock(return_value=response)
         self.patch(client, 'post', mock)
         result = tags.get_hardware_details_for_nodes(
             client, uuid, ['system-id1', 'system-id2'])
-        self.assertEqual([['system-id1', xml_data]], result)
+        self.assertEqual(
+            [['system-id1', xml_data], ['system-id2', None]], list(result))
         url = '/api/1.0/nodegroups/%s/' % (uuid,)
         mock.assert_called_once_with(
-            url, op='node_hardware_details', as_json=True,
+            url, op='stream_node_hardware_details', as_json=True,
             system_ids=["system-id1", "system-id2"])
 
+    def test_get_hardware_details_parses_records_as_they_arrive(self):
+        client, uuid = self.fake_cached_knowledge()
+        content = '["system-id1", "<node />"]\n["system-id2", null]\n'
+        response = FakeResponse(httplib.OK, content)
+        lines = iter(response)
+        self.patch(FakeResponse, '__iter__', lambda self: lines)
+        self.patch(client, 'post', MagicMock(return_value=response))
+        result = tags.get_hardware_details_for_nodes(
+            client, uuid, ['system-id1', 'system-id2'])
+        self.assertEqual(['system-id1', '<node />'], next(result))
+        # The second line has not been read yet.
+        self.assertEqual(['["system-id2", null]\n'], list(lines))
+
+    def test_get_hardware_details_checks_status(self):
+        client, uuid = self.fake_cached_knowledge()
+        response = FakeResponse(httplib.FORBIDDEN, '')
+        self.patch(client, 'post', MagicMock(return_value=response))
+        result = tags.get_hardware_details_for_nodes(
+            client, uuid, ['system-id1'])
+        self.assertRaises(AssertionError, list, result)
+
     def test_post_updated_nodes_calls_correct_api_and_parses_result(self):
         client, uuid = self.fake_cached_knowledge()
         content = '{"added": 1, "removed": 2}'
@@ -141,6 +187,31 @@ class TestTagUpdating(PservTestCase):
             definition=wrong_tag_definition,
             add=['add-system-id'], remove=['remove-1', 'remove-2'])
 
+    def test_post_rebuild_started_calls_correct_api(self):
+        client, uuid = self.fake_cached_knowledge()
+        response = FakeResponse(httplib.OK, '{"started": "tag"}')
+        post_mock = MagicMock(return_value=response)
+        self.patch(client, 'post', post_mock)
+        name = factory.make_name('tag')
+        tag_definition = factory.make_name('//')
+        self.assertTrue(
+            tags.post_rebuild_started(client, name, tag_definition, uuid))
+        url = '/api/1.0/tags/%s/' % (name,)
+        post_mock.assert_called_once_with(
+            url, op='start_rebuild', as_json=True, nodegroup=uuid,
+            definition=tag_definition)
+
+    def test_post_rebuild_started_handles_conflict(self):
+        # If the tag's definition changed after the rebuild was requested,
+        # the rebuild is superseded and the worker gets a CONFLICT.
+        client, uuid = self.fake_cached_knowledge()
+        err = urllib2.HTTPError(
+            'url', httplib.CONFLICT, "Definition doesn't match", {}, None)
+        self.patch(client, 'post', MagicMock(side_effect=err))
+        self.assertFalse(
+            tags.post_rebuild_started(
+                client, factory.make_name('tag'), '//node', uuid))
+
     def test_process_batch_evaluates_xpath(self):
         # Yay, something that doesn't need patching...
         xpath = etree.XPath('//node')
@@ -159,6 +230,81 @@ class TestTagUpdating(PservTestCase):
             ([], ['a', 'b', 'c']),
             tags.process_batch(xpath, details))
 
+    def test_process_chunk_evaluates_definition(self):
+        details = [['a', '<node />'], ['b', '<not-node />']]
+        self.assertEqual(
+            (['a'], ['b']), tags.process_chunk(('//node', details)))
+
+    def test_matching_pool_works_in_daemonic_process(self):
+        # Celery's worker processes are daemonic.
+        self.patch(current_process(), '_daemonic', True)
+        details = [['a', '<node />'], ['b', '<not-node />']]
+        with tags.matching_pool(2) as pool:
+            results = [
+                pool.match('//node', details),
+                pool.match('//not-node', details),
+                pool.match('//node', details),
+                ]
+            self.assertEqual(
+                [[['a'], ['b']], [['b'], ['a']], [['a'], ['b']]],
+                [result.get() for result in results])
+
+    def test_matching_pool_reports_helper_failure(self):
+        with tags.matching_pool(1) as pool:
+            # The helper gives up on a definition that doesn't compile.
+            result = pool.match('//[', [['a', '<node />']])
+            with ExpectedException(CalledProcessError):
+                result.get()
+
+    def test_process_all_divides_batches_among_processes(self):
+        details = [
+            ['a', '<node />'],
+            ['b', '<not-node />'],
+            ['c', '<parent><node /></parent>'],
+            ['d', None],
+            ['e', '<node><node /></node>'],
+            ]
+        self.patch(
+            tags, 'get_hardware_details_for_nodes',
+            MultiFakeMethod([
+                FakeMethod(result=details[:3]),
+                FakeMethod(result=details[3:]),
+                ]))
+        self.patch(tags, 'post_updated_nodes')
+        client = object()
+        uuid = factory.make_name('nodegroupuuid')
+        tag_name = factory.make_name('tag')
+        system_ids = [system_id for system_id, xml in details]
+        tags.process_all(
+            client, tag_name, '//node', uuid, system_ids,
+            etree.XPath('//node'), batch_size=3, processes=2, chunk_size=2)
+        tags.post_updated_nodes.assert_called_once_with(
+            client, tag_name, '//node', uuid, ['a', 'c', 'e'], ['b', 'd'])
+
+    def test_process_all_limits_chunks_waiting_to_be_matched(self):
+        details = [['node-%d' % i, '<node />'] for i in range(20)]
+        pool = FakeMatchingPool()
+
+        @contextmanager
+        def fake_matching_pool(processes):
+            yield pool
+        self.patch(tags, 'matching_pool', fake_matching_pool)
+        self.patch(
+            tags, 'get_hardware_details_for_nodes',
+            FakeMethod(result=iter(details)))
+        self.patch(tags, 'post_updated_nodes')
+        client = object()
+        uuid = factory.make_name('nodegroupuuid')
+        tag_name = factory.make_name('tag')
+        system_ids = [system_id for system_id, xml in details]
+        tags.process_all(
+            client, tag_name, '//node', uuid, system_ids,
+            etree.XPath('//node'), processes=2, chunk_size=1)
+        self.assertEqual((4, 0), (pool.max_pending, pool.pending))
+        # The results are collected in order.
+        tags.post_updated_nodes.assert_called_once_with(
+            client, tag_name, '//node', uuid, system_ids, [])
+
     def test_process_node_tags_no_secrets(self):
         self.patch(MAASClient, 'get')
         self.patch(MAASClient, 'post')
@@ -174,11 +320,16 @@ class TestTagUpdating(PservTestCase):
             result=FakeResponse(httplib.OK, '["system-id1", "system-id2"]'))
         post_hw_details = FakeMethod(
             result=FakeResponse(httplib.OK,
-                '[["system-id1", "<node />"], ["system-id2", "<no-node />"]]'))
-        get_fake = MultiFakeMethod([get_nodes])
+                '["system-id1", "<node />"]\n["system-id2", "<no-node />"]\n'))
+        get_tagged_nodes = FakeMethod(
+            result=FakeResponse(httplib.OK, '["system-id2"]'))
+        get_fake = MultiFakeMethod([get_nodes, get_tagged_nodes])
         post_update_fake = FakeMethod(
             result=FakeResponse(httplib.OK, '{"added": 1, "removed": 1}'))
-        post_fake = MultiFakeMethod([post_hw_details, post_update_fake])
+        post_start_fake = FakeMethod(
+            result=FakeResponse(httplib.OK, '{"started": "tag"}'))
+        post_fake = MultiFakeMethod(
+            [post_start_fake, post_hw_details, post_update_fake])
         self.patch(MAASClient, 'get', get_fake)
         self.patch(MAASClient, 'post', post_fake)
         tag_name = factory.make_name('tag')
@@ -187,11 +338,19 @@ class TestTagUpdating(PservTestCase):
         tags.process_node_tags(tag_name, tag_definition)
         nodegroup_url = '/api/1.0/nodegroups/%s/' % (nodegroup_uuid,)
         tag_url = '/api/1.0/tags/%s/' % (tag_name,)
+        self.assertEqual(
+            [((tag_url,), {'as_json': True, 'op': 'start_rebuild',
+                           'nodegroup': nodegroup_uuid,
+                           'definition': tag_definition})],
+            post_start_fake.calls)
         self.assertEqual([((nodegroup_url,), {'op': 'list_nodes'})],
                          get_nodes.calls)
+        self.assertEqual(
+            [((nodegroup_url,), {'op': 'list_nodes', 'tag': tag_name})],
+            get_tagged_nodes.calls)
         self.assertEqual([((nodegroup_url,),
                           {'as_json': True,
-                           'op': 'node_hardware_details',
+                           'op': 'stream_node_hardware_details',
                            'system_ids': ['system-id1', 'system-id2']})],
                          post_hw_details.calls)
         self.assertEqual([((tag_url,),
@@ -203,6 +362,19 @@ class TestTagUpdating(PservTestCase):
                            'remove': ['system-id2'],
                           })], post_update_fake.calls)
 
+    def test_process_node_tags_skips_superseded_rebuild(self):
+        client = object()
+        uuid = factory.make_name('nodegroupuuid')
+        self.patch(
+            tags, 'get_cached_knowledge',
+            MagicMock(return_value=(client, uuid)))
+        self.patch(tags, 'post_rebuild_started', FakeMethod(result=False))
+        self.patch(tags, 'get_nodes_for_node_group')
+        self.patch(tags, 'process_all')
+        tags.process_node_tags(factory.make_name('tag'), '//node')
+        self.assertFalse(tags.get_nodes_for_node_group.called)
+        self.assertFalse(tags.process_all.called)
+
     def test_process_node_tags_requests_details_in_batches(self):
         client = object()
         uuid = factory.make_name('nodegroupuuid')
@@ -211,20 +383,24 @@ class TestTagUpdating(PservTestCase):
             MagicMock(return_value=(client, uuid)))
         self.patch(
             tags, 'get_nodes_for_node_group',
-            MagicMock(return_value=['a', 'b', 'c']))
+            MagicMock(side_effect=[['a', 'b', 'c'], ['b', 'c']]))
         fake_first = FakeMethod(
             result=[['a', '<node />'], ['b', '<not-node />']])
         fake_second = FakeMethod(
             result=[['c', '<parent><node /></parent>']])
         self.patch(tags, 'get_hardware_details_for_nodes',
             MultiFakeMethod([fake_first, fake_second]))
+        self.patch(tags, 'post_rebuild_started', FakeMethod(result=True))
         self.patch(tags, 'post_updated_nodes')
         tag_name = factory.make_name('tag')
         tag_definition = '//node'
         tags.process_node_tags(tag_name, tag_definition, batch_size=2)
         tags.get_cached_knowledge.assert_called_once_with()
-        tags.get_nodes_for_node_group.assert_called_once_with(client, uuid)
+        self.assertEqual(
+            [call(client, uuid), call(client, uuid, tag_name)],
+            tags.get_nodes_for_node_group.call_args_list)
         self.assertEqual([((client, uuid, ['a', 'b']), {})], fake_first.calls)
         self.assertEqual([((client, uuid, ['c']), {})], fake_second.calls)
+        # Only the changes to the tag's membership are posted.
         tags.post_updated_nodes.assert_called_once_with(
-            client, tag_name, tag_definition, uuid, ['a', 'c'], ['b'])
+            client, tag_name, tag_definition, uuid, ['a'], ['b'])
@@ -44,12 +44,14 @@ from provisioningserver import (
     cache,
     tags,
     tasks,
+    tftp,
     utils,
     )
 from provisioningserver.dhcp import (
     config,
     leases,
     )
+from provisioningserver.dns import config as dns_config_module
 from provisioningserver.dns.config import (
     conf,
     DNSForwardZoneConfig,
@@ -59,15 +61,26 @@ from provisioningserver.dns.config import (
     MAAS_RNDC_CONF_NAME,
     )
 from provisioningserver.enum import POWER_TYPE
+from provisioningserver.power import (
+    executor,
+    poller,
+    )
+from provisioningserver.power.executor import (
+    PowerActionResult,
+    PowerExecutor,
+    )
 from provisioningserver.power.poweraction import PowerActionFail
 from provisioningserver.pxe import tftppath
 from provisioningserver.tags import MissingCredentials
 from provisioningserver.tasks import (
     add_new_dhcp_host_map,
     import_boot_images,
+    invalidate_pxe_configs,
     Omshell,
     power_off,
+    power_off_nodes,
     power_on,
+    power_on_nodes,
     refresh_secrets,
     remove_dhcp_host_map,
     report_boot_images,
@@ -75,6 +88,7 @@ from provisioningserver.tasks import (
     rndc_command,
     RNDC_COMMAND_MAX_RETRY,
     setup_rndc_configuration,
+    update_dns_zone_records,
     update_node_tags,
     UPDATE_NODE_TAGS_MAX_RETRY,
     write_dhcp_config,
@@ -144,15 +158,65 @@ class TestPowerTasks(PservTestCase):
             PowerActionFail, power_on.delay, POWER_TYPE.WAKE_ON_LAN)
 
     def test_ether_wake_power_on(self):
+        send_magic_packets = self.patch(executor, 'send_magic_packets')
         result = power_on.delay(
             POWER_TYPE.WAKE_ON_LAN, mac_address=arbitrary_mac)
         self.assertTrue(result.successful())
+        send_magic_packets.assert_called_once_with([arbitrary_mac])
 
     def test_ether_wake_does_not_support_power_off(self):
         self.assertRaises(
             PowerActionFail, power_off.delay,
             POWER_TYPE.WAKE_ON_LAN, mac=arbitrary_mac)
 
+    def fake_run_action(self, failing_power_type=None):
+        """Patch `PowerExecutor.run_action` to record the actions it gets.
+
+        Actions for `failing_power_type` fail.
+        """
+        actions = []
+
+        def run_action(executor, power_type, power_change, power_params):
+            actions.append((power_type, power_change, power_params))
+            if power_type == failing_power_type:
+                error = PowerActionFail()
+            else:
+                error = None
+            return PowerActionResult(
+                power_params.get('system_id'), power_type, power_change,
+                1, 0.1, error, None)
+
+        self.patch(PowerExecutor, 'run_action', run_action)
+        return actions
+
+    def test_power_on_nodes_powers_on_each_node(self):
+        actions = self.fake_run_action()
+        power_actions = [
+            (POWER_TYPE.IPMI, {'system_id': factory.make_name('node')}),
+            (POWER_TYPE.VIRSH, {'system_id': factory.make_name('node')}),
+            ]
+        power_on_nodes.delay(power_actions)
+        self.assertItemsEqual(
+            [
+                (power_type, 'on', power_params)
+                for power_type, power_params in power_actions],
+            actions)
+
+    def test_power_off_nodes_continues_past_failures(self):
+        actions = self.fake_run_action(failing_power_type=POWER_TYPE.VIRSH)
+        power_actions = [
+            (POWER_TYPE.VIRSH, {'system_id': factory.make_name('node')}),
+            (POWER_TYPE.IPMI, {'system_id': factory.make_name('node')}),
+            ]
+        self.assertRaises(
+            PowerActionFail, power_off_nodes.delay, power_actions)
+        self.assertEqual(2, len(actions))
+
+    def test_poll_power_states_polls_power_states(self):
+        poll_power_states = self.patch(poller, 'poll_power_states')
+        tasks.poll_power_states.delay()
+        poll_power_states.assert_called_once_with()
+
 
 class TestDHCPTasks(PservTestCase):
 
@@ -192,6 +256,20 @@ class TestDHCPTasks(PservTestCase):
         tasks.upload_dhcp_leases.delay()
         self.assertEqual(1, leases.process_leases.call_count)
 
+    def test_update_dhcp_leases(self):
+        self.patch(
+            leases, 'check_lease_changes',
+            Mock(return_value=(datetime.utcnow(), {})))
+        self.patch(leases, 'process_leases', Mock())
+        tasks.update_dhcp_leases.delay()
+        self.assertEqual(1, leases.process_leases.call_count)
+
+    def test_update_dhcp_leases_does_nothing_without_changes(self):
+        self.patch(leases, 'check_lease_changes', Mock(return_value=None))
+        self.patch(leases, 'process_leases', Mock())
+        tasks.update_dhcp_leases.delay()
+        self.assertEqual(0, leases.process_leases.call_count)
+
     def test_add_new_dhcp_host_map(self):
         # We don't want to actually run omshell in the task, so we stub
         # out the wrapper class's _run method and record what it would
@@ -292,6 +370,8 @@ class TestDNSTasks(PservTestCase):
         # executing real rndc commands).
         self.rndc_recorder = FakeMethod()
         self.patch(tasks, 'execute_rndc_command', self.rndc_recorder)
+        self.patch(
+            dns_config_module, 'execute_rndc_command', self.rndc_recorder)
 
     def test_write_dns_config_writes_file(self):
         zone_names = [random.randint(1, 100), random.randint(1, 100)]
@@ -314,6 +394,14 @@ class TestDNSTasks(PservTestCase):
                 )),
             result)
 
+    def test_write_dns_config_skips_callback_if_unchanged(self):
+        write_dns_config.delay()
+        command = factory.getRandomString()
+        result = write_dns_config.delay(
+            callback=rndc_command.subtask(args=[command]))
+        self.assertEqual(
+            (True, []), (result.successful(), self.rndc_recorder.calls))
+
     def test_write_dns_config_attached_to_dns_worker_queue(self):
         self.assertEqual(
             write_dns_config.queue,
@@ -348,10 +436,34 @@ class TestDNSTasks(PservTestCase):
                     Equals(True),
                     FileExists(),
                     FileExists(),
-                    Equals([((command, ), {})]),
+                    Equals([
+                        ((['freeze', domain], ), {}),
+                        ((['thaw', domain], ), {}),
+                        ((['freeze', '0.168.192.in-addr.arpa'], ), {}),
+                        ((['thaw', '0.168.192.in-addr.arpa'], ), {}),
+                        ((command, ), {}),
+                        ]),
                 )),
             result)
 
+    def test_write_dns_zone_config_writes_unfrozen_zone(self):
+        # A zone that the DNS server cannot freeze, e.g. because it
+        # does not know it yet, is written all the same.
+        self.patch(
+            dns_config_module, 'execute_rndc_command',
+            FakeMethod(failure=CalledProcessError(1, 'rndc')))
+        domain = factory.getRandomString()
+        zone = DNSForwardZoneConfig(
+            domain, serial=random.randint(1, 100),
+            networks=[IPNetwork('192.168.0.3/24')])
+        result = write_dns_zone_config.delay(zones=[zone])
+        self.assertThat(
+            (
+                result.successful(),
+                os.path.join(self.dns_conf_dir, 'zone.%s' % domain),
+            ),
+            MatchesListwise((Equals(True), FileExists())))
+
     def test_write_dns_zone_config_attached_to_dns_worker_queue(self):
         self.assertEqual(
             write_dns_zone_config.queue,
@@ -427,6 +539,29 @@ class TestDNSTasks(PservTestCase):
     def test_rndc_command_attached_to_dns_worker_queue(self):
         self.assertEqual(rndc_command.queue, celery_config.WORKER_QUEUE_DNS)
 
+    def test_update_dns_zone_records_sends_updates(self):
+        recorder = self.patch(tasks, 'execute_nsupdate', FakeMethod())
+        domain = factory.getRandomString()
+        ip = factory.getRandomIPInNetwork(IPNetwork('192.168.0.3/24'))
+        zone = DNSForwardZoneConfig(
+            domain, serial=random.randint(1, 100),
+            mapping={factory.getRandomString(): ip})
+        command = factory.getRandomString()
+        result = update_dns_zone_records.delay(
+            zones=[zone], callback=rndc_command.subtask(args=[command]))
+        self.assertEqual(
+            (
+                True,
+                [((zone.get_update_commands(), ), {})],
+                [((command, ), {})],
+            ),
+            (result.successful(), recorder.calls, self.rndc_recorder.calls))
+
+    def test_update_dns_zone_records_attached_to_dns_worker_queue(self):
+        self.assertEqual(
+            update_dns_zone_records.queue,
+            celery_config.WORKER_QUEUE_DNS)
+
     def test_write_full_dns_config_sets_up_config(self):
         # write_full_dns_config writes the config file, writes
         # the zone files, and reloads the dns service.
@@ -461,12 +596,30 @@ class TestDNSTasks(PservTestCase):
             MatchesListwise(
                 (
                     Equals(True),
-                    Equals([((command,), {})]),
+                    Equals([
+                        ((['freeze'],), {}),
+                        ((['thaw'],), {}),
+                        ((command,), {}),
+                        ]),
                     FileExists(),
                     FileExists(),
                     FileExists(),
                 )))
 
+    def test_write_full_dns_config_skips_callback_if_unchanged(self):
+        zones = [
+            DNSForwardZoneConfig(
+                factory.getRandomString(), serial=random.randint(1, 100),
+                networks=[IPNetwork('192.168.0.3/24')]),
+            ]
+        write_full_dns_config.delay(zones=zones)
+        command = factory.getRandomString()
+        result = write_full_dns_config.delay(
+            zones=zones, callback=rndc_command.subtask(args=[command]))
+        self.assertEqual(
+            (True, [((['freeze'],), {}), ((['thaw'],), {})] * 2),
+            (result.successful(), self.rndc_recorder.calls))
+
     def test_write_full_dns_attached_to_dns_worker_queue(self):
         self.assertEqual(
             write_full_dns_config.queue,
@@ -493,6 +646,12 @@ class TestBootImagesTasks(PservTestCase):
         args, kwargs = MAASClient.post.call_args
         self.assertItemsEqual([image], json.loads(kwargs['images']))
 
+    def test_invalidate_pxe_configs_notifies_tftp_server(self):
+        send = self.patch(tftp, 'send_pxe_config_invalidation')
+        mac = factory.getRandomMACAddress()
+        invalidate_pxe_configs.delay([mac])
+        send.assert_called_once_with([mac])
+
 
 class TestTagTasks(PservTestCase):
 
@@ -13,8 +13,10 @@ __metaclass__ = type
 __all__ = []
 
 from functools import partial
+import httplib
 import json
 from os import path
+import socket
 from urllib import urlencode
 from urlparse import (
     parse_qsl,
@@ -28,15 +30,25 @@ from provisioningserver.pxe.tftppath import compose_config_path
 from provisioningserver.tests.test_kernel_opts import make_kernel_parameters
 from provisioningserver.tftp import (
     BytesReader,
+    KernelParamsCache,
+    PersistentPageGetter,
+    PXEConfigCacheInvalidator,
+    send_pxe_config_invalidation,
     TFTPBackend,
     )
 from testtools.deferredruntest import AsynchronousDeferredRunTest
 from tftp.backend import IReader
+from twisted.internet import reactor
 from twisted.internet.defer import (
+    Deferred,
     inlineCallbacks,
     succeed,
     )
+from twisted.internet.task import Clock
 from twisted.python import context
+from twisted.web.error import Error
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 from zope.interface.verify import verifyObject
 
 
@@ -162,6 +174,198 @@ class TestTFTPBackendRegex(TestCase):
             match.groupdict())
 
 
+def make_request_params(mac=None):
+    """Make parameters like those `TFTPBackend.get_reader` passes on."""
+    if mac is None:
+        mac = factory.getRandomMACAddress(b"-")
+    return {
+        "mac": mac,
+        "local": factory.getRandomIPAddress(),
+        "remote": factory.getRandomIPAddress(),
+        "cluster_uuid": factory.getRandomUUID(),
+        }
+
+
+class TestKernelParamsCache(TestCase):
+    """Tests for `provisioningserver.tftp.KernelParamsCache`."""
+
+    def test_get_returns_cached_kernel_params(self):
+        cache = KernelParamsCache(60, Clock())
+        params = make_request_params()
+        kernel_params = make_kernel_parameters()
+        cache.set(params, kernel_params)
+        self.assertEqual(kernel_params, cache.get(params))
+        self.assertEqual((1, 0), (cache.hits, cache.misses))
+
+    def test_get_ignores_remote_address(self):
+        # Nodes boot from different addresses over time; the config does
+        # not depend on them.
+        cache = KernelParamsCache(60, Clock())
+        params = make_request_params()
+        kernel_params = make_kernel_parameters()
+        cache.set(params, kernel_params)
+        params["remote"] = factory.getRandomIPAddress()
+        self.assertEqual(kernel_params, cache.get(params))
+
+    def test_get_misses_other_mac_address(self):
+        cache = KernelParamsCache(60, Clock())
+        cache.set(make_request_params(), make_kernel_parameters())
+        self.assertIsNone(cache.get(make_request_params()))
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+
+    def test_get_expires_entries(self):
+        clock = Clock()
+        cache = KernelParamsCache(60, clock)
+        params = make_request_params()
+        cache.set(params, make_kernel_parameters())
+        clock.advance(60)
+        self.assertIsNone(cache.get(params))
+        self.assertEqual({}, cache.entries)
+
+    def test_zero_ttl_disables_cache(self):
+        cache = KernelParamsCache(0, Clock())
+        params = make_request_params()
+        cache.set(params, make_kernel_parameters())
+        self.assertIsNone(cache.get(params))
+
+    def test_invalidate_forgets_mac_addresses(self):
+        cache = KernelParamsCache(60, Clock())
+        mac = factory.getRandomMACAddress(b"-")
+        changed = make_request_params(mac)
+        unchanged = make_request_params()
+        cache.set(changed, make_kernel_parameters())
+        cache.set(unchanged, make_kernel_parameters())
+        # The region separates octets with colons.
+        cache.invalidate([mac.upper().replace("-", ":")])
+        self.assertIsNone(cache.get(changed))
+        self.assertIsNotNone(cache.get(unchanged))
+        self.assertEqual(1, cache.invalidations)
+
+    def test_invalidate_forgets_everything_by_default(self):
+        cache = KernelParamsCache(60, Clock())
+        default_params = {"local": factory.getRandomIPAddress()}
+        cache.set(default_params, make_kernel_parameters())
+        cache.set(make_request_params(), make_kernel_parameters())
+        cache.invalidate()
+        self.assertEqual(({}, 2), (cache.entries, cache.invalidations))
+
+
+class TestPXEConfigCacheInvalidation(TestCase):
+    """Tests for invalidating a `KernelParamsCache` from a worker."""
+
+    def test_invalidator_invalidates_mac_addresses(self):
+        cache = KernelParamsCache(60, Clock())
+        params = make_request_params()
+        cache.set(params, make_kernel_parameters())
+        PXEConfigCacheInvalidator(cache).datagramReceived(
+            json.dumps([params["mac"]]), ("127.0.0.1", 12345))
+        self.assertIsNone(cache.get(params))
+
+    def test_invalidator_invalidates_everything_for_null(self):
+        cache = KernelParamsCache(60, Clock())
+        cache.set(make_request_params(), make_kernel_parameters())
+        PXEConfigCacheInvalidator(cache).datagramReceived(
+            json.dumps(None), ("127.0.0.1", 12345))
+        self.assertEqual({}, cache.entries)
+
+    def test_invalidator_ignores_malformed_datagrams(self):
+        cache = KernelParamsCache(60, Clock())
+        cache.set(make_request_params(), make_kernel_parameters())
+        PXEConfigCacheInvalidator(cache).datagramReceived(
+            b"{", ("127.0.0.1", 12345))
+        self.assertEqual(1, len(cache.entries))
+
+    def make_listener(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(listener.close)
+        listener.bind(("127.0.0.1", 0))
+        listener.settimeout(5)
+        return listener, listener.getsockname()[1]
+
+    def test_send_sends_mac_addresses_in_batches(self):
+        self.patch(tftp_module, "INVALIDATION_BATCH_SIZE", 2)
+        listener, port = self.make_listener()
+        macs = [factory.getRandomMACAddress() for i in range(3)]
+        send_pxe_config_invalidation(macs, port=port)
+        self.assertEqual(
+            [macs[:2], macs[2:]],
+            [json.loads(listener.recv(65536)) for i in range(2)])
+
+    def test_send_sends_null_to_invalidate_everything(self):
+        listener, port = self.make_listener()
+        send_pxe_config_invalidation(port=port)
+        self.assertIsNone(json.loads(listener.recv(65536)))
+
+
+class PageResource(Resource):
+    """Serve `body` with `status`, for any path."""
+
+    isLeaf = True
+
+    def __init__(self, body=b"", status=httplib.OK):
+        Resource.__init__(self)
+        self.body = body
+        self.status = status
+
+    def render_GET(self, request):
+        request.setResponseCode(self.status)
+        return self.body
+
+
+class CountingSite(Site):
+    """A `Site` that counts the connections made to it."""
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return Site.buildProtocol(self, addr)
+
+
+class TestPersistentPageGetter(TestCase):
+    """Tests for `provisioningserver.tftp.PersistentPageGetter`."""
+
+    run_tests_with = AsynchronousDeferredRunTest.make_factory(timeout=5)
+
+    def serve(self, resource):
+        """Serve `resource` locally.  Returns the site and its URL."""
+        site = CountingSite(resource)
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        url = b"http://127.0.0.1:%d/" % port.getHost().port
+        return site, url
+
+    def make_page_getter(self):
+        page_getter = PersistentPageGetter(2)
+        self.addCleanup(page_getter.close)
+        return page_getter
+
+    @inlineCallbacks
+    def test_get_page_returns_body(self):
+        body = factory.getRandomString().encode("ascii")
+        site, url = self.serve(PageResource(body))
+        page = yield self.make_page_getter().get_page(url)
+        self.assertEqual(body, page)
+
+    @inlineCallbacks
+    def test_get_page_reuses_connection(self):
+        site, url = self.serve(PageResource(b"page"))
+        page_getter = self.make_page_getter()
+        yield page_getter.get_page(url)
+        yield page_getter.get_page(url)
+        self.assertEqual(1, site.connections)
+
+    @inlineCallbacks
+    def test_get_page_fails_like_getPage_for_other_statuses(self):
+        site, url = self.serve(PageResource(status=httplib.NO_CONTENT))
+        try:
+            yield self.make_page_getter().get_page(url)
+        except Error as error:
+            self.assertEqual(b"204", error.status)
+        else:
+            self.fail("No error raised.")
+
+
 class TestTFTPBackend(TestCase):
     """Tests for `provisioningserver.tftp.TFTPBackend`."""
 
@@ -175,6 +379,7 @@ class TestTFTPBackend(TestCase):
         self.assertEqual((True, False), (backend.can_read, backend.can_write))
         self.assertEqual(temp_dir, backend.base.path)
         self.assertEqual(generator_url, backend.generator_url.geturl())
+        self.assertEqual(0, backend.kernel_params_cache.ttl)
 
     def test_get_generator_url(self):
         # get_generator_url() merges the parameters obtained from the request
@@ -283,3 +488,76 @@ class TestTFTPBackend(TestCase):
         self.assertEqual(fake_render_result.encode("utf-8"), output)
         backend.render_pxe_config.assert_called_once_with(
             kernel_params=fake_kernel_params, **fake_params)
+
+    @inlineCallbacks
+    def test_get_kernel_params_caches_kernel_params(self):
+        backend = TFTPBackend(
+            self.make_dir(), b"http://example.com/", cache_ttl=60)
+        params = make_request_params()
+        kernel_params = make_kernel_parameters()
+        get_page = self.patch(backend, "get_page")
+        get_page.return_value = succeed(json.dumps(kernel_params._asdict()))
+        first = yield backend.get_kernel_params(params)
+        second = yield backend.get_kernel_params(params)
+        self.assertEqual((kernel_params, kernel_params), (first, second))
+        self.assertEqual(1, get_page.call_count)
+        self.assertEqual(1, backend.kernel_params_cache.hits)
+
+    @inlineCallbacks
+    def test_get_kernel_params_fetches_again_after_invalidation(self):
+        backend = TFTPBackend(
+            self.make_dir(), b"http://example.com/", cache_ttl=60)
+        params = make_request_params()
+        data = json.dumps(make_kernel_parameters()._asdict())
+        get_page = self.patch(backend, "get_page")
+        get_page.side_effect = lambda url: succeed(data)
+        yield backend.get_kernel_params(params)
+        backend.kernel_params_cache.invalidate([params["mac"]])
+        yield backend.get_kernel_params(params)
+        self.assertEqual(2, get_page.call_count)
+
+    def test_get_kernel_params_coalesces_pending_fetches(self):
+        backend = TFTPBackend(self.make_dir(), b"http://example.com/")
+        params = make_request_params()
+        kernel_params = make_kernel_parameters()
+        fetch = Deferred()
+        get_page = self.patch(backend, "get_page")
+        get_page.return_value = fetch
+        # A retry may come from another remote address on the same node.
+        retry_params = dict(params, remote=factory.getRandomIPAddress())
+        first = backend.get_kernel_params(params)
+        second = backend.get_kernel_params(retry_params)
+        fetch.callback(json.dumps(kernel_params._asdict()))
+        results = []
+        first.addCallback(results.append)
+        second.addCallback(results.append)
+        self.assertEqual([kernel_params, kernel_params], results)
+        self.assertEqual(1, get_page.call_count)
+        self.assertEqual(1, backend.kernel_params_cache.coalesced)
+        self.assertEqual({}, backend.pending_fetches)
+
+    def test_get_kernel_params_passes_failure_to_coalesced_fetches(self):
+        backend = TFTPBackend(self.make_dir(), b"http://example.com/")
+        params = make_request_params()
+        fetch = Deferred()
+        self.patch(backend, "get_page").return_value = fetch
+        first = backend.get_kernel_params(params)
+        second = backend.get_kernel_params(params)
+        fetch.errback(Error(b"204"))
+        failures = []
+        first.addErrback(failures.append)
+        second.addErrback(failures.append)
+        self.assertEqual(
+            [Error, Error], [failure.type for failure in failures])
+        self.assertEqual({}, backend.pending_fetches)
+
+    def test_get_kernel_params_does_not_cache_if_invalidated_meanwhile(self):
+        backend = TFTPBackend(
+            self.make_dir(), b"http://example.com/", cache_ttl=60)
+        params = make_request_params()
+        fetch = Deferred()
+        self.patch(backend, "get_page").return_value = fetch
+        backend.get_kernel_params(params)
+        backend.kernel_params_cache.invalidate([params["mac"]])
+        fetch.callback(json.dumps(make_kernel_parameters()._asdict()))
+        self.assertEqual({}, backend.kernel_params_cache.entries)
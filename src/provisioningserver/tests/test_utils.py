@@ -35,6 +35,7 @@ from maastesting import root
 from maastesting.factory import factory
 from maastesting.fakemethod import FakeMethod
 from maastesting.testcase import TestCase
+from lxml import etree
 from mock import Mock
 import netifaces
 from netifaces import (
@@ -43,10 +44,12 @@ from netifaces import (
     AF_INET6,
     )
 import provisioningserver
+from provisioningserver import utils
 from provisioningserver.utils import (
     ActionScript,
     atomic_write,
     AtomicWriteScript,
+    compile_xpath,
     get_all_interface_addresses,
     get_mtime,
     incremental_write,
@@ -56,6 +59,7 @@ from provisioningserver.utils import (
     pick_new_mtime,
     Safe,
     ShellTemplate,
+    split_chunks,
     sudo_write_file,
     write_custom_config_section,
     )
@@ -777,3 +781,42 @@ class TestAtomicWriteScript(TestCase):
 
         mocked_atomic_write.assert_called_once_with(
             content, filename, mode=0600, overwrite=True)
+
+
+class TestSplitChunks(TestCase):
+
+    def test_splits_iterable(self):
+        self.assertEqual(
+            [[1, 2], [3, 4], [5]],
+            list(split_chunks(iter([1, 2, 3, 4, 5]), 2)))
+
+    def test_splits_empty_iterable(self):
+        self.assertEqual([], list(split_chunks(iter([]), 2)))
+
+
+class TestCompileXPath(TestCase):
+
+    def setUp(self):
+        super(TestCompileXPath, self).setUp()
+        self.patch(utils, '_compiled_xpaths', utils.OrderedDict())
+        self.patch(utils, 'COMPILED_XPATH_CACHE_SIZE', 2)
+
+    def test_compiles_expression(self):
+        xpath = compile_xpath('/node/foo')
+        self.assertEqual('/node/foo', xpath.path)
+        self.assertTrue(xpath(etree.XML('<node><foo /></node>')))
+
+    def test_caches_compiled_expression(self):
+        self.assertIs(compile_xpath('/node/foo'), compile_xpath('/node/foo'))
+
+    def test_forgets_least_recently_used_expression(self):
+        foo = compile_xpath('/node/foo')
+        bar = compile_xpath('/node/bar')
+        self.assertIs(foo, compile_xpath('/node/foo'))
+        compile_xpath('/node/baz')
+        self.assertEqual(
+            ['/node/foo', '/node/baz'], list(utils._compiled_xpaths))
+        self.assertIsNot(bar, compile_xpath('/node/bar'))
+
+    def test_raises_syntax_error(self):
+        self.assertRaises(etree.XPathSyntaxError, compile_xpath, '//[')
@@ -11,14 +11,20 @@ from __future__ import (
 
 __metaclass__ = type
 __all__ = [
+    "KernelParamsCache",
+    "PersistentPageGetter",
+    "PXEConfigCacheInvalidator",
+    "send_pxe_config_invalidation",
     "TFTPBackend",
     ]
 
+from contextlib import closing
 import httplib
 from io import BytesIO
 from itertools import repeat
 import json
 import re
+import socket
 from urllib import urlencode
 from urlparse import (
     parse_qsl,
@@ -26,6 +32,7 @@ from urlparse import (
     )
 
 from provisioningserver.cluster_config import get_cluster_uuid
+from provisioningserver.config import Config
 from provisioningserver.enum import ARP_HTYPE
 from provisioningserver.kernel_opts import KernelParameters
 from provisioningserver.pxe.config import render_pxe_config
@@ -35,9 +42,24 @@ from tftp.backend import (
     IReader,
     )
 from tftp.errors import FileNotFound
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred,
+    succeed,
+    )
+from twisted.internet.protocol import (
+    DatagramProtocol,
+    Protocol,
+    )
+from twisted.python import log
 from twisted.python.context import get
-from twisted.web.client import getPage
+from twisted.web.client import (
+    Agent,
+    HTTPConnectionPool,
+    ResponseDone,
+    )
 import twisted.web.error
+from twisted.web.http import PotentialDataLoss
 from zope.interface import implementer
 
 
@@ -56,6 +78,214 @@ class BytesReader:
         self.buffer.close()
 
 
+def normalise_mac_address(mac_address):
+    """Write `mac_address` the way PXELINUX does: lower case, with hyphens.
+
+    MAC addresses from the region controller are separated by colons.
+    """
+    return mac_address.lower().replace(":", "-")
+
+
+class KernelParamsCache:
+    """Cache of the kernel parameters that the region has served.
+
+    PXELINUX retries, and nodes with several NICs ask for the same config
+    more than once, so during a boot storm many requests are identical.
+    Entries are keyed on (mac, arch, subarch, local), and expire `ttl`
+    seconds after they were fetched.  The region also pushes invalidations
+    when a node's boot configuration changes; see
+    `PXEConfigCacheInvalidator`.
+
+    `hits`, `misses`, and `invalidations` count lookups and removed
+    entries, for reporting the cache's effectiveness.  `coalesced` counts
+    the misses that joined a fetch already in progress, rather than
+    fetching again.  `generation` goes up with every invalidation, so
+    that a fetch that overlaps one can avoid caching a stale result.
+
+    :param ttl: Seconds to keep an entry.  Zero disables the cache.
+    :param clock: An `IReactorTime` provider.
+    """
+
+    key_fields = ("mac", "arch", "subarch", "local")
+
+    def __init__(self, ttl, clock=reactor):
+        super(KernelParamsCache, self).__init__()
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    def make_key(self, params):
+        """Return the cache key for the request `params`."""
+        return tuple(params.get(field) for field in self.key_fields)
+
+    def get(self, params):
+        """Return the cached kernel parameters for `params`, or None."""
+        key = self.make_key(params)
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, kernel_params = entry
+            if expires > self.clock.seconds():
+                self.hits += 1
+                return kernel_params
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, params, kernel_params):
+        """Cache `kernel_params`, as fetched for `params`."""
+        if self.ttl > 0:
+            expires = self.clock.seconds() + self.ttl
+            self.entries[self.make_key(params)] = expires, kernel_params
+
+    def invalidate(self, mac_addresses=None):
+        """Forget the entries for `mac_addresses`, or all entries if None.
+
+        Entries for the "default" configs are not tied to a MAC address,
+        so only a full invalidation removes them before they expire.
+        """
+        if mac_addresses is None:
+            stale = list(self.entries)
+        else:
+            macs = {normalise_mac_address(mac) for mac in mac_addresses}
+            stale = [key for key in self.entries if key[0] in macs]
+        for key in stale:
+            del self.entries[key]
+        self.invalidations += len(stale)
+        self.generation += 1
+
+    def report(self):
+        """Log the hit rate and size of the cache."""
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            log.msg(
+                "PXE config cache: %d hits, %d misses (%.0f%% hit rate), "
+                "%d coalesced, %d invalidated, %d entries." % (
+                    self.hits, self.misses, 100.0 * self.hits / lookups,
+                    self.coalesced, self.invalidations, len(self.entries)))
+
+
+class PXEConfigCacheInvalidator(DatagramProtocol):
+    """Receive cache invalidations from this cluster's workers.
+
+    Each datagram holds a JSON list of MAC addresses whose PXE configs
+    have changed, or JSON null to invalidate everything.  Workers send
+    them with `send_pxe_config_invalidation`.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def datagramReceived(self, data, addr):
+        try:
+            mac_addresses = json.loads(data)
+        except ValueError:
+            log.msg(
+                "Ignoring malformed PXE config invalidation from %s:%d." % (
+                    addr))
+        else:
+            self.cache.invalidate(mac_addresses)
+
+
+# How many MAC addresses to send in each invalidation datagram.  At 19
+# bytes or so each, this keeps datagrams well under 64KiB.
+INVALIDATION_BATCH_SIZE = 1000
+
+
+def send_pxe_config_invalidation(mac_addresses=None, port=None):
+    """Tell this cluster's TFTP server to forget cached PXE configs.
+
+    :param mac_addresses: The MAC addresses whose configs have changed,
+        or None to invalidate all of them.
+    :param port: The port of the TFTP server's invalidation listener on
+        localhost.  Defaults to the `tftp.invalidation_port` setting.
+    """
+    if port is None:
+        port = Config.load_from_cache()["tftp"]["invalidation_port"]
+    if mac_addresses is None:
+        datagrams = [json.dumps(None)]
+    else:
+        mac_addresses = list(mac_addresses)
+        datagrams = [
+            json.dumps(mac_addresses[start:start + INVALIDATION_BATCH_SIZE])
+            for start in range(
+                0, len(mac_addresses), INVALIDATION_BATCH_SIZE)]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    with closing(sock):
+        for datagram in datagrams:
+            sock.sendto(datagram, ("127.0.0.1", port))
+
+
+class BodyCollector(Protocol):
+    """Collect the body of an HTTP response, then fire `finished` with it."""
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.data = []
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(b"".join(self.data))
+        else:
+            self.finished.errback(reason)
+
+
+class PersistentPageGetter:
+    """Fetch pages over persistent HTTP/1.1 connections.
+
+    `getPage` makes a new connection for every request.  This keeps up to
+    `max_per_host` idle connections to each host open for reuse.
+
+    `get_page` is a drop-in replacement for `getPage`: it fires with the
+    body of the page, or fails with `twisted.web.error.Error` for a status
+    other than 200, 201 or 202.
+
+    :param max_per_host: Maximum number of idle connections to keep open
+        to each host.
+    """
+
+    ok_statuses = (httplib.OK, httplib.CREATED, httplib.ACCEPTED)
+
+    def __init__(self, max_per_host, clock=reactor):
+        super(PersistentPageGetter, self).__init__()
+        self.pool = HTTPConnectionPool(clock, persistent=True)
+        self.pool.maxPersistentPerHost = max_per_host
+        self.agent = Agent(clock, pool=self.pool)
+
+    def get_page(self, url):
+        """Fetch `url`.  Returns a `Deferred` that fires with its body."""
+        d = self.agent.request(b"GET", url)
+        d.addCallback(self.read_response)
+        return d
+
+    def read_response(self, response):
+        if response.length == 0:
+            # Twisted 12.3 never finishes delivering an empty 204 body.
+            finished = succeed(b"")
+        else:
+            finished = Deferred()
+            response.deliverBody(BodyCollector(finished))
+
+        def check_status(body):
+            if response.code not in self.ok_statuses:
+                raise twisted.web.error.Error(
+                    b"%d" % response.code, response.phrase, body)
+            return body
+
+        return finished.addCallback(check_status)
+
+    def close(self):
+        """Close the idle connections.  Returns a `Deferred`."""
+        return self.pool.closeCachedConnections()
+
+
 class TFTPBackend(FilesystemSynchronousBackend):
     """A partially dynamic read-only TFTP server.
 
@@ -77,7 +307,6 @@ class TFTPBackend(FilesystemSynchronousBackend):
     fetch files at many similar paths which must not be passed on.
     """
 
-    get_page = staticmethod(getPage)
     render_pxe_config = staticmethod(render_pxe_config)
 
     # PXELINUX represents a MAC address in IEEE 802 hyphen-separated
@@ -112,16 +341,26 @@ class TFTPBackend(FilesystemSynchronousBackend):
             re_mac_address=re_mac_address),
         re.VERBOSE)
 
-    def __init__(self, base_path, generator_url):
+    def __init__(self, base_path, generator_url, cache_ttl=0,
+                 generator_connections=2):
         """
         :param base_path: The root directory for this TFTP server.
         :param generator_url: The URL which can be queried for the PXE
             config. See `get_generator_url` for the types of queries it is
             expected to accept.
+        :param cache_ttl: Seconds to cache the kernel parameters obtained
+            from the generator URL.  Zero disables caching.
+        :param generator_connections: Maximum number of idle connections
+            to the generator URL's host to keep open for reuse.
         """
         super(TFTPBackend, self).__init__(
             base_path, can_read=True, can_write=False)
         self.generator_url = urlparse(generator_url)
+        self.kernel_params_cache = KernelParamsCache(cache_ttl)
+        self.page_getter = PersistentPageGetter(generator_connections)
+        self.get_page = self.page_getter.get_page
+        # Deferreds waiting for fetches in progress, by cache key.
+        self.pending_fetches = {}
 
     def get_generator_url(self, params):
         """Calculate the URL, including query, from which we can fetch
@@ -149,14 +388,46 @@ class TFTPBackend(FilesystemSynchronousBackend):
             path requested.
         :return: A `KernelParameters` instance.
         """
+        cache = self.kernel_params_cache
+        kernel_params = cache.get(params)
+        if kernel_params is not None:
+            return succeed(kernel_params)
+
+        # Requests for the same config while it is being fetched, as from
+        # PXELINUX retrying, wait for that fetch rather than starting
+        # another.
+        key = cache.make_key(params)
+        waiters = self.pending_fetches.get(key)
+        if waiters is not None:
+            cache.coalesced += 1
+            d = Deferred()
+            waiters.append(d)
+            return d
+        waiters = self.pending_fetches[key] = []
+        generation = cache.generation
+
         url = self.get_generator_url(params)
 
         def reassemble(data):
             return KernelParameters(**data)
 
+        def store(kernel_params):
+            # Don't cache what may have been invalidated in the meantime.
+            if cache.generation == generation:
+                cache.set(params, kernel_params)
+            return kernel_params
+
+        def notify_waiters(result):
+            del self.pending_fetches[key]
+            for waiter in waiters:
+                waiter.callback(result)
+            return result
+
         d = self.get_page(url)
         d.addCallback(json.loads)
         d.addCallback(reassemble)
+        d.addCallback(store)
+        d.addBoth(notify_waiters)
         return d
 
     @deferred
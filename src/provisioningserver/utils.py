@@ -13,19 +13,23 @@ __metaclass__ = type
 __all__ = [
     "ActionScript",
     "atomic_write",
+    "compile_xpath",
     "deferred",
     "import_settings",
     "incremental_write",
     "MainScript",
     "parse_key_value_file",
     "ShellTemplate",
+    "split_chunks",
     "sudo_write_file",
     "write_custom_config_section",
     ]
 
 from argparse import ArgumentParser
+from collections import OrderedDict
 import errno
 from functools import wraps
+from itertools import islice
 import netifaces
 import os
 from os import fdopen
@@ -38,9 +42,11 @@ from subprocess import (
     )
 import sys
 import tempfile
+import threading
 from time import time
 
 from lockfile import FileLock
+from lxml import etree
 from provisioningserver.config import Config
 import tempita
 from twisted.internet.defer import maybeDeferred
@@ -471,3 +477,40 @@ def get_all_interface_addresses():
             for inet_address in addresses[netifaces.AF_INET]:
                 if "addr" in inet_address:
                     yield inet_address["addr"]
+
+
+def split_chunks(iterable, chunk_size):
+    """Split `iterable` into lists of up to `chunk_size` items each."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+
+# How many compiled XPath expressions `compile_xpath` keeps around.
+COMPILED_XPATH_CACHE_SIZE = 100
+
+# Compiled XPath expressions, keyed by their text, most recently used last.
+_compiled_xpaths = OrderedDict()
+_compiled_xpaths_lock = threading.Lock()
+
+
+def compile_xpath(expression):
+    """Return `expression` compiled as an `etree.XPath`.
+
+    Compiling an expression costs more than evaluating it against a node's
+    hardware details, and the same tag definitions get evaluated for node
+    after node, so the most recently used expressions are kept.
+
+    :raises: `etree.XPathSyntaxError` if the expression is invalid.
+    """
+    with _compiled_xpaths_lock:
+        xpath = _compiled_xpaths.pop(expression, None)
+        if xpath is None:
+            xpath = etree.XPath(expression)
+        _compiled_xpaths[expression] = xpath
+        if len(_compiled_xpaths) > COMPILED_XPATH_CACHE_SIZE:
+            _compiled_xpaths.popitem(last=False)
+    return xpath